@@ -0,0 +1,335 @@
+import argparse
+import asyncio
+import bisect
+import itertools
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import asyncpg
+
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+CREATE_USER = "createUser"
+GET_USER = "getUser"
+TRANSFER = "transfer"
+
+DISTRIBUTION_UNIFORM = "uniform"
+DISTRIBUTION_ZIPF = "zipf"
+
+_INSUFFICIENT_FUNDS_BODY = b"Insufficient funds."
+_LOCK_BOUNCES_METRIC = "ledger_lock_bounces_total"
+
+
+class _HttpConnection:
+  # Just enough HTTP/1.1 for the app's responses, so the harness only needs
+  # the app's own requirements. The connection is kept alive between requests.
+
+  def __init__(self, host, port):
+    self._host = host
+    self._port = port
+    self._reader = None
+    self._writer = None
+
+  async def Request(self, method, path, body=None):
+    if not self._writer:
+      self._reader, self._writer = await asyncio.open_connection(
+          self._host, self._port)
+    data = json.dumps(body).encode() if body is not None else b""
+    self._writer.write(
+        f"{method} {path} HTTP/1.1\r\nHost: {self._host}\r\n"
+        f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n"
+        "\r\n".encode() + data)
+    try:
+      await self._writer.drain()
+      status = int((await self._reader.readline()).split()[1])
+      headers = {}
+      while True:
+        line = await self._reader.readline()
+        if line in (b"\r\n", b""):
+          break
+        name, value = line.decode().split(":", 1)
+        headers[name.strip().lower()] = value.strip()
+      if headers.get("transfer-encoding") == "chunked":
+        body = b""
+        while True:
+          size = int((await self._reader.readline()).strip(), 16)
+          chunk = await self._reader.readexactly(size + 2)
+          if not size:
+            break
+          body += chunk[:-2]
+      else:
+        body = await self._reader.readexactly(
+            int(headers.get("content-length", 0)))
+    except (OSError, IndexError, ValueError, asyncio.IncompleteReadError):
+      self.Close()
+      raise ConnectionError(f"{method} {path} failed")
+    if headers.get("connection") == "close":
+      self.Close()
+    return status, body
+
+  def Close(self):
+    if self._writer:
+      self._writer.close()
+      self._reader, self._writer = None, None
+
+
+def _MakeUserPicker(user_ids, distribution, zipf_exponent, rng):
+  if distribution == DISTRIBUTION_UNIFORM:
+    return lambda: rng.choice(user_ids)
+  # The k-th user is picked with probability proportional to 1 / k^s, so a
+  # few accounts get most of the traffic, like merchants or exchanges.
+  cum_weights = list(itertools.accumulate(
+      1 / rank ** zipf_exponent for rank in range(1, len(user_ids) + 1)))
+  return lambda: user_ids[
+      bisect.bisect_left(cum_weights, rng.random() * cum_weights[-1])]
+
+def _Percentile(sorted_values, percent):
+  # Nearest rank.
+  if not sorted_values:
+    return None
+  rank = math.ceil(percent / 100 * len(sorted_values))
+  return sorted_values[max(rank - 1, 0)]
+
+def _ReadCounter(metrics, name):
+  for line in metrics.splitlines():
+    if line.startswith(name + " "):
+      return float(line.split()[1])
+  return 0.0
+
+def _GetCommit():
+  try:
+    return subprocess.run(
+        ["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+        check=True, cwd=SRC_DIR).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+async def _WaitForApp(host, port, timeout):
+  deadline = time.monotonic() + timeout
+  while True:
+    connection = _HttpConnection(host, port)
+    try:
+      status, _ = await connection.Request("GET", "/metrics")
+      if status == 200:
+        return
+    except ConnectionError:
+      pass
+    finally:
+      connection.Close()
+    if time.monotonic() > deadline:
+      raise TimeoutError("App didn't start.")
+    await asyncio.sleep(0.2)
+
+async def _SeedUsers(connection, user_count):
+  user_ids = []
+  for first in range(0, user_count, 100000):
+    status, body = await connection.Request(
+        "POST", "/users/batch", {"count": min(100000, user_count - first)})
+    if status != 201:
+      raise RuntimeError(f"Seeding users failed with status {status}.")
+    for first_user_id, last_user_id in json.loads(body)["userIdRanges"]:
+      user_ids.extend(range(first_user_id, last_user_id + 1))
+  return user_ids
+
+async def _Seed(datasource_name, connection, user_count):
+  # Every run starts from the same tables, so runs are comparable.
+  db = await asyncpg.connect(dsn=datasource_name)
+  try:
+    await db.execute(
+        "TRUNCATE users, balance_slots, transfers, "
+        "transfer_idempotency_keys, balance_checkpoints, transfer_volume, "
+        "user_transfer_volume, transfer_rollup_progress RESTART IDENTITY")
+    user_ids = await _SeedUsers(connection, user_count)
+    await db.execute("ANALYZE users, transfers")
+    return user_ids
+  finally:
+    await db.close()
+
+async def _CountLockBounces(connection, measure_from, duration):
+  # Lock bounces are only visible in the app's metrics, so they are read at
+  # both ends of the measured window.
+  counts = []
+  for at in (measure_from, measure_from + duration):
+    await asyncio.sleep(max(at - time.monotonic(), 0))
+    _, metrics = await connection.Request("GET", "/metrics")
+    counts.append(_ReadCounter(metrics.decode(), _LOCK_BOUNCES_METRIC))
+  return counts[1] - counts[0]
+
+async def _RunWorker(args, user_ids, worker_id, start, results):
+  rng = random.Random(args.seed * 100003 + worker_id)
+  pick_user = _MakeUserPicker(
+      user_ids, args.distribution, args.zipf_exponent, rng)
+  connection = _HttpConnection(args.host, args.port)
+  measure_from = start + args.warmup
+  deadline = measure_from + args.duration
+  try:
+    while True:
+      sent = time.monotonic()
+      if sent >= deadline:
+        break
+      draw = rng.random()
+      if draw < args.create_ratio:
+        operation, request = CREATE_USER, ("POST", "/users", None)
+      elif draw < args.create_ratio + args.read_ratio:
+        operation = GET_USER
+        request = ("GET", f"/users/{pick_user()}", None)
+      else:
+        operation = TRANSFER
+        user_id_from = pick_user()
+        user_id_to = pick_user()
+        while user_id_to == user_id_from:
+          user_id_to = pick_user()
+        request = ("POST", "/transactions", {
+            "userIdFrom": user_id_from, "userIdTo": user_id_to,
+            "amount": rng.randint(1, args.max_amount)})
+      try:
+        status, body = await connection.Request(*request)
+      except ConnectionError:
+        status, body = 0, b""
+      if sent >= measure_from:
+        results.append(
+            (operation, status, time.monotonic() - sent,
+             body == _INSUFFICIENT_FUNDS_BODY))
+  finally:
+    connection.Close()
+
+def _Summarize(results, duration):
+  summary = {}
+  for operation in (CREATE_USER, GET_USER, TRANSFER):
+    latencies = sorted(
+        latency for result_operation, _, latency, _ in results
+        if result_operation == operation)
+    statuses = {}
+    for result_operation, status, _, _ in results:
+      if result_operation == operation:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    summary[operation] = {
+        "requests": len(latencies),
+        "throughput": len(latencies) / duration,
+        "latencyMs": {
+            name: latencies and _Percentile(latencies, percent) * 1000 or None
+            for name, percent in (("p50", 50), ("p95", 95), ("p99", 99),
+                                  ("max", 100))},
+        "statuses": statuses,
+    }
+  return summary
+
+
+async def Run(args):
+  app_env = dict(os.environ, DEFAULT_BALANCE=str(args.balance))
+  app_env.update(setting.split("=", 1) for setting in args.app_env)
+  # The in-memory ledger starts empty in a directory of its own.
+  memory_dir = None
+  if app_env.get("LEDGER_BACKEND") == "memory":
+    memory_dir = tempfile.TemporaryDirectory()
+    app_env["MEMORY_LEDGER_DIR"] = memory_dir.name
+  # Lock bounces log a traceback each, so the app's output goes to a file.
+  app_log = open(args.app_log, "w") if args.app_log else subprocess.DEVNULL
+  app = subprocess.Popen(
+      [sys.executable, "-m", "uvicorn", "--app-dir", SRC_DIR,
+       "--host", args.host, "--port", str(args.port), "--log-level", "warning",
+       "ledger.app:app"],
+      env=app_env, stdout=app_log, stderr=subprocess.STDOUT)
+  connection = _HttpConnection(args.host, args.port)
+  try:
+    await _WaitForApp(args.host, args.port, 30)
+    if memory_dir:
+      user_ids = await _SeedUsers(connection, args.users)
+    else:
+      user_ids = await _Seed(os.environ["DATASOURCE"], connection, args.users)
+
+    results = []
+    start = time.monotonic()
+    _, lock_bounces = await asyncio.gather(
+        asyncio.gather(*[
+            _RunWorker(args, user_ids, worker_id, start, results)
+            for worker_id in range(args.concurrency)]),
+        _CountLockBounces(connection, start + args.warmup, args.duration))
+    duration = time.monotonic() - start - args.warmup
+  finally:
+    connection.Close()
+    app.terminate()
+    app.wait()
+    if args.app_log:
+      app_log.close()
+    if memory_dir:
+      memory_dir.cleanup()
+
+  operations = _Summarize(results, duration)
+  transfers = operations[TRANSFER]["requests"]
+  insufficient_funds = sum(
+      1 for operation, _, _, is_insufficient_funds in results
+      if operation == TRANSFER and is_insufficient_funds)
+  return {
+      "commit": _GetCommit(),
+      "config": {
+          name: value for name, value in vars(args).items()
+          if name not in ("host", "port", "output", "app_log")},
+      "durationSeconds": duration,
+      "requests": len(results),
+      "throughput": len(results) / duration,
+      "operations": operations,
+      "lockBounceRate": lock_bounces / transfers if transfers else None,
+      "insufficientFundsRate": (
+          insufficient_funds / transfers if transfers else None),
+  }
+
+
+def Main():
+  parser = argparse.ArgumentParser(
+      description="Load tests the app against the Postgres in DATASOURCE, or "
+                  "a new in-memory ledger with --app-env LEDGER_BACKEND=memory, "
+                  "and prints the results as JSON. Truncates users and "
+                  "transfers.")
+  parser.add_argument("--users", type=int, default=10000,
+                      help="users seeded before the run")
+  parser.add_argument("--balance", type=int, default=1000,
+                      help="balance of seeded and created users")
+  parser.add_argument("--concurrency", type=int, default=32,
+                      help="requests in flight")
+  parser.add_argument("--duration", type=float, default=30,
+                      help="measured seconds")
+  parser.add_argument("--warmup", type=float, default=5,
+                      help="seconds of load before measuring")
+  parser.add_argument("--read-ratio", type=float, default=0.5,
+                      help="share of GET /users/{id}")
+  parser.add_argument("--create-ratio", type=float, default=0.01,
+                      help="share of POST /users, the rest are transfers")
+  parser.add_argument("--distribution",
+                      choices=[DISTRIBUTION_UNIFORM, DISTRIBUTION_ZIPF],
+                      default=DISTRIBUTION_UNIFORM,
+                      help="popularity of accounts")
+  parser.add_argument("--zipf-exponent", type=float, default=1.0)
+  parser.add_argument("--max-amount", type=int, default=10,
+                      help="transfer amounts are uniform in [1, max-amount]")
+  parser.add_argument("--seed", type=int, default=1)
+  parser.add_argument("--app-env", action="append", default=[],
+                      metavar="NAME=VALUE",
+                      help="extra app configuration, e.g. "
+                           "TRANSFER_GROUP_COMMIT=true")
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=4010)
+  parser.add_argument("--output", help="file for the results, default stdout")
+  parser.add_argument("--app-log", help="file for the app's output")
+  args = parser.parse_args()
+  if args.read_ratio + args.create_ratio > 1:
+    parser.error("--read-ratio plus --create-ratio exceeds 1")
+
+  report = json.dumps(asyncio.run(Run(args)), indent=2)
+  if args.output:
+    with open(args.output, "w") as file:
+      file.write(report + "\n")
+  else:
+    print(report)
+
+
+if __name__ == "__main__":
+  Main()
@@ -1,6 +1,25 @@
 from ledger.app import app
+from ledger.app import sql_client as app_sql_client
+from ledger.events import TransferEventHub
+from ledger.importer import Import
+from ledger.ledger_api import LedgerAPI
+from ledger.metrics import DB_READS
+from ledger.migrations import LoadMigrations, Migration
+from ledger.model import (
+    DIRECTION_RECEIVED, DIRECTION_SENT, InsufficientFundsException,
+    ReplayedTransferId)
+from ledger.partitions import Maintain
+from ledger.replicas import ReplicaReader
+from ledger.sharding import ID_RANGE_SIZE, ShardedPostgreSQLClient
+from ledger.sql_client import PoolConfig, PostgreSQLClient
+from ledger.tracing import Tracer
+from ledger.user_cache import UserCache
 
+import asyncio
 import asyncpg
+from datetime import datetime, timedelta, timezone
+import gzip
+import json
 import os
 import pytest
 import pytest_asyncio
@@ -13,7 +32,10 @@ async def ExecuteSqlQuery(query):
 
 async def CleanSqlTables():
   # Warning: Keep in sync with database schema
-  await ExecuteSqlQuery("TRUNCATE users, transfers RESTART IDENTITY")
+  await ExecuteSqlQuery(
+      "TRUNCATE users, balance_slots, transfers, "
+      "transfer_idempotency_keys, balance_checkpoints, transfer_volume, "
+      "user_transfer_volume, transfer_rollup_progress RESTART IDENTITY")
 
 @pytest_asyncio.fixture
 async def http_client():         
@@ -69,13 +91,25 @@ async def test_CreateUser_Ok(http_client):
   assert await response.get_data(True) == '1'
 
 @pytest.mark.asyncio
-async def test_CreateUser_MethodNotAllowed(http_client):  
-  response = await http_client.get("/users")    
-  assert response.status == "405 METHOD NOT ALLOWED"
+async def test_CreateUsers_Ok(http_client):
+  await ExecuteSqlQuery("INSERT INTO users (balance) VALUES (100)")
 
-  response = await http_client.head("/users")    
-  assert response.status == "405 METHOD NOT ALLOWED"
+  response = await http_client.post("/users/batch", json={"count": 3})
+  assert response.status == "201 CREATED"
+  assert await response.get_json() == {"userIdRanges": [[2, 4]]}
+
+  response = await http_client.post(
+      "/users/batch", json={"balances": [10, 0]})
+  assert response.status == "201 CREATED"
+  assert await response.get_json() == {"userIdRanges": [[5, 6]]}
+
+  users = await ExecuteSqlQuery(
+      "SELECT user_id, balance FROM users ORDER BY user_id")
+  assert [tuple(user) for user in users] == [
+      (1, 100), (2, 100), (3, 100), (4, 100), (5, 10), (6, 0)]
 
+@pytest.mark.asyncio
+async def test_CreateUser_MethodNotAllowed(http_client):  
   response = await http_client.patch("/users")    
   assert response.status == "405 METHOD NOT ALLOWED"
   
@@ -85,6 +119,28 @@ async def test_CreateUser_MethodNotAllowed(http_client):
   response = await http_client.trace("/users")    
   assert response.status == "405 METHOD NOT ALLOWED"
 
+@pytest.mark.asyncio
+async def test_GetUsersDetails_Ok(http_client):
+  await ExecuteSqlQuery("INSERT INTO users (user_id, balance) VALUES (1, 100)")
+  await ExecuteSqlQuery("INSERT INTO users (user_id, balance) VALUES (2, 200)")
+  response = await http_client.get("/users?ids=2,3,1,2")
+  assert response.status == "200 OK"
+  json = await response.get_json()
+  assert json == {"users": [
+      {"userId": 2, "balance": 200}, {"userId": 1, "balance": 100}]}
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("query", [
+  "",  # No ids.
+  "?ids=",  # Empty.
+  "?ids=1,abc",  # Not numeric.
+  "?ids=1,0",  # Not positive.
+  "?ids=1,,2",  # Mess.
+])
+async def test_GetUsersDetails_InvalidUserIds(http_client, query):
+  response = await http_client.get(f"/users{query}")
+  assert response.status == "400 BAD REQUEST"
+
 @pytest.mark.asyncio
 async def test_Transfer_Ok(http_client): 
   await ExecuteSqlQuery("INSERT INTO users (user_id, balance) VALUES (1, 100)")
@@ -351,4 +407,1478 @@ async def test_Transfer_OnConcurrentTransaction_DoesNotCreateRecordOfTransfer(
        json={"userIdFrom": "2", "userIdTo": "1", "amount": "25"})  
     
   transfer = await ExecuteSqlQuery("SELECT user_id_from FROM transfers")
-  assert not transfer
\ No newline at end of file
+  assert not transfer
+@pytest.mark.asyncio
+async def test_TransferBatch_Ok(http_client):
+  await ExecuteSqlQuery("INSERT INTO users (user_id, balance) VALUES (1, 100)")
+  await ExecuteSqlQuery("INSERT INTO users (user_id, balance) VALUES (2, 200)")
+  await ExecuteSqlQuery("INSERT INTO users (user_id, balance) VALUES (3, 0)")
+
+  response = await http_client.post(
+      "/transactions/batch",
+      json=[{"userIdFrom": "2", "userIdTo": "1", "amount": "25"},
+            {"userIdFrom": "3", "userIdTo": "1", "amount": "25"},
+            {"userIdFrom": "1", "userIdTo": "3", "amount": "125"},
+            {"userIdFrom": "1", "userIdTo": "4", "amount": "1"}])
+
+  assert response.status == "200 OK"
+  response_json = await response.get_json()
+  assert response_json == {"results": [
+      {"transferId": 1},
+      {"error": "Insufficient funds."},
+      {"transferId": 2},
+      {"error": "Invalid arguments."}]}
+  users = await ExecuteSqlQuery(
+      "SELECT user_id, balance FROM users ORDER BY user_id")
+  assert [user["balance"] for user in users] == [0, 175, 125]
+  transfers = await ExecuteSqlQuery('''
+      SELECT user_id_from, user_id_to, amount
+      FROM transfers ORDER BY transfer_id''')
+  assert [tuple(transfer) for transfer in transfers] == [
+      (2, 1, 25), (1, 3, 125)]
+
+@pytest.mark.asyncio
+async def test_TransferBatch_OnConcurrentTransaction_Bounces(http_client):
+  await ExecuteSqlQuery("INSERT INTO users (user_id, balance) VALUES (1, 100)")
+  await ExecuteSqlQuery("INSERT INTO users (user_id, balance) VALUES (2, 200)")
+
+  connection = await asyncpg.connect(os.environ["DATASOURCE"])
+  async with connection.transaction():
+    await connection.execute(
+        "UPDATE users SET balance = 200 WHERE user_id = 1")
+    response = await http_client.post(
+        "/transactions/batch",
+        json=[{"userIdFrom": "2", "userIdTo": "1", "amount": "25"}])
+
+    assert response.status == "500 INTERNAL SERVER ERROR"
+
+@pytest.mark.asyncio
+async def test_Transfer_IdempotencyKeyReplaysTransfer(http_client):
+  await ExecuteSqlQuery("INSERT INTO users (user_id, balance) VALUES (1, 100)")
+  await ExecuteSqlQuery("INSERT INTO users (user_id, balance) VALUES (2, 200)")
+
+  for _ in range(2):
+    response = await http_client.post(
+        "/transactions",
+        json={"userIdFrom": "2", "userIdTo": "1", "amount": "25"},
+        headers={"Idempotency-Key": "replay-header"})
+    assert response.status == "200 OK"
+    assert await response.get_json() == {"transferId": 1}
+  response = await http_client.post(
+      "/transactions",
+      json={"userIdFrom": "2", "userIdTo": "1", "amount": "25",
+            "idempotencyKey": "replay-body"})
+  assert await response.get_json() == {"transferId": 2}
+  # Bypasses the in-process cache, like another worker would.
+  transfer_id = await app_sql_client.Transfer(2, 1, 25, "replay-body")
+  assert transfer_id == 2
+  assert isinstance(transfer_id, ReplayedTransferId)
+
+  users = await ExecuteSqlQuery(
+      "SELECT user_id, balance FROM users ORDER BY user_id")
+  assert [user["balance"] for user in users] == [150, 150]
+  keys = await ExecuteSqlQuery(
+      "SELECT idempotency_key, transfer_id FROM transfer_idempotency_keys "
+      "ORDER BY transfer_id")
+  assert [tuple(key) for key in keys] == [
+      ("replay-header", 1), ("replay-body", 2)]
+
+@pytest.mark.asyncio
+async def test_Transfer_IdempotencyKeyOfOtherUsersReplaysTransfer(
+    http_client):
+  await ExecuteSqlQuery("INSERT INTO users (user_id, balance) VALUES (1, 100)")
+  await ExecuteSqlQuery("INSERT INTO users (user_id, balance) VALUES (2, 200)")
+  await ExecuteSqlQuery("INSERT INTO users (user_id, balance) VALUES (3, 0)")
+  assert await app_sql_client.Transfer(2, 1, 25, "other-users") == 1
+  assert await app_sql_client.Transfer(1, 3, 5, "other-users") == 1
+
+  # Different row locks, so the race is only caught by the key's index.
+  connection = await asyncpg.connect(os.environ["DATASOURCE"])
+  async with connection.transaction():
+    await connection.execute(
+        "INSERT INTO transfer_idempotency_keys (idempotency_key, transfer_id) "
+        "VALUES ('racing', 1)")
+    transfer = asyncio.create_task(app_sql_client.Transfer(1, 3, 5, "racing"))
+    await asyncio.sleep(0.05)
+  await connection.close()
+
+  assert await transfer == 1
+  users = await ExecuteSqlQuery(
+      "SELECT user_id, balance FROM users ORDER BY user_id")
+  assert [user["balance"] for user in users] == [125, 175, 0]
+
+@pytest.mark.asyncio
+async def test_TransferBatch_IdempotencyKeys(http_client):
+  await ExecuteSqlQuery("INSERT INTO users (user_id, balance) VALUES (1, 100)")
+  await ExecuteSqlQuery("INSERT INTO users (user_id, balance) VALUES (2, 200)")
+  assert await app_sql_client.Transfer(2, 1, 25, "batch-known") == 1
+
+  results = await app_sql_client.TransferBatch(
+      [(2, 1, 25), (1, 2, 10), (2, 1, 5), (1, 2, 10)],
+      ["batch-known", "batch-new", None, "batch-new"])
+
+  assert results[:3] == [1, 2, 3]
+  assert isinstance(results[0], ReplayedTransferId)
+  assert not isinstance(results[1], ReplayedTransferId)
+  assert isinstance(results[3], ValueError)
+  users = await ExecuteSqlQuery(
+      "SELECT user_id, balance FROM users ORDER BY user_id")
+  assert [user["balance"] for user in users] == [120, 180]
+  keys = await ExecuteSqlQuery(
+      "SELECT idempotency_key, transfer_id FROM transfer_idempotency_keys "
+      "ORDER BY transfer_id")
+  assert [tuple(key) for key in keys] == [
+      ("batch-known", 1), ("batch-new", 2)]
+
+@pytest.mark.asyncio
+async def test_TransferBatch_IdempotencyKeyOfOtherUsersReplaysTransfer(
+    http_client):
+  await ExecuteSqlQuery("INSERT INTO users (user_id, balance) VALUES (1, 100)")
+  await ExecuteSqlQuery("INSERT INTO users (user_id, balance) VALUES (2, 200)")
+  assert await app_sql_client.Transfer(2, 1, 25, "before") == 1
+
+  # Committed after the batch read the known keys, so only its insert of the
+  # key finds it.
+  connection = await asyncpg.connect(os.environ["DATASOURCE"])
+  async with connection.transaction():
+    await connection.execute(
+        "INSERT INTO transfer_idempotency_keys (idempotency_key, transfer_id) "
+        "VALUES ('racing', 1)")
+    batch = asyncio.create_task(app_sql_client.TransferBatch(
+        [(1, 2, 10), (2, 1, 5), (1, 2, 20)], ["racing", None, "new"]))
+    await asyncio.sleep(0.05)
+  await connection.close()
+
+  # The retry draws new transfer ids.
+  results = await batch
+  assert results[0] == 1
+  assert isinstance(results[0], ReplayedTransferId)
+  transfers = await ExecuteSqlQuery(
+      "SELECT transfer_id FROM transfers ORDER BY transfer_id")
+  assert [transfer["transfer_id"] for transfer in transfers] == [
+      1, *results[1:]]
+  users = await ExecuteSqlQuery(
+      "SELECT user_id, balance FROM users ORDER BY user_id")
+  assert [user["balance"] for user in users] == [110, 190]
+  keys = await ExecuteSqlQuery(
+      "SELECT idempotency_key, transfer_id FROM transfer_idempotency_keys "
+      "ORDER BY idempotency_key")
+  assert [tuple(key) for key in keys] == [
+      ("before", 1), ("new", results[2]), ("racing", 1)]
+
+@pytest.mark.asyncio
+async def test_DeleteIdempotencyKeys(http_client):
+  await ExecuteSqlQuery(
+      "INSERT INTO transfer_idempotency_keys "
+      "(idempotency_key, transfer_id, created_at) "
+      "VALUES ('old', 1, localtimestamp - interval '2 hours'), "
+      "('new', 2, localtimestamp)")
+
+  assert await app_sql_client.DeleteIdempotencyKeys(3600) == 1
+  keys = await ExecuteSqlQuery(
+      "SELECT idempotency_key FROM transfer_idempotency_keys")
+  assert [key["idempotency_key"] for key in keys] == ["new"]
+
+@pytest_asyncio.fixture
+async def statements_sql_client(http_client):
+  sql_client = PostgreSQLClient(
+      os.environ["DATASOURCE"], use_transfer_function=False)
+  await sql_client.CreateConnectionPool()
+  yield sql_client
+  await sql_client.CloseConnectionPool()
+
+@pytest.mark.asyncio
+async def test_TransferWithStatements_Ok(statements_sql_client):
+  await ExecuteSqlQuery("INSERT INTO users (user_id, balance) VALUES (1, 100)")
+  await ExecuteSqlQuery("INSERT INTO users (user_id, balance) VALUES (2, 200)")
+
+  transfer_id = await statements_sql_client.Transfer(2, 1, 25)
+
+  assert transfer_id == 1
+  users = await ExecuteSqlQuery(
+      "SELECT user_id, balance FROM users ORDER BY user_id")
+  assert [user["balance"] for user in users] == [125, 175]
+
+@pytest.mark.asyncio
+async def test_TransferWithStatements_IdempotencyKey(statements_sql_client):
+  await ExecuteSqlQuery("INSERT INTO users (user_id, balance) VALUES (1, 100)")
+  await ExecuteSqlQuery("INSERT INTO users (user_id, balance) VALUES (2, 200)")
+
+  assert await statements_sql_client.Transfer(2, 1, 25, "statements") == 1
+  assert await statements_sql_client.Transfer(2, 1, 25, "statements") == 1
+
+  users = await ExecuteSqlQuery(
+      "SELECT user_id, balance FROM users ORDER BY user_id")
+  assert [user["balance"] for user in users] == [125, 175]
+
+@pytest.mark.asyncio
+async def test_TransferWithStatements_InsufficientFunds(statements_sql_client):
+  await ExecuteSqlQuery("INSERT INTO users (user_id, balance) VALUES (1, 10)")
+  await ExecuteSqlQuery("INSERT INTO users (user_id, balance) VALUES (2, 20)")
+
+  with pytest.raises(InsufficientFundsException):
+    await statements_sql_client.Transfer(2, 1, 25)
+
+@pytest.mark.asyncio
+async def test_TransferWithStatements_UserDoesNotExist(statements_sql_client):
+  await ExecuteSqlQuery("INSERT INTO users (user_id, balance) VALUES (1, 10)")
+
+  with pytest.raises(ValueError):
+    await statements_sql_client.Transfer(1, 2, 5)
+
+@pytest_asyncio.fixture(params=[True, False])
+async def waiting_sql_client(request, http_client):
+  sql_client = PostgreSQLClient(
+      os.environ["DATASOURCE"], use_transfer_function=request.param,
+      lock_timeout_ms=200)
+  await sql_client.CreateConnectionPool()
+  yield sql_client
+  await sql_client.CloseConnectionPool()
+
+@pytest.mark.asyncio
+async def test_TransferWithLockTimeout_WaitsForConcurrentTransaction(
+    waiting_sql_client):
+  await ExecuteSqlQuery("INSERT INTO users (user_id, balance) VALUES (1, 100)")
+  await ExecuteSqlQuery("INSERT INTO users (user_id, balance) VALUES (2, 200)")
+
+  connection = await asyncpg.connect(os.environ["DATASOURCE"])
+  transaction = connection.transaction()
+  await transaction.start()
+  await connection.execute("SELECT * FROM users WHERE user_id = 1 FOR UPDATE")
+  transfer = asyncio.create_task(waiting_sql_client.Transfer(2, 1, 25))
+  await asyncio.sleep(0.05)
+  await transaction.commit()
+  await connection.close()
+
+  assert await transfer == 1
+  users = await ExecuteSqlQuery(
+      "SELECT user_id, balance FROM users ORDER BY user_id")
+  assert [user["balance"] for user in users] == [125, 175]
+
+@pytest.mark.asyncio
+async def test_TransferWithLockTimeout_TimesOut(waiting_sql_client):
+  await ExecuteSqlQuery("INSERT INTO users (user_id, balance) VALUES (1, 100)")
+  await ExecuteSqlQuery("INSERT INTO users (user_id, balance) VALUES (2, 200)")
+
+  connection = await asyncpg.connect(os.environ["DATASOURCE"])
+  async with connection.transaction():
+    await connection.execute(
+        "UPDATE users SET balance = 200 WHERE user_id = 1")
+    with pytest.raises(asyncpg.exceptions.LockNotAvailableError):
+      await waiting_sql_client.Transfer(2, 1, 25)
+  await connection.close()
+
+async def InsertSplitAccount(slot_count=4):
+  # User 2 receives into slot_count slots.
+  await ExecuteSqlQuery("INSERT INTO users (user_id, balance) VALUES (1, 100)")
+  await ExecuteSqlQuery("INSERT INTO users (user_id, balance) VALUES (2, 0)")
+  assert await app_sql_client.SetSlotCount(2, slot_count)
+
+@pytest.mark.asyncio
+async def test_SplitAccount_CreditsGoToSlots(http_client):
+  await InsertSplitAccount()
+
+  for _ in range(10):
+    response = await http_client.post("/transactions", json={
+        "userIdFrom": 1, "userIdTo": 2, "amount": 1})
+    assert response.status_code == 200
+
+  users = await ExecuteSqlQuery(
+      "SELECT user_id, balance FROM users ORDER BY user_id")
+  assert [user["balance"] for user in users] == [90, 0]
+  slots = await ExecuteSqlQuery(
+      "SELECT sum(balance) AS balance FROM balance_slots WHERE user_id = 2")
+  assert slots[0]["balance"] == 10
+  response = await http_client.get("/users/2")
+  assert (await response.get_json())["balance"] == 10
+  response = await http_client.get("/users?ids=1,2")
+  assert sorted(
+      user["balance"] for user in (await response.get_json())["users"]) == [
+          10, 90]
+
+@pytest.mark.asyncio
+async def test_SplitAccount_CreditDoesNotLockUsersRow(http_client):
+  await InsertSplitAccount()
+
+  connection = await asyncpg.connect(os.environ["DATASOURCE"])
+  async with connection.transaction():
+    await connection.execute("SELECT * FROM users WHERE user_id = 2 FOR UPDATE")
+    response = await http_client.post("/transactions", json={
+        "userIdFrom": 1, "userIdTo": 2, "amount": 5})
+    assert response.status_code == 200
+  await connection.close()
+
+@pytest.mark.asyncio
+async def test_SplitAccount_ConcurrentCreditsDontBounce(http_client):
+  await app_sql_client.InsertUsers([0] + [10] * 20)
+  assert await app_sql_client.SetSlotCount(1, 8)
+
+  transfer_ids = await asyncio.gather(*[
+      app_sql_client.Transfer(user_id, 1, 10) for user_id in range(2, 22)])
+
+  assert sorted(transfer_ids) == list(range(1, 21))
+  assert (await app_sql_client.FetchUser(1)).balance == 200
+
+@pytest.mark.parametrize("use_transfer_function", [True, False])
+@pytest.mark.asyncio
+async def test_SplitAccount_DebitDrawsFromSlots(
+    http_client, use_transfer_function):
+  await InsertSplitAccount()
+  for _ in range(3):
+    await app_sql_client.Transfer(1, 2, 5)
+  sql_client = PostgreSQLClient(
+      os.environ["DATASOURCE"], use_transfer_function=use_transfer_function)
+  await sql_client.CreateConnectionPool()
+
+  assert await sql_client.Transfer(2, 1, 12) == 4
+  with pytest.raises(InsufficientFundsException):
+    await sql_client.Transfer(2, 1, 4)
+  await sql_client.CloseConnectionPool()
+
+  users = await ExecuteSqlQuery(
+      "SELECT user_id, balance FROM users ORDER BY user_id")
+  assert [user["balance"] for user in users] == [97, 3]
+  slots = await ExecuteSqlQuery(
+      "SELECT sum(balance) AS balance FROM balance_slots WHERE user_id = 2")
+  assert slots[0]["balance"] == 0
+
+@pytest.mark.asyncio
+async def test_SplitAccount_TransferBatchDrawsFromSlots(http_client):
+  await InsertSplitAccount()
+  for _ in range(2):
+    await app_sql_client.Transfer(1, 2, 5)
+
+  results = await app_sql_client.TransferBatch([(2, 1, 6), (2, 1, 6)])
+
+  assert results[0] == 3
+  assert isinstance(results[1], InsufficientFundsException)
+  response = await http_client.get("/users/2")
+  assert (await response.get_json())["balance"] == 4
+
+@pytest.mark.asyncio
+async def test_ConsolidateBalanceSlots(http_client):
+  await InsertSplitAccount()
+  for _ in range(4):
+    await app_sql_client.Transfer(1, 2, 5)
+
+  assert await app_sql_client.ConsolidateBalanceSlots() == 1
+  assert await app_sql_client.ConsolidateBalanceSlots() == 0
+
+  users = await ExecuteSqlQuery(
+      "SELECT user_id, balance FROM users ORDER BY user_id")
+  assert [user["balance"] for user in users] == [80, 20]
+
+@pytest.mark.asyncio
+async def test_ConsolidateBalanceSlots_WaitsForTransfersOfUser(http_client):
+  await InsertSplitAccount()
+  for _ in range(4):
+    await app_sql_client.Transfer(1, 2, 5)
+  connection = await asyncpg.connect(os.environ["DATASOURCE"])
+  transaction = connection.transaction()
+  await transaction.start()
+  await connection.execute("SELECT 1 FROM users WHERE user_id = 2 FOR UPDATE")
+
+  consolidation = asyncio.create_task(app_sql_client.ConsolidateBalanceSlots())
+  await asyncio.sleep(0.1)
+  assert not consolidation.done()
+  await transaction.rollback()
+  await connection.close()
+
+  assert await consolidation == 1
+  [[slot_balance, balance]] = await ExecuteSqlQuery('''
+      SELECT (SELECT sum(balance) FROM balance_slots WHERE user_id = 2),
+             (SELECT balance FROM users WHERE user_id = 2)''')
+  assert (slot_balance, balance) == (0, 20)
+
+@pytest.mark.asyncio
+async def test_SetSlotCount_JoinsBalanceBack(http_client):
+  await InsertSplitAccount()
+  await app_sql_client.Transfer(1, 2, 5)
+
+  assert await app_sql_client.SetSlotCount(2, 0)
+  await app_sql_client.Transfer(1, 2, 5)
+
+  users = await ExecuteSqlQuery(
+      "SELECT user_id, balance, slot_count FROM users ORDER BY user_id")
+  assert [tuple(user) for user in users] == [(1, 90, 0), (2, 10, 0)]
+  assert not await app_sql_client.SetSlotCount(3, 4)
+
+@pytest.mark.asyncio
+async def test_UserCache_InvalidatesOtherWorkers(http_client):
+  await ExecuteSqlQuery("INSERT INTO users (user_id, balance) VALUES (1, 100)")
+  worker_sql_clients = [PostgreSQLClient(os.environ["DATASOURCE"]),
+                        PostgreSQLClient(os.environ["DATASOURCE"])]
+  for sql_client in worker_sql_clients:
+    await sql_client.CreateConnectionPool()
+  caches = [UserCache(sql_client, 10, 60) for sql_client in worker_sql_clients]
+  for cache in caches:
+    await cache.Start()
+
+  assert (await caches[0].FetchUser(1)).balance == 100
+  await ExecuteSqlQuery("UPDATE users SET balance = 75 WHERE user_id = 1")
+  caches[1].Invalidate([1])
+  for _ in range(100):
+    if not caches[0].Stats()["size"]:
+      break
+    await asyncio.sleep(0.01)
+
+  assert (await caches[0].FetchUser(1)).balance == 75
+  for sql_client in worker_sql_clients:
+    await sql_client.CloseConnectionPool()
+
+async def WaitForEvents(subscription, count):
+  return [
+      await asyncio.wait_for(subscription.Get(), 5) for _ in range(count)]
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("use_transfer_function", [True, False])
+async def test_TransferEvents_Transfer(http_client, use_transfer_function):
+  await ExecuteSqlQuery(
+      "INSERT INTO users (user_id, balance) VALUES (1, 100), (2, 100)")
+  sql_client = PostgreSQLClient(
+      os.environ["DATASOURCE"], use_transfer_function=use_transfer_function,
+      notify_transfers=True)
+  await sql_client.CreateConnectionPool()
+  event_hub = TransferEventHub(sql_client)
+  await event_hub.Start()
+  sender = event_hub.Subscribe(1)
+  receiver = event_hub.Subscribe(2)
+
+  transfer_id = await sql_client.Transfer(1, 2, 30)
+  with pytest.raises(InsufficientFundsException):
+    await sql_client.Transfer(1, 2, 100)
+
+  [sent] = await WaitForEvents(sender, 1)
+  [received] = await WaitForEvents(receiver, 1)
+  transfer = (await ExecuteSqlQuery("SELECT * FROM transfers"))[0]
+  assert sent == {
+      "transferId": transfer_id,
+      "timestamp": transfer["transfer_timestamp"].isoformat(),
+      "userIdFrom": 1, "userIdTo": 2, "amount": 30, "balance": 70}
+  assert received == {**sent, "balance": 130}
+  await sql_client.CloseConnectionPool()
+
+@pytest.mark.asyncio
+async def test_TransferEvents_TransferBatch(http_client):
+  await ExecuteSqlQuery(
+      "INSERT INTO users (user_id, balance) VALUES (1, 100), (2, 100)")
+  sql_client = PostgreSQLClient(
+      os.environ["DATASOURCE"], notify_transfers=True)
+  await sql_client.CreateConnectionPool()
+  event_hub = TransferEventHub(sql_client)
+  await event_hub.Start()
+  subscription = event_hub.Subscribe(2)
+
+  transfer_ids = await sql_client.TransferBatch(
+      [(1, 2, 10), (2, 1, 500), (1, 2, 20)])
+
+  events = await WaitForEvents(subscription, 2)
+  # Balances are the ones the batch's transaction left.
+  assert [(event["transferId"], event["amount"], event["balance"])
+          for event in events] == [
+              (transfer_ids[0], 10, 130), (transfer_ids[2], 20, 130)]
+  await sql_client.CloseConnectionPool()
+
+@pytest.mark.asyncio
+async def test_TransferEvents_SplitAccount(http_client):
+  await ExecuteSqlQuery(
+      "INSERT INTO users (user_id, balance) VALUES (1, 100), (2, 100)")
+  sql_client = PostgreSQLClient(
+      os.environ["DATASOURCE"], notify_transfers=True)
+  await sql_client.CreateConnectionPool()
+  await sql_client.SetSlotCount(2, 4)
+  event_hub = TransferEventHub(sql_client)
+  await event_hub.Start()
+  subscription = event_hub.Subscribe(2)
+
+  await sql_client.Transfer(1, 2, 30)
+
+  [event] = await WaitForEvents(subscription, 1)
+  assert event["balance"] == 130
+  await sql_client.CloseConnectionPool()
+
+@pytest.mark.asyncio
+async def test_TransferEvents_NotSentByDefault(http_client):
+  await ExecuteSqlQuery(
+      "INSERT INTO users (user_id, balance) VALUES (1, 100), (2, 100)")
+  event_hub = TransferEventHub(app_sql_client)
+  await event_hub.Start()
+  subscription = event_hub.Subscribe(1)
+
+  await app_sql_client.Transfer(1, 2, 30)
+
+  with pytest.raises(asyncio.TimeoutError):
+    await asyncio.wait_for(subscription.Get(), 0.2)
+
+@pytest.mark.asyncio
+async def test_TransferEvents_ListenConnectionIsRestored(http_client):
+  await ExecuteSqlQuery(
+      "INSERT INTO users (user_id, balance) VALUES (1, 100), (2, 100)")
+  sql_client = PostgreSQLClient(
+      os.environ["DATASOURCE"], notify_transfers=True)
+  await sql_client.CreateConnectionPool()
+  event_hub = TransferEventHub(sql_client)
+  await event_hub.Start()
+  subscription = event_hub.Subscribe(1)
+
+  await ExecuteSqlQuery(
+      "SELECT pg_terminate_backend("
+      f"{sql_client._listen_connection.get_server_pid()})")
+
+  # Streams end, so that their clients start over from the current balance.
+  assert await asyncio.wait_for(subscription.Get(), 5) is None
+  for _ in range(50):
+    if sql_client._listen_connection:
+      break
+    await asyncio.sleep(0.1)
+  subscription = event_hub.Subscribe(1)
+  transfer_id = await sql_client.Transfer(1, 2, 30)
+  [event] = await WaitForEvents(subscription, 1)
+  assert (event["transferId"], event["balance"]) == (transfer_id, 70)
+  await sql_client.CloseConnectionPool()
+
+@pytest.mark.asyncio
+async def test_GetUserEvents_Disabled(http_client):
+  response = await http_client.get("/users/1/events")
+  assert response.status == "404 NOT FOUND"
+
+async def InsertTransfers(transfers):
+  # Only the partitions of the current months exist up front.
+  await ExecuteSqlQuery(
+      f"SELECT create_transfer_partitions('{transfers[0][3]}', "
+      f"'{transfers[-1][3]}')")
+  for user_id_from, user_id_to, amount, timestamp in transfers:
+    await ExecuteSqlQuery(f'''
+        INSERT INTO transfers
+            (user_id_from, user_id_to, amount, transfer_timestamp)
+        VALUES ({user_id_from}, {user_id_to}, {amount}, '{timestamp}')''')
+
+async def FetchCurrentHour():
+  [[hour]] = await ExecuteSqlQuery(
+      "SELECT date_trunc('hour', now() AT TIME ZONE 'utc')")
+  return hour
+
+@pytest.mark.asyncio
+async def test_RollUpTransfers_Volume(http_client):
+  earlier = await FetchCurrentHour() - timedelta(hours=2)
+  later = earlier + timedelta(hours=1)
+  await ExecuteSqlQuery(
+      "INSERT INTO users (user_id, balance) VALUES (1, 0), (2, 0), (3, 0)")
+  await InsertTransfers([
+      (1, 2, 10, earlier + timedelta(minutes=15)),
+      (1, 3, 20, earlier + timedelta(minutes=45)),
+      (2, 3, 5, later + timedelta(minutes=5))])
+
+  assert await app_sql_client.RollUpTransfers(0) == 3
+  assert await app_sql_client.RollUpTransfers(0) == 0
+  await InsertTransfers([(3, 1, 7, later + timedelta(minutes=10))])
+  # Older than the previous round, so never rolled up.
+  assert await app_sql_client.RollUpTransfers(0) == 0
+
+  response = await http_client.get("/stats/volume?bucket=hour&limit=2")
+  assert response.status == "200 OK"
+  json = await response.get_json()
+  assert json["bucket"] == "hour"
+  assert json["rolledUpUntil"]
+  assert json["buckets"] == [
+      {"bucketStart": later.isoformat(), "transferCount": 1, "amount": 5},
+      {"bucketStart": earlier.isoformat(), "transferCount": 2, "amount": 30}]
+  # The hours may fall on two days.
+  response = await http_client.get("/stats/volume?bucket=day")
+  buckets = (await response.get_json())["buckets"]
+  assert sum(bucket["transferCount"] for bucket in buckets) == 3
+  assert sum(bucket["amount"] for bucket in buckets) == 35
+  rows = await ExecuteSqlQuery('''
+      SELECT user_id, sum(sent_count), sum(sent_amount), sum(received_count),
+             sum(received_amount)
+      FROM user_transfer_volume WHERE granularity = 'day'
+      GROUP BY user_id ORDER BY user_id''')
+  assert [tuple(row) for row in rows] == [
+      (1, 2, 30, 0, 0), (2, 1, 5, 1, 10), (3, 0, 0, 2, 25)]
+
+@pytest.mark.asyncio
+async def test_RollUpTransfers_BackfillsInSlices(http_client, monkeypatch):
+  monkeypatch.setattr("ledger.sql_client._ROLLUP_SLICE_SECONDS", 3600)
+  hour = await FetchCurrentHour()
+  await ExecuteSqlQuery(
+      "INSERT INTO users (user_id, balance) VALUES (1, 0), (2, 0)")
+  await InsertTransfers([
+      (1, 2, 10, hour - timedelta(hours=5)),
+      (2, 1, 20, hour - timedelta(hours=1))])
+
+  assert await app_sql_client.RollUpTransfers(0) == 2
+  rows = await ExecuteSqlQuery('''
+      SELECT bucket_start, transfer_count FROM transfer_volume
+      WHERE granularity = 'hour' ORDER BY bucket_start''')
+  assert [tuple(row) for row in rows] == [
+      (hour - timedelta(hours=5), 1), (hour - timedelta(hours=1), 1)]
+
+@pytest.mark.asyncio
+async def test_RollUpTransfers_PrunesOldMinutesAndHours(
+    http_client, monkeypatch):
+  monkeypatch.setattr("ledger.sql_client._ROLLUP_SLICE_SECONDS", 30 * 86400)
+  hour = await FetchCurrentHour()
+  await ExecuteSqlQuery(
+      "INSERT INTO users (user_id, balance) VALUES (1, 0), (2, 0)")
+  await InsertTransfers([
+      # Past MAX_ROLLUP_BUCKETS hours.
+      (1, 2, 10, hour - timedelta(hours=1100)),
+      # Past MAX_ROLLUP_BUCKETS minutes.
+      (1, 2, 20, hour - timedelta(hours=20)),
+      (1, 2, 30, hour - timedelta(hours=1))])
+
+  assert await app_sql_client.RollUpTransfers(0) == 3
+  for table in ("transfer_volume", "user_transfer_volume"):
+    rows = await ExecuteSqlQuery(f'''
+        SELECT granularity, count(DISTINCT bucket_start) FROM {table}
+        GROUP BY granularity''')
+    bucket_counts = dict(map(tuple, rows))
+    assert (bucket_counts["minute"], bucket_counts["hour"]) == (1, 2)
+  response = await http_client.get("/stats/volume?bucket=day")
+  buckets = (await response.get_json())["buckets"]
+  assert sum(bucket["transferCount"] for bucket in buckets) == 3
+
+@pytest.mark.asyncio
+async def test_RollUpTransfers_LeavesOutUnsettledTransfers(http_client):
+  hour = await FetchCurrentHour()
+  await ExecuteSqlQuery(
+      "INSERT INTO users (user_id, balance) VALUES (1, 100), (2, 0)")
+  await InsertTransfers([(1, 2, 10, hour - timedelta(hours=2))])
+  await app_sql_client.Transfer(1, 2, 20)
+
+  assert await app_sql_client.RollUpTransfers(3600) == 1
+  # Picks the last transfer up once it settled.
+  assert await app_sql_client.RollUpTransfers(0) == 1
+
+@pytest.mark.asyncio
+async def test_RollUpTransfers_SkipsRoundOfOtherWorker(http_client):
+  connection = await asyncpg.connect(os.environ["DATASOURCE"])
+  try:
+    await connection.execute(
+        "SELECT pg_advisory_lock(hashtext('transfer_rollups'))")
+    assert await app_sql_client.RollUpTransfers(0) is None
+  finally:
+    await connection.close()
+
+@pytest.mark.asyncio
+async def test_RollUpTransfers_TopUsers(http_client):
+  response = await http_client.get("/stats/top-senders")
+  assert await response.get_json() == {
+      "window": "24h", "rolledUpUntil": None, "users": []}
+  for _ in range(3):
+    await http_client.post("/users")
+  for user_id_from, user_id_to, amount in [
+      (1, 2, 10), (1, 3, 20), (2, 3, 5), (3, 1, 1)]:
+    response = await http_client.post("/transactions", json={
+        "userIdFrom": user_id_from, "userIdTo": user_id_to,
+        "amount": amount})
+    assert response.status == "200 OK"
+
+  assert await app_sql_client.RollUpTransfers(0) == 4
+
+  response = await http_client.get("/stats/top-senders?window=1h&limit=2")
+  assert response.status == "200 OK"
+  assert (await response.get_json())["users"] == [
+      {"userId": 1, "transferCount": 2, "amount": 30},
+      {"userId": 2, "transferCount": 1, "amount": 5}]
+  response = await http_client.get("/stats/top-receivers?window=2d")
+  assert (await response.get_json())["users"] == [
+      {"userId": 3, "transferCount": 2, "amount": 25},
+      {"userId": 2, "transferCount": 1, "amount": 10},
+      {"userId": 1, "transferCount": 1, "amount": 1}]
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("path", [
+  "/stats/volume?bucket=week",
+  "/stats/volume?limit=0",
+  "/stats/top-senders?window=24",
+  "/stats/top-senders?window=0h",
+  "/stats/top-receivers?limit=abc",
+])
+async def test_Rollups_InvalidArgs(http_client, path):
+  response = await http_client.get(path)
+  assert response.status == "400 BAD REQUEST"
+
+@pytest.mark.asyncio
+async def test_GetUserTransfers_PagesNewestFirst(http_client):
+  await InsertTransfers([
+      (1, 2, 10, "2024-01-01"),
+      (2, 1, 20, "2024-01-02"),
+      (2, 3, 30, "2024-01-03"),
+      (3, 1, 40, "2024-01-04")])
+
+  response = await http_client.get("/users/1/transfers?limit=2")
+  assert response.status == "200 OK"
+  page = await response.get_json()
+  assert page == {
+      "transfers": [
+          {"transferId": 4, "timestamp": "2024-01-04T00:00:00",
+           "userIdFrom": 3, "userIdTo": 1, "amount": 40},
+          {"transferId": 2, "timestamp": "2024-01-02T00:00:00",
+           "userIdFrom": 2, "userIdTo": 1, "amount": 20}],
+      "nextCursor": 2}
+
+  response = await http_client.get("/users/1/transfers?limit=2&cursor=2")
+  page = await response.get_json()
+  assert [transfer["transferId"] for transfer in page["transfers"]] == [1]
+  assert page["nextCursor"] is None
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("query, expected_transfer_ids", [
+  ("direction=sent", [3, 2]),
+  ("direction=received", [1]),
+  ("since=2024-01-02&until=2024-01-03", [2]),
+  ("direction=sent&since=2024-01-03", [3]),
+])
+async def test_GetUserTransfers_Filters(
+    http_client, query, expected_transfer_ids):
+  await InsertTransfers([
+      (1, 2, 10, "2024-01-01"),
+      (2, 1, 20, "2024-01-02"),
+      (2, 3, 30, "2024-01-03"),
+      (3, 1, 40, "2024-01-04")])
+
+  response = await http_client.get(f"/users/2/transfers?{query}")
+
+  page = await response.get_json()
+  assert [transfer["transferId"] for transfer in page["transfers"]] == (
+      expected_transfer_ids)
+
+async def InsertUsersWithHistory():
+  # Opening balances 100, 50 and 100.
+  await ExecuteSqlQuery(
+      "INSERT INTO users (user_id, balance) VALUES (1, 150), (2, 40), (3, 60)")
+  await InsertTransfers([
+      (1, 2, 10, "2024-01-01"),
+      (2, 1, 20, "2024-01-02"),
+      (3, 1, 40, "2024-01-04")])
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("as_of, expected_balance", [
+  ("2023-12-31", 100),
+  ("2024-01-01", 90),
+  ("2024-01-03T12:00:00", 110),
+  ("2024-01-04", 150),
+  ("2100-01-01", 150),
+])
+async def test_GetUserDetails_AsOfWithoutCheckpoints(
+    http_client, as_of, expected_balance):
+  await InsertUsersWithHistory()
+
+  response = await http_client.get(f"/users/1?asOf={as_of}")
+
+  assert response.status == "200 OK"
+  assert await response.get_json() == {
+      "userId": 1, "balance": expected_balance,
+      "asOf": datetime.fromisoformat(as_of).isoformat()}
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("as_of, expected_balance", [
+  ("2024-01-01T12:00:00", 980),  # Back from the checkpoint.
+  ("2024-01-03", 1000),
+  ("2024-01-05", 1040),  # Forward from the checkpoint.
+])
+async def test_GetUserDetails_AsOfStartsFromNearestCheckpoint(
+    http_client, as_of, expected_balance):
+  await InsertUsersWithHistory()
+  # Off on purpose, to tell where the balance was computed from.
+  await ExecuteSqlQuery(
+      "INSERT INTO balance_checkpoints (user_id, checkpoint_timestamp, balance) "
+      "VALUES (1, '2024-01-02 12:00', 1000)")
+
+  response = await http_client.get(f"/users/1?asOf={as_of}")
+
+  assert (await response.get_json())["balance"] == expected_balance
+
+@pytest.mark.asyncio
+async def test_GetUserDetails_AsOfUserDoesNotExist(http_client):
+  response = await http_client.get("/users/1?asOf=2024-01-01")
+  assert response.status == "400 BAD REQUEST"
+
+@pytest.mark.asyncio
+async def test_GetUserDetails_AsOfTransferOfSessionInOtherTimeZone(
+    http_client):
+  await ExecuteSqlQuery(
+      "INSERT INTO users (user_id, balance) VALUES (1, 100), (2, 0)")
+  connection = await asyncpg.connect(
+      os.environ["DATASOURCE"], server_settings={"timezone": "Asia/Tokyo"})
+  await connection.execute("SELECT transfer(1, 2, 10)")
+  await connection.close()
+
+  as_of = datetime.now(timezone.utc).isoformat()
+  response = await http_client.get(f"/users/2", query_string={"asOf": as_of})
+
+  assert (await response.get_json())["balance"] == 10
+
+@pytest.mark.asyncio
+async def test_WriteBalanceCheckpoints(http_client):
+  await InsertUsersWithHistory()
+
+  assert await app_sql_client.WriteBalanceCheckpoints(2, 0) == 2
+  # User 3 is due after one more transfer, user 1 after two.
+  for _ in range(2):
+    await http_client.post("/transactions", json={
+        "userIdFrom": 1, "userIdTo": 3, "amount": 5})
+    assert await app_sql_client.WriteBalanceCheckpoints(2, 0) == 1
+
+  checkpoints = await ExecuteSqlQuery('''
+      SELECT user_id, balance FROM balance_checkpoints
+      ORDER BY checkpoint_timestamp, user_id''')
+  assert [tuple(checkpoint) for checkpoint in checkpoints] == [
+      (1, 150), (2, 40), (3, 65), (1, 140)]
+  response = await http_client.get("/users/1?asOf=2024-01-03")
+  assert (await response.get_json())["balance"] == 110
+
+@pytest.mark.asyncio
+async def test_WriteBalanceCheckpoints_LeavesOutUnsettledTransfers(
+    http_client):
+  await InsertUsersWithHistory()
+  await http_client.post("/transactions", json={
+      "userIdFrom": 1, "userIdTo": 3, "amount": 5})
+
+  # As of an hour ago, before the last transfer.
+  assert await app_sql_client.WriteBalanceCheckpoints(1, 3600) == 3
+  # Picks the last transfer up once it settled.
+  assert await app_sql_client.WriteBalanceCheckpoints(1, 0) == 2
+
+  checkpoints = await ExecuteSqlQuery('''
+      SELECT user_id, balance FROM balance_checkpoints
+      ORDER BY checkpoint_timestamp, user_id''')
+  assert [tuple(checkpoint) for checkpoint in checkpoints] == [
+      (1, 150), (2, 40), (3, 60), (1, 145), (3, 65)]
+
+@pytest.mark.asyncio
+async def test_ExportTransfers_StreamsTimeRange(http_client):
+  await InsertTransfers([
+      (1, 2, 10, "2024-01-01"),
+      (2, 1, 20, "2024-01-02"),
+      (2, 3, 30, "2024-01-03"),
+      (3, 1, 40, "2024-01-04")])
+
+  response = await http_client.get(
+      "/transfers/export?since=2024-01-02&until=2024-01-04")
+
+  assert response.status == "200 OK"
+  lines = (await response.get_data(True)).splitlines()
+  assert [json.loads(line)["transferId"] for line in lines] == [2, 3]
+
+@pytest.mark.asyncio
+async def test_StreamTransfers_ReadsInChunks(statements_sql_client):
+  await InsertTransfers(
+      [(1, 2, amount, "2024-01-01") for amount in range(1, 6)])
+
+  chunks = [
+      [transfer.amount for transfer in chunk]
+      async for chunk in statements_sql_client.StreamTransfers(
+          datetime(2024, 1, 1), datetime(2024, 1, 2), 2)]
+
+  assert chunks == [[1, 2], [3, 4], [5]]
+
+@pytest.mark.asyncio
+async def test_Import_MergesAndReconcilesBalances(http_client, tmp_path):
+  await ExecuteSqlQuery("INSERT INTO users (user_id, balance) VALUES (1, 100)")
+  await ExecuteSqlQuery(
+      "INSERT INTO balance_checkpoints (user_id, checkpoint_timestamp, balance) "
+      "VALUES (1, '2023-12-31', 100), (1, '2024-01-01', 100)")
+  (tmp_path / "users.csv").write_text("userId,balance\n2,50\n3,0\n")
+  (tmp_path / "users.ndjson").write_text('{"userId": 4, "balance": 10}\n')
+  (tmp_path / "transfers.csv").write_text(
+      "timestamp,userIdFrom,userIdTo,amount\n"
+      "2024-01-02,2,3,20\n"
+      "2024-01-01,1,2,30\n")
+  (tmp_path / "transfers.ndjson").write_text(
+      '{"timestamp": "2024-01-03", "userIdFrom": 3, "userIdTo": 4, '
+      '"amount": 5}\n')
+
+  await Import(
+      os.environ["DATASOURCE"],
+      [str(tmp_path / "users.csv"), str(tmp_path / "users.ndjson")],
+      [str(tmp_path / "transfers.csv"), str(tmp_path / "transfers.ndjson")],
+      2)
+
+  users = await ExecuteSqlQuery(
+      "SELECT user_id, balance FROM users ORDER BY user_id")
+  assert [tuple(user) for user in users] == [(1, 70), (2, 60), (3, 15), (4, 15)]
+  transfers = await ExecuteSqlQuery('''
+      SELECT user_id_from, user_id_to, amount FROM transfers
+      ORDER BY transfer_id''')
+  assert [tuple(transfer) for transfer in transfers] == [
+      (1, 2, 30), (2, 3, 20), (3, 4, 5)]
+  indexes = await ExecuteSqlQuery(
+      "SELECT indexname FROM pg_indexes WHERE tablename = 'transfers'")
+  assert len(indexes) == 4
+  checkpoints = await ExecuteSqlQuery(
+      "SELECT checkpoint_timestamp FROM balance_checkpoints")
+  assert [checkpoint[0] for checkpoint in checkpoints] == [
+      datetime(2023, 12, 31)]
+  response = await http_client.post("/users")
+  assert await response.get_data(True) == '5'
+
+@pytest.mark.asyncio
+async def test_Import_BackdatedTransfersAreRolledUpAgain(
+    http_client, tmp_path):
+  hour = await FetchCurrentHour()
+  first, imported, last = (hour - timedelta(days=days) for days in (3, 2, 1))
+  await ExecuteSqlQuery(
+      "INSERT INTO users (user_id, balance) VALUES (1, 100), (2, 0)")
+  await InsertTransfers([(1, 2, 10, first), (1, 2, 20, last)])
+  assert await app_sql_client.RollUpTransfers(0) == 2
+  (tmp_path / "transfers.csv").write_text(
+      f"timestamp,userIdFrom,userIdTo,amount\n{imported},1,2,5\n")
+
+  await Import(
+      os.environ["DATASOURCE"], [], [str(tmp_path / "transfers.csv")], 1)
+  # Rolls up the day of the imported transfer and the days after it again.
+  assert await app_sql_client.RollUpTransfers(0) == 2
+
+  response = await http_client.get("/stats/volume?bucket=hour")
+  assert [
+      (bucket["bucketStart"], bucket["amount"])
+      for bucket in (await response.get_json())["buckets"]] == [
+          (last.isoformat(), 20), (imported.isoformat(), 5),
+          (first.isoformat(), 10)]
+  response = await http_client.get("/stats/top-senders?window=7d")
+  assert (await response.get_json())["users"] == [
+      {"userId": 1, "transferCount": 3, "amount": 35}]
+
+@pytest.mark.asyncio
+async def test_Import_OverdrawnUserRollsBack(http_client, tmp_path):
+  (tmp_path / "users.csv").write_text("userId,balance\n1,10\n2,0\n")
+  (tmp_path / "transfers.csv").write_text(
+      "timestamp,userIdFrom,userIdTo,amount\n2024-01-01,1,2,30\n")
+
+  with pytest.raises(ValueError):
+    await Import(
+        os.environ["DATASOURCE"], [str(tmp_path / "users.csv")],
+        [str(tmp_path / "transfers.csv")], 1)
+
+  assert not await ExecuteSqlQuery("SELECT user_id FROM users")
+  assert not await ExecuteSqlQuery("SELECT transfer_id FROM transfers")
+
+@pytest.mark.asyncio
+async def test_GetPoolStats_Ok(http_client):
+  await http_client.get("/users/1")
+  response = await http_client.get("/stats/pool")
+  assert response.status == "200 OK"
+  stats = await response.get_json()
+  assert stats["size"] >= 1
+  assert stats["acquireWaitSeconds"]["count"] >= 1
+  assert stats["acquireTimeouts"] == 0
+
+@pytest.mark.asyncio
+async def test_GetMetrics(http_client):
+  await http_client.post("/users")
+  await http_client.post("/users")
+  await http_client.post(
+      "/transactions", json={"userIdFrom": 1, "userIdTo": 2, "amount": 10})
+  await http_client.post(
+      "/transactions", json={"userIdFrom": 1, "userIdTo": 2, "amount": 10**9})
+  response = await http_client.get("/metrics")
+  assert response.status == "200 OK"
+  assert response.content_type.startswith("text/plain")
+  metrics = (await response.get_data()).decode()
+  assert ('ledger_http_requests_total{route="CreateUser",method="POST",'
+          'status="201"}') in metrics
+  assert ('ledger_http_requests_total{route="Transfer",method="POST",'
+          'status="400"}') in metrics
+  assert ('ledger_sql_statement_duration_seconds_count'
+          '{statement="insert_user"}') in metrics
+  assert "ledger_transfer_amount_total " in metrics
+  assert "ledger_insufficient_funds_total " in metrics
+  assert "ledger_db_pool_connections " in metrics
+
+@pytest.mark.asyncio
+async def test_PoolConfig_AcquireTimeoutIsCounted(http_client):
+  sql_client = PostgreSQLClient(
+      os.environ["DATASOURCE"],
+      pool_config=PoolConfig(
+          min_size=1, max_size=1, acquire_timeout=0.05,
+          init_sql="SET application_name = 'ledger_test'"))
+  await sql_client.CreateConnectionPool()
+  async with sql_client._Acquire() as connection:
+    assert await connection.fetchval(
+        "SHOW application_name") == "ledger_test"
+    with pytest.raises(asyncio.TimeoutError):
+      await sql_client.FetchUser(1)
+  stats = sql_client.PoolStats()
+  await sql_client.CloseConnectionPool()
+
+  assert stats["acquireTimeouts"] == 1
+  assert stats["maxSize"] == 1
+
+@pytest.mark.asyncio
+async def test_PoolConfig_AcquireTimeoutIsServiceUnavailable(http_client):
+  await ExecuteSqlQuery("INSERT INTO users (user_id, balance) VALUES (1, 100)")
+  sql_client = PostgreSQLClient(
+      os.environ["DATASOURCE"],
+      pool_config=PoolConfig(min_size=1, max_size=1, acquire_timeout=0.05))
+  await sql_client.CreateConnectionPool()
+  ledger_api = LedgerAPI(100, sql_client)
+  async with sql_client._Acquire():
+    response = await ledger_api.GetUserDetails("1")
+  await sql_client.CloseConnectionPool()
+
+  assert response.status == "503 SERVICE UNAVAILABLE"
+  assert response.headers["Retry-After"] == "1"
+
+@pytest.mark.asyncio
+async def test_Tracing_TransferRequest(http_client, monkeypatch, tmp_path):
+  await ExecuteSqlQuery(
+      "INSERT INTO users (user_id, balance) VALUES (1, 100), (2, 100)")
+  trace_file = tmp_path / "traces.jsonl"
+  tracer = Tracer(str(trace_file), 0, 60000, 1000000, 1)
+  monkeypatch.setattr("ledger.app.tracer", tracer)
+  trace_id = "4bf92f3577b34da6a3ce929d0e0e4736"
+
+  response = await http_client.post(
+      "/transactions", json={"userIdFrom": 1, "userIdTo": 2, "amount": 5},
+      headers={"traceparent": f"00-{trace_id}-00f067aa0ba902b7-01"})
+  await http_client.get("/users/1")
+  tracer.Close()
+
+  assert response.status == "200 OK"
+  [spans] = [json.loads(line) for line in trace_file.read_text().splitlines()]
+  assert spans[0]["name"] == "POST Transfer"
+  assert spans[0]["tags"]["http.status_code"] == "200"
+  assert {span["traceId"] for span in spans} == {trace_id}
+  assert {"parse_json", "validate", "pool_acquire"} <= {
+      span["name"] for span in spans}
+  assert any(span["name"].startswith("sql ") for span in spans)
+
+@pytest.mark.asyncio
+async def test_Tracing_TransferStatementsAndCommit(http_client, tmp_path):
+  await ExecuteSqlQuery(
+      "INSERT INTO users (user_id, balance) VALUES (1, 100), (2, 100)")
+  trace_file = tmp_path / "traces.jsonl"
+  tracer = Tracer(str(trace_file), 1, 60000, 1000000, 1)
+  sql_client = PostgreSQLClient(
+      os.environ["DATASOURCE"], use_transfer_function=False)
+  await sql_client.CreateConnectionPool()
+
+  trace = tracer.Start("POST Transfer")
+  await sql_client.Transfer(1, 2, 5)
+  tracer.Finish(trace)
+  tracer.Close()
+  await sql_client.CloseConnectionPool()
+
+  [spans] = [json.loads(line) for line in trace_file.read_text().splitlines()]
+  assert [span["name"] for span in spans] == [
+      "POST Transfer", "pool_acquire", "sql lock_users", "sql update_user",
+      "sql update_user", "sql insert_transfer", "sql commit"]
+
+@pytest_asyncio.fixture
+async def migrations_sql_client(http_client):
+  # Test migrations get versions after the real ones, and are removed again.
+  sql_client = PostgreSQLClient(os.environ["DATASOURCE"])
+  await sql_client.CreateConnectionPool()
+  yield sql_client
+  await sql_client.CloseConnectionPool()
+  await ExecuteSqlQuery("DROP TABLE IF EXISTS migration_test")
+  await ExecuteSqlQuery("DELETE FROM schema_migrations WHERE version >= 9000")
+
+@pytest.mark.asyncio
+async def test_ApplyMigrations_AppliesPendingOnce(migrations_sql_client):
+  migrations = LoadMigrations() + [
+      Migration(9000, "create", "CREATE TABLE migration_test (c INT);"),
+      Migration(
+          9001, "index",
+          "-- migration: no transaction\n"
+          "CREATE INDEX CONCURRENTLY migration_test_c_idx "
+          "ON migration_test (c)", in_transaction=False)]
+
+  assert await migrations_sql_client.FetchPendingMigrations(migrations) == (
+      migrations[-2:])
+  results = await asyncio.gather(
+      migrations_sql_client.ApplyMigrations(migrations),
+      migrations_sql_client.ApplyMigrations(migrations))
+
+  assert sorted(results) == [[], [9000, 9001]]
+  assert await migrations_sql_client.ApplyMigrations(migrations) == []
+  assert await ExecuteSqlQuery(
+      "SELECT version, name FROM schema_migrations WHERE version >= 9000 "
+      "ORDER BY 1") == [(9000, "create"), (9001, "index")]
+  assert await ExecuteSqlQuery(
+      "SELECT indexname FROM pg_indexes "
+      "WHERE tablename = 'migration_test'") == [("migration_test_c_idx",)]
+
+@pytest.mark.asyncio
+async def test_ApplyMigrations_FailedMigrationIsRolledBack(
+    migrations_sql_client):
+  migrations = [
+      Migration(9000, "create", "CREATE TABLE migration_test (c INT);"),
+      Migration(
+          9001, "fails",
+          "INSERT INTO migration_test VALUES (1); SELECT 1 / 0;")]
+
+  with pytest.raises(asyncpg.exceptions.DivisionByZeroError):
+    await migrations_sql_client.ApplyMigrations(migrations)
+
+  assert await ExecuteSqlQuery("SELECT * FROM migration_test") == []
+  assert [migration.version for migration in await (
+      migrations_sql_client.FetchPendingMigrations(migrations))] == [9001]
+
+@pytest.mark.asyncio
+async def test_ApplyMigrations_SetsSettings(migrations_sql_client):
+  migrations = [Migration(
+      9000, "create",
+      "CREATE TABLE migration_test AS "
+      "SELECT current_setting('ledger.test') AS setting;")]
+
+  await migrations_sql_client.ApplyMigrations(
+      migrations, {"ledger.test": 7})
+
+  assert await ExecuteSqlQuery("SELECT * FROM migration_test") == [("7",)]
+
+@pytest.mark.asyncio
+async def test_Schema_PartitionsExistingTransfersTable(http_client):
+  connection = await asyncpg.connect(os.environ["DATASOURCE"])
+  await connection.execute("DROP SCHEMA IF EXISTS legacy CASCADE")
+  await connection.execute("CREATE SCHEMA legacy")
+  await connection.execute("SET search_path = legacy")
+  try:
+    # The transfers table as it was before partitioning.
+    await connection.execute('''
+        CREATE TABLE transfers (
+          transfer_id BIGSERIAL,
+          transfer_timestamp TIMESTAMP DEFAULT current_timestamp,
+          user_id_from BIGINT,
+          user_id_to BIGINT,
+          amount BIGINT NOT NULL
+        );
+        INSERT INTO transfers
+            (user_id_from, user_id_to, amount, transfer_timestamp)
+        VALUES (1, 2, 10, '2024-01-01'), (2, 1, 5, '2024-03-05')''')
+    schema = LoadMigrations()[0].sql
+    await connection.execute(schema)
+    await connection.execute(schema)
+
+    partitions = await connection.fetch('''
+        SELECT inhrelid::regclass::text AS name,
+               pg_get_expr(relpartbound, inhrelid) AS bound
+        FROM pg_inherits JOIN pg_class ON oid = inhrelid
+        WHERE inhparent = 'transfers'::regclass ORDER BY name''')
+    assert partitions[0]["name"] == "transfers_legacy"
+    assert partitions[0]["bound"] == (
+        "FOR VALUES FROM (MINVALUE) TO ('2024-04-01 00:00:00')")
+    assert len(partitions) == 3
+    transfer_id = await connection.fetchval('''
+        INSERT INTO transfers (user_id_from, user_id_to, amount)
+        VALUES (1, 2, 1) RETURNING transfer_id''')
+    assert transfer_id == 3
+    transfers = await connection.fetch(
+        "SELECT transfer_id FROM transfers ORDER BY transfer_id")
+    assert [transfer["transfer_id"] for transfer in transfers] == [1, 2, 3]
+  finally:
+    await connection.execute("DROP SCHEMA legacy CASCADE")
+    await connection.close()
+
+@pytest.mark.asyncio
+async def test_MaintainPartitions_CreatesAndArchives(http_client, tmp_path):
+  await InsertTransfers([
+      (1, 2, 10, "2024-01-01"),
+      (2, 1, 20, "2024-01-31 23:59:59")])
+
+  await Maintain(os.environ["DATASOURCE"], 2, 3, str(tmp_path))
+
+  partitions = await ExecuteSqlQuery('''
+      SELECT inhrelid::regclass::text AS name FROM pg_inherits
+      WHERE inhparent = 'transfers'::regclass''')
+  names = {partition["name"] for partition in partitions}
+  assert "transfers_p202401" not in names
+  months = await ExecuteSqlQuery('''
+      SELECT to_char(localtimestamp + make_interval(months => n), 'YYYYMM')
+          AS month
+      FROM generate_series(0, 2) AS n''')
+  assert {f"transfers_p{month['month']}" for month in months} <= names
+  assert await ExecuteSqlQuery(
+      "SELECT to_regclass('transfers_p202401') AS name") == [(None,)]
+  with gzip.open(tmp_path / "transfers_p202401.csv.gz", "rt") as file:
+    assert file.read().splitlines() == [
+        "transferId,timestamp,userIdFrom,userIdTo,amount",
+        "1,2024-01-01 00:00:00,1,2,10",
+        "2,2024-01-31 23:59:59,2,1,20"]
+  assert not await ExecuteSqlQuery("SELECT * FROM transfers")
+
+@pytest.mark.asyncio
+async def test_MaintainPartitions_KeepsMonthsWithinRetention(
+    http_client, tmp_path):
+  [[month]] = await ExecuteSqlQuery(
+      "SELECT date_trunc('month', now() AT TIME ZONE 'utc')")
+  months = [month]
+  for _ in range(3):
+    months.append((months[-1] - timedelta(days=1)).replace(day=1))
+  # Two full months are kept besides the current one. The month before ends
+  # right at the cutoff.
+  expired, kept = months[3], months[2]
+  expired_name, kept_name = (
+      f"transfers_p{timestamp:%Y%m}" for timestamp in (expired, kept))
+  await InsertTransfers([(1, 2, 10, expired), (2, 1, 20, kept)])
+
+  await Maintain(os.environ["DATASOURCE"], 0, 2, str(tmp_path))
+
+  partitions = await ExecuteSqlQuery('''
+      SELECT inhrelid::regclass::text AS name FROM pg_inherits
+      WHERE inhparent = 'transfers'::regclass''')
+  names = {partition["name"] for partition in partitions}
+  assert expired_name not in names
+  assert kept_name in names
+  assert (tmp_path / f"{expired_name}.csv.gz").exists()
+  transfers = await ExecuteSqlQuery("SELECT amount FROM transfers")
+  assert [transfer["amount"] for transfer in transfers] == [20]
+
+@pytest_asyncio.fixture
+async def sharded_sql_client(http_client):
+  # The app's database is the first shard.
+  shards = [
+      PostgreSQLClient(os.environ["DATASOURCE"]),
+      PostgreSQLClient(os.environ["TEST_SHARD_DATASOURCE"])]
+  sql_client = ShardedPostgreSQLClient(shards)
+  await sql_client.CreateConnectionPool()
+  await sql_client.ApplyMigrations(LoadMigrations())
+  for datasource_name in (
+      os.environ["DATASOURCE"], os.environ["TEST_SHARD_DATASOURCE"]):
+    connection = await asyncpg.connect(datasource_name)
+    await connection.execute(
+        "TRUNCATE users, balance_slots, transfers, "
+        "transfer_idempotency_keys, coordinator_log, transfer_volume, "
+        "user_transfer_volume, transfer_rollup_progress RESTART IDENTITY")
+    await connection.close()
+  yield sql_client
+  await sql_client.CloseConnectionPool()
+  # Left behind by failed tests, they would block the next TRUNCATE.
+  for datasource_name in (
+      os.environ["DATASOURCE"], os.environ["TEST_SHARD_DATASOURCE"]):
+    connection = await asyncpg.connect(datasource_name)
+    for row in await connection.fetch("SELECT gid FROM pg_prepared_xacts"):
+      await connection.execute(f"ROLLBACK PREPARED '{row['gid']}'")
+    await connection.close()
+
+async def FetchShardRows(shard_index, query):
+  datasource_name = (
+      os.environ["DATASOURCE"], os.environ["TEST_SHARD_DATASOURCE"])[
+          shard_index]
+  connection = await asyncpg.connect(datasource_name)
+  try:
+    return [tuple(row) for row in await connection.fetch(query)]
+  finally:
+    await connection.close()
+
+@pytest.mark.asyncio
+async def test_Sharding_IdRangesMatchShardIndex(sharded_sql_client):
+  [migration] = [
+      migration for migration in LoadMigrations() if migration.version == 7]
+  for index, datasource_name in enumerate((
+      os.environ["DATASOURCE"], os.environ["TEST_SHARD_DATASOURCE"])):
+    connection = await asyncpg.connect(datasource_name)
+    transaction = connection.transaction()
+    await transaction.start()
+    try:
+      # The app's database was migrated before it became the first shard.
+      await connection.execute(
+          "SELECT set_config('ledger.id_range_start', $1, true), "
+          "set_config('ledger.id_range_size', $2, true)",
+          str(index * ID_RANGE_SIZE), str(ID_RANGE_SIZE))
+      await connection.execute(migration.sql)
+      ranges = await connection.fetch('''
+          SELECT greatest(min_value, 1), max_value FROM pg_sequences
+          WHERE sequencename IN
+              ('users_user_id_seq', 'transfers_transfer_id_seq')''')
+    finally:
+      await transaction.rollback()
+      await connection.close()
+    assert len(ranges) == 2
+    for first_id, last_id in ranges:
+      assert sharded_sql_client._ShardIndex(first_id) == index
+      assert sharded_sql_client._ShardIndex(last_id) == index
+      assert sharded_sql_client._ShardIndex(last_id + 1) != index
+
+@pytest.mark.asyncio
+async def test_Sharding_InsertUserAllocatesIdsPerShard(sharded_sql_client):
+  user_ids = [await sharded_sql_client.InsertUser(100) for _ in range(4)]
+
+  assert user_ids == [1, ID_RANGE_SIZE, 2, ID_RANGE_SIZE + 1]
+  assert await FetchShardRows(1, "SELECT user_id FROM users") == [
+      (ID_RANGE_SIZE,), (ID_RANGE_SIZE + 1,)]
+  users = await sharded_sql_client.FetchUsers([ID_RANGE_SIZE, 1, 3])
+  assert sorted(user.user_id for user in users) == [1, ID_RANGE_SIZE]
+
+@pytest.mark.asyncio
+async def test_Sharding_TransferWithinShard(sharded_sql_client):
+  user_ids = [await sharded_sql_client.InsertUser(100) for _ in range(4)]
+
+  transfer_id = await sharded_sql_client.Transfer(user_ids[1], user_ids[3], 30)
+
+  assert transfer_id == ID_RANGE_SIZE
+  assert await FetchShardRows(1, "SELECT balance FROM users ORDER BY 1") == [
+      (70,), (130,)]
+
+@pytest.mark.asyncio
+async def test_Sharding_TransferAcrossShards(sharded_sql_client):
+  user_id_from = await sharded_sql_client.InsertUser(100)
+  user_id_to = await sharded_sql_client.InsertUser(100)
+
+  transfer_id = await sharded_sql_client.Transfer(
+      user_id_from, user_id_to, 30, idempotency_key="across")
+  assert await sharded_sql_client.Transfer(
+      user_id_from, user_id_to, 30, idempotency_key="across") == transfer_id
+
+  assert transfer_id == 1
+  assert (await sharded_sql_client.FetchUser(user_id_from)).balance == 70
+  assert (await sharded_sql_client.FetchUser(user_id_to)).balance == 130
+  for shard_index, user_id in ((0, user_id_from), (1, user_id_to)):
+    assert await FetchShardRows(
+        shard_index, "SELECT transfer_id, user_id_from, user_id_to, amount "
+        "FROM transfers") == [(1, user_id_from, user_id_to, 30)]
+    transfers = await sharded_sql_client.FetchTransfers(user_id, "all", 10)
+    assert [transfer.transfer_id for transfer in transfers] == [1]
+    assert await FetchShardRows(
+        shard_index, "SELECT * FROM coordinator_log") == []
+  chunks = [
+      chunk async for chunk in sharded_sql_client.StreamTransfers(
+          datetime(2000, 1, 1), datetime(2100, 1, 1), 10)]
+  assert [[transfer.transfer_id for transfer in chunk] for chunk in chunks] == [
+      [1]]
+  assert await FetchShardRows(0, "SELECT gid FROM pg_prepared_xacts") == []
+  assert await FetchShardRows(1, "SELECT gid FROM pg_prepared_xacts") == []
+
+@pytest.mark.asyncio
+async def test_Sharding_TransferEventsAcrossShards(sharded_sql_client):
+  # The fixture cleans up the shards.
+  shards = [
+      PostgreSQLClient(datasource_name, notify_transfers=True)
+      for datasource_name in (
+          os.environ["DATASOURCE"], os.environ["TEST_SHARD_DATASOURCE"])]
+  sql_client = ShardedPostgreSQLClient(shards)
+  await sql_client.CreateConnectionPool()
+  event_hub = TransferEventHub(sql_client)
+  await event_hub.Start()
+  user_id_from = await sql_client.InsertUser(100)
+  user_id_to = await sql_client.InsertUser(100)
+  sender = event_hub.Subscribe(user_id_from)
+  receiver = event_hub.Subscribe(user_id_to)
+
+  transfer_id = await sql_client.Transfer(user_id_from, user_id_to, 30)
+
+  [sent] = await WaitForEvents(sender, 1)
+  [received] = await WaitForEvents(receiver, 1)
+  assert (sent["transferId"], sent["balance"]) == (transfer_id, 70)
+  assert (received["transferId"], received["balance"]) == (transfer_id, 130)
+  await sql_client.CloseConnectionPool()
+
+@pytest.mark.asyncio
+async def test_Sharding_RollUpTransfersAcrossShards(sharded_sql_client):
+  user_id_from = await sharded_sql_client.InsertUser(100)
+  user_id_to = await sharded_sql_client.InsertUser(100)
+  await sharded_sql_client.Transfer(user_id_from, user_id_to, 30)
+
+  assert await sharded_sql_client.RollUpTransfers(0) == 1
+
+  [bucket] = await sharded_sql_client.FetchTransferVolume("day", 10)
+  assert (bucket.transfer_count, bucket.amount) == (1, 30)
+  [sender] = await sharded_sql_client.FetchTopUsers(
+      DIRECTION_SENT, "day", 1, 10)
+  assert (sender.user_id, sender.amount) == (user_id_from, 30)
+  [receiver] = await sharded_sql_client.FetchTopUsers(
+      DIRECTION_RECEIVED, "day", 1, 10)
+  assert (receiver.user_id, receiver.amount) == (user_id_to, 30)
+  assert await sharded_sql_client.FetchRollupProgress()
+
+@pytest.mark.asyncio
+async def test_Sharding_TransferAcrossShardsInsufficientFunds(
+    sharded_sql_client):
+  user_id_from = await sharded_sql_client.InsertUser(10)
+  user_id_to = await sharded_sql_client.InsertUser(10)
+
+  with pytest.raises(InsufficientFundsException):
+    await sharded_sql_client.Transfer(user_id_from, user_id_to, 30)
+  # The receiver doesn't exist, after the sender's side was prepared.
+  with pytest.raises(ValueError):
+    await sharded_sql_client.Transfer(user_id_from, ID_RANGE_SIZE + 5, 5)
+
+  assert (await sharded_sql_client.FetchUser(user_id_from)).balance == 10
+  assert await FetchShardRows(0, "SELECT gid FROM pg_prepared_xacts") == []
+  assert await FetchShardRows(0, "SELECT * FROM transfers") == []
+
+@pytest.mark.asyncio
+async def test_Sharding_RecoverPreparedTransactions(sharded_sql_client):
+  shards = [
+      PostgreSQLClient(os.environ["DATASOURCE"]),
+      PostgreSQLClient(os.environ["TEST_SHARD_DATASOURCE"])]
+  for shard in shards:
+    await shard.CreateConnectionPool()
+  user_ids = [await sharded_sql_client.InsertUser(100) for _ in range(4)]
+  # Coordinators that crashed after preparing both sides of a transfer from
+  # the first shard to the second; only the first logged its commit.
+  for transaction_id, user_id_from, user_id_to in (
+      ("ledger_0_a", user_ids[0], user_ids[1]),
+      ("ledger_0_b", user_ids[2], user_ids[3])):
+    transfer_id, timestamp = await shards[0].PrepareTransferDebit(
+        transaction_id + "_0", user_id_from, user_id_to, 10)
+    await shards[1].PrepareTransferCredit(
+        transaction_id + "_1", transfer_id, timestamp, user_id_from,
+        user_id_to, 10)
+  assert await shards[0].DecideTransaction("ledger_0_a", True)
+
+  # Too young to be in doubt.
+  assert await sharded_sql_client.RecoverPreparedTransactions(60) == 0
+  assert await sharded_sql_client.RecoverPreparedTransactions(0) == 4
+
+  users = await sharded_sql_client.FetchUsers(user_ids)
+  assert sorted((user.user_id, user.balance) for user in users) == [
+      (1, 90), (2, 100), (ID_RANGE_SIZE, 110), (ID_RANGE_SIZE + 1, 100)]
+  assert await FetchShardRows(
+      0, "SELECT transaction_id, committed FROM coordinator_log "
+      "ORDER BY 1") == [("ledger_0_a", True), ("ledger_0_b", False)]
+  assert await FetchShardRows(1, "SELECT gid FROM pg_prepared_xacts") == []
+  # A late coordinator can't commit anymore.
+  assert not await shards[0].DecideTransaction("ledger_0_b", True)
+  for shard in shards:
+    await shard.CloseConnectionPool()
+
+@pytest_asyncio.fixture
+async def replica_reader(http_client):
+  primary = PostgreSQLClient(os.environ["DATASOURCE"])
+  await primary.CreateConnectionPool()
+  reader = ReplicaReader(
+      primary, [PostgreSQLClient(os.environ["TEST_REPLICA_DATASOURCE"])],
+      10, 1000, 1)
+  await reader.Start()
+  yield reader
+  await reader.Close()
+  await primary.CloseConnectionPool()
+
+@pytest.mark.asyncio
+async def test_Replicas_CheckReplicas(replica_reader):
+  assert await replica_reader.CheckReplicas() == 1
+  replica, = replica_reader.Stats()["replicas"]
+  assert replica["healthy"]
+  assert replica["error"] is None
+  assert replica["lagBytes"] >= 0
+
+@pytest.mark.asyncio
+async def test_Replicas_ReadOwnWrite(replica_reader):
+  replica_reads = DB_READS.Value(target="replica")
+  await ExecuteSqlQuery("INSERT INTO users (user_id, balance) VALUES (1, 100)")
+  min_lsn = await replica_reader.FetchWalLsn()
+
+  user = await replica_reader.FetchUser(1, min_lsn=min_lsn)
+
+  assert (user.user_id, user.balance) == (1, 100)
+  assert DB_READS.Value(target="replica") == replica_reads + 1
+
+@pytest.mark.asyncio
+async def test_Replicas_PrimaryIsNotAReplica(http_client):
+  primary = PostgreSQLClient(os.environ["DATASOURCE"])
+  await primary.CreateConnectionPool()
+  reader = ReplicaReader(
+      primary, [PostgreSQLClient(os.environ["DATASOURCE"])], 10, 0, 1)
+  await reader.Start()
+  await ExecuteSqlQuery("INSERT INTO users (user_id, balance) VALUES (1, 100)")
+  primary_reads = DB_READS.Value(target="primary")
+
+  assert await reader.FetchUser(1) is not None
+
+  assert DB_READS.Value(target="primary") == primary_reads + 1
+  assert reader.Stats()["replicas"][0]["error"] == "Not in recovery."
+  await reader.Close()
+  await primary.CloseConnectionPool()
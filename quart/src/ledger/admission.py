@@ -0,0 +1,96 @@
+from ledger.metrics import ADMISSION_REJECTIONS, ADMISSION_WAIT_SECONDS
+from ledger.model import OverloadedException
+
+import asyncio
+import collections
+import contextlib
+import time
+
+
+# Classes of requests, in the order in which waiting requests are admitted.
+PRIORITY_TRANSFER = "transfer"
+PRIORITY_READ = "read"
+PRIORITIES = (PRIORITY_TRANSFER, PRIORITY_READ)
+
+
+class AdmissionController:
+  # Caps the requests that work on the database at max_in_flight per worker.
+  # Requests beyond that wait in a queue per priority, transfers before
+  # reads, of at most max_queued[priority] requests. A request that finds its
+  # queue full, or waits longer than max_wait_ms, is rejected with
+  # OverloadedException right away, so that overload sheds requests instead
+  # of slowing all of them down.
+
+  def __init__(self, max_in_flight, max_queued, max_wait_ms,
+               retry_after_seconds):
+    self._max_in_flight = max_in_flight
+    self._max_queued = max_queued
+    self._max_wait = max_wait_ms / 1000
+    self._retry_after_seconds = retry_after_seconds
+    self._in_flight = 0
+    # Futures of waiting requests, set when a request hands its slot over.
+    self._queues = {priority: collections.deque() for priority in PRIORITIES}
+    self._rejections = collections.Counter()
+
+  @contextlib.asynccontextmanager
+  async def Admit(self, priority):
+    await self._Acquire(priority)
+    try:
+      yield
+    finally:
+      self._Release()
+
+  def Stats(self):
+    return {
+        "inFlight": self._in_flight,
+        "maxInFlight": self._max_in_flight,
+        "queued": {
+            priority: len(queue) for priority, queue in self._queues.items()},
+        "rejected": {
+            priority: self._rejections[priority] for priority in PRIORITIES},
+    }
+
+  async def _Acquire(self, priority):
+    if self._in_flight < self._max_in_flight and not any(self._queues.values()):
+      self._in_flight += 1
+      return
+    queue = self._queues[priority]
+    if len(queue) >= self._max_queued[priority]:
+      self._Reject(priority, "queue_full")
+    future = asyncio.get_running_loop().create_future()
+    queue.append(future)
+    start = time.monotonic()
+    try:
+      await asyncio.wait_for(future, self._max_wait)
+    except asyncio.TimeoutError:
+      self._Abandon(queue, future)
+      self._Reject(priority, "timeout")
+    except BaseException:
+      self._Abandon(queue, future)
+      raise
+    finally:
+      ADMISSION_WAIT_SECONDS.Observe(
+          time.monotonic() - start, priority=priority)
+
+  def _Abandon(self, queue, future):
+    if future.done() and not future.cancelled():
+      # Handed a slot just as the wait ended.
+      self._Release()
+    elif future in queue:
+      queue.remove(future)
+
+  def _Release(self):
+    # The slot goes straight to the next waiting request, if there is one.
+    for priority in PRIORITIES:
+      queue = self._queues[priority]
+      while queue:
+        future = queue.popleft()
+        if not future.done():
+          future.set_result(None)
+          return
+    self._in_flight -= 1
+
+  def _Reject(self, priority, reason):
+    self._rejections[priority] += 1
+    ADMISSION_REJECTIONS.Inc(priority=priority, reason=reason)
+    raise OverloadedException(self._retry_after_seconds)
@@ -1,9 +1,33 @@
 import asyncio
+import functools
 import logging
-from ledger.sql_client import PostgreSQLClient
-from ledger.ledger_api import LedgerAPI
+from ledger.admission import (
+    PRIORITY_READ, PRIORITY_TRANSFER, AdmissionController)
+from ledger.checkpoints import BalanceCheckpointer
+from ledger.sql_client import PoolConfig, PostgreSQLClient
+from ledger.contention import ContentionAwareTransferClient
+from ledger.events import DEFAULT_MAX_QUEUED_EVENTS, TransferEventHub
+from ledger.idempotency import IdempotencyKeyCache
+from ledger.ledger_api import (
+    DEFAULT_MAX_USERS_PER_REQUEST, HTTP_STATUS_OK, LedgerAPI,
+    OverloadedResponse)
+from ledger.memory import MemoryLedger
+from ledger.metrics import (
+    CONTENT_TYPE, REGISTRY, REQUEST_SECONDS, REQUESTS, Gauge)
+from ledger.migrations import LoadMigrations
+from ledger.partitions import TransferPartitionMaintainer
+from ledger.model import (
+    DIRECTION_RECEIVED, DIRECTION_SENT, OverloadedException)
+from ledger.replicas import LSN_HEADER, FormatLsn, ReplicaReader
+from ledger.rollups import TransferRollupUpdater
+from ledger.sharding import ShardedPostgreSQLClient
+from ledger.tracing import TRACEPARENT_HEADER, Tracer
+from ledger.split_accounts import BalanceSlotConsolidator
+from ledger.transfer_scheduler import TransferScheduler
+from ledger.user_cache import UserCache
 import os
-from quart import Quart, request
+import time
+from quart import Quart, g, request
 from quart_cors import cors
 from markupsafe import escape
 
@@ -15,31 +39,403 @@ handler.setFormatter(formatter)
 logger.addHandler(handler)
 
 
-sql_client = PostgreSQLClient(os.environ["DATASOURCE"])
-ledger_api = LedgerAPI(int(os.environ["DEFAULT_BALANCE"]), sql_client)
+def _GetFlag(name, default):
+  return os.environ.get(name, default).lower() == "true"
+
+
+def _GetPoolConfig():
+  defaults = PoolConfig()
+  acquire_timeout = os.environ.get("DB_POOL_ACQUIRE_TIMEOUT_SECONDS")
+  return PoolConfig(
+      min_size=int(os.environ.get("DB_POOL_MIN_SIZE", defaults.min_size)),
+      max_size=int(os.environ.get("DB_POOL_MAX_SIZE", defaults.max_size)),
+      max_queries=int(
+          os.environ.get("DB_POOL_MAX_QUERIES", defaults.max_queries)),
+      max_inactive_connection_lifetime=float(os.environ.get(
+          "DB_POOL_MAX_INACTIVE_CONNECTION_LIFETIME_SECONDS",
+          defaults.max_inactive_connection_lifetime)),
+      statement_cache_size=int(os.environ.get(
+          "DB_STATEMENT_CACHE_SIZE", defaults.statement_cache_size)),
+      acquire_timeout=float(acquire_timeout) if acquire_timeout else None,
+      init_sql=os.environ.get("DB_CONNECTION_INIT_SQL"))
+
+
+queue_on_contention = _GetFlag("TRANSFER_QUEUE_ON_CONTENTION", "false")
+transfer_events = _GetFlag("TRANSFER_EVENTS", "false")
+# The in-memory ledger replaces Postgres and everything that maintains it.
+memory_ledger = None
+if os.environ.get("LEDGER_BACKEND", "postgres") == "memory":
+  for name in ["SHARD_DATASOURCES", "REPLICA_DATASOURCES"]:
+    if os.environ.get(name):
+      raise ValueError(f"{name} can't be used with LEDGER_BACKEND=memory.")
+  if int(os.environ.get("USER_CACHE_MAX_SIZE", "0")) > 0:
+    raise ValueError("The user cache can't be used with LEDGER_BACKEND=memory.")
+  if transfer_events:
+    raise ValueError(
+        "TRANSFER_EVENTS can't be used with LEDGER_BACKEND=memory.")
+  memory_ledger = MemoryLedger(
+      os.environ["MEMORY_LEDGER_DIR"],
+      float(os.environ.get("MEMORY_LEDGER_SNAPSHOT_INTERVAL_SECONDS", "300")),
+      _GetFlag("MEMORY_LEDGER_FSYNC", "true"))
+  datasource_names = []
+else:
+  # DATASOURCE is the first shard.
+  datasource_names = [os.environ["DATASOURCE"]] + os.environ.get(
+      "SHARD_DATASOURCES", "").split()
+shards = [
+    PostgreSQLClient(
+        datasource_name,
+        use_transfer_function=_GetFlag("USE_TRANSFER_FUNCTION", "true"),
+        lock_timeout_ms=(
+            int(os.environ.get("TRANSFER_LOCK_TIMEOUT_MS", "100"))
+            if queue_on_contention else None),
+        pool_config=_GetPoolConfig(),
+        notify_transfers=transfer_events)
+    for datasource_name in datasource_names]
+sharded_client = None
+sql_client = memory_ledger or shards[0]
+if len(shards) > 1:
+  sharded_client = ShardedPostgreSQLClient(
+      shards,
+      float(os.environ.get("SHARD_RECOVERY_INTERVAL_SECONDS", "60")))
+  sql_client = sharded_client
+replica_reader = None
+if os.environ.get("REPLICA_DATASOURCES"):
+  # Replicas of the single database; shards would each need their own.
+  if sharded_client:
+    raise ValueError("REPLICA_DATASOURCES can't be used with shards.")
+  replica_reader = ReplicaReader(
+      sql_client,
+      [PostgreSQLClient(datasource_name, pool_config=_GetPoolConfig())
+       for datasource_name in os.environ["REPLICA_DATASOURCES"].split()],
+      float(os.environ.get("REPLICA_MAX_LAG_SECONDS", "10")),
+      float(os.environ.get("REPLICA_READ_WAIT_MS", "50")),
+      float(os.environ.get("REPLICA_CHECK_INTERVAL_SECONDS", "1")))
+transfer_client = sql_client
+contention_client = None
+if queue_on_contention:
+  contention_client = ContentionAwareTransferClient(
+      transfer_client,
+      int(os.environ.get("TRANSFER_LOCK_STRIPES", "1024")),
+      int(os.environ.get("TRANSFER_MAX_RETRIES", "3")),
+      float(os.environ.get("TRANSFER_RETRY_BACKOFF_MS", "5")))
+  transfer_client = contention_client
+transfer_scheduler = None
+if _GetFlag("TRANSFER_GROUP_COMMIT", "false"):
+  transfer_scheduler = TransferScheduler(
+      transfer_client,
+      int(os.environ.get("TRANSFER_GROUP_COMMIT_MAX_SIZE", "100")),
+      float(os.environ.get("TRANSFER_GROUP_COMMIT_MAX_DELAY_MS", "2")))
+  transfer_client = transfer_scheduler
+# Cache misses read from the primary, so that a balance read from a lagging
+# replica can't be cached after its invalidation.
+user_cache = None
+if int(os.environ.get("USER_CACHE_MAX_SIZE", "0")) > 0:
+  user_cache = UserCache(
+      sql_client,
+      int(os.environ["USER_CACHE_MAX_SIZE"]),
+      float(os.environ.get("USER_CACHE_TTL_SECONDS", "5")))
+idempotency_key_cache = IdempotencyKeyCache(
+    sql_client,
+    int(os.environ.get("IDEMPOTENCY_KEY_CACHE_SIZE", "10000")),
+    float(os.environ.get("IDEMPOTENCY_KEY_TTL_SECONDS", "86400")))
+# Archives of several shards go to subdirectories named by shard index.
+partition_maintainers = [
+    TransferPartitionMaintainer(
+        datasource_name,
+        int(os.environ.get("TRANSFER_PARTITIONS_AHEAD_MONTHS", "3")),
+        int(os.environ.get("TRANSFER_RETENTION_MONTHS", "0")),
+        os.environ.get("TRANSFER_ARCHIVE_DIR") and (
+            os.path.join(os.environ["TRANSFER_ARCHIVE_DIR"], str(index))
+            if len(datasource_names) > 1
+            else os.environ["TRANSFER_ARCHIVE_DIR"]),
+        float(os.environ.get(
+            "TRANSFER_PARTITION_MAINTENANCE_INTERVAL_SECONDS", "3600")))
+    for index, datasource_name in enumerate(datasource_names)]
+# The in-memory ledger finds past balances from its index of transfers.
+balance_checkpointer = None
+if not memory_ledger:
+  balance_checkpointer = BalanceCheckpointer(
+      sql_client,
+      float(os.environ.get("BALANCE_CHECKPOINT_INTERVAL_SECONDS", "300")),
+      int(os.environ.get("BALANCE_CHECKPOINT_MIN_TRANSFERS", "1")),
+      float(os.environ.get("BALANCE_CHECKPOINT_SETTLE_SECONDS", "60")))
+balance_slot_consolidator = None
+consolidation_interval = float(os.environ.get(
+    "BALANCE_SLOT_CONSOLIDATION_INTERVAL_SECONDS", "60"))
+if not memory_ledger and consolidation_interval > 0:
+  balance_slot_consolidator = BalanceSlotConsolidator(
+      sql_client, consolidation_interval)
+transfer_rollup_updater = None
+rollup_interval = float(os.environ.get(
+    "TRANSFER_ROLLUP_INTERVAL_SECONDS", "60"))
+if not memory_ledger and rollup_interval > 0:
+  transfer_rollup_updater = TransferRollupUpdater(
+      sql_client, rollup_interval,
+      float(os.environ.get("TRANSFER_ROLLUP_SETTLE_SECONDS", "60")))
+# One LISTEN connection per worker feeds all of its event streams.
+event_hub = None
+if transfer_events:
+  event_hub = TransferEventHub(
+      sql_client,
+      int(os.environ.get("TRANSFER_EVENTS_MAX_QUEUED_EVENTS",
+                         str(DEFAULT_MAX_QUEUED_EVENTS))))
+# Off unless ADMISSION_MAX_IN_FLIGHT is set; pool acquire timeouts
+# (DB_POOL_ACQUIRE_TIMEOUT_SECONDS) get 503s either way.
+admission_controller = None
+if int(os.environ.get("ADMISSION_MAX_IN_FLIGHT", "0")) > 0:
+  admission_controller = AdmissionController(
+      int(os.environ["ADMISSION_MAX_IN_FLIGHT"]),
+      {
+          PRIORITY_TRANSFER: int(
+              os.environ.get("ADMISSION_MAX_QUEUED_TRANSFERS", "100")),
+          PRIORITY_READ: int(
+              os.environ.get("ADMISSION_MAX_QUEUED_READS", "100")),
+      },
+      float(os.environ.get("ADMISSION_MAX_WAIT_MS", "100")),
+      int(os.environ.get("ADMISSION_RETRY_AFTER_SECONDS", "1")))
+# Off unless TRACE_FILE is set. Slow requests are traced whatever the sample
+# rate.
+tracer = None
+if os.environ.get("TRACE_FILE"):
+  tracer = Tracer(
+      os.environ["TRACE_FILE"],
+      float(os.environ.get("TRACE_SAMPLE_RATE", "0.01")),
+      float(os.environ.get("TRACE_SLOW_REQUEST_MS", "1000")),
+      int(os.environ.get("TRACE_FILE_MAX_BYTES", "104857600")),
+      int(os.environ.get("TRACE_FILE_BACKUP_COUNT", "5")))
+ledger_api = LedgerAPI(
+    int(os.environ["DEFAULT_BALANCE"]), sql_client, transfer_client,
+    user_cache,
+    int(os.environ.get("MAX_USERS_PER_REQUEST",
+                       str(DEFAULT_MAX_USERS_PER_REQUEST))),
+    idempotency_key_cache, replica_reader, event_hub, admission_controller)
 app = Quart(__name__)
-app = cors(app, allow_origin="*")
+app = cors(app, allow_origin="*", expose_headers=[LSN_HEADER])
+
+if not memory_ledger:
+  REGISTRY.Register(Gauge(
+      "ledger_db_pool_connections", "Open connections in the pool.",
+      lambda: sql_client.PoolStats()["size"]))
+  REGISTRY.Register(Gauge(
+      "ledger_db_pool_idle_connections", "Idle connections in the pool.",
+      lambda: sql_client.PoolStats()["idle"]))
+if admission_controller:
+  REGISTRY.Register(Gauge(
+      "ledger_admission_in_flight", "Admitted requests working on the DB.",
+      lambda: admission_controller.Stats()["inFlight"]))
+  REGISTRY.Register(Gauge(
+      "ledger_admission_queued", "Requests waiting to be admitted.",
+      lambda: sum(admission_controller.Stats()["queued"].values())))
+if replica_reader:
+  REGISTRY.Register(Gauge(
+      "ledger_db_replicas_healthy", "Replicas that reads can go to.",
+      lambda: sum(
+          replica["healthy"]
+          for replica in replica_reader.Stats()["replicas"])))
+  REGISTRY.Register(Gauge(
+      "ledger_db_replica_max_lag_seconds",
+      "How far the furthest behind replica is.",
+      lambda: max(
+          replica["lagSeconds"] or 0
+          for replica in replica_reader.Stats()["replicas"])))
 
 
 @app.before_serving
 async def SetUp():  
-  await sql_client.CreateConnectionPool()
-  with open(app.root_path + "/" + os.environ["SCHEMA_PATH"]) as file:
-    await sql_client.ApplyMigrations(file.read())
+  if memory_ledger:
+    await memory_ledger.Open()
+  else:
+    await sql_client.CreateConnectionPool()
+  # Off when python -m ledger.migrations runs ahead of deploys.
+  if not memory_ledger and _GetFlag("MIGRATE_ON_START", "true"):
+    await sql_client.ApplyMigrations(LoadMigrations())
+  if replica_reader:
+    await replica_reader.Start()
+  if sharded_client:
+    sharded_client.Start()
+  if contention_client:
+    contention_client.Start()
+  if user_cache:
+    await user_cache.Start()
+  if event_hub:
+    await event_hub.Start()
+  if transfer_scheduler:
+    transfer_scheduler.Start()
+  idempotency_key_cache.Start()
+  for partition_maintainer in partition_maintainers:
+    partition_maintainer.Start()
+  if balance_checkpointer:
+    balance_checkpointer.Start()
+  if balance_slot_consolidator:
+    balance_slot_consolidator.Start()
+  if transfer_rollup_updater:
+    transfer_rollup_updater.Start()
 
 @app.after_serving
 async def Shutdown():  
-  await sql_client.CloseConnectionPool()
+  if transfer_rollup_updater:
+    await transfer_rollup_updater.Close()
+  if balance_slot_consolidator:
+    await balance_slot_consolidator.Close()
+  if balance_checkpointer:
+    await balance_checkpointer.Close()
+  for partition_maintainer in partition_maintainers:
+    await partition_maintainer.Close()
+  await idempotency_key_cache.Close()
+  if transfer_scheduler:
+    await transfer_scheduler.Close()
+  if sharded_client:
+    await sharded_client.Close()
+  if replica_reader:
+    await replica_reader.Close()
+  if memory_ledger:
+    await memory_ledger.Close()
+  else:
+    await sql_client.CloseConnectionPool()
+  if tracer:
+    tracer.Close()
+
+@app.before_request
+async def StartRequestTimer():
+  g.request_start = time.monotonic()
+  if tracer:
+    g.trace = tracer.Start(
+        f"{request.method} {request.endpoint or 'unmatched'}",
+        request.headers.get(TRACEPARENT_HEADER),
+        **{"http.method": request.method, "http.path": request.path})
+
+# Registered first so that it runs last, after the other after_request
+# functions.
+@app.after_request
+async def FinishTrace(response):
+  if tracer and "trace" in g:
+    tracer.Finish(g.trace, **{"http.status_code": response.status_code})
+  return response
+
+@app.after_request
+async def RecordRequestMetrics(response):
+  # Streamed responses are timed until their headers are ready.
+  route = request.endpoint or "unmatched"
+  REQUESTS.Inc(route=route, method=request.method, status=response.status_code)
+  REQUEST_SECONDS.Observe(
+      time.monotonic() - g.request_start, route=route, method=request.method)
+  return response
+
+@app.after_request
+async def AddLsnHeader(response):
+  # The primary's WAL position after a write, which clients send back with
+  # their reads to see the write on replicas.
+  if (replica_reader and request.method == "POST"
+      and response.status_code < 400):
+    try:
+      response.headers[LSN_HEADER] = FormatLsn(
+          await replica_reader.FetchWalLsn())
+    except Exception as e:
+      logging.exception(e)
+  return response
+
+
+def _Admitted(priority):
+  # Streams and routes that don't use the database aren't admitted.
+  def Decorator(route):
+    @functools.wraps(route)
+    async def AdmittedRoute(*args, **kwargs):
+      if not admission_controller:
+        return await route(*args, **kwargs)
+      try:
+        async with admission_controller.Admit(priority):
+          return await route(*args, **kwargs)
+      except OverloadedException as e:
+        return OverloadedResponse(e)
+    return AdmittedRoute
+  return Decorator
 
 
 @app.post("/users")
+@_Admitted(PRIORITY_TRANSFER)
 async def CreateUser():
   return await ledger_api.CreateUser()
 
+@app.post("/users/batch")
+@_Admitted(PRIORITY_TRANSFER)
+async def CreateUsers():
+  return await ledger_api.CreateUsers(request)
+
+@app.get("/users")
+@_Admitted(PRIORITY_READ)
+async def GetUsersDetails():
+  return await ledger_api.GetUsersDetails(
+      request.args.get("ids"), request.headers.get(LSN_HEADER))
+
 @app.get("/users/<user_id_str>")
+@_Admitted(PRIORITY_READ)
 async def GetUserDetails(user_id_str):
-  return await ledger_api.GetUserDetails(user_id_str)
+  return await ledger_api.GetUserDetails(
+      user_id_str, request.args.get("asOf"), request.headers.get(LSN_HEADER))
+
+@app.get("/users/<user_id_str>/transfers")
+@_Admitted(PRIORITY_READ)
+async def GetUserTransfers(user_id_str):
+  return await ledger_api.GetUserTransfers(
+      user_id_str, request.args, request.headers.get(LSN_HEADER))
+
+@app.get("/users/<user_id_str>/events")
+async def GetUserEvents(user_id_str):
+  return await ledger_api.GetUserEvents(user_id_str)
 
 @app.post("/transactions")
+@_Admitted(PRIORITY_TRANSFER)
 async def Transfer():
-  return await ledger_api.Transfer(request)
\ No newline at end of file
+  return await ledger_api.Transfer(
+      request, request.headers.get("Idempotency-Key"))
+
+@app.post("/transactions/batch")
+@_Admitted(PRIORITY_TRANSFER)
+async def TransferBatch():
+  return await ledger_api.TransferBatch(request)
+
+@app.get("/transfers/export")
+async def ExportTransfers():
+  return await ledger_api.ExportTransfers(
+      request.args, request.headers.get(LSN_HEADER))
+
+@app.get("/stats/pool")
+async def GetPoolStats():
+  return await ledger_api.GetPoolStats()
+
+@app.get("/stats/user-cache")
+async def GetUserCacheStats():
+  return await ledger_api.GetUserCacheStats()
+
+@app.get("/stats/replicas")
+async def GetReplicaStats():
+  return await ledger_api.GetReplicaStats()
+
+@app.get("/stats/volume")
+@_Admitted(PRIORITY_READ)
+async def GetTransferVolume():
+  return await ledger_api.GetTransferVolume(request.args)
+
+@app.get("/stats/top-senders")
+@_Admitted(PRIORITY_READ)
+async def GetTopSenders():
+  return await ledger_api.GetTopUsers(DIRECTION_SENT, request.args)
+
+@app.get("/stats/top-receivers")
+@_Admitted(PRIORITY_READ)
+async def GetTopReceivers():
+  return await ledger_api.GetTopUsers(DIRECTION_RECEIVED, request.args)
+
+@app.get("/stats/admission")
+async def GetAdmissionStats():
+  return await ledger_api.GetAdmissionStats()
+
+@app.get("/stats/events")
+async def GetEventStats():
+  return await ledger_api.GetEventStats()
+
+
+@app.get("/metrics")
+async def GetMetrics():
+  return REGISTRY.Render(), HTTP_STATUS_OK, {"Content-Type": CONTENT_TYPE}
@@ -0,0 +1,63 @@
+import typing
+
+
+@typing.runtime_checkable
+class LedgerBackend(typing.Protocol):
+  # The storage LedgerAPI reads and writes through. PostgreSQLClient,
+  # ShardedPostgreSQLClient and MemoryLedger implement it. Users and transfers
+  # get positive int ids and timestamps are naive datetimes in UTC. The
+  # min_lsn of reads is only for ReplicaReader, other backends ignore it.
+
+  async def InsertUser(self, balance):
+    # Returns the new user id.
+    ...
+
+  async def InsertUsers(self, balances):
+    # Returns the new user ids as [first, last] ranges.
+    ...
+
+  async def FetchUser(self, user_id, min_lsn=None):
+    # Returns a User, or None if there is no such user.
+    ...
+
+  async def FetchUsers(self, user_ids, min_lsn=None):
+    # Returns the Users that exist, in any order.
+    ...
+
+  async def FetchBalanceAsOf(self, user_id, timestamp, min_lsn=None):
+    # Returns the balance after the transfers up to and including timestamp,
+    # or None if there is no such user.
+    ...
+
+  async def FetchTransfers(self, user_id, direction, limit,
+                           before_transfer_id=None, since=None, until=None,
+                           min_lsn=None):
+    # Returns up to limit TransferRecords of the user in the direction,
+    # newest first, with since <= timestamp < until.
+    ...
+
+  async def StreamTransfers(self, since, until, chunk_size, min_lsn=None):
+    # Yields lists of the TransferRecords with since <= timestamp < until in
+    # transfer_id order.
+    ...
+
+  async def Transfer(self, user_id_from, user_id_to, amount,
+                     idempotency_key=None):
+    # Returns the transfer id, or the original one if idempotency_key is
+    # known. Raises ValueError if a user doesn't exist or they are the same,
+    # and InsufficientFundsException if user_id_from has less than amount.
+    ...
+
+  async def TransferBatch(self, transfers, idempotency_keys=None):
+    # Returns one transfer id or exception per transfer, as Transfer would,
+    # applying the transfers in order. A key repeated in the batch is a
+    # ValueError.
+    ...
+
+  async def FetchIdempotencyKeys(self, idempotency_keys):
+    # Returns {key: transfer_id} of the known keys.
+    ...
+
+  async def DeleteIdempotencyKeys(self, max_age_seconds):
+    # Returns the number of deleted keys.
+    ...
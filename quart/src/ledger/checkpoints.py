@@ -0,0 +1,25 @@
+import logging
+
+from ledger.periodic import PeriodicTask
+
+
+class BalanceCheckpointer(PeriodicTask):
+  # Writes balance checkpoints in the background every interval_seconds for
+  # the users with at least min_transfers transfers since their last one, so
+  # that balances as of a past time only replay a bounded number of transfers.
+  # Checkpoints trail the clock by settle_seconds, the longest a transfer may
+  # take to commit.
+
+  def __init__(self, sql_client, interval_seconds, min_transfers,
+               settle_seconds):
+    super().__init__(self.WriteCheckpoints, interval_seconds)
+    self._sql_client = sql_client
+    self._min_transfers = min_transfers
+    self._settle_seconds = settle_seconds
+
+  async def WriteCheckpoints(self):
+    # None means another worker wrote them.
+    written_count = await self._sql_client.WriteBalanceCheckpoints(
+        self._min_transfers, self._settle_seconds)
+    if written_count:
+      logging.info("Wrote %d balance checkpoints", written_count)
@@ -0,0 +1,58 @@
+import asyncio
+import asyncpg
+import contextlib
+import itertools
+import random
+
+
+_RETRYABLE_ERRORS = (
+    asyncpg.exceptions.LockNotAvailableError,
+    asyncpg.exceptions.SerializationError,
+    asyncpg.exceptions.DeadlockDetectedError,
+)
+
+
+class ContentionAwareTransferClient:
+  # Queues transfers that touch the same account inside the process instead of
+  # letting them bounce off each other's row locks in Postgres. Lock and
+  # serialization failures that still happen, e.g. against other workers, are
+  # retried with jittered exponential backoff.
+
+  def __init__(self, sql_client, lock_stripes, max_retries, retry_backoff_ms):
+    self._sql_client = sql_client
+    self._lock_stripes = lock_stripes
+    self._max_retries = max_retries
+    self._retry_backoff = retry_backoff_ms / 1000
+    self._locks = None
+
+  def Start(self):
+    # Locks are created here so that they bind to the serving event loop.
+    self._locks = [asyncio.Lock() for _ in range(self._lock_stripes)]
+
+  async def Transfer(self, user_id_from, user_id_to, amount,
+                     idempotency_key=None):
+    return await self._RunSerialized(
+        [user_id_from, user_id_to], self._sql_client.Transfer,
+        user_id_from, user_id_to, amount, idempotency_key)
+
+  async def TransferBatch(self, transfers, idempotency_keys=None):
+    user_ids = [
+        user_id for user_id_from, user_id_to, _ in transfers
+        for user_id in (user_id_from, user_id_to)]
+    return await self._RunSerialized(
+        user_ids, self._sql_client.TransferBatch, transfers, idempotency_keys)
+
+  async def _RunSerialized(self, user_ids, operation, *args):
+    # Stripes are taken in index order so that two transfers can't deadlock.
+    stripes = sorted({user_id % self._lock_stripes for user_id in user_ids})
+    async with contextlib.AsyncExitStack() as stack:
+      for stripe in stripes:
+        await stack.enter_async_context(self._locks[stripe])
+      for attempt in itertools.count():
+        try:
+          return await operation(*args)
+        except _RETRYABLE_ERRORS:
+          if attempt >= self._max_retries:
+            raise
+        await asyncio.sleep(
+            random.uniform(0, self._retry_backoff * 2 ** attempt))
@@ -0,0 +1,146 @@
+import asyncio
+from datetime import datetime
+import json
+import logging
+
+
+MIME_TYPE = "text/event-stream"
+# Comment lines keep idle streams open through proxies.
+HEARTBEAT_SECONDS = 15
+DEFAULT_MAX_QUEUED_EVENTS = 100
+
+
+def _FormatEvent(name, data):
+  return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+
+class Subscription:
+  # Transfer events of one user for one stream. A subscriber that falls
+  # max_queued_events behind is cut off rather than buffered without bound;
+  # its client reconnects and starts over from the current balance.
+
+  def __init__(self, user_id, max_queued_events):
+    self.user_id = user_id
+    self._events = asyncio.Queue(max_queued_events)
+    self.overflowed = False
+
+  def Put(self, event):
+    if self.overflowed:
+      return
+    try:
+      self._events.put_nowait(event)
+    except asyncio.QueueFull:
+      self.overflowed = True
+      self.End()
+
+  def End(self):
+    while not self._events.empty():
+      self._events.get_nowait()
+    # Wakes the stream up to end it.
+    self._events.put_nowait(None)
+
+  async def Get(self):
+    # Returns the next event, or None once cut off.
+    return await self._events.get()
+
+
+class TransferEventHub:
+  # Fans the transfers that the worker's LISTEN connection is notified of out
+  # to the subscriptions of their users, with the balance each user had after
+  # the transfer's transaction. Transfers only notify if the sql_client's
+  # shards were made with notify_transfers.
+
+  def __init__(self, sql_client,
+               max_queued_events=DEFAULT_MAX_QUEUED_EVENTS):
+    self._sql_client = sql_client
+    self._max_queued_events = max_queued_events
+    # user_id -> set of Subscriptions.
+    self._subscriptions = {}
+    self._events = 0
+    self._overflows = 0
+
+  async def Start(self):
+    await self._sql_client.ListenForTransfers(
+        self._OnNotification, self._OnInterruption)
+
+  def Subscribe(self, user_id):
+    subscription = Subscription(user_id, self._max_queued_events)
+    self._subscriptions.setdefault(user_id, set()).add(subscription)
+    return subscription
+
+  def Unsubscribe(self, subscription):
+    subscriptions = self._subscriptions.get(subscription.user_id)
+    if subscriptions is None:
+      return
+    subscriptions.discard(subscription)
+    if not subscriptions:
+      del self._subscriptions[subscription.user_id]
+
+  def Stats(self):
+    return {
+        "users": len(self._subscriptions),
+        "subscriptions": sum(map(len, self._subscriptions.values())),
+        "events": self._events,
+        "overflows": self._overflows,
+    }
+
+  def _OnInterruption(self):
+    # Transfers may have been missed, so every stream ends, and its client
+    # reconnects and starts over from the current balance, like after an
+    # overflow.
+    for subscriptions in list(self._subscriptions.values()):
+      for subscription in list(subscriptions):
+        subscription.End()
+        self.Unsubscribe(subscription)
+
+  def _OnNotification(self, connection, pid, channel, payload):
+    try:
+      transfer = json.loads(payload)
+      event = {
+          "transferId": transfer["transferId"],
+          # Formatted like the other endpoints' timestamps.
+          "timestamp": datetime.fromisoformat(
+              transfer["timestamp"]).isoformat(),
+          "userIdFrom": transfer["userIdFrom"],
+          "userIdTo": transfer["userIdTo"],
+          "amount": transfer["amount"],
+      }
+      balances = [
+          (transfer["userIdFrom"], transfer["balanceFrom"]),
+          (transfer["userIdTo"], transfer["balanceTo"])]
+    except (ValueError, KeyError, TypeError) as e:
+      logging.exception(e)
+      return
+    for user_id, balance in balances:
+      # The shard of the other user sends its balance.
+      if balance is None:
+        continue
+      for subscription in list(self._subscriptions.get(user_id, ())):
+        self._events += 1
+        subscription.Put({**event, "balance": balance})
+        if subscription.overflowed:
+          self._overflows += 1
+          self.Unsubscribe(subscription)
+
+
+async def StreamUserEvents(event_hub, user, subscription):
+  # Yields a balance event with the user's current balance, then a transfer
+  # event per transfer of the user with their balance after it. The
+  # subscription was made before user was read, so no transfer falls in
+  # between, but transfers around the read may come after the balance that
+  # includes them.
+  try:
+    yield _FormatEvent(
+        "balance", {"userId": user.user_id, "balance": user.balance})
+    while True:
+      try:
+        event = await asyncio.wait_for(
+            subscription.Get(), HEARTBEAT_SECONDS)
+      except asyncio.TimeoutError:
+        yield ": heartbeat\n\n"
+        continue
+      if event is None:
+        return
+      yield _FormatEvent("transfer", event)
+  finally:
+    event_hub.Unsubscribe(subscription)
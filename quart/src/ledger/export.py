@@ -0,0 +1,78 @@
+from ledger.sql_client import PostgreSQLClient
+
+import argparse
+import asyncio
+import csv
+from datetime import datetime
+import io
+import json
+import os
+import sys
+
+
+FORMAT_NDJSON = "ndjson"
+FORMAT_CSV = "csv"
+MIME_TYPES = {
+    FORMAT_NDJSON: "application/x-ndjson",
+    FORMAT_CSV: "text/csv",
+}
+DEFAULT_CHUNK_SIZE = 10000
+
+_CSV_HEADER = ["transferId", "timestamp", "userIdFrom", "userIdTo", "amount"]
+
+
+def _ToJson(transfer):
+  return json.dumps({
+      "transferId": transfer.transfer_id,
+      "timestamp": transfer.timestamp.isoformat(),
+      "userIdFrom": transfer.user_id_from,
+      "userIdTo": transfer.user_id_to,
+      "amount": transfer.amount
+  })
+
+def _ToCsv(rows):
+  buffer = io.StringIO()
+  csv.writer(buffer).writerows(rows)
+  return buffer.getvalue()
+
+
+async def FormatTransfers(chunks, export_format):
+  # Turns chunks from PostgreSQLClient.StreamTransfers into one bytes object
+  # per chunk, so memory use is bounded by the chunk size.
+  if export_format == FORMAT_CSV:
+    yield _ToCsv([_CSV_HEADER]).encode()
+  async for transfers in chunks:
+    if export_format == FORMAT_CSV:
+      text = _ToCsv(
+          [transfer.transfer_id, transfer.timestamp.isoformat(),
+           transfer.user_id_from, transfer.user_id_to, transfer.amount]
+          for transfer in transfers)
+    else:
+      text = "".join(_ToJson(transfer) + "\n" for transfer in transfers)
+    yield text.encode()
+
+
+async def Main():
+  parser = argparse.ArgumentParser(
+      description="Exports transfers of a time range to stdout.")
+  parser.add_argument("--since", required=True, type=datetime.fromisoformat,
+                      help="inclusive start, UTC, ISO 8601")
+  parser.add_argument("--until", required=True, type=datetime.fromisoformat,
+                      help="exclusive end, UTC, ISO 8601")
+  parser.add_argument("--format", choices=list(MIME_TYPES),
+                      default=FORMAT_NDJSON)
+  parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+  args = parser.parse_args()
+
+  sql_client = PostgreSQLClient(os.environ["DATASOURCE"])
+  await sql_client.CreateConnectionPool()
+  try:
+    chunks = sql_client.StreamTransfers(args.since, args.until, args.chunk_size)
+    async for data in FormatTransfers(chunks, args.format):
+      sys.stdout.buffer.write(data)
+  finally:
+    await sql_client.CloseConnectionPool()
+
+
+if __name__ == "__main__":
+  asyncio.run(Main())
@@ -0,0 +1,79 @@
+from ledger.model import ReplayedTransferId
+
+import asyncio
+import collections
+import logging
+import time
+
+
+MAX_KEY_LENGTH = 255
+# Expired keys are deleted from Postgres at most this long after they expire.
+_PURGE_INTERVAL_SECONDS = 60
+
+
+class IdempotencyKeyCache:
+  # Bounded LRU of idempotency keys of committed transfers in front of the
+  # transfer_idempotency_keys table, so that replays of recent requests are
+  # answered without a DB round trip. Requests with a key that is still in
+  # flight in this process wait for its result instead of running again. The
+  # table stays the source of truth; keys are purged from it after ttl_seconds.
+
+  def __init__(self, sql_client, max_size, ttl_seconds):
+    self._sql_client = sql_client
+    self._max_size = max_size
+    self._ttl = ttl_seconds
+    self._entries = collections.OrderedDict()
+    self._in_flight = {}
+    self._purger = None
+
+  def Start(self):
+    self._purger = asyncio.create_task(self._PurgeExpiredKeys())
+
+  async def Close(self):
+    self._purger.cancel()
+    try:
+      await self._purger
+    except asyncio.CancelledError:
+      pass
+
+  async def Run(self, idempotency_key, transfer):
+    # transfer is called without arguments and returns the new transfer id.
+    # Requests that didn't run it get a ReplayedTransferId.
+    transfer_id = self._Get(idempotency_key)
+    if transfer_id is not None:
+      return ReplayedTransferId(transfer_id)
+
+    task = self._in_flight.get(idempotency_key)
+    replayed = task is not None
+    if not task:
+      task = asyncio.ensure_future(transfer())
+      self._in_flight[idempotency_key] = task
+      task.add_done_callback(
+          lambda _: self._in_flight.pop(idempotency_key, None))
+    # Shielded, so a cancelled request doesn't cancel the others waiting.
+    transfer_id = await asyncio.shield(task)
+    self.Put(idempotency_key, transfer_id)
+    return ReplayedTransferId(transfer_id) if replayed else transfer_id
+
+  def Put(self, idempotency_key, transfer_id):
+    if not self._max_size:
+      return
+    self._entries[idempotency_key] = (transfer_id, time.monotonic() + self._ttl)
+    self._entries.move_to_end(idempotency_key)
+    if len(self._entries) > self._max_size:
+      self._entries.popitem(last=False)
+
+  def _Get(self, idempotency_key):
+    entry = self._entries.get(idempotency_key)
+    if entry and entry[1] > time.monotonic():
+      self._entries.move_to_end(idempotency_key)
+      return entry[0]
+    return None
+
+  async def _PurgeExpiredKeys(self):
+    while True:
+      await asyncio.sleep(min(self._ttl, _PURGE_INTERVAL_SECONDS))
+      try:
+        await self._sql_client.DeleteIdempotencyKeys(self._ttl)
+      except Exception as e:
+        logging.exception(e)
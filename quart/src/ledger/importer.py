@@ -0,0 +1,236 @@
+import argparse
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import csv
+from datetime import datetime, timezone
+import json
+import logging
+import os
+
+import asyncpg
+
+
+USERS = "users"
+TRANSFERS = "transfers"
+
+# Staging tables are unlogged and index-free so that loading them is as cheap
+# as Postgres allows. They only live for the duration of an import.
+_CREATE_STAGING_TABLES = '''
+    DROP TABLE IF EXISTS import_users, import_transfers;
+    CREATE UNLOGGED TABLE import_users (
+      user_id BIGINT NOT NULL,
+      balance BIGINT NOT NULL
+    );
+    CREATE UNLOGGED TABLE import_transfers (
+      transfer_timestamp TIMESTAMP NOT NULL,
+      user_id_from BIGINT NOT NULL,
+      user_id_to BIGINT NOT NULL,
+      amount BIGINT NOT NULL
+    );'''
+_STAGING_COLUMNS = {
+    USERS: ("import_users", ["user_id", "balance"]),
+    TRANSFERS: ("import_transfers",
+                ["transfer_timestamp", "user_id_from", "user_id_to", "amount"]),
+}
+# Checks run before anything is merged; each query returns a sample of
+# offending rows.
+_CHECKS = {
+    "duplicate user ids": '''
+        SELECT user_id FROM import_users
+        GROUP BY user_id HAVING count(*) > 1 LIMIT 10''',
+    "users that already exist": '''
+        SELECT user_id FROM import_users JOIN users USING (user_id) LIMIT 10''',
+    "negative opening balances": '''
+        SELECT user_id FROM import_users WHERE balance < 0 LIMIT 10''',
+    "invalid transfers": '''
+        SELECT user_id_from, user_id_to, amount FROM import_transfers
+        WHERE amount <= 0 OR user_id_from = user_id_to LIMIT 10''',
+    "transfers of unknown users": '''
+        SELECT user_id FROM (
+          SELECT user_id_from AS user_id FROM import_transfers
+          UNION SELECT user_id_to FROM import_transfers
+        ) AS transfer_users
+        WHERE NOT EXISTS (
+            SELECT 1 FROM import_users WHERE import_users.user_id =
+                transfer_users.user_id)
+          AND NOT EXISTS (
+            SELECT 1 FROM users WHERE users.user_id = transfer_users.user_id)
+        LIMIT 10''',
+}
+
+
+def _ReadRows(path):
+  with open(path, newline="") as file:
+    if path.endswith(".csv"):
+      yield from csv.DictReader(file)
+    else:
+      for line in file:
+        if line.strip():
+          yield json.loads(line)
+
+def _ParseTimestamp(timestamp_str):
+  # Stored in UTC without a time zone, like timestamps of the API.
+  timestamp = datetime.fromisoformat(timestamp_str)
+  if timestamp.tzinfo:
+    timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+  return timestamp
+
+def ReadRecords(kind, path):
+  # Files use the field names of the API, e.g. userId and balance for users,
+  # userIdFrom, userIdTo, amount and timestamp for transfers. Users' balances
+  # are their balances before the imported transfers. Timestamps without
+  # offset are UTC.
+  for row in _ReadRows(path):
+    if kind == USERS:
+      yield int(row["userId"]), int(row["balance"])
+    else:
+      yield (_ParseTimestamp(row["timestamp"]), int(row["userIdFrom"]),
+             int(row["userIdTo"]), int(row["amount"]))
+
+
+async def _LoadFileAsync(datasource_name, kind, path):
+  table_name, columns = _STAGING_COLUMNS[kind]
+  connection = await asyncpg.connect(dsn=datasource_name)
+  try:
+    result = await connection.copy_records_to_table(
+        table_name, records=ReadRecords(kind, path), columns=columns)
+    return int(result.split()[-1])
+  finally:
+    await connection.close()
+
+def _LoadFile(datasource_name, kind, path):
+  # Runs in a worker process, so files are parsed in parallel.
+  return asyncio.run(_LoadFileAsync(datasource_name, kind, path))
+
+
+async def _Merge(connection):
+  for problem, query in _CHECKS.items():
+    rows = await connection.fetch(query)
+    if rows:
+      raise ValueError(
+          f"Import has {problem}: {[tuple(row) for row in rows]}")
+
+  # Secondary indexes are dropped for the load and rebuilt in one pass
+  # afterwards, which is much cheaper than maintaining them row by row.
+  index_definitions = await connection.fetch('''
+      SELECT indexname, indexdef FROM pg_indexes
+      WHERE schemaname = current_schema() AND tablename = 'transfers'
+        AND indexname NOT IN (
+          SELECT conname FROM pg_constraint
+          WHERE conrelid = 'transfers'::regclass)''')
+  for index in index_definitions:
+    await connection.execute(f'DROP INDEX "{index["indexname"]}"')
+
+  await connection.execute('''
+      INSERT INTO users (user_id, balance)
+      SELECT user_id, balance FROM import_users''')
+  await connection.execute('''
+      SELECT setval(pg_get_serial_sequence('users', 'user_id'),
+                    (SELECT max(user_id) FROM users))
+      WHERE EXISTS (SELECT 1 FROM import_users)''')
+  await connection.execute('''
+      SELECT create_transfer_partitions(
+          min(transfer_timestamp), max(transfer_timestamp))
+      FROM import_transfers''')
+  await connection.execute('''
+      INSERT INTO transfers
+          (transfer_timestamp, user_id_from, user_id_to, amount)
+      SELECT transfer_timestamp, user_id_from, user_id_to, amount
+      FROM import_transfers ORDER BY transfer_timestamp''')
+
+  # Reconcile balances with the imported transfers.
+  overdrawn = await connection.fetch('''
+      WITH reconciled AS (
+        UPDATE users SET balance = users.balance + net.amount
+        FROM (
+          SELECT user_id, sum(amount) AS amount FROM (
+            SELECT user_id_to AS user_id, amount FROM import_transfers
+            UNION ALL
+            SELECT user_id_from, -amount FROM import_transfers
+          ) AS legs
+          GROUP BY user_id
+        ) AS net
+        WHERE users.user_id = net.user_id
+        RETURNING users.user_id, users.balance
+      )
+      SELECT user_id, balance FROM reconciled WHERE balance < 0 LIMIT 10''')
+  if overdrawn:
+    raise ValueError(
+        "Imported transfers overdraw users: "
+        f"{[tuple(row) for row in overdrawn]}")
+
+  # Checkpoints from after the first imported transfer left it out.
+  await connection.execute('''
+      DELETE FROM balance_checkpoints
+      WHERE checkpoint_timestamp >= (
+          SELECT min(transfer_timestamp) FROM import_transfers)
+        AND user_id IN (
+          SELECT user_id_from FROM import_transfers
+          UNION SELECT user_id_to FROM import_transfers)''')
+
+  # Rollups from the day of the first imported transfer on left it out. They
+  # are dropped and rolled up again from there, which the lock keeps a
+  # rollup round from doing at the same time.
+  await connection.execute(
+      "SELECT pg_advisory_xact_lock(hashtext('transfer_rollups'))")
+  rollup_start = await connection.fetchval('''
+      SELECT date_trunc('day', min(transfer_timestamp)) FROM import_transfers
+      HAVING min(transfer_timestamp) < (
+          SELECT rolled_up_until FROM transfer_rollup_progress)''')
+  if rollup_start is not None:
+    for table in ("transfer_volume", "user_transfer_volume"):
+      await connection.execute(
+          f"DELETE FROM {table} WHERE bucket_start >= $1", rollup_start)
+    await connection.execute(
+        "UPDATE transfer_rollup_progress SET rolled_up_until = $1",
+        rollup_start)
+
+  for index in index_definitions:
+    # Indexes of the partitioned table are listed as ON ONLY transfers, which
+    # would leave out the partitions.
+    await connection.execute(
+        index["indexdef"].replace(" ON ONLY ", " ON ", 1))
+
+
+async def Import(datasource_name, user_paths, transfer_paths, jobs):
+  # Loads the files into staging tables in parallel, then merges them into
+  # users and transfers in a single transaction.
+  connection = await asyncpg.connect(dsn=datasource_name)
+  try:
+    await connection.execute(_CREATE_STAGING_TABLES)
+    loop = asyncio.get_running_loop()
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+      counts = await asyncio.gather(*[
+          loop.run_in_executor(
+              executor, _LoadFile, datasource_name, kind, path)
+          for kind, paths in ((USERS, user_paths), (TRANSFERS, transfer_paths))
+          for path in paths])
+    logging.info("Staged %d rows from %d files", sum(counts), len(counts))
+
+    async with connection.transaction():
+      await _Merge(connection)
+    await connection.execute("ANALYZE users, transfers")
+  finally:
+    await connection.execute(
+        "DROP TABLE IF EXISTS import_users, import_transfers")
+    await connection.close()
+
+
+def Main():
+  parser = argparse.ArgumentParser(
+      description="Imports users and transfers from CSV or NDJSON files.")
+  parser.add_argument("--users", nargs="*", default=[],
+                      help="files with userId and opening balance")
+  parser.add_argument("--transfers", nargs="*", default=[],
+                      help="files with userIdFrom, userIdTo, amount, timestamp")
+  parser.add_argument("--jobs", type=int, default=os.cpu_count(),
+                      help="files loaded in parallel")
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.INFO)
+  asyncio.run(Import(
+      os.environ["DATASOURCE"], args.users, args.transfers, args.jobs))
+
+
+if __name__ == "__main__":
+  Main()
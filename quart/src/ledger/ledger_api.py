@@ -1,15 +1,57 @@
-from ledger.model import InsufficientFundsException
+from ledger.events import MIME_TYPE as EVENTS_MIME_TYPE, StreamUserEvents
+from ledger.export import (
+    DEFAULT_CHUNK_SIZE, FORMAT_NDJSON, MIME_TYPES, FormatTransfers)
+from ledger.idempotency import MAX_KEY_LENGTH
+from ledger.metrics import INSUFFICIENT_FUNDS, TRANSFER_AMOUNT, TRANSFERS
+from ledger.model import (
+    DIRECTION_ALL, DIRECTION_RECEIVED, DIRECTION_SENT, GRANULARITIES,
+    GRANULARITY_DAY, GRANULARITY_HOUR, GRANULARITY_MINUTE,
+    MAX_ROLLUP_BUCKETS, InsufficientFundsException, OverloadedException,
+    ReplayedTransferId, User)
+from ledger.replicas import ParseLsn
+from ledger.tracing import Span
 
+from datetime import datetime, timezone
+import asyncio
 import json
 import logging
+import re
 from quart.wrappers import Response
 
 
 HTTP_STATUS_OK = 200
 HTTP_STATUS_CREATED = 201
 HTTP_STATUS_BAD_REQUEST = 400
+HTTP_STATUS_NOT_FOUND = 404
 HTTP_STATUS_SERVER_ERROR = 500
+HTTP_STATUS_SERVICE_UNAVAILABLE = 503
 
+MAX_TRANSFER_BATCH_SIZE = 10000
+MAX_USERS_PER_BULK_CREATE = 100000
+DEFAULT_MAX_USERS_PER_REQUEST = 1000
+DEFAULT_TRANSFERS_PAGE_SIZE = 100
+MAX_TRANSFERS_PAGE_SIZE = 1000
+DEFAULT_VOLUME_BUCKETS = 24
+DEFAULT_TOP_USERS = 10
+DEFAULT_TOP_USERS_WINDOW = "24h"
+MAX_TOP_USERS = 1000
+# Windows of top users are whole minutes, hours or days, e.g. 15m or 7d.
+_WINDOW_PATTERN = re.compile(r"(\d+)([mhd])")
+_WINDOW_GRANULARITIES = {
+    "m": GRANULARITY_MINUTE, "h": GRANULARITY_HOUR, "d": GRANULARITY_DAY}
+
+
+def OverloadedResponse(e):
+  return Response(
+      status=HTTP_STATUS_SERVICE_UNAVAILABLE,
+      headers={"Retry-After": str(e.retry_after_seconds)})
+
+def _ErrorResponse(e):
+  # Overload is expected under load and is retried by clients, not logged.
+  if isinstance(e, OverloadedException):
+    return OverloadedResponse(e)
+  logging.exception(e)
+  return Response(status=HTTP_STATUS_SERVER_ERROR)
 
 def _ValidatePositiveInt(int_str):
   try:
@@ -18,6 +60,47 @@ def _ValidatePositiveInt(int_str):
   except:
     return False, None 
 
+def _ValidateNonNegativeInt(int_str):
+  try:
+    number = int(int_str)
+    return number >= 0, number
+  except:
+    return False, None
+
+def _ValidateTimestamp(timestamp_str):
+  # transfer_timestamp holds UTC without a time zone, see
+  # 0006_utc_timestamps.sql.
+  try:
+    timestamp = datetime.fromisoformat(timestamp_str)
+    if timestamp.tzinfo:
+      timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return True, timestamp
+  except:
+    return False, None
+
+def _ValidateLsn(lsn_str):
+  # No LSN to wait for is valid too.
+  if lsn_str is None:
+    return True, None
+  try:
+    return True, ParseLsn(lsn_str)
+  except ValueError:
+    return False, None
+
+def _ValidateWindow(window_str):
+  # Returns the granularity and number of buckets of the window.
+  match = _WINDOW_PATTERN.fullmatch(window_str)
+  if not match:
+    return False, None, None
+  bucket_count = int(match[1])
+  if not 0 < bucket_count <= MAX_ROLLUP_BUCKETS:
+    return False, None, None
+  return True, _WINDOW_GRANULARITIES[match[2]], bucket_count
+
+def _ValidateIdempotencyKey(idempotency_key):
+  return (isinstance(idempotency_key, str)
+          and 0 < len(idempotency_key) <= MAX_KEY_LENGTH)
+
 def _DisallowDuplicateKeys(pairs):
   result = {}
   for key, val in pairs:
@@ -26,28 +109,114 @@ def _DisallowDuplicateKeys(pairs):
     result[key] = val
   return result
 
+def _ParseTransfer(json_data):
+  if not isinstance(json_data, dict):
+    return None
+
+  is_ok_user_id_from, user_id_from = _ValidatePositiveInt(
+      json_data.get('userIdFrom', ''))
+  if not is_ok_user_id_from:
+    return None
+
+  is_ok_user_id_to, user_id_to = _ValidatePositiveInt(
+      json_data.get('userIdTo', ''))
+  if not is_ok_user_id_to:
+    return None
+
+  is_ok_amount, amount = _ValidatePositiveInt(json_data.get('amount', ''))
+  if not is_ok_amount:
+    return None
+
+  if user_id_from == user_id_to:
+    return None
+
+  return user_id_from, user_id_to, amount
+
 
 class LedgerAPI:
 
-  def __init__(self, default_balance, sql_client):
+  def __init__(self, default_balance, sql_client, transfer_client=None,
+               user_cache=None,
+               max_users_per_request=DEFAULT_MAX_USERS_PER_REQUEST,
+               idempotency_key_cache=None, replica_reader=None,
+               event_hub=None, admission_controller=None):
     self._default_balance = default_balance
+    self._max_users_per_request = max_users_per_request
+    # A LedgerBackend, see ledger/backend.py.
     self._sql_client = sql_client
+    # Transfers may go through a wrapper of sql_client, e.g. the group-commit
+    # scheduler.
+    self._transfer_client = transfer_client or sql_client
+    self._user_cache = user_cache
+    # Reads may go to replicas, writes always go to sql_client.
+    self._reader = replica_reader or sql_client
+    self._replica_reader = replica_reader
+    self._user_reader = user_cache or self._reader
+    self._idempotency_key_cache = idempotency_key_cache
+    self._event_hub = event_hub
+    # Admits requests in app.py; only its stats are served here.
+    self._admission_controller = admission_controller
 
   async def CreateUser(self):
     try:
       user_id = await self._sql_client.InsertUser(self._default_balance)
+      if self._user_cache:
+        self._user_cache.Put(User(user_id, self._default_balance))
       return str(user_id), HTTP_STATUS_CREATED
     except Exception as e:
-      logging.exception(e)
-      return Response(status=HTTP_STATUS_SERVER_ERROR)
+      return _ErrorResponse(e)
 
-  async def GetUserDetails(self, user_id_str):    
+  async def CreateUsers(self, request):
+    data = await request.get_data()
+    try:
+      json_data = json.loads(data, object_pairs_hook=_DisallowDuplicateKeys)
+    except ValueError:
+      return Response(status=HTTP_STATUS_BAD_REQUEST)
+    if not isinstance(json_data, dict) or len(json_data) != 1:
+      return Response(status=HTTP_STATUS_BAD_REQUEST)
+
+    if "count" in json_data:
+      is_count_valid, count = _ValidatePositiveInt(json_data["count"])
+      if not is_count_valid or count > MAX_USERS_PER_BULK_CREATE:
+        return Response(status=HTTP_STATUS_BAD_REQUEST)
+      balances = [self._default_balance] * count
+    elif "balances" in json_data:
+      balances = json_data["balances"]
+      if (not isinstance(balances, list) or not balances
+          or len(balances) > MAX_USERS_PER_BULK_CREATE):
+        return Response(status=HTTP_STATUS_BAD_REQUEST)
+      for i, balance_str in enumerate(balances):
+        is_balance_valid, balances[i] = _ValidateNonNegativeInt(balance_str)
+        if not is_balance_valid:
+          return Response(status=HTTP_STATUS_BAD_REQUEST)
+    else:
+      return Response(status=HTTP_STATUS_BAD_REQUEST)
+
+    try:
+      user_id_ranges = await self._sql_client.InsertUsers(balances)
+      return {"userIdRanges": user_id_ranges}, HTTP_STATUS_CREATED
+    except Exception as e:
+      return _ErrorResponse(e)
+
+  async def GetUserDetails(self, user_id_str, as_of_str=None, lsn_str=None):
+    # lsn_str is the Ledger-LSN of the client's last write, which the read
+    # has to see.
     is_user_id_valid, user_id = _ValidatePositiveInt(user_id_str)
     if not is_user_id_valid:
       return Response(status=HTTP_STATUS_BAD_REQUEST)
+    is_lsn_valid, min_lsn = _ValidateLsn(lsn_str)
+    if not is_lsn_valid:
+      return Response(status=HTTP_STATUS_BAD_REQUEST)
+
+    if as_of_str is not None:
+      return await self._GetUserBalanceAsOf(user_id, as_of_str, min_lsn)
 
     try:
-      user = await self._sql_client.FetchUser(user_id)
+      if min_lsn is None:
+        user = await self._user_reader.FetchUser(user_id)
+      else:
+        # Other workers' caches may not have dropped the user yet.
+        user = await self._reader.FetchUser(user_id, min_lsn=min_lsn)
       if not user:
         return Response(status=HTTP_STATUS_BAD_REQUEST)
 
@@ -56,43 +225,357 @@ class LedgerAPI:
           "balance": user.balance
       }
     except Exception as e:
-      logging.exception(e)
-      return Response(status=HTTP_STATUS_SERVER_ERROR)
+      return _ErrorResponse(e)
 
-  async def Transfer(self, request):    
-    data = await request.get_data()    
-    json_data = None
-    try:      
-      json_data = json.loads(data, object_pairs_hook=_DisallowDuplicateKeys)
-      print("data:", data, json_data)
-    except ValueError:
+  async def _GetUserBalanceAsOf(self, user_id, as_of_str, min_lsn):
+    # Past balances are computed in Postgres, never read from the user cache.
+    is_timestamp_valid, as_of = _ValidateTimestamp(as_of_str)
+    if not is_timestamp_valid:
+      return Response(status=HTTP_STATUS_BAD_REQUEST)
+
+    try:
+      balance = await self._reader.FetchBalanceAsOf(
+          user_id, as_of, min_lsn=min_lsn)
+      if balance is None:
+        return Response(status=HTTP_STATUS_BAD_REQUEST)
+
+      return {
+          "userId": user_id,
+          "balance": balance,
+          "asOf": as_of.isoformat()
+      }
+    except Exception as e:
+      return _ErrorResponse(e)
+
+  async def GetUsersDetails(self, user_ids_str, lsn_str=None):
+    if not user_ids_str:
       return Response(status=HTTP_STATUS_BAD_REQUEST)
-    
-    is_ok_user_id_from, user_id_from = _ValidatePositiveInt(
-        json_data.get('userIdFrom', ''))
-    if not is_ok_user_id_from:
+    is_lsn_valid, min_lsn = _ValidateLsn(lsn_str)
+    if not is_lsn_valid:
       return Response(status=HTTP_STATUS_BAD_REQUEST)
 
-    is_ok_user_id_to, user_id_to = _ValidatePositiveInt(
-        json_data.get('userIdTo', ''))
-    if not is_ok_user_id_to:
+    user_ids = []
+    for user_id_str in user_ids_str.split(","):
+      is_user_id_valid, user_id = _ValidatePositiveInt(user_id_str)
+      if not is_user_id_valid:
+        return Response(status=HTTP_STATUS_BAD_REQUEST)
+      user_ids.append(user_id)
+    user_ids = list(dict.fromkeys(user_ids))
+    if len(user_ids) > self._max_users_per_request:
       return Response(status=HTTP_STATUS_BAD_REQUEST)
 
-    is_ok_amount, amount = _ValidatePositiveInt(json_data.get('amount', ''))
-    if not is_ok_amount:
+    try:
+      if min_lsn is None:
+        users = await self._user_reader.FetchUsers(user_ids)
+      else:
+        users = await self._reader.FetchUsers(user_ids, min_lsn=min_lsn)
+      users = {user.user_id: user for user in users}
+      # Users that don't exist are left out.
+      return {
+          "users": [
+              {"userId": user_id, "balance": users[user_id].balance}
+              for user_id in user_ids if user_id in users]
+      }
+    except Exception as e:
+      return _ErrorResponse(e)
+
+  async def GetUserTransfers(self, user_id_str, args, lsn_str=None):
+    is_user_id_valid, user_id = _ValidatePositiveInt(user_id_str)
+    if not is_user_id_valid:
+      return Response(status=HTTP_STATUS_BAD_REQUEST)
+    is_lsn_valid, min_lsn = _ValidateLsn(lsn_str)
+    if not is_lsn_valid:
       return Response(status=HTTP_STATUS_BAD_REQUEST)
 
-    if user_id_from == user_id_to:
+    direction = args.get("direction", DIRECTION_ALL)
+    if direction not in (DIRECTION_ALL, DIRECTION_SENT, DIRECTION_RECEIVED):
       return Response(status=HTTP_STATUS_BAD_REQUEST)
-    
+
+    is_limit_valid, limit = _ValidatePositiveInt(
+        args.get("limit", DEFAULT_TRANSFERS_PAGE_SIZE))
+    if not is_limit_valid or limit > MAX_TRANSFERS_PAGE_SIZE:
+      return Response(status=HTTP_STATUS_BAD_REQUEST)
+
+    cursor = None
+    if "cursor" in args:
+      is_cursor_valid, cursor = _ValidatePositiveInt(args["cursor"])
+      if not is_cursor_valid:
+        return Response(status=HTTP_STATUS_BAD_REQUEST)
+
+    time_range = {}
+    for name in ("since", "until"):
+      if name in args:
+        is_timestamp_valid, time_range[name] = _ValidateTimestamp(args[name])
+        if not is_timestamp_valid:
+          return Response(status=HTTP_STATUS_BAD_REQUEST)
+
+    try:
+      # One extra row tells whether there is a next page.
+      transfers = await self._reader.FetchTransfers(
+          user_id, direction, limit + 1, before_transfer_id=cursor,
+          min_lsn=min_lsn, **time_range)
+    except Exception as e:
+      return _ErrorResponse(e)
+
+    next_cursor = None
+    if len(transfers) > limit:
+      transfers = transfers[:limit]
+      next_cursor = transfers[-1].transfer_id
+    return {
+        "transfers": [
+            {
+                "transferId": transfer.transfer_id,
+                "timestamp": transfer.timestamp.isoformat(),
+                "userIdFrom": transfer.user_id_from,
+                "userIdTo": transfer.user_id_to,
+                "amount": transfer.amount
+            }
+            for transfer in transfers],
+        "nextCursor": next_cursor
+    }
+
+  async def GetUserEvents(self, user_id_str):
+    if not self._event_hub:
+      return Response(status=HTTP_STATUS_NOT_FOUND)
+    is_user_id_valid, user_id = _ValidatePositiveInt(user_id_str)
+    if not is_user_id_valid:
+      return Response(status=HTTP_STATUS_BAD_REQUEST)
+
+    # Subscribed first, so that no transfer is missed after the read. The
+    # read goes to the primary, which the notifications come from.
+    subscription = self._event_hub.Subscribe(user_id)
+    try:
+      user = await self._sql_client.FetchUser(user_id)
+    except Exception as e:
+      self._event_hub.Unsubscribe(subscription)
+      return _ErrorResponse(e)
+    if not user:
+      self._event_hub.Unsubscribe(subscription)
+      return Response(status=HTTP_STATUS_BAD_REQUEST)
+
+    response = Response(
+        StreamUserEvents(self._event_hub, user, subscription),
+        mimetype=EVENTS_MIME_TYPE)
+    response.headers["Cache-Control"] = "no-cache"
+    # Streams stay open until the client goes away.
+    response.timeout = None
+    return response
+
+  async def ExportTransfers(self, args, lsn_str=None):
+    export_format = args.get("format", FORMAT_NDJSON)
+    if export_format not in MIME_TYPES:
+      return Response(status=HTTP_STATUS_BAD_REQUEST)
+    is_lsn_valid, min_lsn = _ValidateLsn(lsn_str)
+    if not is_lsn_valid:
+      return Response(status=HTTP_STATUS_BAD_REQUEST)
+
+    time_range = []
+    for name in ("since", "until"):
+      is_timestamp_valid, timestamp = _ValidateTimestamp(args.get(name))
+      if not is_timestamp_valid:
+        return Response(status=HTTP_STATUS_BAD_REQUEST)
+      time_range.append(timestamp)
+
+    # Rows are sent as they are read; an error halfway through can only cut
+    # the response short.
+    chunks = self._reader.StreamTransfers(
+        *time_range, DEFAULT_CHUNK_SIZE, min_lsn=min_lsn)
+    response = Response(
+        FormatTransfers(chunks, export_format),
+        mimetype=MIME_TYPES[export_format])
+    # Large exports take longer than the default response timeout.
+    response.timeout = None
+    return response
+
+  async def Transfer(self, request, idempotency_key=None):
+    # The idempotency key comes from the Idempotency-Key header or the
+    # idempotencyKey field of the body.
+    with Span("read_body"):
+      data = await request.get_data()
+    json_data = None
+    try:
+      with Span("parse_json"):
+        json_data = json.loads(
+            data, object_pairs_hook=_DisallowDuplicateKeys)
+    except ValueError:
+      return Response(status=HTTP_STATUS_BAD_REQUEST)
+
+    with Span("validate"):
+      transfer = _ParseTransfer(json_data)
+      if not transfer:
+        return Response(status=HTTP_STATUS_BAD_REQUEST)
+      user_id_from, user_id_to, amount = transfer
+
+      if "idempotencyKey" in json_data:
+        if idempotency_key not in (None, json_data["idempotencyKey"]):
+          return Response(status=HTTP_STATUS_BAD_REQUEST)
+        idempotency_key = json_data["idempotencyKey"]
+      if (idempotency_key is not None
+          and not _ValidateIdempotencyKey(idempotency_key)):
+        return Response(status=HTTP_STATUS_BAD_REQUEST)
+
+    async def RunTransfer():
+      return await self._transfer_client.Transfer(
+          user_id_from, user_id_to, amount, idempotency_key=idempotency_key)
+
     try:
-      transfer_id = await self._sql_client.Transfer(
-          user_id_from, user_id_to, amount)      
+      if idempotency_key is not None and self._idempotency_key_cache:
+        transfer_id = await self._idempotency_key_cache.Run(
+            idempotency_key, RunTransfer)
+      else:
+        transfer_id = await RunTransfer()
+      if not isinstance(transfer_id, ReplayedTransferId):
+        TRANSFERS.Inc()
+        TRANSFER_AMOUNT.Inc(amount)
+      if self._user_cache:
+        self._user_cache.Invalidate([user_id_from, user_id_to])
       return {"transferId": transfer_id}, HTTP_STATUS_OK
     except ValueError:
       return Response(status=HTTP_STATUS_BAD_REQUEST)
     except InsufficientFundsException:
+      INSUFFICIENT_FUNDS.Inc()
       return "Insufficient funds.", HTTP_STATUS_BAD_REQUEST
     except Exception as e:
-      logging.exception(e)      
-      return Response(status=HTTP_STATUS_SERVER_ERROR)
+      return _ErrorResponse(e)
+
+  async def TransferBatch(self, request):
+    with Span("read_body"):
+      data = await request.get_data()
+    try:
+      with Span("parse_json"):
+        json_data = json.loads(
+            data, object_pairs_hook=_DisallowDuplicateKeys)
+    except ValueError:
+      return Response(status=HTTP_STATUS_BAD_REQUEST)
+
+    with Span("validate"):
+      if (not isinstance(json_data, list) or not json_data
+          or len(json_data) > MAX_TRANSFER_BATCH_SIZE):
+        return Response(status=HTTP_STATUS_BAD_REQUEST)
+
+      transfers = [_ParseTransfer(leg) for leg in json_data]
+      valid_transfers = [transfer for transfer in transfers if transfer]
+    results = []
+    try:
+      if valid_transfers:
+        results = await self._sql_client.TransferBatch(valid_transfers)
+    except Exception as e:
+      return _ErrorResponse(e)
+
+    if self._user_cache:
+      self._user_cache.Invalidate(
+          user_id
+          for (user_id_from, user_id_to, _), result
+          in zip(valid_transfers, results)
+          if not isinstance(result, Exception)
+          for user_id in (user_id_from, user_id_to))
+
+    results = iter(results)
+    response = []
+    for transfer in transfers:
+      result = next(results) if transfer else ValueError()
+      if isinstance(result, ValueError):
+        response.append({"error": "Invalid arguments."})
+      elif isinstance(result, InsufficientFundsException):
+        INSUFFICIENT_FUNDS.Inc()
+        response.append({"error": "Insufficient funds."})
+      elif isinstance(result, Exception):
+        # Only transfers across shards fail on their own.
+        logging.exception(result)
+        response.append({"error": "Transfer failed."})
+      else:
+        if not isinstance(result, ReplayedTransferId):
+          TRANSFERS.Inc()
+          TRANSFER_AMOUNT.Inc(transfer[2])
+        response.append({"transferId": result})
+    return {"results": response}, HTTP_STATUS_OK
+
+  async def GetPoolStats(self):
+    # Only backends on Postgres have a connection pool.
+    if not hasattr(self._sql_client, "PoolStats"):
+      return Response(status=HTTP_STATUS_NOT_FOUND)
+    return self._sql_client.PoolStats(), HTTP_STATUS_OK
+
+  async def GetTransferVolume(self, args):
+    # Read from the rollups only, which trail the clock; rolledUpUntil tells
+    # how far.
+    if not hasattr(self._sql_client, "FetchTransferVolume"):
+      return Response(status=HTTP_STATUS_NOT_FOUND)
+    granularity = args.get("bucket", GRANULARITY_HOUR)
+    if granularity not in GRANULARITIES:
+      return Response(status=HTTP_STATUS_BAD_REQUEST)
+    is_limit_valid, limit = _ValidatePositiveInt(
+        args.get("limit", DEFAULT_VOLUME_BUCKETS))
+    if not is_limit_valid or limit > MAX_ROLLUP_BUCKETS:
+      return Response(status=HTTP_STATUS_BAD_REQUEST)
+
+    try:
+      rolled_up_until, buckets = await asyncio.gather(
+          self._sql_client.FetchRollupProgress(),
+          self._sql_client.FetchTransferVolume(granularity, limit))
+    except Exception as e:
+      return _ErrorResponse(e)
+    return {
+        "bucket": granularity,
+        "rolledUpUntil": rolled_up_until and rolled_up_until.isoformat(),
+        "buckets": [
+            {
+                "bucketStart": bucket.bucket_start.isoformat(),
+                "transferCount": bucket.transfer_count,
+                "amount": bucket.amount
+            }
+            for bucket in buckets]
+    }, HTTP_STATUS_OK
+
+  async def GetTopUsers(self, direction, args):
+    # The window is the latest buckets of its unit, including the one being
+    # rolled up, e.g. 24h is the current hour and the 23 before it.
+    if not hasattr(self._sql_client, "FetchTopUsers"):
+      return Response(status=HTTP_STATUS_NOT_FOUND)
+    window_str = args.get("window", DEFAULT_TOP_USERS_WINDOW)
+    is_window_valid, granularity, bucket_count = _ValidateWindow(window_str)
+    if not is_window_valid:
+      return Response(status=HTTP_STATUS_BAD_REQUEST)
+    is_limit_valid, limit = _ValidatePositiveInt(
+        args.get("limit", DEFAULT_TOP_USERS))
+    if not is_limit_valid or limit > MAX_TOP_USERS:
+      return Response(status=HTTP_STATUS_BAD_REQUEST)
+
+    try:
+      rolled_up_until, users = await asyncio.gather(
+          self._sql_client.FetchRollupProgress(),
+          self._sql_client.FetchTopUsers(
+              direction, granularity, bucket_count, limit))
+    except Exception as e:
+      return _ErrorResponse(e)
+    return {
+        "window": window_str,
+        "rolledUpUntil": rolled_up_until and rolled_up_until.isoformat(),
+        "users": [
+            {
+                "userId": user.user_id,
+                "transferCount": user.transfer_count,
+                "amount": user.amount
+            }
+            for user in users]
+    }, HTTP_STATUS_OK
+
+  async def GetUserCacheStats(self):
+    if not self._user_cache:
+      return Response(status=HTTP_STATUS_NOT_FOUND)
+    return self._user_cache.Stats(), HTTP_STATUS_OK
+
+  async def GetReplicaStats(self):
+    if not self._replica_reader:
+      return Response(status=HTTP_STATUS_NOT_FOUND)
+    return self._replica_reader.Stats(), HTTP_STATUS_OK
+
+  async def GetAdmissionStats(self):
+    if not self._admission_controller:
+      return Response(status=HTTP_STATUS_NOT_FOUND)
+    return self._admission_controller.Stats(), HTTP_STATUS_OK
+
+  async def GetEventStats(self):
+    if not self._event_hub:
+      return Response(status=HTTP_STATUS_NOT_FOUND)
+    return self._event_hub.Stats(), HTTP_STATUS_OK
@@ -0,0 +1,546 @@
+from ledger.metrics import WAL_FLUSH_SECONDS
+from ledger.model import (
+    DIRECTION_RECEIVED, DIRECTION_SENT, InsufficientFundsException,
+    ReplayedTransferId, TransferRecord, User)
+
+from array import array
+import asyncio
+import bisect
+from datetime import datetime, timedelta
+import fcntl
+import json
+import logging
+import os
+import re
+import struct
+import sys
+import time
+import zlib
+
+
+_EPOCH = datetime(1970, 1, 1)
+_SEGMENT_PATTERN = re.compile(r"wal-(\d+)\.log")
+_SNAPSHOT_PATTERN = re.compile(r"snapshot-(\d+)\.bin")
+# Entries of the log are their length and CRC-32, then their records. The
+# records of an entry are recovered all or none.
+_ENTRY_HEADER = struct.Struct("<II")
+# b"U", number of users, then their int64 balances.
+_USERS_RECORD = struct.Struct("<cI")
+# b"T", user_id_from, user_id_to, amount, timestamp in microseconds since the
+# epoch, length of the UTF-8 idempotency key, then the key.
+_TRANSFER_RECORD = struct.Struct("<cqqqqH")
+
+
+def _SegmentName(segment):
+  return f"wal-{segment:010d}.log"
+
+
+def _SnapshotName(segment):
+  return f"snapshot-{segment:010d}.bin"
+
+
+def _ToMicroseconds(timestamp):
+  return (timestamp - _EPOCH) // timedelta(microseconds=1)
+
+
+def _FromMicroseconds(microseconds):
+  return _EPOCH + timedelta(microseconds=microseconds)
+
+
+def _PackTransfer(user_id_from, user_id_to, amount, timestamp,
+                  idempotency_key):
+  key = idempotency_key.encode() if idempotency_key is not None else b""
+  return _TRANSFER_RECORD.pack(
+      b"T", user_id_from, user_id_to, amount, timestamp, len(key)) + key
+
+
+class MemoryLedger:
+  # A ledger in the memory of this process, for single node deployments and
+  # load tests without a round trip to a database. Balances and transfers are
+  # int64 arrays indexed by id - 1. Every change is applied in memory, then
+  # appended to a write-ahead log in directory and returned once the log is
+  # written and, with fsync, synced. Changes that arrive during a sync are
+  # written and synced together by the next one. Every
+  # snapshot_interval_seconds the state goes to a snapshot and the log before
+  # it is deleted. Open recovers the latest snapshot and replays the log after
+  # it, dropping an entry torn by a crash.
+  #
+  # Reads may see a change before it is durable. The log has the changes in
+  # the order they were applied, so a crash never keeps a change without the
+  # ones before it. Only one process can open a directory.
+
+  def __init__(self, directory, snapshot_interval_seconds=300, fsync=True):
+    self._directory = directory
+    self._snapshot_interval = snapshot_interval_seconds
+    self._fsync = fsync
+    self._balances = array("q")
+    self._users_from = array("q")
+    self._users_to = array("q")
+    self._amounts = array("q")
+    # Microseconds since the epoch, never decreasing.
+    self._timestamps = array("q")
+    # Per user, None until their first transfer, then the indexes of their
+    # transfers in order.
+    self._user_transfers = []
+    # {key: (transfer_id, created_at)}, oldest first.
+    self._idempotency_keys = {}
+    # The segment of the log new changes go to; the flusher thread switches
+    # self._file to it when it reaches the rotation.
+    self._segment = 0
+    self._file = None
+    self._lock_file = None
+    self._pending = []
+    self._last_logged = None
+    self._logged_since_snapshot = False
+    self._wake = asyncio.Event()
+    self._snapshot_lock = asyncio.Lock()
+    self._error = None
+    self._closing = False
+    self._flusher = None
+    self._snapshotter = None
+
+  async def Open(self):
+    os.makedirs(self._directory, exist_ok=True)
+    self._lock_file = open(self._Path("LOCK"), "w")
+    try:
+      fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+      self._lock_file.close()
+      raise ValueError(f"{self._directory} is open in another process.")
+    await asyncio.to_thread(self._Recover)
+    self._file = open(self._Path(_SegmentName(self._segment)), "ab")
+    self._flusher = asyncio.create_task(self._RunFlusher())
+    if self._snapshot_interval > 0:
+      self._snapshotter = asyncio.create_task(self._RunSnapshots())
+
+  async def Close(self):
+    if self._snapshotter:
+      self._snapshotter.cancel()
+      try:
+        await self._snapshotter
+      except asyncio.CancelledError:
+        pass
+    # Whatever is pending is still written.
+    self._closing = True
+    self._wake.set()
+    await self._flusher
+    self._file.close()
+    self._lock_file.close()
+
+  async def InsertUser(self, balance):
+    user_id_ranges = await self.InsertUsers([balance])
+    return user_id_ranges[0][0]
+
+  async def InsertUsers(self, balances):
+    self._CheckWritable()
+    if not balances:
+      return []
+    # Raises OverflowError before anything changes.
+    new_balances = array("q", balances)
+    first_user_id = len(self._balances) + 1
+    self._ApplyUsers(new_balances)
+    await self._Log(
+        _USERS_RECORD.pack(b"U", len(new_balances))
+        + struct.pack(f"<{len(new_balances)}q", *new_balances))
+    return [[first_user_id, first_user_id + len(new_balances) - 1]]
+
+  async def FetchUser(self, user_id, min_lsn=None):
+    if not self._HasUser(user_id):
+      return None
+    return User(user_id, self._balances[user_id - 1])
+
+  async def FetchUsers(self, user_ids, min_lsn=None):
+    return [
+        User(user_id, self._balances[user_id - 1])
+        for user_id in dict.fromkeys(user_ids) if self._HasUser(user_id)]
+
+  async def FetchBalanceAsOf(self, user_id, timestamp, min_lsn=None):
+    # Goes back from the current balance over the transfers after timestamp.
+    if not self._HasUser(user_id):
+      return None
+    balance = self._balances[user_id - 1]
+    indexes = self._user_transfers[user_id - 1] or ()
+    start = bisect.bisect_right(
+        indexes, _ToMicroseconds(timestamp),
+        key=self._timestamps.__getitem__)
+    for position in range(start, len(indexes)):
+      index = indexes[position]
+      if self._users_to[index] == user_id:
+        balance -= self._amounts[index]
+      else:
+        balance += self._amounts[index]
+    return balance
+
+  async def FetchTransfers(self, user_id, direction, limit,
+                           before_transfer_id=None, since=None, until=None,
+                           min_lsn=None):
+    # Newest first. A user's transfers are in transfer_id and timestamp
+    # order, so the bounds are binary searches.
+    if not self._HasUser(user_id) or not self._user_transfers[user_id - 1]:
+      return []
+    indexes = self._user_transfers[user_id - 1]
+    end = len(indexes)
+    if before_transfer_id is not None:
+      end = bisect.bisect_left(indexes, before_transfer_id - 1)
+    if until is not None:
+      end = bisect.bisect_left(
+          indexes, _ToMicroseconds(until), hi=end,
+          key=self._timestamps.__getitem__)
+    start = 0
+    if since is not None:
+      start = bisect.bisect_left(
+          indexes, _ToMicroseconds(since), hi=end,
+          key=self._timestamps.__getitem__)
+
+    transfers = []
+    for position in range(end - 1, start - 1, -1):
+      if len(transfers) == limit:
+        break
+      index = indexes[position]
+      if direction == DIRECTION_SENT and self._users_from[index] != user_id:
+        continue
+      if direction == DIRECTION_RECEIVED and self._users_to[index] != user_id:
+        continue
+      transfers.append(self._TransferRecord(index))
+    return transfers
+
+  async def StreamTransfers(self, since, until, chunk_size, min_lsn=None):
+    # Transfers made during the export are left out.
+    start = bisect.bisect_left(self._timestamps, _ToMicroseconds(since))
+    end = bisect.bisect_left(self._timestamps, _ToMicroseconds(until))
+    for chunk_start in range(start, end, chunk_size):
+      yield [
+          self._TransferRecord(index)
+          for index in range(chunk_start, min(chunk_start + chunk_size, end))]
+
+  async def Transfer(self, user_id_from, user_id_to, amount,
+                     idempotency_key=None):
+    self._CheckWritable()
+    if not self._IsValidTransfer(user_id_from, user_id_to):
+      raise ValueError("Invalid arguments.")
+    if idempotency_key in self._idempotency_keys:
+      # The original transfer may still be on its way to the log.
+      await self._WaitForLog()
+      return ReplayedTransferId(self._idempotency_keys[idempotency_key][0])
+    if self._balances[user_id_from - 1] < amount:
+      raise InsufficientFundsException()
+    timestamp = self._Now()
+    transfer_id = self._ApplyTransfer(
+        user_id_from, user_id_to, amount, timestamp, idempotency_key)
+    await self._Log(_PackTransfer(
+        user_id_from, user_id_to, amount, timestamp, idempotency_key))
+    return transfer_id
+
+  async def TransferBatch(self, transfers, idempotency_keys=None):
+    # Same results as PostgreSQLClient.TransferBatch. The applied transfers
+    # are one entry of the log.
+    self._CheckWritable()
+    idempotency_keys = idempotency_keys or [None] * len(transfers)
+    timestamp = self._Now()
+    results = []
+    records = []
+    seen_keys = set()
+    for (user_id_from, user_id_to, amount), key in zip(
+        transfers, idempotency_keys):
+      if (not self._IsValidTransfer(user_id_from, user_id_to)
+          or key in seen_keys):
+        results.append(ValueError("Invalid arguments."))
+      elif key in self._idempotency_keys:
+        results.append(ReplayedTransferId(self._idempotency_keys[key][0]))
+        seen_keys.add(key)
+      elif self._balances[user_id_from - 1] < amount:
+        results.append(InsufficientFundsException())
+      else:
+        try:
+          results.append(self._ApplyTransfer(
+              user_id_from, user_id_to, amount, timestamp, key))
+        except OverflowError as e:
+          results.append(e)
+          continue
+        records.append(_PackTransfer(
+            user_id_from, user_id_to, amount, timestamp, key))
+        if key is not None:
+          seen_keys.add(key)
+    if records:
+      await self._Log(b"".join(records))
+    else:
+      await self._WaitForLog()
+    return results
+
+  async def FetchIdempotencyKeys(self, idempotency_keys):
+    return {
+        key: self._idempotency_keys[key][0]
+        for key in idempotency_keys if key in self._idempotency_keys}
+
+  async def DeleteIdempotencyKeys(self, max_age_seconds):
+    # Deletions aren't logged: keys that come back with a recovery are
+    # deleted again by the next call.
+    created_before = time.time_ns() // 1000 - int(max_age_seconds * 1e6)
+    expired = []
+    for key, (_, created_at) in self._idempotency_keys.items():
+      if created_at >= created_before:
+        break
+      expired.append(key)
+    for key in expired:
+      del self._idempotency_keys[key]
+    return len(expired)
+
+  async def Snapshot(self):
+    # The state is dumped where the log moves on to a new segment, so the
+    # snapshot and that segment onwards have every change.
+    async with self._snapshot_lock:
+      self._CheckWritable()
+      self._segment += 1
+      segment = self._segment
+      state = self._DumpState()
+      self._logged_since_snapshot = False
+      await self._Log(segment)
+      await asyncio.to_thread(self._WriteSnapshot, segment, state)
+    logging.info("Wrote snapshot %d of %d users and %d transfers",
+                 segment, len(self._balances), len(self._amounts))
+
+  def _Path(self, name):
+    return os.path.join(self._directory, name)
+
+  def _HasUser(self, user_id):
+    return 0 < user_id <= len(self._balances)
+
+  def _IsValidTransfer(self, user_id_from, user_id_to):
+    return (user_id_from != user_id_to and self._HasUser(user_id_from)
+            and self._HasUser(user_id_to))
+
+  def _CheckWritable(self):
+    if self._error:
+      # Memory may have changes the log doesn't.
+      raise RuntimeError("The write-ahead log failed.") from self._error
+    if self._closing:
+      raise RuntimeError("The ledger is closed.")
+
+  def _Now(self):
+    now = time.time_ns() // 1000
+    return max(now, self._timestamps[-1]) if self._timestamps else now
+
+  def _TransferRecord(self, index):
+    return TransferRecord(
+        index + 1, _FromMicroseconds(self._timestamps[index]),
+        self._users_from[index], self._users_to[index], self._amounts[index])
+
+  def _ApplyUsers(self, balances):
+    self._balances.extend(balances)
+    self._user_transfers.extend([None] * len(balances))
+
+  def _ApplyTransfer(self, user_id_from, user_id_to, amount, timestamp,
+                     idempotency_key):
+    # Raises OverflowError before anything changes if the balance of
+    # user_id_to would not fit.
+    self._balances[user_id_to - 1] += amount
+    self._balances[user_id_from - 1] -= amount
+    index = len(self._amounts)
+    self._users_from.append(user_id_from)
+    self._users_to.append(user_id_to)
+    self._amounts.append(amount)
+    self._timestamps.append(timestamp)
+    for user_id in (user_id_from, user_id_to):
+      if self._user_transfers[user_id - 1] is None:
+        self._user_transfers[user_id - 1] = array("q")
+      self._user_transfers[user_id - 1].append(index)
+    transfer_id = index + 1
+    if idempotency_key is not None:
+      self._idempotency_keys[idempotency_key] = (transfer_id, timestamp)
+    return transfer_id
+
+  def _ApplyEntry(self, payload):
+    offset = 0
+    while offset < len(payload):
+      kind = payload[offset:offset + 1]
+      if kind == b"U":
+        _, count = _USERS_RECORD.unpack_from(payload, offset)
+        offset += _USERS_RECORD.size
+        self._ApplyUsers(
+            array("q", struct.unpack_from(f"<{count}q", payload, offset)))
+        offset += 8 * count
+      elif kind == b"T":
+        _, user_id_from, user_id_to, amount, timestamp, key_length = (
+            _TRANSFER_RECORD.unpack_from(payload, offset))
+        offset += _TRANSFER_RECORD.size
+        key = None
+        if key_length:
+          key = payload[offset:offset + key_length].decode()
+        offset += key_length
+        self._ApplyTransfer(user_id_from, user_id_to, amount, timestamp, key)
+      else:
+        raise ValueError(f"Unknown record {kind!r} in the write-ahead log.")
+
+  async def _Log(self, entry):
+    # Queues bytes of records, or the number of a segment to move on to, and
+    # returns once the log has them.
+    if isinstance(entry, bytes):
+      entry = _ENTRY_HEADER.pack(len(entry), zlib.crc32(entry)) + entry
+      self._logged_since_snapshot = True
+    future = asyncio.get_running_loop().create_future()
+    self._pending.append((entry, future))
+    self._last_logged = future
+    self._wake.set()
+    # A canceled caller doesn't cancel the write.
+    await asyncio.shield(future)
+
+  async def _WaitForLog(self):
+    # Returns once the log has everything queued so far.
+    if self._last_logged:
+      await asyncio.shield(self._last_logged)
+
+  async def _RunFlusher(self):
+    while self._pending or not self._closing:
+      if not self._pending:
+        await self._wake.wait()
+        self._wake.clear()
+        continue
+      pending, self._pending = self._pending, []
+      try:
+        with WAL_FLUSH_SECONDS.Time():
+          await asyncio.to_thread(
+              self._WriteLog, [entry for entry, _ in pending])
+      except Exception as e:
+        logging.exception(e)
+        self._error = e
+      for _, future in pending:
+        if future.done():
+          continue
+        if self._error:
+          future.set_exception(
+              RuntimeError("The write-ahead log failed."))
+        else:
+          future.set_result(None)
+
+  def _WriteLog(self, entries):
+    # Runs in a thread, the only one that touches self._file once open.
+    for entry in entries:
+      if isinstance(entry, int):
+        self._Sync(self._file)
+        self._file.close()
+        self._file = open(self._Path(_SegmentName(entry)), "ab")
+        self._SyncDirectory()
+      else:
+        self._file.write(entry)
+    self._Sync(self._file)
+
+  def _Sync(self, file):
+    file.flush()
+    if self._fsync:
+      os.fsync(file.fileno())
+
+  def _SyncDirectory(self):
+    # Makes created, renamed and deleted files durable.
+    if not self._fsync:
+      return
+    fd = os.open(self._directory, os.O_RDONLY)
+    try:
+      os.fsync(fd)
+    finally:
+      os.close(fd)
+
+  def _Arrays(self):
+    return [self._balances, self._users_from, self._users_to, self._amounts,
+            self._timestamps]
+
+  def _DumpState(self):
+    # Copies, so that changes while the snapshot is written don't go in.
+    header = {
+        "byteorder": sys.byteorder,
+        "users": len(self._balances),
+        "transfers": len(self._amounts),
+        "idempotencyKeys": [
+            [key, transfer_id, created_at]
+            for key, (transfer_id, created_at)
+            in self._idempotency_keys.items()],
+    }
+    return [json.dumps(header).encode() + b"\n"] + [
+        values.tobytes() for values in self._Arrays()]
+
+  def _WriteSnapshot(self, segment, state):
+    path = self._Path(_SnapshotName(segment))
+    with open(path + ".tmp", "wb") as file:
+      for part in state:
+        file.write(part)
+      self._Sync(file)
+    os.replace(path + ".tmp", path)
+    self._SyncDirectory()
+    for name in os.listdir(self._directory):
+      match = (_SEGMENT_PATTERN.fullmatch(name)
+               or _SNAPSHOT_PATTERN.fullmatch(name))
+      if match and int(match[1]) < segment:
+        os.remove(self._Path(name))
+
+  def _LoadSnapshot(self, segment):
+    with open(self._Path(_SnapshotName(segment)), "rb") as file:
+      header = json.loads(file.readline())
+      if header["byteorder"] != sys.byteorder:
+        raise ValueError("The snapshot is of a machine of another byte order.")
+      self._balances.fromfile(file, header["users"])
+      for values in self._Arrays()[1:]:
+        values.fromfile(file, header["transfers"])
+    self._user_transfers = [None] * header["users"]
+    for index in range(header["transfers"]):
+      for user_id in (self._users_from[index], self._users_to[index]):
+        if self._user_transfers[user_id - 1] is None:
+          self._user_transfers[user_id - 1] = array("q")
+        self._user_transfers[user_id - 1].append(index)
+    self._idempotency_keys = {
+        key: (transfer_id, created_at)
+        for key, transfer_id, created_at in header["idempotencyKeys"]}
+
+  def _Recover(self):
+    snapshots = []
+    segments = []
+    for name in os.listdir(self._directory):
+      if name.endswith(".tmp"):
+        # A snapshot cut short by a crash.
+        os.remove(self._Path(name))
+      elif match := _SNAPSHOT_PATTERN.fullmatch(name):
+        snapshots.append(int(match[1]))
+      elif match := _SEGMENT_PATTERN.fullmatch(name):
+        segments.append(int(match[1]))
+    first_segment = 0
+    if snapshots:
+      first_segment = max(snapshots)
+      self._LoadSnapshot(first_segment)
+    segments = sorted(
+        segment for segment in segments if segment >= first_segment)
+    if segments != list(range(first_segment, first_segment + len(segments))):
+      raise ValueError(
+          f"Segments of the write-ahead log in {self._directory} are missing.")
+    for segment in segments:
+      self._Replay(segment, segment == segments[-1])
+    self._segment = segments[-1] if segments else first_segment
+    logging.info("Recovered %d users and %d transfers from %s",
+                 len(self._balances), len(self._amounts), self._directory)
+
+  def _Replay(self, segment, is_last):
+    path = self._Path(_SegmentName(segment))
+    with open(path, "rb") as file:
+      data = file.read()
+    offset = 0
+    while offset + _ENTRY_HEADER.size <= len(data):
+      length, crc = _ENTRY_HEADER.unpack_from(data, offset)
+      start = offset + _ENTRY_HEADER.size
+      payload = data[start:start + length]
+      if len(payload) < length or zlib.crc32(payload) != crc:
+        break
+      self._ApplyEntry(payload)
+      offset = start + length
+    if offset < len(data):
+      # Only the last entry can be torn, by a crash while it was written.
+      if not is_last:
+        raise ValueError(f"{path} is corrupt at byte {offset}.")
+      logging.warning("Dropping a torn entry at byte %d of %s", offset, path)
+      os.truncate(path, offset)
+
+  async def _RunSnapshots(self):
+    while True:
+      await asyncio.sleep(self._snapshot_interval)
+      if not self._logged_since_snapshot:
+        continue
+      try:
+        await self.Snapshot()
+      except Exception as e:
+        logging.exception(e)
@@ -0,0 +1,149 @@
+from ledger.stats import Histogram, LATENCY_BUCKETS
+
+import contextlib
+import time
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _FormatLabels(label_names, label_values, extra=()):
+  pairs = list(zip(label_names, label_values)) + list(extra)
+  if not pairs:
+    return ""
+  escaped = (
+      (name, str(value).replace("\\", "\\\\").replace('"', '\\"')
+       .replace("\n", "\\n"))
+      for name, value in pairs)
+  return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Counter:
+
+  def __init__(self, name, help, label_names=()):
+    self.name = name
+    self.help = help
+    self._label_names = tuple(label_names)
+    self._values = {}
+
+  def Inc(self, amount=1, **labels):
+    key = tuple(labels[name] for name in self._label_names)
+    self._values[key] = self._values.get(key, 0) + amount
+
+  def Value(self, **labels):
+    return self._values.get(
+        tuple(labels[name] for name in self._label_names), 0)
+
+  def Render(self):
+    lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+    for key, value in self._values.items():
+      lines.append(
+          f"{self.name}{_FormatLabels(self._label_names, key)} {value}")
+    return lines
+
+
+class LabeledHistogram:
+
+  def __init__(self, name, help, label_names=(), buckets=LATENCY_BUCKETS):
+    self.name = name
+    self.help = help
+    self._label_names = tuple(label_names)
+    self._buckets = buckets
+    self._histograms = {}
+
+  def Observe(self, value, **labels):
+    key = tuple(labels[name] for name in self._label_names)
+    histogram = self._histograms.get(key)
+    if not histogram:
+      histogram = self._histograms[key] = Histogram(self._buckets)
+    histogram.Observe(value)
+
+  @contextlib.contextmanager
+  def Time(self, **labels):
+    start = time.monotonic()
+    try:
+      yield
+    finally:
+      self.Observe(time.monotonic() - start, **labels)
+
+  def Render(self):
+    lines = [f"# HELP {self.name} {self.help}",
+             f"# TYPE {self.name} histogram"]
+    for key, histogram in self._histograms.items():
+      for bound, count in zip(histogram.buckets + ("+Inf",),
+                              histogram.CumulativeCounts()):
+        labels = _FormatLabels(self._label_names, key, [("le", bound)])
+        lines.append(f"{self.name}_bucket{labels} {count}")
+      labels = _FormatLabels(self._label_names, key)
+      lines.append(f"{self.name}_sum{labels} {histogram.sum}")
+      lines.append(f"{self.name}_count{labels} {histogram.count}")
+    return lines
+
+
+class Gauge:
+  # Read from a callback at scrape time.
+
+  def __init__(self, name, help, read):
+    self.name = name
+    self.help = help
+    self._read = read
+
+  def Render(self):
+    return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge",
+            f"{self.name} {self._read()}"]
+
+
+class Registry:
+
+  def __init__(self):
+    self._metrics = []
+
+  def Register(self, metric):
+    self._metrics.append(metric)
+    return metric
+
+  def Render(self):
+    # Prometheus text exposition format.
+    return "".join(
+        line + "\n" for metric in self._metrics for line in metric.Render())
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.Register(Counter(
+    "ledger_http_requests_total", "HTTP requests by route and status.",
+    ["route", "method", "status"]))
+REQUEST_SECONDS = REGISTRY.Register(LabeledHistogram(
+    "ledger_http_request_duration_seconds",
+    "Time to produce the HTTP response.", ["route", "method"]))
+STATEMENT_SECONDS = REGISTRY.Register(LabeledHistogram(
+    "ledger_sql_statement_duration_seconds",
+    "Round trip time of SQL statements.", ["statement"]))
+TRANSFERS = REGISTRY.Register(Counter(
+    "ledger_transfers_total", "Committed transfers."))
+TRANSFER_AMOUNT = REGISTRY.Register(Counter(
+    "ledger_transfer_amount_total", "Tokens moved by committed transfers."))
+INSUFFICIENT_FUNDS = REGISTRY.Register(Counter(
+    "ledger_insufficient_funds_total",
+    "Transfers rejected for insufficient funds."))
+LOCK_BOUNCES = REGISTRY.Register(Counter(
+    "ledger_lock_bounces_total",
+    "Transfers that failed to get a row lock in Postgres."))
+DB_READS = REGISTRY.Register(Counter(
+    "ledger_db_reads_total",
+    "Reads that could go to a replica, by the database that served them.",
+    ["target"]))
+WAL_FLUSH_SECONDS = REGISTRY.Register(LabeledHistogram(
+    "ledger_wal_flush_duration_seconds",
+    "Time to write and sync a batch of the in-memory ledger's log."))
+ADMISSION_REJECTIONS = REGISTRY.Register(Counter(
+    "ledger_admission_rejections_total",
+    "Requests rejected with 503 by admission control.",
+    ["priority", "reason"]))
+ADMISSION_WAIT_SECONDS = REGISTRY.Register(LabeledHistogram(
+    "ledger_admission_wait_seconds",
+    "Time requests waited in the admission queues.", ["priority"]))
+TRACES_WRITTEN = REGISTRY.Register(Counter(
+    "ledger_traces_written_total",
+    "Request traces written to the trace file, by why they were kept.",
+    ["reason"]))
@@ -0,0 +1,79 @@
+from ledger.sharding import ShardedPostgreSQLClient
+from ledger.sql_client import PostgreSQLClient
+
+import argparse
+import asyncio
+from dataclasses import dataclass
+import logging
+import os
+import re
+
+
+MIGRATIONS_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "sql", "migrations")
+# Migrations are files named <version>_<name>.sql, applied in version order.
+_FILE_NAME_PATTERN = re.compile(r"(\d+)_(\w+)\.sql")
+# First line of migrations that can't run in a transaction, such as
+# CREATE INDEX CONCURRENTLY. Postgres runs a script of several statements in
+# one transaction anyway, so they should hold a single statement.
+NO_TRANSACTION_MARKER = "-- migration: no transaction"
+
+
+@dataclass
+class Migration:
+  version: int
+  name: str
+  sql: str
+  in_transaction: bool = True
+
+
+def LoadMigrations(directory=MIGRATIONS_DIR):
+  migrations = []
+  for file_name in os.listdir(directory):
+    match = _FILE_NAME_PATTERN.fullmatch(file_name)
+    if not match:
+      continue
+    with open(os.path.join(directory, file_name)) as file:
+      sql = file.read()
+    migrations.append(Migration(
+        int(match[1]), match[2], sql,
+        not sql.startswith(NO_TRANSACTION_MARKER)))
+  migrations.sort(key=lambda migration: migration.version)
+  versions = [migration.version for migration in migrations]
+  if len(set(versions)) != len(versions):
+    raise ValueError(f"Duplicate migration versions in {directory}.")
+  return migrations
+
+
+async def Main():
+  parser = argparse.ArgumentParser(
+      description="Applies pending schema migrations to DATASOURCE and the "
+                  "databases in SHARD_DATASOURCES, e.g. ahead of a deploy.")
+  parser.add_argument("--dir", default=MIGRATIONS_DIR,
+                      help="directory of <version>_<name>.sql files")
+  parser.add_argument("--list", action="store_true",
+                      help="only list the pending migrations")
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.INFO)
+  migrations = LoadMigrations(args.dir)
+  shards = [
+      PostgreSQLClient(datasource_name)
+      for datasource_name in [os.environ["DATASOURCE"]] + os.environ.get(
+          "SHARD_DATASOURCES", "").split()]
+  sql_client = (
+      ShardedPostgreSQLClient(shards) if len(shards) > 1 else shards[0])
+  await sql_client.CreateConnectionPool()
+  try:
+    if args.list:
+      for migration in await sql_client.FetchPendingMigrations(migrations):
+        print(f"{migration.version}_{migration.name}")
+    else:
+      await sql_client.ApplyMigrations(migrations)
+  finally:
+    await sql_client.CloseConnectionPool()
+
+
+if __name__ == "__main__":
+  asyncio.run(Main())
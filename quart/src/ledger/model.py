@@ -1,9 +1,58 @@
 from dataclasses import dataclass
+from datetime import datetime
+
+# Directions of a user's transfer history.
+DIRECTION_SENT = "sent"
+DIRECTION_RECEIVED = "received"
+DIRECTION_ALL = "all"
+# Bucket sizes of transfer rollups, as Postgres' date_trunc() names them.
+GRANULARITY_MINUTE = "minute"
+GRANULARITY_HOUR = "hour"
+GRANULARITY_DAY = "day"
+GRANULARITIES = (GRANULARITY_MINUTE, GRANULARITY_HOUR, GRANULARITY_DAY)
+# The stats endpoints read at most this many of the latest buckets, so minute
+# and hour rollups are pruned past it.
+MAX_ROLLUP_BUCKETS = 1000
+PRUNED_GRANULARITIES = (GRANULARITY_MINUTE, GRANULARITY_HOUR)
 
 @dataclass
 class User:
   user_id : int
   balance: int
 
+@dataclass
+class TransferRecord:
+  transfer_id: int
+  timestamp: datetime
+  user_id_from: int
+  user_id_to: int
+  amount: int
+
+@dataclass
+class VolumeBucket:
+  bucket_start: datetime
+  transfer_count: int
+  amount: int
+
+@dataclass
+class UserVolume:
+  user_id: int
+  transfer_count: int
+  amount: int
+
 class InsufficientFundsException(Exception):
     pass
+
+class OverloadedException(TimeoutError):
+  # The worker has more work than it can take on; the client should retry
+  # after retry_after_seconds. A TimeoutError, like the pool timeouts it
+  # stands for.
+
+  def __init__(self, retry_after_seconds=1):
+    super().__init__("Overloaded.")
+    self.retry_after_seconds = retry_after_seconds
+
+class ReplayedTransferId(int):
+  # Transfer id returned for an idempotency key that an earlier request
+  # committed: the transfer wasn't repeated, so it isn't counted again.
+  pass
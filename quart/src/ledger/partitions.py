@@ -0,0 +1,144 @@
+import argparse
+import asyncio
+from datetime import datetime
+import gzip
+import logging
+import os
+import re
+
+import asyncpg
+
+from ledger.periodic import PeriodicTask
+
+
+# Keeps maintenance from queueing up behind long transactions while holding
+# its place in the lock queue, which would block transfers. It runs again on
+# the next round instead.
+_LOCK_TIMEOUT_MS = 1000
+_UPPER_BOUND = re.compile(r"TO \('([^']+)'\)")
+# Tables that were partitions of transfers and still wait to be archived.
+_DETACHED_PARTITIONS = r"^transfers_(p[0-9]{6}|legacy)$"
+
+
+async def _ListPartitions(connection):
+  rows = await connection.fetch('''
+      SELECT partition.relname, inhdetachpending,
+             pg_get_expr(partition.relpartbound, partition.oid) AS bound
+      FROM pg_inherits
+      JOIN pg_class AS partition ON partition.oid = inhrelid
+      WHERE inhparent = 'transfers'::regclass''')
+  return [
+      (row["relname"], row["inhdetachpending"],
+       datetime.fromisoformat(_UPPER_BOUND.search(row["bound"]).group(1)))
+      for row in rows]
+
+async def _Archive(connection, table_name, archive_dir):
+  # Same columns as the CSV export. The file only appears under its final name
+  # once it is complete, and the table is dropped only after that. Chunks are
+  # compressed in a thread, as this runs on the app's event loop.
+  path = os.path.join(archive_dir, f"{table_name}.csv.gz")
+  with gzip.open(path + ".partial", "wb") as file:
+    async def Write(data):
+      await asyncio.to_thread(file.write, data)
+    await connection.copy_from_query(f'''
+        SELECT transfer_id AS "transferId", transfer_timestamp AS timestamp,
+               user_id_from AS "userIdFrom", user_id_to AS "userIdTo", amount
+        FROM "{table_name}" ORDER BY transfer_id''',
+        output=Write, format="csv", header=True)
+  os.replace(path + ".partial", path)
+  await connection.execute(f'DROP TABLE "{table_name}"')
+  return path
+
+
+async def Maintain(datasource_name, months_ahead, retention_months=0,
+                   archive_dir=None):
+  # Creates the partitions of the next months_ahead months. Partitions whose
+  # rows are all older than retention_months months are detached and, if
+  # archive_dir is set, written to gzipped CSV files there and dropped.
+  # Detached partitions are kept otherwise.
+  connection = await asyncpg.connect(dsn=datasource_name)
+  try:
+    # One worker at a time; the others skip this round.
+    if not await connection.fetchval(
+        "SELECT pg_try_advisory_lock(hashtext('transfer_partitions'))"):
+      return
+    await connection.execute(f"SET lock_timeout = {_LOCK_TIMEOUT_MS}")
+    created_count = await connection.fetchval('''
+        SELECT create_transfer_partitions(
+            now() AT TIME ZONE 'utc',
+            now() AT TIME ZONE 'utc' + make_interval(months => $1))''',
+        months_ahead)
+    if created_count:
+      logging.info("Created %d transfer partitions", created_count)
+
+    if retention_months:
+      cutoff = await connection.fetchval('''
+          SELECT date_trunc('month', now() AT TIME ZONE 'utc')
+              - make_interval(months => $1)''',
+          retention_months)
+      for name, detach_pending, upper_bound in await _ListPartitions(
+          connection):
+        # CONCURRENTLY only takes a SHARE UPDATE EXCLUSIVE lock on transfers.
+        # A detach that was interrupted has to be finalized.
+        if detach_pending:
+          await connection.execute(
+              f'ALTER TABLE transfers DETACH PARTITION "{name}" FINALIZE')
+        elif upper_bound <= cutoff:
+          await connection.execute(
+              f'ALTER TABLE transfers DETACH PARTITION "{name}" CONCURRENTLY')
+        else:
+          continue
+        logging.info("Detached transfer partition %s", name)
+
+    if archive_dir:
+      os.makedirs(archive_dir, exist_ok=True)
+      detached = await connection.fetch('''
+          SELECT relname FROM pg_class
+          WHERE relnamespace = current_schema()::regnamespace
+            AND relkind = 'r' AND NOT relispartition AND relname ~ $1''',
+          _DETACHED_PARTITIONS)
+      for row in detached:
+        path = await _Archive(connection, row["relname"], archive_dir)
+        logging.info("Archived transfer partition to %s", path)
+  finally:
+    await connection.close()
+
+
+class TransferPartitionMaintainer(PeriodicTask):
+  # Runs Maintain in the background of the app every interval_seconds.
+
+  def __init__(self, datasource_name, months_ahead, retention_months,
+               archive_dir, interval_seconds):
+    super().__init__(self.Maintain, interval_seconds, run_first=True)
+    self._datasource_name = datasource_name
+    self._months_ahead = months_ahead
+    self._retention_months = retention_months
+    self._archive_dir = archive_dir
+
+  async def Maintain(self):
+    await Maintain(
+        self._datasource_name, self._months_ahead, self._retention_months,
+        self._archive_dir)
+
+
+def Main():
+  parser = argparse.ArgumentParser(
+      description="Creates upcoming monthly partitions of transfers and "
+                  "detaches or archives expired ones.")
+  parser.add_argument("--months-ahead", type=int, default=3,
+                      help="months to create partitions for in advance")
+  parser.add_argument("--retention-months", type=int, default=0,
+                      help="full months of transfers to keep, 0 keeps all")
+  parser.add_argument("--archive-dir",
+                      help="directory for gzipped CSV files of expired "
+                           "partitions, which are then dropped")
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.INFO)
+  asyncio.run(Maintain(
+      os.environ["DATASOURCE"], args.months_ahead, args.retention_months,
+      args.archive_dir))
+
+
+if __name__ == "__main__":
+  Main()
@@ -0,0 +1,34 @@
+import asyncio
+import logging
+
+
+class PeriodicTask:
+  # Awaits round() in the background every interval_seconds, first after
+  # interval_seconds, or right away if run_first. A round that fails is logged
+  # and the next one runs as planned.
+
+  def __init__(self, round, interval_seconds, run_first=False):
+    self._round = round
+    self._interval = interval_seconds
+    self._run_first = run_first
+    self._worker = None
+
+  def Start(self):
+    self._worker = asyncio.create_task(self._Run())
+
+  async def Close(self):
+    self._worker.cancel()
+    try:
+      await self._worker
+    except asyncio.CancelledError:
+      pass
+
+  async def _Run(self):
+    if not self._run_first:
+      await asyncio.sleep(self._interval)
+    while True:
+      try:
+        await self._round()
+      except Exception as e:
+        logging.exception(e)
+      await asyncio.sleep(self._interval)
@@ -0,0 +1,250 @@
+from ledger.metrics import DB_READS
+
+import asyncio
+import asyncpg
+import collections
+import itertools
+import logging
+import re
+import time
+
+
+# Writes return the WAL position of the primary in this header, reads wait
+# for it with the same header.
+LSN_HEADER = "Ledger-LSN"
+_LSN_PATTERN = re.compile(r"([0-9A-Fa-f]{1,8})/([0-9A-Fa-f]{1,8})")
+# Errors after which a replica isn't read from until its next check passes.
+_CONNECTION_ERRORS = (
+    OSError,
+    asyncio.TimeoutError,
+    asyncpg.exceptions.PostgresConnectionError,
+    asyncpg.exceptions.InterfaceError,
+)
+_REPLAY_POLL_SECONDS = 0.005
+
+
+def ParseLsn(lsn_str):
+  # Postgres writes WAL positions as the high and low 32 bits in hex.
+  match = _LSN_PATTERN.fullmatch(lsn_str)
+  if not match:
+    raise ValueError(f"Invalid LSN: {lsn_str}")
+  return int(match[1], 16) << 32 | int(match[2], 16)
+
+
+def FormatLsn(lsn):
+  return f"{lsn >> 32:X}/{lsn & 0xFFFFFFFF:X}"
+
+
+class _Replica:
+
+  def __init__(self, index, sql_client):
+    self.index = index
+    self.sql_client = sql_client
+    self.connected = False
+    self.healthy = False
+    self.replay_lsn = 0
+    self.lag_bytes = None
+    self.lag_seconds = None
+    self.error = None
+
+
+class ReplicaReader:
+  # Sends reads to streaming replicas of the primary, with the read interface
+  # of PostgreSQLClient. Replicas are checked every check_interval_seconds
+  # and read from while they are reachable and at most max_lag_seconds
+  # behind. A read with a min_lsn, the WAL position after a client's last
+  # write, goes to a replica that has replayed it, waiting up to read_wait_ms
+  # for one to catch up, and to the primary otherwise. Reads that fail on a
+  # replica are retried on the primary.
+
+  def __init__(self, primary, replicas, max_lag_seconds, read_wait_ms,
+               check_interval_seconds):
+    self._primary = primary
+    self._replicas = [
+        _Replica(index, replica) for index, replica in enumerate(replicas)]
+    self._max_lag = max_lag_seconds
+    self._read_wait = read_wait_ms / 1000
+    self._check_interval = check_interval_seconds
+    self._turns = itertools.count()
+    # (time, WAL position) of the primary at recent checks. A replica is as
+    # far behind as the oldest of them it hasn't replayed, which doesn't
+    # depend on the replica's clock or on it still receiving WAL.
+    self._primary_lsns = collections.deque()
+    self._checker = None
+
+  async def Start(self):
+    await self.CheckReplicas()
+    self._checker = asyncio.create_task(self._RunChecks())
+
+  async def Close(self):
+    self._checker.cancel()
+    try:
+      await self._checker
+    except asyncio.CancelledError:
+      pass
+    for replica in self._replicas:
+      if replica.connected:
+        await replica.sql_client.CloseConnectionPool()
+
+  def Stats(self):
+    return {
+        "replicas": [
+            {
+                "healthy": replica.healthy,
+                "replayLsn": FormatLsn(replica.replay_lsn),
+                "lagBytes": replica.lag_bytes,
+                "lagSeconds": replica.lag_seconds,
+                "error": replica.error,
+            }
+            for replica in self._replicas],
+        "replicaReads": DB_READS.Value(target="replica"),
+        "primaryReads": DB_READS.Value(target="primary"),
+    }
+
+  async def FetchWalLsn(self):
+    return ParseLsn(await self._primary.FetchWalLsn())
+
+  async def FetchUser(self, user_id, min_lsn=None):
+    return await self._Read(
+        min_lsn, lambda sql_client: sql_client.FetchUser(user_id))
+
+  async def FetchUsers(self, user_ids, min_lsn=None):
+    return await self._Read(
+        min_lsn, lambda sql_client: sql_client.FetchUsers(user_ids))
+
+  async def FetchBalanceAsOf(self, user_id, timestamp, min_lsn=None):
+    return await self._Read(
+        min_lsn,
+        lambda sql_client: sql_client.FetchBalanceAsOf(user_id, timestamp))
+
+  async def FetchTransfers(self, user_id, direction, limit,
+                           before_transfer_id=None, since=None, until=None,
+                           min_lsn=None):
+    return await self._Read(
+        min_lsn, lambda sql_client: sql_client.FetchTransfers(
+            user_id, direction, limit, before_transfer_id=before_transfer_id,
+            since=since, until=until))
+
+  async def StreamTransfers(self, since, until, chunk_size, min_lsn=None):
+    # All chunks come from one database, as another replica may not have
+    # replayed the transfers in the id range the first chunk found. A replica
+    # that fails halfway cuts the export short, like any other error.
+    replica = await self._PickReplica(min_lsn)
+    DB_READS.Inc(target="replica" if replica else "primary")
+    sql_client = replica.sql_client if replica else self._primary
+    async for chunk in sql_client.StreamTransfers(since, until, chunk_size):
+      yield chunk
+
+  async def CheckReplicas(self):
+    # Returns the number of healthy replicas.
+    try:
+      primary_lsn = ParseLsn(await self._primary.FetchWalLsn())
+      now = time.monotonic()
+      self._primary_lsns.append((now, primary_lsn))
+      # Anything older only tells that a replica is too far behind.
+      oldest = now - self._max_lag - self._check_interval
+      while self._primary_lsns[0][0] < oldest:
+        self._primary_lsns.popleft()
+    except Exception as e:
+      logging.exception(e)
+      primary_lsn = None
+    await asyncio.gather(*[
+        self._CheckReplica(replica, primary_lsn)
+        for replica in self._replicas])
+    return sum(replica.healthy for replica in self._replicas)
+
+  async def _CheckReplica(self, replica, primary_lsn):
+    error = None
+    try:
+      status = await asyncio.wait_for(
+          self._FetchReplayStatus(replica), self._check_interval)
+      if not status["in_recovery"]:
+        error = "Not in recovery."
+      else:
+        replica.lag_seconds = self._LagSeconds(replica.replay_lsn)
+        if primary_lsn is not None:
+          replica.lag_bytes = max(primary_lsn - replica.replay_lsn, 0)
+        if replica.lag_seconds > self._max_lag:
+          error = "Lagging behind."
+    except Exception as e:
+      error = str(e) or type(e).__name__
+
+    healthy = error is None
+    if healthy != replica.healthy:
+      logging.info("Replica %d is %s", replica.index,
+                   "healthy" if healthy else f"unhealthy: {error}")
+    replica.healthy = healthy
+    replica.error = error
+
+  async def _FetchReplayStatus(self, replica):
+    if not replica.connected:
+      await replica.sql_client.CreateConnectionPool()
+      replica.connected = True
+    status = await replica.sql_client.FetchReplayStatus()
+    if status["replay_lsn"]:
+      replica.replay_lsn = max(
+          replica.replay_lsn, ParseLsn(status["replay_lsn"]))
+    return status
+
+  def _LagSeconds(self, replay_lsn):
+    now = time.monotonic()
+    for observed_at, primary_lsn in self._primary_lsns:
+      if primary_lsn > replay_lsn:
+        return now - observed_at
+    return 0.0
+
+  async def _PickReplica(self, min_lsn):
+    # Round robin over the healthy replicas, None if no replica will do.
+    healthy = [replica for replica in self._replicas if replica.healthy]
+    if not healthy:
+      return None
+    turn = next(self._turns) % len(healthy)
+    healthy = healthy[turn:] + healthy[:turn]
+    if min_lsn is None:
+      return healthy[0]
+    for replica in healthy:
+      if replica.replay_lsn >= min_lsn:
+        return replica
+
+    # None had replayed it at its last check; the first one is asked again.
+    replica = healthy[0]
+    deadline = time.monotonic() + self._read_wait
+    while True:
+      try:
+        await self._FetchReplayStatus(replica)
+      except _CONNECTION_ERRORS as e:
+        self._MarkUnhealthy(replica, e)
+        return None
+      if replica.replay_lsn >= min_lsn:
+        return replica
+      if time.monotonic() + _REPLAY_POLL_SECONDS > deadline:
+        return None
+      await asyncio.sleep(_REPLAY_POLL_SECONDS)
+
+  async def _Read(self, min_lsn, read):
+    replica = await self._PickReplica(min_lsn)
+    if replica:
+      try:
+        result = await read(replica.sql_client)
+        DB_READS.Inc(target="replica")
+        return result
+      except asyncpg.exceptions.SerializationError:
+        # Canceled for conflicting with the replay of the WAL.
+        pass
+      except _CONNECTION_ERRORS as e:
+        self._MarkUnhealthy(replica, e)
+    DB_READS.Inc(target="primary")
+    return await read(self._primary)
+
+  def _MarkUnhealthy(self, replica, error):
+    logging.warning("Replica %d is unhealthy: %s", replica.index, error)
+    replica.healthy = False
+    replica.error = str(error) or type(error).__name__
+
+  async def _RunChecks(self):
+    while True:
+      await asyncio.sleep(self._check_interval)
+      try:
+        await self.CheckReplicas()
+      except Exception as e:
+        logging.exception(e)
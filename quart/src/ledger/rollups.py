@@ -0,0 +1,22 @@
+import logging
+
+from ledger.periodic import PeriodicTask
+
+
+class TransferRollupUpdater(PeriodicTask):
+  # Adds new transfers to the rollups behind the stats endpoints in the
+  # background every interval_seconds. Like balance checkpoints, rollups
+  # trail the clock by settle_seconds, the longest a transfer may take to
+  # commit.
+
+  def __init__(self, sql_client, interval_seconds, settle_seconds):
+    super().__init__(self.RollUp, interval_seconds)
+    self._sql_client = sql_client
+    self._settle_seconds = settle_seconds
+
+  async def RollUp(self):
+    # None means another worker rolled them up.
+    transfer_count = await self._sql_client.RollUpTransfers(
+        self._settle_seconds)
+    if transfer_count:
+      logging.info("Rolled up %d transfers", transfer_count)
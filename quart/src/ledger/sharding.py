@@ -0,0 +1,379 @@
+from ledger.model import TransferRecord, VolumeBucket
+
+import asyncio
+import itertools
+import logging
+import uuid
+
+import asyncpg
+
+
+# Every shard hands out user and transfer ids from its own range of this size,
+# so the shard of a user is user_id // ID_RANGE_SIZE. The first shard's range
+# starts at 1, so a single database keeps its ids when it becomes the first
+# shard.
+ID_RANGE_SIZE = 2 ** 40
+_TRANSACTION_PREFIX = "ledger_"
+# Coordinators finish their transactions within milliseconds; recovery leaves
+# younger in-doubt transactions to them.
+_RECOVERY_MIN_AGE_SECONDS = 60
+_DECISION_TTL_SECONDS = 86400
+
+
+async def _FinishPreparedTransaction(shard, transaction_id, commit):
+  try:
+    await shard.FinishPreparedTransaction(transaction_id, commit)
+  except asyncpg.exceptions.UndefinedObjectError:
+    # Finished by recovery, or never prepared.
+    pass
+
+
+class ShardedPostgreSQLClient:
+  # Spreads users over several databases by user_id range, with the interface
+  # of PostgreSQLClient. Transfers between users on the same shard run as
+  # before. Transfers across shards commit with two-phase commit, coordinated
+  # by the sender's shard, whose coordinator_log decides the outcome: a
+  # transaction prepared on both shards is committed once its commit is
+  # logged. Transactions left in doubt by a crashed coordinator are rolled
+  # back by recovery unless their commit was logged (presumed abort). Both
+  # shards keep a copy of the transfer row, under the same transfer id.
+
+  def __init__(self, shards, recovery_interval_seconds=60):
+    self._shards = shards
+    self._next_shard = itertools.cycle(range(len(shards)))
+    self._recovery_interval = recovery_interval_seconds
+    self._recoverer = None
+
+  def _ShardIndex(self, user_id):
+    # None for ids outside of every shard's range, which can't exist.
+    index = user_id // ID_RANGE_SIZE
+    return index if index < len(self._shards) else None
+
+  def _Shard(self, user_id):
+    index = self._ShardIndex(user_id)
+    return self._shards[index] if index is not None else None
+
+  async def FetchPendingMigrations(self, migrations):
+    # Pending on any shard.
+    pending = {}
+    for shard in self._shards:
+      for migration in await shard.FetchPendingMigrations(migrations):
+        pending[migration.version] = migration
+    return sorted(pending.values(), key=lambda migration: migration.version)
+
+  async def ApplyMigrations(self, migrations):
+    # Returns the versions applied to any shard.
+    applied_versions = set()
+    for index, shard in enumerate(self._shards):
+      applied_versions.update(await shard.ApplyMigrations(
+          migrations, {
+              "ledger.id_range_start": index * ID_RANGE_SIZE,
+              "ledger.id_range_size": ID_RANGE_SIZE,
+          }))
+    return sorted(applied_versions)
+
+  async def CreateConnectionPool(self):
+    await asyncio.gather(
+        *[shard.CreateConnectionPool() for shard in self._shards])
+
+  async def CloseConnectionPool(self):
+    await asyncio.gather(
+        *[shard.CloseConnectionPool() for shard in self._shards])
+
+  def Start(self):
+    self._recoverer = asyncio.create_task(self._RunRecovery())
+
+  async def Close(self):
+    self._recoverer.cancel()
+    try:
+      await self._recoverer
+    except asyncio.CancelledError:
+      pass
+
+  def PoolStats(self):
+    shards = [shard.PoolStats() for shard in self._shards]
+    stats = {
+        name: sum(shard[name] for shard in shards)
+        for name in ("size", "idle", "minSize", "maxSize", "acquireTimeouts")}
+    stats["shards"] = shards
+    return stats
+
+  # Notifications go to all workers, not to the users of a shard.
+  async def Listen(self, channel, callback, on_interruption=None):
+    await self._shards[0].Listen(channel, callback, on_interruption)
+
+  async def Notify(self, channel, payloads):
+    await self._shards[0].Notify(channel, payloads)
+
+  # Every shard notifies of its own transfers.
+  async def ListenForTransfers(self, callback, on_interruption=None):
+    await asyncio.gather(*[
+        shard.ListenForTransfers(callback, on_interruption)
+        for shard in self._shards])
+
+  async def InsertUser(self, balance):
+    return await self._shards[next(self._next_shard)].InsertUser(balance)
+
+  async def InsertUsers(self, balances):
+    # A batch stays on one shard, which keeps its id ranges contiguous.
+    return await self._shards[next(self._next_shard)].InsertUsers(balances)
+
+  async def FetchUser(self, user_id, min_lsn=None):
+    shard = self._Shard(user_id)
+    return await shard.FetchUser(user_id, min_lsn=min_lsn) if shard else None
+
+  async def FetchUsers(self, user_ids, min_lsn=None):
+    user_ids_by_shard = {}
+    for user_id in user_ids:
+      index = self._ShardIndex(user_id)
+      if index is not None:
+        user_ids_by_shard.setdefault(index, []).append(user_id)
+    users = await asyncio.gather(*[
+        self._shards[index].FetchUsers(shard_user_ids, min_lsn=min_lsn)
+        for index, shard_user_ids in user_ids_by_shard.items()])
+    return [user for shard_users in users for user in shard_users]
+
+  async def FetchBalanceAsOf(self, user_id, timestamp, min_lsn=None):
+    shard = self._Shard(user_id)
+    if not shard:
+      return None
+    return await shard.FetchBalanceAsOf(user_id, timestamp, min_lsn=min_lsn)
+
+  async def FetchTransfers(self, user_id, direction, limit,
+                           before_transfer_id=None, since=None, until=None,
+                           min_lsn=None):
+    # The user's shard has all of their transfers.
+    shard = self._Shard(user_id)
+    if not shard:
+      return []
+    return await shard.FetchTransfers(
+        user_id, direction, limit, before_transfer_id=before_transfer_id,
+        since=since, until=until, min_lsn=min_lsn)
+
+  async def StreamTransfers(self, since, until, chunk_size, min_lsn=None):
+    # Shards in order of their id ranges, so transfer ids keep increasing.
+    # Each shard only yields the transfers whose id it handed out, which
+    # leaves out the receiver's copy of transfers across shards.
+    for index, shard in enumerate(self._shards):
+      async for chunk in shard.StreamTransfers(
+          since, until, chunk_size, min_lsn=min_lsn):
+        chunk = [
+            transfer for transfer in chunk
+            if transfer.transfer_id // ID_RANGE_SIZE == index]
+        if chunk:
+          yield chunk
+
+  async def Transfer(self, user_id_from, user_id_to, amount,
+                     idempotency_key=None):
+    from_index = self._ShardIndex(user_id_from)
+    to_index = self._ShardIndex(user_id_to)
+    if from_index is None or to_index is None:
+      raise ValueError("Invalid arguments.")
+    if from_index == to_index:
+      return await self._shards[from_index].Transfer(
+          user_id_from, user_id_to, amount, idempotency_key=idempotency_key)
+    return await self._TransferAcrossShards(
+        from_index, to_index, user_id_from, user_id_to, amount,
+        idempotency_key)
+
+  async def TransferBatch(self, transfers, idempotency_keys=None):
+    # Transfers within a shard go to that shard's TransferBatch, the others
+    # run one by one afterwards. Unlike on a single database, the batch isn't
+    # atomic: a transfer across shards that fails gets its exception as its
+    # result.
+    idempotency_keys = idempotency_keys or [None] * len(transfers)
+    results = [None] * len(transfers)
+    batches = {}
+    across_shards = []
+    for position, ((user_id_from, user_id_to, _), key) in enumerate(
+        zip(transfers, idempotency_keys)):
+      from_index = self._ShardIndex(user_id_from)
+      to_index = self._ShardIndex(user_id_to)
+      if from_index is None or to_index is None:
+        results[position] = ValueError("Invalid arguments.")
+      elif from_index == to_index:
+        batches.setdefault(from_index, []).append((position, key))
+      else:
+        across_shards.append(position)
+
+    async def RunBatch(index, positions_and_keys):
+      positions, keys = zip(*positions_and_keys)
+      batch_results = await self._shards[index].TransferBatch(
+          [transfers[position] for position in positions], list(keys))
+      for position, result in zip(positions, batch_results):
+        results[position] = result
+
+    await asyncio.gather(*[
+        RunBatch(index, positions_and_keys)
+        for index, positions_and_keys in batches.items()])
+    for position in across_shards:
+      try:
+        results[position] = await self.Transfer(
+            *transfers[position], idempotency_key=idempotency_keys[position])
+      except Exception as e:
+        results[position] = e
+    return results
+
+  async def FetchIdempotencyKeys(self, idempotency_keys):
+    transfer_ids = {}
+    for shard_transfer_ids in await asyncio.gather(*[
+        shard.FetchIdempotencyKeys(idempotency_keys)
+        for shard in self._shards]):
+      transfer_ids.update(shard_transfer_ids)
+    return transfer_ids
+
+  async def DeleteIdempotencyKeys(self, max_age_seconds):
+    return sum(await asyncio.gather(*[
+        shard.DeleteIdempotencyKeys(max_age_seconds)
+        for shard in self._shards]))
+
+  async def WriteBalanceCheckpoints(self, min_transfers, settle_seconds):
+    counts = [
+        count for count in await asyncio.gather(*[
+            shard.WriteBalanceCheckpoints(min_transfers, settle_seconds)
+            for shard in self._shards])
+        if count is not None]
+    return sum(counts) if counts else None
+
+  async def RollUpTransfers(self, settle_seconds):
+    counts = [
+        count for count in await asyncio.gather(*[
+            shard.RollUpTransfers(settle_seconds) for shard in self._shards])
+        if count is not None]
+    return sum(counts) if counts else None
+
+  async def FetchRollupProgress(self):
+    # The rollups are complete up to the shard furthest behind.
+    progress = await asyncio.gather(
+        *[shard.FetchRollupProgress() for shard in self._shards])
+    return None if None in progress else min(progress)
+
+  async def FetchTransferVolume(self, granularity, limit):
+    buckets = {}
+    for shard_buckets in await asyncio.gather(*[
+        shard.FetchTransferVolume(granularity, limit)
+        for shard in self._shards]):
+      for bucket in shard_buckets:
+        total = buckets.setdefault(
+            bucket.bucket_start, VolumeBucket(bucket.bucket_start, 0, 0))
+        total.transfer_count += bucket.transfer_count
+        total.amount += bucket.amount
+    return sorted(
+        buckets.values(), key=lambda bucket: bucket.bucket_start,
+        reverse=True)[:limit]
+
+  async def FetchTopUsers(self, direction, granularity, bucket_count, limit):
+    # Every user is on one shard, so the top users are among the shards' top
+    # users.
+    users = [
+        user
+        for shard_users in await asyncio.gather(*[
+            shard.FetchTopUsers(direction, granularity, bucket_count, limit)
+            for shard in self._shards])
+        for user in shard_users]
+    return sorted(
+        users, key=lambda user: (-user.amount, user.user_id))[:limit]
+
+  async def SetSlotCount(self, user_id, slot_count):
+    shard = self._Shard(user_id)
+    return await shard.SetSlotCount(user_id, slot_count) if shard else False
+
+  async def ConsolidateBalanceSlots(self):
+    return sum(await asyncio.gather(*[
+        shard.ConsolidateBalanceSlots() for shard in self._shards]))
+
+  async def _TransferAcrossShards(self, from_index, to_index, user_id_from,
+                                  user_id_to, amount, idempotency_key):
+    # The decision is logged under transaction_id, each shard prepares its
+    # side under transaction_id plus its index, which keeps them apart if
+    # shards share a Postgres cluster.
+    transaction_id = f"{_TRANSACTION_PREFIX}{from_index}_{uuid.uuid4().hex}"
+    coordinator = self._shards[from_index]
+    participant = self._shards[to_index]
+    debit_id = f"{transaction_id}_{from_index}"
+    credit_id = f"{transaction_id}_{to_index}"
+
+    transfer_id, transfer_timestamp = await coordinator.PrepareTransferDebit(
+        debit_id, user_id_from, user_id_to, amount, idempotency_key)
+    if transfer_timestamp is None:
+      return transfer_id
+    try:
+      await participant.PrepareTransferCredit(
+          credit_id, transfer_id, transfer_timestamp, user_id_from,
+          user_id_to, amount)
+    except BaseException:
+      await _FinishPreparedTransaction(coordinator, debit_id, False)
+      raise
+    # If this fails, the commit may or may not be logged; recovery finds out.
+    committed = await coordinator.DecideTransaction(transaction_id, True)
+    if not committed:
+      # Recovery rolled it back first.
+      await asyncio.gather(
+          _FinishPreparedTransaction(coordinator, debit_id, False),
+          _FinishPreparedTransaction(participant, credit_id, False))
+      raise TimeoutError("Transfer across shards was rolled back.")
+
+    try:
+      await asyncio.gather(
+          _FinishPreparedTransaction(coordinator, debit_id, True),
+          _FinishPreparedTransaction(participant, credit_id, True))
+    except Exception as e:
+      # The transfer is committed; recovery finishes what is left.
+      logging.exception(e)
+      return transfer_id
+    await coordinator.DeleteTransactionDecision(transaction_id)
+    # Each shard has the balance of its user.
+    transfer = TransferRecord(
+        transfer_id, transfer_timestamp, user_id_from, user_id_to, amount)
+    try:
+      await asyncio.gather(
+          coordinator.NotifyTransfers([transfer]),
+          participant.NotifyTransfers([transfer]))
+    except Exception as e:
+      logging.exception(e)
+    return transfer_id
+
+  async def RecoverPreparedTransactions(
+      self, min_age_seconds=_RECOVERY_MIN_AGE_SECONDS):
+    # Finishes the prepared transactions of coordinators that didn't, as
+    # decided by their coordinator_log. Transactions without a decision are
+    # rolled back, after logging that, so that a late coordinator can't
+    # commit them anymore. Returns the number of finished transactions.
+    prepared = await asyncio.gather(*[
+        shard.ListPreparedTransactions(_TRANSACTION_PREFIX, 0)
+        for shard in self._shards])
+    in_doubt = await asyncio.gather(*[
+        shard.ListPreparedTransactions(_TRANSACTION_PREFIX, min_age_seconds)
+        for shard in self._shards])
+    finished_count = 0
+    for shard, shard_transaction_ids in zip(self._shards, in_doubt):
+      for shard_transaction_id in shard_transaction_ids:
+        transaction_id = shard_transaction_id.rsplit("_", 1)[0]
+        coordinator_index = int(
+            transaction_id[len(_TRANSACTION_PREFIX):].split("_")[0])
+        commit = await self._shards[coordinator_index].DecideTransaction(
+            transaction_id, False)
+        await _FinishPreparedTransaction(shard, shard_transaction_id, commit)
+        logging.info(
+            "%s prepared transaction %s",
+            "Committed" if commit else "Rolled back", shard_transaction_id)
+        finished_count += 1
+
+    # Decisions are kept while any shard still has the transaction prepared.
+    keep_transaction_ids = [
+        shard_transaction_id.rsplit("_", 1)[0]
+        for shard_transaction_ids in prepared
+        for shard_transaction_id in shard_transaction_ids]
+    await asyncio.gather(*[
+        shard.DeleteTransactionDecisions(
+            _DECISION_TTL_SECONDS, keep_transaction_ids)
+        for shard in self._shards])
+    return finished_count
+
+  async def _RunRecovery(self):
+    while True:
+      try:
+        await self.RecoverPreparedTransactions()
+      except Exception as e:
+        logging.exception(e)
+      await asyncio.sleep(self._recovery_interval)
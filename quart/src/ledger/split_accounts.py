@@ -0,0 +1,53 @@
+from ledger.periodic import PeriodicTask
+from ledger.sharding import ShardedPostgreSQLClient
+from ledger.sql_client import PostgreSQLClient
+
+import argparse
+import asyncio
+import logging
+import os
+
+
+class BalanceSlotConsolidator(PeriodicTask):
+  # Draws the slots of split accounts into their users rows in the background
+  # every interval_seconds, so that their debits seldom have to.
+
+  def __init__(self, sql_client, interval_seconds):
+    super().__init__(self.Consolidate, interval_seconds)
+    self._sql_client = sql_client
+
+  async def Consolidate(self):
+    user_count = await self._sql_client.ConsolidateBalanceSlots()
+    if user_count:
+      logging.info("Consolidated the balance slots of %d users", user_count)
+
+
+async def Main():
+  parser = argparse.ArgumentParser(
+      description="Splits the balance of a user that receives many transfers "
+                  "over slots, in DATASOURCE or the shard in "
+                  "SHARD_DATASOURCES that has the user.")
+  parser.add_argument("user_id", type=int)
+  parser.add_argument("slots", type=int,
+                      help="number of slots, 0 joins the balance back")
+  args = parser.parse_args()
+  if args.slots < 0:
+    parser.error("slots can't be negative")
+
+  logging.basicConfig(level=logging.INFO)
+  shards = [
+      PostgreSQLClient(datasource_name)
+      for datasource_name in [os.environ["DATASOURCE"]] + os.environ.get(
+          "SHARD_DATASOURCES", "").split()]
+  sql_client = (
+      ShardedPostgreSQLClient(shards) if len(shards) > 1 else shards[0])
+  await sql_client.CreateConnectionPool()
+  try:
+    if not await sql_client.SetSlotCount(args.user_id, args.slots):
+      parser.exit(1, f"User {args.user_id} doesn't exist.\n")
+  finally:
+    await sql_client.CloseConnectionPool()
+
+
+if __name__ == "__main__":
+  asyncio.run(Main())
@@ -1,43 +1,474 @@
-from ledger.model import InsufficientFundsException, User
+from ledger.model import (
+    DIRECTION_RECEIVED, DIRECTION_SENT, GRANULARITIES, MAX_ROLLUP_BUCKETS,
+    PRUNED_GRANULARITIES, InsufficientFundsException, OverloadedException,
+    ReplayedTransferId, TransferRecord, User, UserVolume, VolumeBucket)
+from ledger.metrics import LOCK_BOUNCES, STATEMENT_SECONDS
+from ledger.stats import Histogram
+from ledger.tracing import Span
 
+import asyncio
 import asyncpg
+import contextlib
+from dataclasses import dataclass
+import logging
+import time
+
+
+# Error codes returned by the transfer() function in sql/migrations.
+_TRANSFER_INVALID_ARGUMENTS = -1
+_TRANSFER_INSUFFICIENT_FUNDS = -2
+_IDEMPOTENCY_KEY_CONSTRAINT = "transfer_idempotency_keys_pkey"
+# Result of a batch leg whose key a concurrent request committed first.
+_KEY_TAKEN = object()
+_MIGRATION_LOCK_POLL_SECONDS = 0.1
+# Backoff between attempts to reconnect the LISTEN connection.
+_LISTEN_RECONNECT_MIN_SECONDS = 0.1
+_LISTEN_RECONNECT_MAX_SECONDS = 30
+# Transfers rolled up per transaction, in seconds of transfer_timestamp.
+_ROLLUP_SLICE_SECONDS = 3600
+# Channel of the notify_transfers() function in sql/migrations.
+TRANSFER_CHANNEL = "ledger_transfers"
+
+
+@contextlib.contextmanager
+def _Timed(statement):
+  with STATEMENT_SECONDS.Time(statement=statement), Span("sql " + statement):
+    yield
+
+
+@contextlib.asynccontextmanager
+async def _Transaction(connection, **kwargs):
+  # Like connection.transaction(), with the commit timed as a statement.
+  transaction = connection.transaction(**kwargs)
+  await transaction.start()
+  try:
+    yield
+  except BaseException:
+    await transaction.rollback()
+    raise
+  with _Timed("commit"):
+    await transaction.commit()
+
+
+@contextlib.contextmanager
+def _CountLockBounces():
+  try:
+    yield
+  except asyncpg.exceptions.LockNotAvailableError:
+    LOCK_BOUNCES.Inc()
+    raise
+
+
+@dataclass
+class PoolConfig:
+  # Defaults are asyncpg's.
+  min_size: int = 10
+  max_size: int = 10
+  max_queries: int = 50000
+  max_inactive_connection_lifetime: float = 300.0
+  statement_cache_size: int = 100
+  # Seconds to wait for a free connection, None waits forever.
+  acquire_timeout: float = None
+  # Executed on every new connection, e.g. to SET session parameters.
+  init_sql: str = None
 
 
 class PostgreSQLClient:
 
-  def __init__(self, datasource_name):
+  def __init__(self, datasource_name, use_transfer_function=True,
+               lock_timeout_ms=None, pool_config=None,
+               notify_transfers=False):
     self._datasource_name = datasource_name
+    self._pool_config = pool_config or PoolConfig()
+    self._acquire_wait_seconds = Histogram()
+    self._acquire_timeouts = 0
+    self._use_transfer_function = use_transfer_function
+    # None bounces transfers off locked rows right away (NOWAIT), otherwise
+    # they wait up to lock_timeout_ms for the lock.
+    self._lock_timeout_ms = lock_timeout_ms
+    # Transfers NOTIFY TRANSFER_CHANNEL as they commit, see ledger/events.py.
+    self._notify_transfers = notify_transfers
     self._connection_pool = None
+    # Dedicated connection shared by all LISTEN subscriptions of this process,
+    # which is reconnected when it drops.
+    self._listen_connection = None
+    # (channel, callback, on_interruption) of every Listen call.
+    self._listeners = []
+    self._listen_reconnect = None
 
-  async def ApplyMigrations(self, migration_script):
-    async with self._connection_pool.acquire() as connection:
-      await connection.execute(migration_script)
+  async def FetchPendingMigrations(self, migrations):
+    async with self._Acquire() as connection:
+      return await self._FetchPendingMigrations(connection, migrations)
+
+  async def ApplyMigrations(self, migrations, settings=None):
+    # Applies the migrations that schema_migrations doesn't list in version
+    # order, each in a transaction of its own, with settings set locally,
+    # unless it can't run in one. One process at a time applies them under a
+    # session advisory lock; the others wait for it and then find nothing
+    # left to do. Up to date databases cost one query. Returns the versions
+    # applied.
+    async with self._Acquire() as connection:
+      if not await self._FetchPendingMigrations(connection, migrations):
+        return []
+      # Blocking in pg_advisory_lock would hold a snapshot, which a
+      # CREATE INDEX CONCURRENTLY of the process applying them waits for.
+      while not await connection.fetchval(
+          "SELECT pg_try_advisory_lock(hashtext('ledger_schema'))"):
+        await asyncio.sleep(_MIGRATION_LOCK_POLL_SECONDS)
+      try:
+        await connection.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+              version INT NOT NULL,
+              name TEXT NOT NULL,
+              applied_at TIMESTAMP NOT NULL DEFAULT current_timestamp,
+              PRIMARY KEY (version)
+            )''')
+        pending = await self._FetchPendingMigrations(connection, migrations)
+        for migration in pending:
+          if migration.in_transaction:
+            async with connection.transaction():
+              for name, value in (settings or {}).items():
+                await connection.execute(
+                    "SELECT set_config($1, $2, true)", name, str(value))
+              await self._ApplyMigration(connection, migration)
+          else:
+            await self._ApplyMigration(connection, migration)
+        return [migration.version for migration in pending]
+      finally:
+        await connection.execute(
+            "SELECT pg_advisory_unlock(hashtext('ledger_schema'))")
 
   async def CreateConnectionPool(self):
-    self._connection_pool = await asyncpg.create_pool(dsn=self._datasource_name)
+    config = self._pool_config
+    init = None
+    if config.init_sql:
+      async def init(connection):
+        await connection.execute(config.init_sql)
+    self._connection_pool = await asyncpg.create_pool(
+        dsn=self._datasource_name,
+        min_size=config.min_size,
+        max_size=config.max_size,
+        max_queries=config.max_queries,
+        max_inactive_connection_lifetime=(
+            config.max_inactive_connection_lifetime),
+        statement_cache_size=config.statement_cache_size,
+        init=init)
   
   async def CloseConnectionPool(self):
+    if self._listen_reconnect:
+      self._listen_reconnect.cancel()
+      self._listen_reconnect = None
+    listen_connection, self._listen_connection = self._listen_connection, None
+    if listen_connection:
+      await listen_connection.close()
     await self._connection_pool.close()
 
+  def PoolStats(self):
+    return {
+        "size": self._connection_pool.get_size(),
+        "idle": self._connection_pool.get_idle_size(),
+        "minSize": self._connection_pool.get_min_size(),
+        "maxSize": self._connection_pool.get_max_size(),
+        "acquireWaitSeconds": self._acquire_wait_seconds.Stats(),
+        "acquireTimeouts": self._acquire_timeouts,
+    }
+
+  @contextlib.asynccontextmanager
+  async def _Acquire(self):
+    start = time.monotonic()
+    try:
+      with Span("pool_acquire"):
+        connection = await self._connection_pool.acquire(
+            timeout=self._pool_config.acquire_timeout)
+    except asyncio.TimeoutError:
+      self._acquire_timeouts += 1
+      raise OverloadedException() from None
+    self._acquire_wait_seconds.Observe(time.monotonic() - start)
+    try:
+      yield connection
+    finally:
+      await self._connection_pool.release(connection)
+
+  async def Listen(self, channel, callback, on_interruption=None):
+    # on_interruption is called without arguments when notifications may have
+    # been missed: when the connection drops, and again once it listens
+    # again.
+    self._listeners.append((channel, callback, on_interruption))
+    if not self._listen_connection:
+      await self._ConnectListener()
+    else:
+      await self._listen_connection.add_listener(channel, callback)
+
+  async def _ConnectListener(self):
+    connection = await asyncpg.connect(dsn=self._datasource_name)
+    try:
+      for channel, callback, _ in self._listeners:
+        await connection.add_listener(channel, callback)
+    except BaseException:
+      await connection.close()
+      raise
+    connection.add_termination_listener(self._OnListenConnectionLost)
+    self._listen_connection = connection
+
+  def _OnListenConnectionLost(self, connection):
+    # Also called for the close in CloseConnectionPool.
+    if connection is not self._listen_connection:
+      return
+    logging.warning("LISTEN connection lost, reconnecting.")
+    self._listen_connection = None
+    self._InterruptListeners()
+    self._listen_reconnect = asyncio.create_task(self._ReconnectListener())
+
+  async def _ReconnectListener(self):
+    delay = _LISTEN_RECONNECT_MIN_SECONDS
+    while True:
+      await asyncio.sleep(delay)
+      try:
+        await self._ConnectListener()
+      except Exception as e:
+        logging.warning("LISTEN reconnect failed: %r", e)
+        delay = min(delay * 2, _LISTEN_RECONNECT_MAX_SECONDS)
+        continue
+      logging.info("LISTEN connection restored.")
+      self._listen_reconnect = None
+      self._InterruptListeners()
+      return
+
+  def _InterruptListeners(self):
+    for _, _, on_interruption in self._listeners:
+      if on_interruption:
+        try:
+          on_interruption()
+        except Exception as e:
+          logging.exception(e)
+
+  async def Notify(self, channel, payloads):
+    async with self._Acquire() as connection:
+      with _Timed("notify"):
+        await connection.execute(
+            "SELECT pg_notify($1, payload) FROM unnest($2::text[]) AS payload",
+            channel, payloads)
+
+  async def ListenForTransfers(self, callback, on_interruption=None):
+    await self.Listen(TRANSFER_CHANNEL, callback, on_interruption)
+
+  async def NotifyTransfers(self, transfers):
+    # For transfers committed without a notification, i.e. across shards,
+    # whose prepared transactions can't NOTIFY. Does nothing unless
+    # notify_transfers is set.
+    if not self._notify_transfers:
+      return
+    async with self._Acquire() as connection:
+      await self._NotifyTransfers(connection, transfers)
+
   async def InsertUser(self, balance):
-    async with self._connection_pool.acquire() as connection:
-      return await connection.fetchval(
-          "INSERT INTO users (balance) VALUES ($1) RETURNING user_id",
-          balance)
+    async with self._Acquire() as connection:
+      with _Timed("insert_user"):
+        return await connection.fetchval(
+            "INSERT INTO users (balance) VALUES ($1) RETURNING user_id",
+            balance)
 
-  async def FetchUser(self, user_id):
-    async with self._connection_pool.acquire() as connection:
-      row = await connection.fetchrow(
-          "SELECT user_id, balance FROM users WHERE user_id = $1", user_id)
+  async def InsertUsers(self, balances):
+    # Returns the new user ids as [first, last] ranges. Concurrent inserts may
+    # take ids in between, so the ids are not always one contiguous range.
+    async with self._Acquire() as connection:
+      with _Timed("insert_users"):
+        rows = await connection.fetch('''
+            WITH inserted AS (
+              INSERT INTO users (balance)
+              SELECT balance FROM unnest($1::bigint[]) AS balance
+              RETURNING user_id
+            )
+            SELECT min(user_id) AS first_user_id, max(user_id) AS last_user_id
+            FROM (
+              SELECT user_id,
+                     user_id - row_number() OVER (ORDER BY user_id) AS run
+              FROM inserted
+            ) AS runs
+            GROUP BY run ORDER BY first_user_id''',
+            balances)
+      return [[row["first_user_id"], row["last_user_id"]] for row in rows]
+
+  # The min_lsn of reads is for replicas, see ledger/replicas.py; a primary
+  # has every write.
+  async def FetchUser(self, user_id, min_lsn=None):
+    async with self._Acquire() as connection:
+      with _Timed("fetch_user"):
+        row = await connection.fetchrow(
+            "SELECT user_id, balance FROM user_balances WHERE user_id = $1",
+            user_id)
       return User(row["user_id"], row["balance"]) if row else None
 
-  async def Transfer(self, user_id_from, user_id_to, amount):
-    async with self._connection_pool.acquire() as connection:
-      async with connection.transaction(isolation='repeatable_read'):
-        rows = await connection.fetch('''
-            SELECT user_id, balance FROM users
-            WHERE user_id in ($1, $2) FOR UPDATE NOWAIT''',
-            user_id_from, user_id_to)
+  async def FetchUsers(self, user_ids, min_lsn=None):
+    async with self._Acquire() as connection:
+      with _Timed("fetch_users"):
+        rows = await connection.fetch(
+            "SELECT user_id, balance FROM user_balances "
+            "WHERE user_id = ANY($1::bigint[])",
+            user_ids)
+      return [User(row["user_id"], row["balance"]) for row in rows]
+
+  async def FetchBalanceAsOf(self, user_id, timestamp, min_lsn=None):
+    # Starts from the user's nearest checkpoint before the timestamp, or after
+    # it if there is none before, so only the transfers in between are read.
+    # Without checkpoints it goes back from the current balance. Returns None
+    # if the user doesn't exist.
+    async with self._Acquire() as connection:
+      async with connection.transaction(
+          isolation='repeatable_read', readonly=True):
+        with _Timed("fetch_balance_checkpoint"):
+          checkpoint = await connection.fetchrow('''
+              SELECT * FROM (
+                (SELECT checkpoint_timestamp, balance, true AS before
+                 FROM balance_checkpoints
+                 WHERE user_id = $1 AND checkpoint_timestamp <= $2
+                 ORDER BY checkpoint_timestamp DESC LIMIT 1)
+                UNION ALL
+                (SELECT checkpoint_timestamp, balance, false
+                 FROM balance_checkpoints
+                 WHERE user_id = $1 AND checkpoint_timestamp > $2
+                 ORDER BY checkpoint_timestamp LIMIT 1)
+              ) AS nearest
+              ORDER BY before DESC LIMIT 1''',
+              user_id, timestamp)
+        if checkpoint and checkpoint["before"]:
+          return checkpoint["balance"] + await self._SumTransfers(
+              connection, user_id, checkpoint["checkpoint_timestamp"],
+              timestamp)
+        if checkpoint:
+          return checkpoint["balance"] - await self._SumTransfers(
+              connection, user_id, timestamp,
+              checkpoint["checkpoint_timestamp"])
+        with _Timed("fetch_user"):
+          balance = await connection.fetchval(
+              "SELECT balance FROM user_balances WHERE user_id = $1", user_id)
+        if balance is None:
+          return None
+        return balance - await self._SumTransfers(
+            connection, user_id, timestamp, None)
+
+  async def FetchTransfers(self, user_id, direction, limit,
+                           before_transfer_id=None, since=None, until=None,
+                           min_lsn=None):
+    # Keyset pagination, newest first. Every direction is read backwards from
+    # its (user_id_*, transfer_id) index, so a page never scans rows before
+    # the cursor. Only the conditions that are set go into the query, so each
+    # combination gets a plan that uses the index for the cursor.
+    args = [user_id, limit]
+    conditions = []
+    if before_transfer_id is not None:
+      args.append(before_transfer_id)
+      conditions.append(f"transfer_id < ${len(args)}")
+    if since is not None:
+      args.append(since)
+      conditions.append(f"transfer_timestamp >= ${len(args)}")
+    if until is not None:
+      args.append(until)
+      conditions.append(f"transfer_timestamp < ${len(args)}")
+
+    columns = ["user_id_from", "user_id_to"]
+    if direction == DIRECTION_SENT:
+      columns = ["user_id_from"]
+    elif direction == DIRECTION_RECEIVED:
+      columns = ["user_id_to"]
+    query = " UNION ALL ".join(
+        f'''(SELECT transfer_id, transfer_timestamp, user_id_from,
+                   user_id_to, amount
+            FROM transfers
+            WHERE {" AND ".join([f"{column} = $1"] + conditions)}
+            ORDER BY transfer_id DESC LIMIT $2)'''
+        for column in columns)
+    if len(columns) > 1:
+      query += " ORDER BY transfer_id DESC LIMIT $2"
+
+    async with self._Acquire() as connection:
+      with _Timed("fetch_transfers"):
+        rows = await connection.fetch(query, *args)
+      return [
+          TransferRecord(
+              row["transfer_id"], row["transfer_timestamp"],
+              row["user_id_from"], row["user_id_to"], row["amount"])
+          for row in rows]
+
+  async def StreamTransfers(self, since, until, chunk_size, min_lsn=None):
+    # Yields lists of transfers in transfer_id order. Every chunk is a short
+    # query of its own on the primary key, so an export of any size neither
+    # buffers the result nor keeps a transaction or connection open.
+    async with self._Acquire() as connection:
+      with _Timed("stream_transfers_range"):
+        first_transfer_id, last_transfer_id = await connection.fetchrow('''
+            SELECT min(transfer_id), max(transfer_id) FROM transfers
+            WHERE transfer_timestamp >= $1 AND transfer_timestamp < $2''',
+            since, until)
+    if first_transfer_id is None:
+      return
+
+    after_transfer_id = first_transfer_id - 1
+    while after_transfer_id < last_transfer_id:
+      async with self._Acquire() as connection:
+        with _Timed("stream_transfers"):
+          rows = await connection.fetch('''
+              SELECT transfer_id, transfer_timestamp, user_id_from, user_id_to,
+                     amount
+              FROM transfers
+              WHERE transfer_id > $1 AND transfer_id <= $2
+                AND transfer_timestamp >= $3 AND transfer_timestamp < $4
+              ORDER BY transfer_id LIMIT $5''',
+              after_transfer_id, last_transfer_id, since, until, chunk_size)
+      if not rows:
+        return
+      after_transfer_id = rows[-1]["transfer_id"]
+      yield [
+          TransferRecord(
+              row["transfer_id"], row["transfer_timestamp"],
+              row["user_id_from"], row["user_id_to"], row["amount"])
+          for row in rows]
+
+  async def FetchWalLsn(self):
+    # The WAL position of the primary, which is past every commit so far.
+    async with self._Acquire() as connection:
+      with _Timed("fetch_wal_lsn"):
+        return await connection.fetchval("SELECT pg_current_wal_lsn()::text")
+
+  async def FetchReplayStatus(self):
+    # Of a replica: whether it is one and the WAL position it has replayed.
+    async with self._Acquire() as connection:
+      with _Timed("fetch_replay_status"):
+        row = await connection.fetchrow('''
+            SELECT pg_is_in_recovery() AS in_recovery,
+                   pg_last_wal_replay_lsn()::text AS replay_lsn''')
+      return dict(row)
+
+  async def Transfer(self, user_id_from, user_id_to, amount,
+                     idempotency_key=None):
+    try:
+      if not self._use_transfer_function:
+        return await self._TransferWithStatements(
+            user_id_from, user_id_to, amount, idempotency_key)
+
+      async with self._Acquire() as connection:
+        with _CountLockBounces(), _Timed("transfer_function"):
+          transfer_id, replayed = await connection.fetchrow(
+              "SELECT * FROM transfer_or_replay($1, $2, $3, $4, $5, $6)",
+              user_id_from, user_id_to, amount, self._lock_timeout_ms,
+              idempotency_key, self._notify_transfers)
+    except asyncpg.exceptions.UniqueViolationError as e:
+      # A request with the same key, but other users, committed first.
+      if e.constraint_name != _IDEMPOTENCY_KEY_CONSTRAINT:
+        raise
+      transfer_ids = await self.FetchIdempotencyKeys([idempotency_key])
+      return ReplayedTransferId(transfer_ids[idempotency_key])
+    if transfer_id == _TRANSFER_INVALID_ARGUMENTS:
+      raise ValueError("Invalid arguments.")
+    if transfer_id == _TRANSFER_INSUFFICIENT_FUNDS:
+      raise InsufficientFundsException()
+    return ReplayedTransferId(transfer_id) if replayed else transfer_id
+
+  async def _TransferWithStatements(self, user_id_from, user_id_to, amount,
+                                    idempotency_key):
+    async with self._Acquire() as connection:
+      async with _Transaction(connection, isolation='repeatable_read'):
+        rows = await self._LockUsers(connection, [user_id_from, user_id_to])
         user_from, user_to = None, None
         for row in rows:
           if row["user_id"] == user_id_from:
@@ -46,6 +477,14 @@ class PostgreSQLClient:
             user_to = User(row["user_id"], row["balance"])
         if not user_from or not user_to:
           raise ValueError("Invalid arguments.")
+        if idempotency_key is not None:
+          transfer_ids = await self._FetchIdempotencyKeys(
+              connection, [idempotency_key])
+          if transfer_ids:
+            return ReplayedTransferId(transfer_ids[idempotency_key])
+        if user_from.balance < amount:
+          user_from.balance = await self._DrawFromSlots(
+              connection, user_from.user_id)
         if user_from.balance < amount:
           raise InsufficientFundsException() 
 
@@ -55,14 +494,662 @@ class PostgreSQLClient:
         user1, user2 = user_from, user_to
         if user_from.user_id > user_to.user_id:
             user1, user2 = user_to, user_from
+        with _Timed("update_user"):
+          await connection.execute(
+              "UPDATE users SET balance = $1 WHERE user_id = $2",
+              user1.balance, user1.user_id)
+        with _Timed("update_user"):
+          await connection.execute(
+              "UPDATE users SET balance = $1 WHERE user_id = $2",
+              user2.balance, user2.user_id)
+        with _Timed("insert_transfer"):
+          transfer = await connection.fetchrow('''
+              INSERT INTO transfers (user_id_from, user_id_to, amount)
+              VALUES ($1, $2, $3) RETURNING transfer_id, transfer_timestamp''',
+              user_id_from, user_id_to, amount)
+        transfer_id = transfer["transfer_id"]
+        if idempotency_key is not None:
+          await self._InsertIdempotencyKeys(
+              connection, [idempotency_key], [transfer_id])
+        if self._notify_transfers:
+          await self._NotifyTransfers(connection, [TransferRecord(
+              transfer_id, transfer["transfer_timestamp"], user_id_from,
+              user_id_to, amount)])
+        return transfer_id
+
+  async def TransferBatch(self, transfers, idempotency_keys=None):
+    # Returns one entry per transfer: either the transfer id or the exception
+    # explaining why that transfer was skipped. Skipped transfers don't abort
+    # the rest of the batch. Transfers whose idempotency key is known get the
+    # original transfer id and are not repeated.
+    idempotency_keys = idempotency_keys or [None] * len(transfers)
+    user_ids = set()
+    for user_id_from, user_id_to, _ in transfers:
+      user_ids.add(user_id_from)
+      user_ids.add(user_id_to)
+    # Keys that requests with other users committed after this transaction
+    # started. Their transfer ids are read once it is over.
+    taken_keys = set()
+    async with self._Acquire() as connection:
+      async with _Transaction(connection, isolation='repeatable_read'):
+        rows = await self._LockUsers(connection, user_ids)
+        balances = {row["user_id"]: row["balance"] for row in rows}
+        # Senders whose users row can't cover all of their transfers in the
+        # batch draw from their slots first, in one round trip.
+        debits = {}
+        for user_id_from, _, amount in transfers:
+          debits[user_id_from] = debits.get(user_id_from, 0) + amount
+        short_user_ids = [
+            user_id for user_id, debit in debits.items()
+            if user_id in balances and balances[user_id] < debit]
+        if short_user_ids:
+          with _Timed("draw_from_slots"):
+            rows = await connection.fetch('''
+                SELECT user_id, draw_from_slots(user_id) AS balance
+                FROM unnest($1::bigint[]) AS user_id''',
+                short_user_ids)
+          balances.update((row["user_id"], row["balance"]) for row in rows)
+        known_transfer_ids = {}
+        if any(key is not None for key in idempotency_keys):
+          known_transfer_ids = await self._FetchIdempotencyKeys(
+              connection, [key for key in idempotency_keys if key is not None])
+        while True:
+          savepoint = connection.transaction()
+          await savepoint.start()
+          try:
+            results = await self._ApplyTransferBatch(
+                connection, transfers, idempotency_keys, dict(balances),
+                known_transfer_ids, taken_keys)
+          except asyncpg.exceptions.UniqueViolationError as e:
+            if e.constraint_name != _IDEMPOTENCY_KEY_CONSTRAINT:
+              raise
+            await savepoint.rollback()
+            taken_keys |= await self._FindTakenIdempotencyKeys(
+                connection,
+                {key for key in idempotency_keys
+                 if key is not None and key not in known_transfer_ids}
+                - taken_keys)
+            continue
+          await savepoint.commit()
+          break
+    if taken_keys:
+      transfer_ids = await self.FetchIdempotencyKeys(list(taken_keys))
+      results = [
+          ReplayedTransferId(transfer_ids[key]) if result is _KEY_TAKEN
+          else result
+          for result, key in zip(results, idempotency_keys)]
+    return results
+
+  async def _ApplyTransferBatch(self, connection, transfers, idempotency_keys,
+                                balances, known_transfer_ids, taken_keys):
+    # Legs whose key is in taken_keys get _KEY_TAKEN.
+    results = []
+    applied = []
+    applied_keys = []
+    seen_keys = set()
+    for (user_id_from, user_id_to, amount), key in zip(
+        transfers, idempotency_keys):
+      if (user_id_from == user_id_to or user_id_from not in balances
+          or user_id_to not in balances or key in seen_keys):
+        results.append(ValueError("Invalid arguments."))
+      elif key in known_transfer_ids:
+        results.append(ReplayedTransferId(known_transfer_ids[key]))
+        seen_keys.add(key)
+      elif key in taken_keys:
+        results.append(_KEY_TAKEN)
+        seen_keys.add(key)
+      elif balances[user_id_from] < amount:
+        results.append(InsufficientFundsException())
+      else:
+        balances[user_id_from] -= amount
+        balances[user_id_to] += amount
+        results.append(None)
+        applied.append((user_id_from, user_id_to, amount))
+        applied_keys.append(key)
+        if key is not None:
+          seen_keys.add(key)
+    if not applied:
+      return results
+
+    changed_user_ids = sorted(
+        {user_id for leg in applied for user_id in leg[:2]})
+    with _Timed("update_users"):
+      await connection.execute('''
+          UPDATE users SET balance = changed.balance
+          FROM unnest($1::bigint[], $2::bigint[])
+              AS changed (user_id, balance)
+          WHERE users.user_id = changed.user_id''',
+          changed_user_ids,
+          [balances[user_id] for user_id in changed_user_ids])
+    # Ids are drawn from the sequence in ordinality order, so sorting them
+    # maps each one back to its transfer.
+    with _Timed("insert_transfers"):
+      rows = await connection.fetch('''
+          INSERT INTO transfers (user_id_from, user_id_to, amount)
+          SELECT user_id_from, user_id_to, amount
+          FROM unnest($1::bigint[], $2::bigint[], $3::bigint[])
+              WITH ORDINALITY AS t (user_id_from, user_id_to, amount, n)
+          ORDER BY n
+          RETURNING transfer_id, transfer_timestamp''',
+          *map(list, zip(*applied)))
+    rows = sorted(rows, key=lambda row: row["transfer_id"])
+    new_transfer_ids = [row["transfer_id"] for row in rows]
+    keyed = [
+        (key, transfer_id)
+        for key, transfer_id in zip(applied_keys, new_transfer_ids)
+        if key is not None]
+    if keyed:
+      await self._InsertIdempotencyKeys(connection, *map(list, zip(*keyed)))
+    if self._notify_transfers:
+      await self._NotifyTransfers(connection, [
+          TransferRecord(row["transfer_id"], row["transfer_timestamp"], *leg)
+          for row, leg in zip(rows, applied)])
+    transfer_ids = iter(new_transfer_ids)
+    return [
+        result if result is not None else next(transfer_ids)
+        for result in results]
+
+  async def PrepareTransferDebit(self, transaction_id, user_id_from,
+                                 user_id_to, amount, idempotency_key=None):
+    # Sender's side of a transfer to a user on another shard: takes amount
+    # from user_id_from, records the transfer and prepares the transaction for
+    # two-phase commit under transaction_id. Returns the new transfer id and
+    # timestamp. If the idempotency key is known, nothing is prepared and the
+    # original transfer id is returned with timestamp None.
+    async with self._Acquire() as connection:
+      with _Timed("begin"):
+        await connection.execute("BEGIN ISOLATION LEVEL REPEATABLE READ")
+      try:
+        rows = await self._LockUsers(connection, [user_id_from])
+        if not rows:
+          raise ValueError("Invalid arguments.")
+        if idempotency_key is not None:
+          transfer_ids = await self._FetchIdempotencyKeys(
+              connection, [idempotency_key])
+          if transfer_ids:
+            await connection.execute("ROLLBACK")
+            return ReplayedTransferId(transfer_ids[idempotency_key]), None
+        balance = rows[0]["balance"]
+        if balance < amount:
+          balance = await self._DrawFromSlots(connection, user_id_from)
+        if balance < amount:
+          raise InsufficientFundsException()
+
+        with _Timed("update_user"):
+          await connection.execute(
+              "UPDATE users SET balance = balance - $1 WHERE user_id = $2",
+              amount, user_id_from)
+        with _Timed("insert_transfer"):
+          transfer = await connection.fetchrow('''
+              INSERT INTO transfers (user_id_from, user_id_to, amount)
+              VALUES ($1, $2, $3) RETURNING transfer_id, transfer_timestamp''',
+              user_id_from, user_id_to, amount)
+        if idempotency_key is not None:
+          await self._InsertIdempotencyKeys(
+              connection, [idempotency_key], [transfer["transfer_id"]])
+        await self._PrepareTransaction(connection, transaction_id)
+      except Exception:
+        await connection.execute("ROLLBACK")
+        raise
+    return transfer["transfer_id"], transfer["transfer_timestamp"]
+
+  async def PrepareTransferCredit(self, transaction_id, transfer_id,
+                                  transfer_timestamp, user_id_from, user_id_to,
+                                  amount):
+    # Receiver's side: adds amount to user_id_to and records the transfer
+    # under the id and timestamp the sender's shard gave it, then prepares.
+    async with self._Acquire() as connection:
+      with _Timed("begin"):
+        await connection.execute("BEGIN ISOLATION LEVEL REPEATABLE READ")
+      try:
+        if not await self._LockUsers(connection, [user_id_to]):
+          raise ValueError("Invalid arguments.")
+        with _Timed("update_user"):
+          await connection.execute(
+              "UPDATE users SET balance = balance + $1 WHERE user_id = $2",
+              amount, user_id_to)
+        with _Timed("insert_transfer"):
+          await connection.execute('''
+              INSERT INTO transfers (transfer_id, transfer_timestamp,
+                                     user_id_from, user_id_to, amount)
+              VALUES ($1, $2, $3, $4, $5)''',
+              transfer_id, transfer_timestamp, user_id_from, user_id_to,
+              amount)
+        await self._PrepareTransaction(connection, transaction_id)
+      except Exception:
+        await connection.execute("ROLLBACK")
+        raise
+
+  async def FinishPreparedTransaction(self, transaction_id, commit):
+    # Raises asyncpg.exceptions.UndefinedObjectError if the transaction isn't
+    # prepared (anymore).
+    async with self._Acquire() as connection:
+      if commit:
+        with _Timed("commit_prepared"):
+          await connection.execute(f"COMMIT PREPARED '{transaction_id}'")
+      else:
+        with _Timed("rollback_prepared"):
+          await connection.execute(f"ROLLBACK PREPARED '{transaction_id}'")
+
+  async def ListPreparedTransactions(self, prefix, min_age_seconds):
+    async with self._Acquire() as connection:
+      with _Timed("list_prepared_transactions"):
+        rows = await connection.fetch('''
+            SELECT gid FROM pg_prepared_xacts
+            WHERE database = current_database() AND starts_with(gid, $1)
+              AND prepared <= now() - make_interval(secs => $2)''',
+            prefix, min_age_seconds)
+    return [row["gid"] for row in rows]
+
+  async def DecideTransaction(self, transaction_id, commit):
+    # Records the outcome of a two-phase transaction coordinated by this
+    # shard, unless one is recorded already. Returns the recorded outcome.
+    async with self._Acquire() as connection:
+      with _Timed("decide_transaction"):
+        committed = await connection.fetchval('''
+            INSERT INTO coordinator_log (transaction_id, committed)
+            VALUES ($1, $2) ON CONFLICT (transaction_id) DO NOTHING
+            RETURNING committed''',
+            transaction_id, commit)
+      if committed is None:
+        # Decided before; a separate statement sees that decision committed.
+        with _Timed("fetch_transaction_decision"):
+          committed = await connection.fetchval(
+              "SELECT committed FROM coordinator_log "
+              "WHERE transaction_id = $1",
+              transaction_id)
+    return committed
+
+  async def DeleteTransactionDecision(self, transaction_id):
+    async with self._Acquire() as connection:
+      with _Timed("delete_transaction_decision"):
         await connection.execute(
-            "UPDATE users SET balance = $1 WHERE user_id = $2",
-            user1.balance, user1.user_id)
+            "DELETE FROM coordinator_log WHERE transaction_id = $1",
+            transaction_id)
+
+  async def DeleteTransactionDecisions(self, max_age_seconds,
+                                       keep_transaction_ids):
+    async with self._Acquire() as connection:
+      with _Timed("delete_transaction_decisions"):
+        result = await connection.execute('''
+            DELETE FROM coordinator_log
+            WHERE decided_at
+                < now() AT TIME ZONE 'utc' - make_interval(secs => $1)
+              AND transaction_id <> ALL($2::text[])''',
+            max_age_seconds, keep_transaction_ids)
+    return int(result.split()[-1])
+
+  async def SetSlotCount(self, user_id, slot_count):
+    # Splits the user's balance over slot_count slots that transfer() credits
+    # without locking the users row, or joins it back into the row with 0.
+    # Returns False if there is no such user.
+    async with self._Acquire() as connection:
+      async with connection.transaction():
+        with _Timed("set_slot_count"):
+          if not await connection.fetchval('''
+              UPDATE users SET slot_count = $2 WHERE user_id = $1
+              RETURNING true''',
+              user_id, slot_count):
+            return False
+          await connection.execute('''
+              INSERT INTO balance_slots (user_id, slot)
+              SELECT $1, generate_series(0, $2 - 1)
+              ON CONFLICT DO NOTHING''',
+              user_id, slot_count)
+        await self._DrawFromSlots(connection, user_id)
+    return True
+
+  async def ConsolidateBalanceSlots(self):
+    # Draws the slots of every user with a balance in them into their users
+    # row, one user per transaction. Returns the number of users.
+    async with self._Acquire() as connection:
+      with _Timed("fetch_balance_slot_users"):
+        user_ids = [row["user_id"] for row in await connection.fetch(
+            "SELECT DISTINCT user_id FROM balance_slots WHERE balance <> 0")]
+      for user_id in user_ids:
+        async with connection.transaction():
+          # Waits for transfers of the user, like transfers wait for it.
+          with _Timed("lock_user"):
+            await connection.execute(
+                "SELECT 1 FROM users WHERE user_id = $1 FOR UPDATE", user_id)
+          await self._DrawFromSlots(connection, user_id)
+    return len(user_ids)
+
+  async def FetchIdempotencyKeys(self, idempotency_keys):
+    async with self._Acquire() as connection:
+      return await self._FetchIdempotencyKeys(connection, idempotency_keys)
+
+  async def DeleteIdempotencyKeys(self, max_age_seconds):
+    async with self._Acquire() as connection:
+      with _Timed("delete_idempotency_keys"):
+        result = await connection.execute('''
+            DELETE FROM transfer_idempotency_keys
+            WHERE created_at
+                < now() AT TIME ZONE 'utc' - make_interval(secs => $1)''',
+            max_age_seconds)
+    return int(result.split()[-1])
+
+  async def WriteBalanceCheckpoints(self, min_transfers, settle_seconds):
+    # Checkpoints the balances as of settle_seconds ago of the users with at
+    # least min_transfers transfers since their last checkpoint. Transfers
+    # have to commit within settle_seconds of their transfer_timestamp, or
+    # they are missing from the checkpoints. Returns the number of checkpoints
+    # written, or None if another worker is writing them.
+    async with self._Acquire() as connection:
+      async with connection.transaction(isolation='repeatable_read'):
+        if not await connection.fetchval(
+            "SELECT pg_try_advisory_xact_lock("
+            "hashtext('balance_checkpoints'))"):
+          return None
+        cut = await connection.fetchrow('''
+            SELECT now() AT TIME ZONE 'utc' - make_interval(secs => $1)
+                       AS checkpoint,
+                   max(checkpoint_timestamp) AS previous
+            FROM balance_checkpoints''',
+            settle_seconds)
+        # Only users with transfers since the previous round can be due. A
+        # user's first checkpoint goes back from the current balance.
+        with _Timed("write_balance_checkpoints"):
+          result = await connection.execute('''
+              WITH active AS (
+                SELECT user_id_from AS user_id FROM transfers
+                WHERE transfer_timestamp > coalesce($1::timestamp, '-infinity')
+                  AND transfer_timestamp <= $2
+                UNION
+                SELECT user_id_to FROM transfers
+                WHERE transfer_timestamp > coalesce($1::timestamp, '-infinity')
+                  AND transfer_timestamp <= $2
+              ), due AS (
+                SELECT active.user_id, last.balance, since.net
+                FROM active
+                LEFT JOIN LATERAL (
+                  SELECT checkpoint_timestamp, balance FROM balance_checkpoints
+                  WHERE balance_checkpoints.user_id = active.user_id
+                  ORDER BY checkpoint_timestamp DESC LIMIT 1
+                ) AS last ON true
+                CROSS JOIN LATERAL (
+                  SELECT count(*) AS count, coalesce(sum(CASE
+                      WHEN user_id_to = active.user_id THEN amount
+                      ELSE -amount END), 0) AS net
+                  FROM transfers
+                  WHERE (user_id_from = active.user_id
+                         OR user_id_to = active.user_id)
+                    AND transfer_timestamp
+                        > coalesce(last.checkpoint_timestamp, '-infinity')
+                    AND transfer_timestamp <= $2
+                ) AS since
+                WHERE since.count >= $3
+              )
+              INSERT INTO balance_checkpoints
+                  (user_id, checkpoint_timestamp, balance)
+              SELECT due.user_id, $2,
+                     coalesce(due.balance + due.net,
+                              user_balances.balance - later.net)
+              FROM due
+              JOIN user_balances USING (user_id)
+              CROSS JOIN LATERAL (
+                SELECT coalesce(sum(CASE
+                    WHEN user_id_to = due.user_id THEN amount
+                    ELSE -amount END), 0) AS net
+                FROM transfers
+                WHERE due.balance IS NULL
+                  AND (user_id_from = due.user_id OR user_id_to = due.user_id)
+                  AND transfer_timestamp > $2
+              ) AS later
+              ON CONFLICT DO NOTHING''',
+              cut["previous"], cut["checkpoint"], min_transfers)
+    return int(result.split()[-1])
+
+  async def RollUpTransfers(self, settle_seconds):
+    # Adds the transfers from the previous round up to settle_seconds ago to
+    # the rollups, the same way as WriteBalanceCheckpoints. Transfers only
+    # count for the users of this database, and in total if their sender is
+    # one, which leaves out the receiver's copy of transfers across shards.
+    # Each transaction adds at most _ROLLUP_SLICE_SECONDS of transfers, so
+    # that the first round, which starts at the oldest transfer, doesn't hold
+    # one snapshot over all of them. Returns the number of transfers rolled
+    # up, or None if another worker is rolling them up.
+    transfer_count = None
+    while True:
+      rolled_up = await self._RollUpTransferSlice(settle_seconds)
+      if rolled_up is None:
+        return transfer_count
+      slice_count, caught_up = rolled_up
+      transfer_count = (transfer_count or 0) + slice_count
+      if caught_up:
+        return transfer_count
+
+  async def _RollUpTransferSlice(self, settle_seconds):
+    # Rolls up the next slice and prunes the minute and hour rollups that are
+    # more than MAX_ROLLUP_BUCKETS buckets older than it, which the stats
+    # endpoints never read. Returns the number of transfers rolled up and
+    # whether they reach settle_seconds ago, or None if another worker holds
+    # the lock.
+    async with self._Acquire() as connection:
+      async with connection.transaction(isolation='repeatable_read'):
+        if not await connection.fetchval(
+            "SELECT pg_try_advisory_xact_lock(hashtext('transfer_rollups'))"):
+          return None
+        cut = await connection.fetchrow('''
+            SELECT previous, settled,
+                   least(settled, previous + make_interval(secs => $2))
+                       AS until
+            FROM (SELECT coalesce(
+                           (SELECT rolled_up_until
+                            FROM transfer_rollup_progress),
+                           (SELECT min(transfer_timestamp) FROM transfers))
+                             AS previous,
+                         now() AT TIME ZONE 'utc'
+                           - make_interval(secs => $1)
+                             AS settled) AS cut''',
+            settle_seconds, _ROLLUP_SLICE_SECONDS)
+        # No previous round and no transfers.
+        if cut["previous"] is None or cut["until"] <= cut["previous"]:
+          return 0, True
+        with _Timed("roll_up_transfers"):
+          transfer_count = await connection.fetchval('''
+              WITH new_transfers AS MATERIALIZED (
+                SELECT transfer_timestamp, user_id_from, user_id_to, amount,
+                       EXISTS (SELECT 1 FROM users
+                               WHERE user_id = user_id_from) AS from_here,
+                       EXISTS (SELECT 1 FROM users
+                               WHERE user_id = user_id_to) AS to_here
+                FROM transfers
+                WHERE transfer_timestamp >= $1 AND transfer_timestamp < $2
+              ), buckets AS (
+                SELECT new_transfers.*, granularity,
+                       date_trunc(granularity, transfer_timestamp)
+                           AS bucket_start
+                FROM new_transfers, unnest($3::text[]) AS granularity
+              ), volume AS (
+                INSERT INTO transfer_volume AS v
+                    (granularity, bucket_start, transfer_count, amount)
+                SELECT granularity, bucket_start, count(*), sum(amount)
+                FROM buckets WHERE from_here
+                GROUP BY granularity, bucket_start
+                ON CONFLICT (granularity, bucket_start) DO UPDATE SET
+                  transfer_count = v.transfer_count + excluded.transfer_count,
+                  amount = v.amount + excluded.amount
+              ), legs AS (
+                SELECT granularity, bucket_start, user_id_from AS user_id,
+                       true AS sent, amount
+                FROM buckets WHERE from_here
+                UNION ALL
+                SELECT granularity, bucket_start, user_id_to, false, amount
+                FROM buckets WHERE to_here
+              ), user_volume AS (
+                INSERT INTO user_transfer_volume AS v
+                    (granularity, bucket_start, user_id, sent_count,
+                     sent_amount, received_count, received_amount)
+                SELECT granularity, bucket_start, user_id,
+                       count(*) FILTER (WHERE sent),
+                       coalesce(sum(amount) FILTER (WHERE sent), 0),
+                       count(*) FILTER (WHERE NOT sent),
+                       coalesce(sum(amount) FILTER (WHERE NOT sent), 0)
+                FROM legs
+                GROUP BY granularity, bucket_start, user_id
+                ON CONFLICT (granularity, bucket_start, user_id) DO UPDATE SET
+                  sent_count = v.sent_count + excluded.sent_count,
+                  sent_amount = v.sent_amount + excluded.sent_amount,
+                  received_count = v.received_count + excluded.received_count,
+                  received_amount =
+                      v.received_amount + excluded.received_amount
+              )
+              SELECT count(*) FROM new_transfers WHERE from_here''',
+              cut["previous"], cut["until"], list(GRANULARITIES))
+          for table in ("transfer_volume", "user_transfer_volume"):
+            await connection.execute(f'''
+                DELETE FROM {table} AS v
+                USING unnest($1::text[]) AS pruned (granularity)
+                WHERE v.granularity = pruned.granularity
+                  AND v.bucket_start
+                      < date_trunc(pruned.granularity, $2::timestamp)
+                        - $3::int * ('1 ' || pruned.granularity)::interval''',
+                list(PRUNED_GRANULARITIES), cut["until"], MAX_ROLLUP_BUCKETS)
+          await connection.execute('''
+              INSERT INTO transfer_rollup_progress (rolled_up_until)
+              VALUES ($1) ON CONFLICT (id) DO UPDATE
+              SET rolled_up_until = excluded.rolled_up_until''',
+              cut["until"])
+    return transfer_count, cut["until"] == cut["settled"]
+
+  async def FetchRollupProgress(self):
+    # Returns the time the rollups are complete up to, or None.
+    async with self._Acquire() as connection:
+      with _Timed("fetch_rollup_progress"):
+        return await connection.fetchval(
+            "SELECT rolled_up_until FROM transfer_rollup_progress")
+
+  async def FetchTransferVolume(self, granularity, limit):
+    # Returns the latest limit VolumeBuckets with transfers, newest first.
+    async with self._Acquire() as connection:
+      with _Timed("fetch_transfer_volume"):
+        rows = await connection.fetch('''
+            SELECT bucket_start, transfer_count, amount FROM transfer_volume
+            WHERE granularity = $1
+            ORDER BY bucket_start DESC LIMIT $2''',
+            granularity, limit)
+    return [VolumeBucket(*row) for row in rows]
+
+  async def FetchTopUsers(self, direction, granularity, bucket_count, limit):
+    # Returns the limit UserVolumes with the largest amounts in the direction
+    # over the latest bucket_count buckets, up to the one being rolled up.
+    column = "sent" if direction == DIRECTION_SENT else "received"
+    async with self._Acquire() as connection:
+      with _Timed("fetch_top_users"):
+        rows = await connection.fetch(f'''
+            SELECT user_id, sum({column}_count)::bigint AS transfer_count,
+                   sum({column}_amount)::bigint AS amount
+            FROM user_transfer_volume
+            WHERE granularity = $1 AND bucket_start >= (
+                SELECT date_trunc($1, rolled_up_until)
+                       - ($2 - 1) * ('1 ' || $1)::interval
+                FROM transfer_rollup_progress)
+              AND {column}_count > 0
+            GROUP BY user_id
+            ORDER BY amount DESC, user_id LIMIT $3''',
+            granularity, bucket_count, limit)
+    return [UserVolume(*row) for row in rows]
+
+  async def _FetchPendingMigrations(self, connection, migrations):
+    try:
+      rows = await connection.fetch("SELECT version FROM schema_migrations")
+    except asyncpg.exceptions.UndefinedTableError:
+      rows = []
+    applied_versions = {row["version"] for row in rows}
+    return [
+        migration for migration in migrations
+        if migration.version not in applied_versions]
+
+  async def _ApplyMigration(self, connection, migration):
+    await connection.execute(migration.sql)
+    await connection.execute(
+        "INSERT INTO schema_migrations (version, name) VALUES ($1, $2)",
+        migration.version, migration.name)
+    logging.info("Applied migration %d_%s", migration.version, migration.name)
+
+  async def _SumTransfers(self, connection, user_id, after, until):
+    # Received minus sent in (after, until], None is unbounded.
+    with _Timed("sum_transfers"):
+      return await connection.fetchval('''
+          SELECT coalesce(sum(CASE
+              WHEN user_id_to = $1 THEN amount ELSE -amount END), 0)::bigint
+          FROM transfers
+          WHERE (user_id_from = $1 OR user_id_to = $1)
+            AND transfer_timestamp > coalesce($2::timestamp, '-infinity')
+            AND transfer_timestamp <= coalesce($3::timestamp, 'infinity')''',
+          user_id, after, until)
+
+  async def _FetchIdempotencyKeys(self, connection, idempotency_keys):
+    with _Timed("fetch_idempotency_keys"):
+      rows = await connection.fetch('''
+          SELECT idempotency_key, transfer_id FROM transfer_idempotency_keys
+          WHERE idempotency_key = ANY($1::text[])''',
+          idempotency_keys)
+    return {row["idempotency_key"]: row["transfer_id"] for row in rows}
+
+  async def _InsertIdempotencyKeys(self, connection, idempotency_keys,
+                                   transfer_ids):
+    with _Timed("insert_idempotency_keys"):
+      await connection.execute('''
+          INSERT INTO transfer_idempotency_keys (idempotency_key, transfer_id)
+          SELECT * FROM unnest($1::text[], $2::bigint[])''',
+          idempotency_keys, transfer_ids)
+
+  async def _FindTakenIdempotencyKeys(self, connection, idempotency_keys):
+    # A repeatable read snapshot doesn't show keys committed after it was
+    # taken, and inserting them with ON CONFLICT raises a serialization
+    # failure instead of skipping them, so each key is tried on its own and
+    # rolled back.
+    taken_keys = set()
+    for idempotency_key in idempotency_keys:
+      savepoint = connection.transaction()
+      await savepoint.start()
+      try:
+        with _Timed("probe_idempotency_key"):
+          await connection.execute('''
+              INSERT INTO transfer_idempotency_keys
+                  (idempotency_key, transfer_id)
+              VALUES ($1, 0)''',
+              idempotency_key)
+      except asyncpg.exceptions.UniqueViolationError:
+        taken_keys.add(idempotency_key)
+      finally:
+        await savepoint.rollback()
+    return taken_keys
+
+  async def _NotifyTransfers(self, connection, transfers):
+    with _Timed("notify_transfers"):
+      await connection.execute(
+          "SELECT notify_transfers($1, $2, $3, $4, $5)",
+          *map(list, zip(*(
+              (transfer.transfer_id, transfer.timestamp,
+               transfer.user_id_from, transfer.user_id_to, transfer.amount)
+              for transfer in transfers))))
+
+  async def _PrepareTransaction(self, connection, transaction_id):
+    # Transaction ids are generated by the app and can't be bind parameters.
+    with _Timed("prepare_transaction"):
+      await connection.execute(f"PREPARE TRANSACTION '{transaction_id}'")
+
+  async def _DrawFromSlots(self, connection, user_id):
+    # The caller holds the lock of the users row. Returns its new balance.
+    with _Timed("draw_from_slots"):
+      return await connection.fetchval(
+          "SELECT draw_from_slots($1)", user_id)
+
+  async def _LockUsers(self, connection, user_ids):
+    # Lock in user_id order to avoid DB deadlock.
+    if self._lock_timeout_ms is None:
+      lock_clause = "FOR UPDATE NOWAIT"
+    else:
+      lock_clause = "FOR UPDATE"
+      with _Timed("set_lock_timeout"):
         await connection.execute(
-            "UPDATE users SET balance = $1 WHERE user_id = $2",
-            user2.balance, user2.user_id)
-        return await connection.fetchval('''
-            INSERT INTO transfers (user_id_from, user_id_to, amount)
-            VALUES ($1, $2, $3) RETURNING transfer_id''',
-            user_id_from, user_id_to, amount)
-        
+            f"SET LOCAL lock_timeout = {int(self._lock_timeout_ms)}")
+    with _CountLockBounces(), _Timed("lock_users"):
+      return await connection.fetch(f'''
+          SELECT user_id, balance FROM users
+          WHERE user_id = ANY($1::bigint[])
+          ORDER BY user_id {lock_clause}''',
+          sorted(user_ids))
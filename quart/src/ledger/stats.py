@@ -0,0 +1,42 @@
+import bisect
+
+
+# Upper bounds, in seconds, suited to latencies from sub-millisecond pool
+# acquires to multi-second lock waits.
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+    5.0, 10.0)
+
+
+class Histogram:
+  # Counts observations per bucket; an observation goes into the first bucket
+  # whose upper bound it doesn't exceed, or into the overflow bucket.
+
+  def __init__(self, buckets=LATENCY_BUCKETS):
+    self.buckets = tuple(buckets)
+    self._counts = [0] * (len(self.buckets) + 1)
+    self.count = 0
+    self.sum = 0.0
+
+  def Observe(self, value):
+    self._counts[bisect.bisect_left(self.buckets, value)] += 1
+    self.count += 1
+    self.sum += value
+
+  def CumulativeCounts(self):
+    # One count per bucket plus +Inf, each including all smaller buckets.
+    counts = []
+    total = 0
+    for count in self._counts:
+      total += count
+      counts.append(total)
+    return counts
+
+  def Stats(self):
+    return {
+        "buckets": {
+            str(bound): count for bound, count
+            in zip(self.buckets + ("+Inf",), self.CumulativeCounts())},
+        "count": self.count,
+        "sum": self.sum,
+    }
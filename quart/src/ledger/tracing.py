@@ -0,0 +1,172 @@
+from ledger.metrics import TRACES_WRITTEN
+
+import contextlib
+import contextvars
+import json
+import logging
+import logging.handlers
+import random
+import re
+import time
+
+
+# W3C trace context of the caller: version-trace_id-parent_id-flags.
+TRACEPARENT_HEADER = "traceparent"
+_TRACEPARENT_PATTERN = re.compile(
+    r"00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})")
+_SAMPLED_FLAG = 0x01
+SERVICE_NAME = "ledger"
+# Keeps traces of requests that run many statements bounded.
+MAX_SPANS_PER_TRACE = 1000
+# Spans named in the slow request log.
+_SLOWEST_SPANS_LOGGED = 3
+
+_trace = contextvars.ContextVar("trace", default=None)
+_parent_span_id = contextvars.ContextVar("parent_span_id", default=None)
+
+
+def _NewId(bits):
+  # Zero is not a valid id.
+  return f"{random.getrandbits(bits) | 1:0{bits // 4}x}"
+
+def _ParseTraceparent(traceparent):
+  # Returns the caller's trace id, span id and whether they sampled it, or
+  # Nones for a missing or invalid header.
+  match = traceparent and _TRACEPARENT_PATTERN.fullmatch(traceparent)
+  if not match or not int(match[1], 16) or not int(match[2], 16):
+    return None, None, False
+  return match[1], match[2], bool(int(match[3], 16) & _SAMPLED_FLAG)
+
+def _NowUs():
+  return time.time_ns() // 1000
+
+
+class Trace:
+  # The spans of one request, as Zipkin v2 spans. The request itself is the
+  # root span, which the other spans hang off.
+
+  def __init__(self, name, trace_id, parent_id, sampled, tags):
+    self.name = name
+    self.trace_id = trace_id
+    self.span_id = _NewId(64)
+    self.parent_id = parent_id
+    self.sampled = sampled
+    self.tags = tags
+    self.spans = []
+    self.dropped_spans = 0
+    self.timestamp_us = _NowUs()
+    self.duration = None
+    self._start = time.monotonic()
+
+  def AddSpan(self, span):
+    if len(self.spans) < MAX_SPANS_PER_TRACE:
+      self.spans.append(span)
+    else:
+      self.dropped_spans += 1
+
+  def ToZipkin(self):
+    root = {
+        "traceId": self.trace_id,
+        "id": self.span_id,
+        "kind": "SERVER",
+        "name": self.name,
+        "timestamp": self.timestamp_us,
+        "duration": int(self.duration * 1e6),
+        "localEndpoint": {"serviceName": SERVICE_NAME},
+        "tags": {name: str(value) for name, value in self.tags.items()},
+    }
+    if self.parent_id:
+      root["parentId"] = self.parent_id
+    if self.dropped_spans:
+      root["tags"]["droppedSpans"] = str(self.dropped_spans)
+    return [root] + self.spans
+
+
+@contextlib.contextmanager
+def Span(name, **tags):
+  # Times the block as a child span of the innermost span of the current
+  # request's trace. Outside of a traced request this does nothing. Yields
+  # the span's tags, which the block may add to.
+  trace = _trace.get()
+  if trace is None:
+    yield tags
+    return
+  span_id = _NewId(64)
+  parent_id = _parent_span_id.get() or trace.span_id
+  token = _parent_span_id.set(span_id)
+  timestamp_us = _NowUs()
+  start = time.monotonic()
+  try:
+    yield tags
+  except BaseException as e:
+    tags["error"] = type(e).__name__
+    raise
+  finally:
+    _parent_span_id.reset(token)
+    trace.AddSpan({
+        "traceId": trace.trace_id,
+        "id": span_id,
+        "parentId": parent_id,
+        "name": name,
+        "timestamp": timestamp_us,
+        "duration": int((time.monotonic() - start) * 1e6),
+        "localEndpoint": {"serviceName": SERVICE_NAME},
+        "tags": {name: str(value) for name, value in tags.items()},
+    })
+
+
+class Tracer:
+  # Records the spans of every request, and writes the traces of a
+  # sample_rate share of requests, of requests their caller sampled and of
+  # every request slower than slow_request_ms to path, where tools that read
+  # Zipkin v2 JSON can load them: a JSON list of spans per trace and line.
+  # The file rotates at max_bytes, keeping backup_count old files. Slow
+  # requests are also logged with their slowest spans.
+
+  def __init__(self, path, sample_rate, slow_request_ms, max_bytes,
+               backup_count):
+    self._sample_rate = sample_rate
+    self._slow_request_seconds = slow_request_ms / 1000
+    handler = logging.handlers.RotatingFileHandler(
+        path, maxBytes=max_bytes, backupCount=backup_count, delay=True)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    # Not registered with logging, so that traces don't reach its handlers.
+    self._file = logging.Logger("ledger.traces")
+    self._file.addHandler(handler)
+
+  def Start(self, name, traceparent=None, **tags):
+    # Makes the trace current for the rest of the request, which runs in a
+    # context of its own.
+    trace_id, parent_id, sampled = _ParseTraceparent(traceparent)
+    trace = Trace(
+        name, trace_id or _NewId(128), parent_id,
+        sampled or random.random() < self._sample_rate, tags)
+    _trace.set(trace)
+    _parent_span_id.set(None)
+    return trace
+
+  def Finish(self, trace, **tags):
+    trace.duration = time.monotonic() - trace._start
+    trace.tags.update(tags)
+    _trace.set(None)
+    slow = trace.duration >= self._slow_request_seconds
+    if slow:
+      self._LogSlowRequest(trace)
+    if slow or trace.sampled:
+      TRACES_WRITTEN.Inc(reason="slow" if slow else "sampled")
+      self._file.info(json.dumps(trace.ToZipkin()))
+
+  def Close(self):
+    for handler in self._file.handlers:
+      handler.close()
+
+  def _LogSlowRequest(self, trace):
+    slowest = sorted(
+        trace.spans, key=lambda span: span["duration"],
+        reverse=True)[:_SLOWEST_SPANS_LOGGED]
+    logging.warning(
+        "Slow request %s took %.3f s, trace %s: %s", trace.name,
+        trace.duration, trace.trace_id,
+        ", ".join(
+            f"{span['name']} {span['duration'] / 1e6:.3f} s"
+            for span in slowest) or "no spans")
@@ -0,0 +1,102 @@
+from ledger.model import OverloadedException
+from ledger.tracing import Span
+
+import asyncio
+import logging
+
+
+class TransferScheduler:
+  # Group commit: transfers that arrive while the previous batch is being
+  # committed, or within max_delay_ms of each other, are committed together in
+  # one DB transaction through TransferBatch of the wrapped client.
+
+  def __init__(self, transfer_client, max_batch_size, max_delay_ms):
+    self._transfer_client = transfer_client
+    self._max_batch_size = max_batch_size
+    self._max_delay = max_delay_ms / 1000
+    self._pending = []
+    self._has_pending = None
+    self._batch_is_full = None
+    self._worker = None
+    self._closing = False
+
+  def Start(self):
+    # Events are created here so that they bind to the serving event loop.
+    self._has_pending = asyncio.Event()
+    self._batch_is_full = asyncio.Event()
+    self._closing = False
+    self._worker = asyncio.create_task(self._Run())
+
+  async def Close(self):
+    # Commits whatever is still pending without waiting for the batch window.
+    self._closing = True
+    self._has_pending.set()
+    self._batch_is_full.set()
+    await self._worker
+
+  async def Transfer(self, user_id_from, user_id_to, amount,
+                     idempotency_key=None):
+    # The worker is gone or about to be, and would never commit the transfer.
+    # A 503 sends the client to a worker that is still serving.
+    if self._closing:
+      raise OverloadedException()
+    future = asyncio.get_running_loop().create_future()
+    self._pending.append(
+        ((user_id_from, user_id_to, amount), idempotency_key, future))
+    self._has_pending.set()
+    if len(self._pending) >= self._max_batch_size:
+      self._batch_is_full.set()
+    # The batch runs in the worker task, outside of this request's trace.
+    with Span("group_commit_wait") as tags:
+      result, tags["batch_size"] = await future
+    if isinstance(result, Exception):
+      raise result
+    return result
+
+  async def _Run(self):
+    while True:
+      await self._has_pending.wait()
+      if not self._pending:
+        return  # Woken up by Close.
+      if not self._batch_is_full.is_set():
+        try:
+          await asyncio.wait_for(self._batch_is_full.wait(), self._max_delay)
+        except asyncio.TimeoutError:
+          pass
+      await self._CommitNextBatch()
+
+  async def _CommitNextBatch(self):
+    batch = self._pending[:self._max_batch_size]
+    self._pending = self._pending[self._max_batch_size:]
+    if not self._closing:
+      if not self._pending:
+        self._has_pending.clear()
+      if len(self._pending) < self._max_batch_size:
+        self._batch_is_full.clear()
+
+    try:
+      results = await self._transfer_client.TransferBatch(
+          [transfer for transfer, _, _ in batch],
+          [idempotency_key for _, idempotency_key, _ in batch])
+    except (OverloadedException, asyncio.TimeoutError) as e:
+      # Retrying would ask for more connections while there are none to spare.
+      results = [e] * len(batch)
+    except Exception as e:
+      # E.g. a lock conflict on one of the users aborts the whole batch.
+      # Transfers are retried on their own, so that only the legs that hit the
+      # problem fail. They run one after the other, as legs of a batch running
+      # at once would bounce off each other's locks on a shared user.
+      logging.warning(
+          "Group commit of %d transfers failed, retrying them one by one: %r",
+          len(batch), e)
+      results = []
+      for transfer, idempotency_key, _ in batch:
+        try:
+          results.append(await self._transfer_client.Transfer(
+              *transfer, idempotency_key=idempotency_key))
+        except Exception as transfer_error:
+          results.append(transfer_error)
+    for (_, _, future), result in zip(batch, results):
+      # The request may have been cancelled while waiting.
+      if not future.done():
+        future.set_result((result, len(batch)))
@@ -0,0 +1,118 @@
+import asyncio
+import collections
+import logging
+import time
+
+
+INVALIDATION_CHANNEL = "user_cache_invalidation"
+# Keeps NOTIFY payloads well below Postgres' 8000 byte limit.
+_MAX_USER_IDS_PER_NOTIFICATION = 500
+
+
+class UserCache:
+  # Read-through LRU cache of User records in front of
+  # PostgreSQLClient.FetchUser. Entries expire after ttl_seconds and are
+  # evicted on every worker through LISTEN/NOTIFY when balances change.
+
+  def __init__(self, sql_client, max_size, ttl_seconds):
+    self._sql_client = sql_client
+    self._max_size = max_size
+    self._ttl = ttl_seconds
+    self._entries = collections.OrderedDict()
+    # Bumped on every invalidation so that a fetch that raced with a transfer
+    # doesn't put a stale balance back into the cache.
+    self._generation = 0
+    self._notify_tasks = set()
+    self._hits = 0
+    self._misses = 0
+    self._evictions = 0
+
+  async def Start(self):
+    await self._sql_client.Listen(
+        INVALIDATION_CHANNEL, self._OnNotification, self._OnInterruption)
+
+  async def FetchUser(self, user_id):
+    user = self._Get(user_id)
+    if user:
+      return user
+
+    generation = self._generation
+    user = await self._sql_client.FetchUser(user_id)
+    if user and generation == self._generation:
+      self.Put(user)
+    return user
+
+  async def FetchUsers(self, user_ids):
+    users = []
+    missing_user_ids = []
+    for user_id in user_ids:
+      user = self._Get(user_id)
+      if user:
+        users.append(user)
+      else:
+        missing_user_ids.append(user_id)
+    if not missing_user_ids:
+      return users
+
+    generation = self._generation
+    fetched_users = await self._sql_client.FetchUsers(missing_user_ids)
+    if generation == self._generation:
+      for user in fetched_users:
+        self.Put(user)
+    return users + fetched_users
+
+  def Put(self, user):
+    self._entries[user.user_id] = (user, time.monotonic() + self._ttl)
+    self._entries.move_to_end(user.user_id)
+    if len(self._entries) > self._max_size:
+      self._entries.popitem(last=False)
+      self._evictions += 1
+
+  def Invalidate(self, user_ids):
+    user_ids = sorted(set(user_ids))
+    if not user_ids:
+      return
+    self._Evict(user_ids)
+    # Other workers are told in the background so that the caller doesn't
+    # wait for another round trip.
+    payloads = [
+        ",".join(map(str, user_ids[i:i + _MAX_USER_IDS_PER_NOTIFICATION]))
+        for i in range(0, len(user_ids), _MAX_USER_IDS_PER_NOTIFICATION)]
+    task = asyncio.create_task(self._Notify(payloads))
+    self._notify_tasks.add(task)
+    task.add_done_callback(self._notify_tasks.discard)
+
+  def Stats(self):
+    return {
+        "size": len(self._entries),
+        "hits": self._hits,
+        "misses": self._misses,
+        "evictions": self._evictions,
+    }
+
+  def _Get(self, user_id):
+    entry = self._entries.get(user_id)
+    if entry and entry[1] > time.monotonic():
+      self._entries.move_to_end(user_id)
+      self._hits += 1
+      return entry[0]
+    self._misses += 1
+    return None
+
+  def _Evict(self, user_ids):
+    self._generation += 1
+    for user_id in user_ids:
+      self._entries.pop(user_id, None)
+
+  async def _Notify(self, payloads):
+    try:
+      await self._sql_client.Notify(INVALIDATION_CHANNEL, payloads)
+    except Exception as e:
+      logging.exception(e)
+
+  def _OnInterruption(self):
+    # Invalidations may have been missed, so no entry can be trusted.
+    self._Evict(list(self._entries))
+
+  def _OnNotification(self, connection, pid, channel, payload):
+    self._Evict(int(user_id) for user_id in payload.split(","))
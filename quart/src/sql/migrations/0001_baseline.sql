@@ -0,0 +1,267 @@
+-- the schema as it was before versioned migrations; every statement is
+-- idempotent, so it also applies to databases created by schema.sql. It runs
+-- under the advisory lock of PostgreSQLClient.ApplyMigrations, which the
+-- conversion of transfers below relies on
+
+-- using more verbose forms of DDL to allow support for more databases
+CREATE TABLE IF NOT EXISTS users (
+  user_id BIGSERIAL,
+  balance BIGINT NOT NULL,
+  PRIMARY KEY (user_id)
+);
+
+-- a transfers table from before partitioning is renamed out of the way here
+-- and attached below as the partition of everything up to the end of its
+-- last month, so no rows have to be copied
+DO $$
+DECLARE
+  legacy_index RECORD;
+BEGIN
+  IF EXISTS (
+      SELECT 1 FROM pg_class
+      WHERE oid = to_regclass('transfers') AND relkind = 'r') THEN
+    ALTER TABLE transfers RENAME TO transfers_legacy;
+    FOR legacy_index IN
+      SELECT indexname FROM pg_indexes
+      WHERE schemaname = current_schema() AND tablename = 'transfers_legacy'
+    LOOP
+      EXECUTE format(
+        'ALTER INDEX %I RENAME TO %I', legacy_index.indexname,
+        'transfers_legacy' || substr(legacy_index.indexname, 10));
+    END LOOP;
+    ALTER SEQUENCE transfers_transfer_id_seq OWNED BY NONE;
+    UPDATE transfers_legacy SET transfer_timestamp = '-infinity'
+    WHERE transfer_timestamp IS NULL;
+    ALTER TABLE transfers_legacy
+      ALTER COLUMN transfer_timestamp SET NOT NULL;
+  END IF;
+END $$;
+
+-- this table is simply to log transactions; it is partitioned by month of
+-- transfer_timestamp, see create_transfer_partitions() and
+-- ledger/partitions.py
+CREATE SEQUENCE IF NOT EXISTS transfers_transfer_id_seq AS BIGINT;
+CREATE TABLE IF NOT EXISTS transfers (
+  transfer_id BIGINT NOT NULL DEFAULT nextval('transfers_transfer_id_seq'),
+  transfer_timestamp TIMESTAMP NOT NULL DEFAULT current_timestamp,
+  user_id_from BIGINT,
+  user_id_to BIGINT,
+  amount BIGINT NOT NULL,
+  -- the partition key has to be part of the primary key
+  PRIMARY KEY (transfer_id, transfer_timestamp)
+) PARTITION BY RANGE (transfer_timestamp);
+ALTER SEQUENCE transfers_transfer_id_seq OWNED BY transfers.transfer_id;
+
+DO $$
+DECLARE
+  upper_bound TIMESTAMP;
+BEGIN
+  IF to_regclass('transfers_legacy') IS NOT NULL AND NOT EXISTS (
+      SELECT 1 FROM pg_inherits
+      WHERE inhrelid = to_regclass('transfers_legacy')) THEN
+    SELECT date_trunc('month', max(transfer_timestamp)) + interval '1 month'
+    INTO upper_bound FROM transfers_legacy;
+    IF upper_bound IS NULL THEN
+      DROP TABLE transfers_legacy;
+    ELSE
+      EXECUTE format(
+        'ALTER TABLE transfers ATTACH PARTITION transfers_legacy '
+        'FOR VALUES FROM (MINVALUE) TO (%L)', upper_bound);
+    END IF;
+  END IF;
+END $$;
+
+-- creates the missing monthly partitions of transfers from the month of p_from
+-- to the month of p_to and returns how many were created. Each partition is
+-- created on its own and then attached, which doesn't block transfers.
+CREATE OR REPLACE FUNCTION create_transfer_partitions(
+  p_from TIMESTAMP,
+  p_to TIMESTAMP
+) RETURNS INT AS $$
+DECLARE
+  month_start TIMESTAMP := date_trunc('month', p_from);
+  partition_name TEXT;
+  created_count INT := 0;
+BEGIN
+  WHILE month_start <= p_to LOOP
+    partition_name := 'transfers_p' || to_char(month_start, 'YYYYMM');
+    IF to_regclass(partition_name) IS NULL THEN
+      BEGIN
+        EXECUTE format(
+          'CREATE TABLE %I (LIKE transfers INCLUDING DEFAULTS)',
+          partition_name);
+        EXECUTE format(
+          'ALTER TABLE transfers ATTACH PARTITION %I '
+          'FOR VALUES FROM (%L) TO (%L)',
+          partition_name, month_start, month_start + interval '1 month');
+        created_count := created_count + 1;
+      EXCEPTION WHEN invalid_object_definition THEN
+        -- overlaps the partition of a table from before partitioning
+        NULL;
+      END;
+    END IF;
+    month_start := month_start + interval '1 month';
+  END LOOP;
+  RETURN created_count;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT create_transfer_partitions(
+  localtimestamp, localtimestamp + interval '1 month');
+
+-- serve per-user history pages newest first without scanning the table
+CREATE INDEX IF NOT EXISTS transfers_user_id_from_transfer_id_idx
+  ON transfers (user_id_from, transfer_id);
+CREATE INDEX IF NOT EXISTS transfers_user_id_to_transfer_id_idx
+  ON transfers (user_id_to, transfer_id);
+-- transfer_timestamp grows with the table, so a tiny BRIN index is enough to
+-- find the transfer_id range of a time window for exports
+CREATE INDEX IF NOT EXISTS transfers_transfer_timestamp_brin_idx
+  ON transfers USING BRIN (transfer_timestamp);
+
+-- idempotency keys of POST /transactions, written in the transaction of the
+-- transfer they belong to; rows older than the configured TTL are purged
+CREATE TABLE IF NOT EXISTS transfer_idempotency_keys (
+  idempotency_key TEXT NOT NULL,
+  transfer_id BIGINT NOT NULL,
+  created_at TIMESTAMP NOT NULL DEFAULT current_timestamp,
+  PRIMARY KEY (idempotency_key)
+);
+CREATE INDEX IF NOT EXISTS transfer_idempotency_keys_created_at_idx
+  ON transfer_idempotency_keys (created_at);
+
+-- balances of users at points in time, so that balances in the past only
+-- need the transfers since the nearest checkpoint
+CREATE TABLE IF NOT EXISTS balance_checkpoints (
+  user_id BIGINT NOT NULL,
+  checkpoint_timestamp TIMESTAMP NOT NULL,
+  balance BIGINT NOT NULL,
+  PRIMARY KEY (user_id, checkpoint_timestamp)
+);
+CREATE INDEX IF NOT EXISTS balance_checkpoints_checkpoint_timestamp_idx
+  ON balance_checkpoints (checkpoint_timestamp);
+
+-- outcomes of two-phase transfers between shards that this shard
+-- coordinates; the first decision recorded for a transaction wins
+CREATE TABLE IF NOT EXISTS coordinator_log (
+  transaction_id TEXT NOT NULL,
+  committed BOOLEAN NOT NULL,
+  decided_at TIMESTAMP NOT NULL DEFAULT current_timestamp,
+  PRIMARY KEY (transaction_id)
+);
+
+-- every shard hands out user and transfer ids from its own range, which
+-- ledger/sharding.py sets for this migration; the first shard's range starts
+-- at 1 but ends where the second shard's begins, like the others
+DO $$
+DECLARE
+  raw_range_start BIGINT :=
+    nullif(current_setting('ledger.id_range_start', true), '')::BIGINT;
+  range_start BIGINT := greatest(raw_range_start, 1);
+  range_end BIGINT := raw_range_start - 1
+    + nullif(current_setting('ledger.id_range_size', true), '')::BIGINT;
+  sequence_name TEXT;
+  last_value BIGINT;
+BEGIN
+  IF range_end IS NULL THEN
+    RETURN;
+  END IF;
+  FOREACH sequence_name IN ARRAY
+      ARRAY['users_user_id_seq', 'transfers_transfer_id_seq'] LOOP
+    EXECUTE format('SELECT last_value FROM %I', sequence_name)
+      INTO last_value;
+    IF last_value < range_start THEN
+      EXECUTE format(
+        'ALTER SEQUENCE %I MINVALUE %s MAXVALUE %s START %s RESTART',
+        sequence_name, range_start, range_end, range_start);
+    ELSE
+      EXECUTE format('ALTER SEQUENCE %I MINVALUE %s MAXVALUE %s START %s',
+        sequence_name, range_start, range_end, range_start);
+    END IF;
+  END LOOP;
+END;
+$$;
+
+-- added two users with some arbit balance just for demo purposes, on the
+-- first shard only
+INSERT INTO users (balance)
+SELECT 100 WHERE NOT EXISTS (SELECT user_id FROM users WHERE user_id = 1)
+  AND coalesce(current_setting('ledger.id_range_start', true), '') IN ('', '0')
+ON CONFLICT (user_id) DO NOTHING;
+INSERT INTO users (balance)
+SELECT 100 WHERE NOT EXISTS (SELECT user_id FROM users WHERE user_id = 2)
+  AND coalesce(current_setting('ledger.id_range_start', true), '') IN ('', '0')
+ON CONFLICT (user_id) DO NOTHING;
+
+-- does the whole transfer in a single round trip; returns the new transfer_id,
+-- -1 if either user does not exist or -2 if the sender has insufficient funds.
+-- Row locks bounce immediately unless p_lock_timeout_ms is given, in which
+-- case they are waited for up to that long. A transfer with a known
+-- p_idempotency_key is not repeated; the original transfer_id is returned.
+DROP FUNCTION IF EXISTS transfer(BIGINT, BIGINT, BIGINT);
+DROP FUNCTION IF EXISTS transfer(BIGINT, BIGINT, BIGINT, INT);
+CREATE OR REPLACE FUNCTION transfer(
+  p_user_id_from BIGINT,
+  p_user_id_to BIGINT,
+  p_amount BIGINT,
+  p_lock_timeout_ms INT DEFAULT NULL,
+  p_idempotency_key TEXT DEFAULT NULL
+) RETURNS BIGINT AS $$
+DECLARE
+  locked_user RECORD;
+  locked_count INT := 0;
+  balance_from BIGINT;
+  new_transfer_id BIGINT;
+BEGIN
+  IF p_user_id_from = p_user_id_to THEN
+    RETURN -1;
+  END IF;
+  -- lock ordered by user_id to avoid deadlock
+  IF p_lock_timeout_ms IS NULL THEN
+    PERFORM 1 FROM users
+    WHERE user_id IN (p_user_id_from, p_user_id_to)
+    ORDER BY user_id FOR UPDATE NOWAIT;
+  ELSE
+    PERFORM set_config('lock_timeout', p_lock_timeout_ms || 'ms', true);
+    PERFORM 1 FROM users
+    WHERE user_id IN (p_user_id_from, p_user_id_to)
+    ORDER BY user_id FOR UPDATE;
+  END IF;
+  FOR locked_user IN
+    SELECT user_id, balance FROM users
+    WHERE user_id IN (p_user_id_from, p_user_id_to)
+  LOOP
+    locked_count := locked_count + 1;
+    IF locked_user.user_id = p_user_id_from THEN
+      balance_from := locked_user.balance;
+    END IF;
+  END LOOP;
+  IF locked_count < 2 THEN
+    RETURN -1;
+  END IF;
+  -- checked under the row locks, so a retry waits for the original to commit
+  IF p_idempotency_key IS NOT NULL THEN
+    SELECT transfer_id INTO new_transfer_id FROM transfer_idempotency_keys
+    WHERE idempotency_key = p_idempotency_key;
+    IF FOUND THEN
+      RETURN new_transfer_id;
+    END IF;
+  END IF;
+  IF balance_from < p_amount THEN
+    RETURN -2;
+  END IF;
+
+  UPDATE users SET balance = CASE
+    WHEN user_id = p_user_id_from THEN balance - p_amount
+    ELSE balance + p_amount END
+  WHERE user_id IN (p_user_id_from, p_user_id_to);
+  INSERT INTO transfers (user_id_from, user_id_to, amount)
+  VALUES (p_user_id_from, p_user_id_to, p_amount)
+  RETURNING transfer_id INTO new_transfer_id;
+  IF p_idempotency_key IS NOT NULL THEN
+    INSERT INTO transfer_idempotency_keys (idempotency_key, transfer_id)
+    VALUES (p_idempotency_key, new_transfer_id);
+  END IF;
+  RETURN new_transfer_id;
+END;
+$$ LANGUAGE plpgsql;
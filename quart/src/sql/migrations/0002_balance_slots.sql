@@ -0,0 +1,134 @@
+-- split accounts: the balance of a user is users.balance plus the balances of
+-- their rows in balance_slots. transfer() credits a user with slot_count > 0
+-- in one of their slots at random instead of their users row, so transfers
+-- into a hot account don't wait for each other's row lock. Debits lock the
+-- users row and draw the slots into it when it runs short. Slot rows stay
+-- when a user is joined back (slot_count 0), so credits that read the old
+-- slot_count still land in one.
+ALTER TABLE users ADD COLUMN IF NOT EXISTS slot_count INT NOT NULL DEFAULT 0;
+
+CREATE TABLE IF NOT EXISTS balance_slots (
+  user_id BIGINT NOT NULL REFERENCES users (user_id),
+  slot INT NOT NULL,
+  balance BIGINT NOT NULL DEFAULT 0,
+  PRIMARY KEY (user_id, slot)
+);
+
+CREATE OR REPLACE VIEW user_balances AS
+SELECT user_id, balance + coalesce((
+    SELECT sum(balance_slots.balance) FROM balance_slots
+    WHERE balance_slots.user_id = users.user_id), 0)::bigint AS balance
+FROM users;
+
+-- moves the balances of the user's slots into their users row, which the
+-- caller has locked; returns the new balance of the row
+CREATE OR REPLACE FUNCTION draw_from_slots(p_user_id BIGINT)
+RETURNS BIGINT AS $$
+DECLARE
+  drawn BIGINT;
+  new_balance BIGINT;
+BEGIN
+  -- RETURNING has the new balances, so the locked ones are subtracted
+  WITH locked AS (
+    SELECT slot, balance FROM balance_slots
+    WHERE user_id = p_user_id AND balance <> 0
+    FOR UPDATE
+  ), drained AS (
+    UPDATE balance_slots
+    SET balance = balance_slots.balance - locked.balance
+    FROM locked
+    WHERE balance_slots.user_id = p_user_id AND balance_slots.slot = locked.slot
+    RETURNING locked.balance
+  )
+  SELECT sum(balance) INTO drawn FROM drained;
+  -- the users row isn't rewritten when there was nothing to draw
+  IF drawn IS NULL THEN
+    SELECT balance INTO new_balance FROM users WHERE user_id = p_user_id;
+  ELSE
+    UPDATE users SET balance = balance + drawn WHERE user_id = p_user_id
+    RETURNING balance INTO new_balance;
+  END IF;
+  RETURN new_balance;
+END;
+$$ LANGUAGE plpgsql;
+
+-- as in 0001_baseline, except that the users row of a split receiver isn't
+-- locked and the sender draws from their slots when short
+CREATE OR REPLACE FUNCTION transfer(
+  p_user_id_from BIGINT,
+  p_user_id_to BIGINT,
+  p_amount BIGINT,
+  p_lock_timeout_ms INT DEFAULT NULL,
+  p_idempotency_key TEXT DEFAULT NULL
+) RETURNS BIGINT AS $$
+DECLARE
+  slot_count_to INT;
+  slot_to INT;
+  locked_user_ids BIGINT[];
+  balance_from BIGINT;
+  new_transfer_id BIGINT;
+BEGIN
+  IF p_user_id_from = p_user_id_to THEN
+    RETURN -1;
+  END IF;
+  SELECT slot_count INTO slot_count_to FROM users
+  WHERE user_id = p_user_id_to;
+  IF NOT FOUND THEN
+    RETURN -1;
+  END IF;
+  locked_user_ids := CASE WHEN slot_count_to > 0
+    THEN ARRAY[p_user_id_from] ELSE ARRAY[p_user_id_from, p_user_id_to] END;
+  -- lock ordered by user_id to avoid deadlock
+  IF p_lock_timeout_ms IS NULL THEN
+    PERFORM 1 FROM users
+    WHERE user_id = ANY(locked_user_ids)
+    ORDER BY user_id FOR UPDATE NOWAIT;
+  ELSE
+    PERFORM set_config('lock_timeout', p_lock_timeout_ms || 'ms', true);
+    PERFORM 1 FROM users
+    WHERE user_id = ANY(locked_user_ids)
+    ORDER BY user_id FOR UPDATE;
+  END IF;
+  SELECT balance INTO balance_from FROM users WHERE user_id = p_user_id_from;
+  IF NOT FOUND THEN
+    RETURN -1;
+  END IF;
+  -- checked under the sender's row lock, so a retry waits for the original
+  -- to commit
+  IF p_idempotency_key IS NOT NULL THEN
+    SELECT transfer_id INTO new_transfer_id FROM transfer_idempotency_keys
+    WHERE idempotency_key = p_idempotency_key;
+    IF FOUND THEN
+      RETURN new_transfer_id;
+    END IF;
+  END IF;
+  IF balance_from < p_amount THEN
+    balance_from := draw_from_slots(p_user_id_from);
+  END IF;
+  IF balance_from < p_amount THEN
+    RETURN -2;
+  END IF;
+
+  IF slot_count_to > 0 THEN
+    UPDATE users SET balance = balance - p_amount
+    WHERE user_id = p_user_id_from;
+    -- drawn once, random() in the WHERE clause would be drawn per row
+    slot_to := floor(random() * slot_count_to)::INT;
+    UPDATE balance_slots SET balance = balance + p_amount
+    WHERE user_id = p_user_id_to AND slot = slot_to;
+  ELSE
+    UPDATE users SET balance = CASE
+      WHEN user_id = p_user_id_from THEN balance - p_amount
+      ELSE balance + p_amount END
+    WHERE user_id IN (p_user_id_from, p_user_id_to);
+  END IF;
+  INSERT INTO transfers (user_id_from, user_id_to, amount)
+  VALUES (p_user_id_from, p_user_id_to, p_amount)
+  RETURNING transfer_id INTO new_transfer_id;
+  IF p_idempotency_key IS NOT NULL THEN
+    INSERT INTO transfer_idempotency_keys (idempotency_key, transfer_id)
+    VALUES (p_idempotency_key, new_transfer_id);
+  END IF;
+  RETURN new_transfer_id;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,122 @@
+-- transfer events: notify_transfers() sends one notification per transfer on
+-- the ledger_transfers channel, with the balances of both users as their
+-- transaction left them, see ledger/events.py. Postgres delivers it when the
+-- transaction commits, and not at all if it rolls back. NOTIFY serializes
+-- commits on a global lock, so transfers only notify when asked to. Users
+-- that aren't in this database get a null balance; transfers across shards
+-- notify on both.
+CREATE OR REPLACE FUNCTION notify_transfers(
+  p_transfer_ids BIGINT[],
+  p_transfer_timestamps TIMESTAMP[],
+  p_user_ids_from BIGINT[],
+  p_user_ids_to BIGINT[],
+  p_amounts BIGINT[]
+) RETURNS VOID AS $$
+BEGIN
+  PERFORM pg_notify('ledger_transfers', json_build_object(
+    'transferId', t.transfer_id,
+    'timestamp', t.transfer_timestamp,
+    'userIdFrom', t.user_id_from,
+    'userIdTo', t.user_id_to,
+    'amount', t.amount,
+    'balanceFrom', (SELECT balance FROM user_balances
+                    WHERE user_id = t.user_id_from),
+    'balanceTo', (SELECT balance FROM user_balances
+                  WHERE user_id = t.user_id_to))::text)
+  FROM unnest(p_transfer_ids, p_transfer_timestamps, p_user_ids_from,
+              p_user_ids_to, p_amounts)
+    WITH ORDINALITY AS t (transfer_id, transfer_timestamp, user_id_from,
+                          user_id_to, amount, n)
+  ORDER BY n;
+END;
+$$ LANGUAGE plpgsql;
+
+-- as in 0002_balance_slots, plus p_notify; the old signature is dropped so
+-- that calls without p_notify aren't ambiguous
+DROP FUNCTION IF EXISTS transfer(BIGINT, BIGINT, BIGINT, INT, TEXT);
+CREATE OR REPLACE FUNCTION transfer(
+  p_user_id_from BIGINT,
+  p_user_id_to BIGINT,
+  p_amount BIGINT,
+  p_lock_timeout_ms INT DEFAULT NULL,
+  p_idempotency_key TEXT DEFAULT NULL,
+  p_notify BOOLEAN DEFAULT false
+) RETURNS BIGINT AS $$
+DECLARE
+  slot_count_to INT;
+  slot_to INT;
+  locked_user_ids BIGINT[];
+  balance_from BIGINT;
+  new_transfer_id BIGINT;
+  new_transfer_timestamp TIMESTAMP;
+BEGIN
+  IF p_user_id_from = p_user_id_to THEN
+    RETURN -1;
+  END IF;
+  SELECT slot_count INTO slot_count_to FROM users
+  WHERE user_id = p_user_id_to;
+  IF NOT FOUND THEN
+    RETURN -1;
+  END IF;
+  locked_user_ids := CASE WHEN slot_count_to > 0
+    THEN ARRAY[p_user_id_from] ELSE ARRAY[p_user_id_from, p_user_id_to] END;
+  -- lock ordered by user_id to avoid deadlock
+  IF p_lock_timeout_ms IS NULL THEN
+    PERFORM 1 FROM users
+    WHERE user_id = ANY(locked_user_ids)
+    ORDER BY user_id FOR UPDATE NOWAIT;
+  ELSE
+    PERFORM set_config('lock_timeout', p_lock_timeout_ms || 'ms', true);
+    PERFORM 1 FROM users
+    WHERE user_id = ANY(locked_user_ids)
+    ORDER BY user_id FOR UPDATE;
+  END IF;
+  SELECT balance INTO balance_from FROM users WHERE user_id = p_user_id_from;
+  IF NOT FOUND THEN
+    RETURN -1;
+  END IF;
+  -- checked under the sender's row lock, so a retry waits for the original
+  -- to commit
+  IF p_idempotency_key IS NOT NULL THEN
+    SELECT transfer_id INTO new_transfer_id FROM transfer_idempotency_keys
+    WHERE idempotency_key = p_idempotency_key;
+    IF FOUND THEN
+      RETURN new_transfer_id;
+    END IF;
+  END IF;
+  IF balance_from < p_amount THEN
+    balance_from := draw_from_slots(p_user_id_from);
+  END IF;
+  IF balance_from < p_amount THEN
+    RETURN -2;
+  END IF;
+
+  IF slot_count_to > 0 THEN
+    UPDATE users SET balance = balance - p_amount
+    WHERE user_id = p_user_id_from;
+    -- drawn once, random() in the WHERE clause would be drawn per row
+    slot_to := floor(random() * slot_count_to)::INT;
+    UPDATE balance_slots SET balance = balance + p_amount
+    WHERE user_id = p_user_id_to AND slot = slot_to;
+  ELSE
+    UPDATE users SET balance = CASE
+      WHEN user_id = p_user_id_from THEN balance - p_amount
+      ELSE balance + p_amount END
+    WHERE user_id IN (p_user_id_from, p_user_id_to);
+  END IF;
+  INSERT INTO transfers (user_id_from, user_id_to, amount)
+  VALUES (p_user_id_from, p_user_id_to, p_amount)
+  RETURNING transfer_id, transfer_timestamp
+  INTO new_transfer_id, new_transfer_timestamp;
+  IF p_idempotency_key IS NOT NULL THEN
+    INSERT INTO transfer_idempotency_keys (idempotency_key, transfer_id)
+    VALUES (p_idempotency_key, new_transfer_id);
+  END IF;
+  IF p_notify THEN
+    PERFORM notify_transfers(
+      ARRAY[new_transfer_id], ARRAY[new_transfer_timestamp],
+      ARRAY[p_user_id_from], ARRAY[p_user_id_to], ARRAY[p_amount]);
+  END IF;
+  RETURN new_transfer_id;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,30 @@
+-- transfer rollups: counts and sums of transfers per minute, hour and day
+-- bucket, in total and per user, for the stats endpoints, so that they don't
+-- aggregate the transfers table. The rollup worker adds the transfers up to
+-- rolled_up_until, see ledger/rollups.py. Bucket starts are in UTC, like
+-- transfer_timestamp. Rollups outlive archived partitions.
+CREATE TABLE IF NOT EXISTS transfer_volume (
+  granularity TEXT NOT NULL,
+  bucket_start TIMESTAMP NOT NULL,
+  transfer_count BIGINT NOT NULL,
+  amount BIGINT NOT NULL,
+  PRIMARY KEY (granularity, bucket_start)
+);
+
+CREATE TABLE IF NOT EXISTS user_transfer_volume (
+  granularity TEXT NOT NULL,
+  bucket_start TIMESTAMP NOT NULL,
+  user_id BIGINT NOT NULL,
+  sent_count BIGINT NOT NULL,
+  sent_amount BIGINT NOT NULL,
+  received_count BIGINT NOT NULL,
+  received_amount BIGINT NOT NULL,
+  PRIMARY KEY (granularity, bucket_start, user_id)
+);
+
+-- at most one row; no row means nothing is rolled up yet
+CREATE TABLE IF NOT EXISTS transfer_rollup_progress (
+  id BOOLEAN NOT NULL DEFAULT true CHECK (id),
+  rolled_up_until TIMESTAMP NOT NULL,
+  PRIMARY KEY (id)
+);
@@ -0,0 +1,113 @@
+-- transfer replays: transfer_or_replay() is transfer() of
+-- 0003_transfer_events, plus o_replayed, which is true when the idempotency
+-- key was known and o_transfer_id is the original transfer's, so that replays
+-- aren't counted as new transfers. transfer() now wraps it, for workers that
+-- still call it during a deploy.
+CREATE OR REPLACE FUNCTION transfer_or_replay(
+  p_user_id_from BIGINT,
+  p_user_id_to BIGINT,
+  p_amount BIGINT,
+  p_lock_timeout_ms INT DEFAULT NULL,
+  p_idempotency_key TEXT DEFAULT NULL,
+  p_notify BOOLEAN DEFAULT false,
+  OUT o_transfer_id BIGINT,
+  OUT o_replayed BOOLEAN
+) AS $$
+DECLARE
+  slot_count_to INT;
+  slot_to INT;
+  locked_user_ids BIGINT[];
+  balance_from BIGINT;
+  new_transfer_id BIGINT;
+  new_transfer_timestamp TIMESTAMP;
+BEGIN
+  o_replayed := false;
+  IF p_user_id_from = p_user_id_to THEN
+    o_transfer_id := -1;
+    RETURN;
+  END IF;
+  SELECT slot_count INTO slot_count_to FROM users
+  WHERE user_id = p_user_id_to;
+  IF NOT FOUND THEN
+    o_transfer_id := -1;
+    RETURN;
+  END IF;
+  locked_user_ids := CASE WHEN slot_count_to > 0
+    THEN ARRAY[p_user_id_from] ELSE ARRAY[p_user_id_from, p_user_id_to] END;
+  -- lock ordered by user_id to avoid deadlock
+  IF p_lock_timeout_ms IS NULL THEN
+    PERFORM 1 FROM users
+    WHERE user_id = ANY(locked_user_ids)
+    ORDER BY user_id FOR UPDATE NOWAIT;
+  ELSE
+    PERFORM set_config('lock_timeout', p_lock_timeout_ms || 'ms', true);
+    PERFORM 1 FROM users
+    WHERE user_id = ANY(locked_user_ids)
+    ORDER BY user_id FOR UPDATE;
+  END IF;
+  SELECT balance INTO balance_from FROM users WHERE user_id = p_user_id_from;
+  IF NOT FOUND THEN
+    o_transfer_id := -1;
+    RETURN;
+  END IF;
+  -- checked under the sender's row lock, so a retry waits for the original
+  -- to commit
+  IF p_idempotency_key IS NOT NULL THEN
+    SELECT transfer_id INTO new_transfer_id FROM transfer_idempotency_keys
+    WHERE idempotency_key = p_idempotency_key;
+    IF FOUND THEN
+      o_transfer_id := new_transfer_id;
+      o_replayed := true;
+      RETURN;
+    END IF;
+  END IF;
+  IF balance_from < p_amount THEN
+    balance_from := draw_from_slots(p_user_id_from);
+  END IF;
+  IF balance_from < p_amount THEN
+    o_transfer_id := -2;
+    RETURN;
+  END IF;
+
+  IF slot_count_to > 0 THEN
+    UPDATE users SET balance = balance - p_amount
+    WHERE user_id = p_user_id_from;
+    -- drawn once, random() in the WHERE clause would be drawn per row
+    slot_to := floor(random() * slot_count_to)::INT;
+    UPDATE balance_slots SET balance = balance + p_amount
+    WHERE user_id = p_user_id_to AND slot = slot_to;
+  ELSE
+    UPDATE users SET balance = CASE
+      WHEN user_id = p_user_id_from THEN balance - p_amount
+      ELSE balance + p_amount END
+    WHERE user_id IN (p_user_id_from, p_user_id_to);
+  END IF;
+  INSERT INTO transfers (user_id_from, user_id_to, amount)
+  VALUES (p_user_id_from, p_user_id_to, p_amount)
+  RETURNING transfer_id, transfer_timestamp
+  INTO new_transfer_id, new_transfer_timestamp;
+  IF p_idempotency_key IS NOT NULL THEN
+    INSERT INTO transfer_idempotency_keys (idempotency_key, transfer_id)
+    VALUES (p_idempotency_key, new_transfer_id);
+  END IF;
+  IF p_notify THEN
+    PERFORM notify_transfers(
+      ARRAY[new_transfer_id], ARRAY[new_transfer_timestamp],
+      ARRAY[p_user_id_from], ARRAY[p_user_id_to], ARRAY[p_amount]);
+  END IF;
+  o_transfer_id := new_transfer_id;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION transfer(
+  p_user_id_from BIGINT,
+  p_user_id_to BIGINT,
+  p_amount BIGINT,
+  p_lock_timeout_ms INT DEFAULT NULL,
+  p_idempotency_key TEXT DEFAULT NULL,
+  p_notify BOOLEAN DEFAULT false
+) RETURNS BIGINT AS $$
+  SELECT o_transfer_id FROM transfer_or_replay(
+    p_user_id_from, p_user_id_to, p_amount, p_lock_timeout_ms,
+    p_idempotency_key, p_notify);
+$$ LANGUAGE sql;
@@ -0,0 +1,14 @@
+-- utc timestamps: columns of type TIMESTAMP hold UTC, which the as-of
+-- balances, checkpoints, rollups and partitions rely on, so their defaults no
+-- longer depend on the TimeZone setting of the session that writes them. Rows
+-- written before hold the session's local time, which is UTC unless the
+-- server or the client was set to another time zone.
+ALTER TABLE transfers
+  ALTER COLUMN transfer_timestamp SET DEFAULT (now() AT TIME ZONE 'utc');
+ALTER TABLE transfer_idempotency_keys
+  ALTER COLUMN created_at SET DEFAULT (now() AT TIME ZONE 'utc');
+ALTER TABLE coordinator_log
+  ALTER COLUMN decided_at SET DEFAULT (now() AT TIME ZONE 'utc');
+
+SELECT create_transfer_partitions(
+  now() AT TIME ZONE 'utc', now() AT TIME ZONE 'utc' + interval '1 month');
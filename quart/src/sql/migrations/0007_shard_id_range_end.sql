@@ -0,0 +1,20 @@
+-- shard id range end: 0001_baseline ended the first shard's range at
+-- ID_RANGE_SIZE, the first id of the second shard, so both could hand it out.
+-- Ends it one id earlier on shards migrated before the fix; the other shards'
+-- ranges were right and are set to the same end again.
+DO $$
+DECLARE
+  range_end BIGINT :=
+    nullif(current_setting('ledger.id_range_start', true), '')::BIGINT - 1
+    + nullif(current_setting('ledger.id_range_size', true), '')::BIGINT;
+  sequence_name TEXT;
+BEGIN
+  IF range_end IS NULL THEN
+    RETURN;
+  END IF;
+  FOREACH sequence_name IN ARRAY
+      ARRAY['users_user_id_seq', 'transfers_transfer_id_seq'] LOOP
+    EXECUTE format('ALTER SEQUENCE %I MAXVALUE %s', sequence_name, range_end);
+  END LOOP;
+END;
+$$;
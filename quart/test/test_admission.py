@@ -0,0 +1,106 @@
+from ledger.admission import (
+    PRIORITY_READ, PRIORITY_TRANSFER, AdmissionController)
+from ledger.model import OverloadedException
+
+import asyncio
+import pytest
+
+def Controller(max_in_flight=1, max_queued=10, max_wait_ms=1000):
+  return AdmissionController(
+      max_in_flight,
+      {PRIORITY_TRANSFER: max_queued, PRIORITY_READ: max_queued},
+      max_wait_ms, 2)
+
+async def Hold(controller, priority, release, admitted=None):
+  async with controller.Admit(priority):
+    if admitted is not None:
+      admitted.append(priority)
+    await release.wait()
+
+@pytest.mark.asyncio
+async def test_Admit_UpToMaxInFlight():
+  controller = Controller(max_in_flight=2)
+  release = asyncio.Event()
+  holders = [
+      asyncio.create_task(Hold(controller, PRIORITY_READ, release))
+      for _ in range(2)]
+  await asyncio.sleep(0)
+
+  assert controller.Stats() == {
+      "inFlight": 2,
+      "maxInFlight": 2,
+      "queued": {PRIORITY_TRANSFER: 0, PRIORITY_READ: 0},
+      "rejected": {PRIORITY_TRANSFER: 0, PRIORITY_READ: 0},
+  }
+  release.set()
+  await asyncio.gather(*holders)
+  assert controller.Stats()["inFlight"] == 0
+
+@pytest.mark.asyncio
+async def test_Admit_QueueFullIsRejected():
+  controller = Controller(max_queued=1)
+  release = asyncio.Event()
+  holder = asyncio.create_task(Hold(controller, PRIORITY_READ, release))
+  waiter = asyncio.create_task(Hold(controller, PRIORITY_READ, release))
+  await asyncio.sleep(0)
+
+  with pytest.raises(OverloadedException) as e:
+    async with controller.Admit(PRIORITY_READ):
+      pass
+  assert e.value.retry_after_seconds == 2
+  assert controller.Stats()["rejected"][PRIORITY_READ] == 1
+  release.set()
+  await asyncio.gather(holder, waiter)
+  assert controller.Stats()["inFlight"] == 0
+
+@pytest.mark.asyncio
+async def test_Admit_WaitTimesOut():
+  controller = Controller(max_wait_ms=10)
+  release = asyncio.Event()
+  holder = asyncio.create_task(Hold(controller, PRIORITY_TRANSFER, release))
+  await asyncio.sleep(0)
+
+  with pytest.raises(OverloadedException):
+    async with controller.Admit(PRIORITY_TRANSFER):
+      pass
+  assert controller.Stats()["queued"][PRIORITY_TRANSFER] == 0
+  assert controller.Stats()["rejected"][PRIORITY_TRANSFER] == 1
+  release.set()
+  await holder
+  assert controller.Stats()["inFlight"] == 0
+
+@pytest.mark.asyncio
+async def test_Admit_TransfersBeforeReads():
+  controller = Controller()
+  release = asyncio.Event()
+  admitted = []
+  holder = asyncio.create_task(Hold(controller, PRIORITY_READ, release))
+  await asyncio.sleep(0)
+  waiters = [
+      asyncio.create_task(Hold(controller, priority, release, admitted))
+      for priority in (PRIORITY_READ, PRIORITY_TRANSFER, PRIORITY_READ)]
+  await asyncio.sleep(0)
+
+  assert controller.Stats()["queued"] == {
+      PRIORITY_TRANSFER: 1, PRIORITY_READ: 2}
+  release.set()
+  await asyncio.gather(holder, *waiters)
+  assert admitted == [PRIORITY_TRANSFER, PRIORITY_READ, PRIORITY_READ]
+  assert controller.Stats()["inFlight"] == 0
+
+@pytest.mark.asyncio
+async def test_Admit_CancelledWaiterLeavesQueue():
+  controller = Controller()
+  release = asyncio.Event()
+  holder = asyncio.create_task(Hold(controller, PRIORITY_READ, release))
+  await asyncio.sleep(0)
+  waiter = asyncio.create_task(Hold(controller, PRIORITY_READ, release))
+  await asyncio.sleep(0)
+
+  waiter.cancel()
+  with pytest.raises(asyncio.CancelledError):
+    await waiter
+  assert controller.Stats()["queued"][PRIORITY_READ] == 0
+  release.set()
+  await holder
+  assert controller.Stats()["inFlight"] == 0
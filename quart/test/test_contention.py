@@ -0,0 +1,101 @@
+from ledger.contention import ContentionAwareTransferClient
+from ledger.model import InsufficientFundsException
+
+import asyncio
+import asyncpg
+import pytest
+import pytest_asyncio
+from unittest.mock import AsyncMock
+
+@pytest_asyncio.fixture
+async def mock_sql_client():
+  return AsyncMock()
+
+def _CreateClient(sql_client, max_retries=3):
+  client = ContentionAwareTransferClient(sql_client, 16, max_retries, 1)
+  client.Start()
+  return client
+
+@pytest.mark.asyncio
+async def test_Transfer_Ok(mock_sql_client):
+  mock_sql_client.Transfer = AsyncMock(return_value=1)
+  transfer_id = await _CreateClient(mock_sql_client).Transfer(2, 1, 25)
+  assert transfer_id == 1
+  mock_sql_client.Transfer.assert_awaited_once_with(2, 1, 25, None)
+
+@pytest.mark.asyncio
+async def test_Transfer_SerializesTransfersOnSameAccount(mock_sql_client):
+  in_flight = 0
+  max_in_flight = 0
+  async def Transfer(user_id_from, user_id_to, amount, idempotency_key):
+    nonlocal in_flight, max_in_flight
+    in_flight += 1
+    max_in_flight = max(max_in_flight, in_flight)
+    await asyncio.sleep(0.01)
+    in_flight -= 1
+    return 1
+  mock_sql_client.Transfer = Transfer
+  client = _CreateClient(mock_sql_client)
+
+  await asyncio.gather(
+      client.Transfer(1, 2, 10),
+      client.Transfer(3, 1, 10),
+      client.Transfer(2, 3, 10))
+
+  assert max_in_flight == 1
+
+@pytest.mark.asyncio
+async def test_Transfer_RunsTransfersOnDisjointAccountsConcurrently(
+    mock_sql_client):
+  in_flight = 0
+  max_in_flight = 0
+  async def Transfer(user_id_from, user_id_to, amount, idempotency_key):
+    nonlocal in_flight, max_in_flight
+    in_flight += 1
+    max_in_flight = max(max_in_flight, in_flight)
+    await asyncio.sleep(0.01)
+    in_flight -= 1
+    return 1
+  mock_sql_client.Transfer = Transfer
+  client = _CreateClient(mock_sql_client)
+
+  await asyncio.gather(client.Transfer(1, 2, 10), client.Transfer(3, 4, 10))
+
+  assert max_in_flight == 2
+
+@pytest.mark.parametrize("retryable_error", [
+  asyncpg.exceptions.LockNotAvailableError,
+  asyncpg.exceptions.SerializationError,
+  asyncpg.exceptions.DeadlockDetectedError,
+])
+@pytest.mark.asyncio
+async def test_Transfer_RetriesLockAndSerializationFailures(
+    mock_sql_client, retryable_error):
+  mock_sql_client.Transfer = AsyncMock(side_effect=[retryable_error(""), 1])
+  transfer_id = await _CreateClient(mock_sql_client).Transfer(2, 1, 25)
+  assert transfer_id == 1
+  assert mock_sql_client.Transfer.await_count == 2
+
+@pytest.mark.asyncio
+async def test_Transfer_GivesUpAfterMaxRetries(mock_sql_client):
+  mock_sql_client.Transfer = AsyncMock(
+      side_effect=asyncpg.exceptions.LockNotAvailableError(""))
+  with pytest.raises(asyncpg.exceptions.LockNotAvailableError):
+    await _CreateClient(mock_sql_client, max_retries=2).Transfer(2, 1, 25)
+  assert mock_sql_client.Transfer.await_count == 3
+
+@pytest.mark.asyncio
+async def test_Transfer_DoesNotRetryInsufficientFunds(mock_sql_client):
+  mock_sql_client.Transfer = AsyncMock(side_effect=InsufficientFundsException)
+  with pytest.raises(InsufficientFundsException):
+    await _CreateClient(mock_sql_client).Transfer(2, 1, 25)
+  assert mock_sql_client.Transfer.await_count == 1
+
+@pytest.mark.asyncio
+async def test_TransferBatch_Ok(mock_sql_client):
+  mock_sql_client.TransferBatch = AsyncMock(return_value=[1, 2])
+  results = await _CreateClient(mock_sql_client).TransferBatch(
+      [(2, 1, 25), (1, 3, 5)])
+  assert results == [1, 2]
+  mock_sql_client.TransferBatch.assert_awaited_once_with(
+      [(2, 1, 25), (1, 3, 5)], None)
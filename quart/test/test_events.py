@@ -0,0 +1,145 @@
+from ledger import events
+from ledger.events import StreamUserEvents, TransferEventHub
+from ledger.model import User
+
+import json
+import pytest
+import pytest_asyncio
+from unittest.mock import AsyncMock
+
+@pytest_asyncio.fixture
+async def mock_sql_client():
+  return AsyncMock()
+
+def Notification(transfer_id=1, user_id_from=1, user_id_to=2, amount=10,
+                 balance_from=90, balance_to=110):
+  return json.dumps({
+      "transferId": transfer_id,
+      "timestamp": "2024-01-01T00:00:00.5",
+      "userIdFrom": user_id_from,
+      "userIdTo": user_id_to,
+      "amount": amount,
+      "balanceFrom": balance_from,
+      "balanceTo": balance_to,
+  })
+
+async def StartedHub(mock_sql_client, max_queued_events=10):
+  hub = TransferEventHub(mock_sql_client, max_queued_events)
+  await hub.Start()
+  return hub, mock_sql_client.ListenForTransfers.await_args.args[0]
+
+@pytest.mark.asyncio
+async def test_Notification_GoesToSubscribersOfBothUsers(mock_sql_client):
+  hub, callback = await StartedHub(mock_sql_client)
+  senders = [hub.Subscribe(1), hub.Subscribe(1)]
+  receiver = hub.Subscribe(2)
+  other = hub.Subscribe(3)
+
+  callback(None, 0, "ledger_transfers", Notification())
+
+  transfer = {
+      "transferId": 1, "timestamp": "2024-01-01T00:00:00.500000",
+      "userIdFrom": 1, "userIdTo": 2, "amount": 10}
+  for sender in senders:
+    assert await sender.Get() == {**transfer, "balance": 90}
+  assert await receiver.Get() == {**transfer, "balance": 110}
+  assert other._events.empty()
+  assert hub.Stats() == {
+      "users": 3, "subscriptions": 4, "events": 3, "overflows": 0}
+
+@pytest.mark.asyncio
+async def test_Notification_SkipsUserOfOtherShard(mock_sql_client):
+  hub, callback = await StartedHub(mock_sql_client)
+  sender = hub.Subscribe(1)
+  receiver = hub.Subscribe(2)
+
+  callback(None, 0, "ledger_transfers", Notification(balance_to=None))
+
+  assert (await sender.Get())["balance"] == 90
+  assert receiver._events.empty()
+
+@pytest.mark.asyncio
+async def test_Notification_MalformedPayloadIsIgnored(mock_sql_client):
+  hub, callback = await StartedHub(mock_sql_client)
+  subscription = hub.Subscribe(1)
+
+  callback(None, 0, "ledger_transfers", "not json")
+  callback(None, 0, "ledger_transfers", "{}")
+
+  assert subscription._events.empty()
+
+@pytest.mark.asyncio
+async def test_Notification_OverflowCutsSubscriptionOff(mock_sql_client):
+  hub, callback = await StartedHub(mock_sql_client, max_queued_events=2)
+  subscription = hub.Subscribe(1)
+
+  for transfer_id in range(1, 4):
+    callback(None, 0, "ledger_transfers", Notification(transfer_id))
+
+  assert subscription.overflowed
+  assert await subscription.Get() is None
+  assert hub.Stats()["overflows"] == 1
+  assert hub.Stats()["subscriptions"] == 0
+
+@pytest.mark.asyncio
+async def test_Interruption_EndsAllSubscriptions(mock_sql_client):
+  hub, callback = await StartedHub(mock_sql_client)
+  subscriptions = [hub.Subscribe(1), hub.Subscribe(1), hub.Subscribe(2)]
+  callback(None, 0, "ledger_transfers", Notification())
+
+  on_interruption = mock_sql_client.ListenForTransfers.await_args.args[1]
+  on_interruption()
+
+  for subscription in subscriptions:
+    assert await subscription.Get() is None
+  assert hub.Stats()["subscriptions"] == 0
+  assert hub.Stats()["overflows"] == 0
+
+@pytest.mark.asyncio
+async def test_Unsubscribe(mock_sql_client):
+  hub, callback = await StartedHub(mock_sql_client)
+  subscription = hub.Subscribe(1)
+
+  hub.Unsubscribe(subscription)
+  hub.Unsubscribe(subscription)
+  callback(None, 0, "ledger_transfers", Notification())
+
+  assert subscription._events.empty()
+  assert hub.Stats()["users"] == 0
+
+@pytest.mark.asyncio
+async def test_StreamUserEvents(mock_sql_client):
+  hub, callback = await StartedHub(mock_sql_client)
+  subscription = hub.Subscribe(1)
+  stream = StreamUserEvents(hub, User(1, 100), subscription)
+
+  assert await anext(stream) == (
+      'event: balance\ndata: {"userId": 1, "balance": 100}\n\n')
+  callback(None, 0, "ledger_transfers", Notification())
+  event = await anext(stream)
+  assert event.startswith("event: transfer\ndata: ")
+  assert json.loads(event.split("data: ")[1])["balance"] == 90
+  await stream.aclose()
+
+  assert hub.Stats()["subscriptions"] == 0
+
+@pytest.mark.asyncio
+async def test_StreamUserEvents_Heartbeat(mock_sql_client, monkeypatch):
+  monkeypatch.setattr(events, "HEARTBEAT_SECONDS", 0)
+  hub = TransferEventHub(mock_sql_client)
+  stream = StreamUserEvents(hub, User(1, 100), hub.Subscribe(1))
+
+  await anext(stream)
+  assert await anext(stream) == ": heartbeat\n\n"
+  await stream.aclose()
+
+@pytest.mark.asyncio
+async def test_StreamUserEvents_EndsOnOverflow(mock_sql_client):
+  hub, callback = await StartedHub(mock_sql_client, max_queued_events=1)
+  stream = StreamUserEvents(hub, User(1, 100), hub.Subscribe(1))
+
+  callback(None, 0, "ledger_transfers", Notification(1))
+  callback(None, 0, "ledger_transfers", Notification(2))
+
+  assert [event async for event in stream] == [
+      'event: balance\ndata: {"userId": 1, "balance": 100}\n\n']
@@ -0,0 +1,39 @@
+from ledger.export import FormatTransfers
+from ledger.model import TransferRecord
+
+from datetime import datetime
+import pytest
+
+
+async def _Chunks(chunks):
+  for chunk in chunks:
+    yield chunk
+
+_CHUNKS = [
+    [TransferRecord(1, datetime(2024, 1, 1), 1, 2, 10),
+     TransferRecord(2, datetime(2024, 1, 2), 2, 1, 20)],
+    [TransferRecord(3, datetime(2024, 1, 3, 12, 30), 3, 1, 30)],
+]
+
+@pytest.mark.asyncio
+async def test_FormatTransfers_Ndjson():
+  data = [data async for data in FormatTransfers(_Chunks(_CHUNKS), "ndjson")]
+  assert data == [
+      b'{"transferId": 1, "timestamp": "2024-01-01T00:00:00", '
+      b'"userIdFrom": 1, "userIdTo": 2, "amount": 10}\n'
+      b'{"transferId": 2, "timestamp": "2024-01-02T00:00:00", '
+      b'"userIdFrom": 2, "userIdTo": 1, "amount": 20}\n',
+      b'{"transferId": 3, "timestamp": "2024-01-03T12:30:00", '
+      b'"userIdFrom": 3, "userIdTo": 1, "amount": 30}\n']
+
+@pytest.mark.asyncio
+async def test_FormatTransfers_Csv():
+  data = [data async for data in FormatTransfers(_Chunks(_CHUNKS), "csv")]
+  assert data == [
+      b"transferId,timestamp,userIdFrom,userIdTo,amount\r\n",
+      b"1,2024-01-01T00:00:00,1,2,10\r\n2,2024-01-02T00:00:00,2,1,20\r\n",
+      b"3,2024-01-03T12:30:00,3,1,30\r\n"]
+
+@pytest.mark.asyncio
+async def test_FormatTransfers_NoTransfers():
+  assert [data async for data in FormatTransfers(_Chunks([]), "ndjson")] == []
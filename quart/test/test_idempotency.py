@@ -0,0 +1,90 @@
+from ledger.idempotency import IdempotencyKeyCache
+from ledger.model import InsufficientFundsException, ReplayedTransferId
+
+import asyncio
+import pytest
+import pytest_asyncio
+from unittest.mock import AsyncMock
+
+@pytest_asyncio.fixture
+async def mock_sql_client():
+  return AsyncMock()
+
+@pytest.mark.asyncio
+async def test_Run_ReplaysCachedTransferId(mock_sql_client):
+  transfer = AsyncMock(return_value=7)
+  cache = IdempotencyKeyCache(mock_sql_client, 10, 60)
+
+  transfer_id = await cache.Run("key", transfer)
+  replayed_transfer_id = await cache.Run("key", transfer)
+
+  assert transfer_id == replayed_transfer_id == 7
+  assert not isinstance(transfer_id, ReplayedTransferId)
+  assert isinstance(replayed_transfer_id, ReplayedTransferId)
+  transfer.assert_awaited_once()
+
+@pytest.mark.asyncio
+async def test_Run_ConcurrentRequestsShareOneTransfer(mock_sql_client):
+  started = asyncio.Event()
+  finish = asyncio.Event()
+  calls = 0
+  async def Transfer():
+    nonlocal calls
+    calls += 1
+    started.set()
+    await finish.wait()
+    return 7
+  cache = IdempotencyKeyCache(mock_sql_client, 10, 60)
+
+  first = asyncio.create_task(cache.Run("key", Transfer))
+  await started.wait()
+  second = asyncio.create_task(cache.Run("key", Transfer))
+  await asyncio.sleep(0)
+  finish.set()
+
+  assert await asyncio.gather(first, second) == [7, 7]
+  assert not isinstance(first.result(), ReplayedTransferId)
+  assert isinstance(second.result(), ReplayedTransferId)
+  assert calls == 1
+
+@pytest.mark.asyncio
+async def test_Run_FailedTransferIsNotCached(mock_sql_client):
+  transfer = AsyncMock(side_effect=[InsufficientFundsException, 7])
+  cache = IdempotencyKeyCache(mock_sql_client, 10, 60)
+
+  with pytest.raises(InsufficientFundsException):
+    await cache.Run("key", transfer)
+  assert await cache.Run("key", transfer) == 7
+
+@pytest.mark.asyncio
+async def test_Run_WithoutCacheAlwaysRunsTransfer(mock_sql_client):
+  # The transfer itself replays known keys from Postgres.
+  transfer = AsyncMock(return_value=7)
+  cache = IdempotencyKeyCache(mock_sql_client, 0, 60)
+
+  await cache.Run("key", transfer)
+  await cache.Run("key", transfer)
+
+  assert transfer.await_count == 2
+
+@pytest.mark.asyncio
+async def test_Put_EvictsLeastRecentlyUsed(mock_sql_client):
+  transfer = AsyncMock(return_value=9)
+  cache = IdempotencyKeyCache(mock_sql_client, 2, 60)
+  cache.Put("a", 1)
+  cache.Put("b", 2)
+  assert await cache.Run("a", transfer) == 1
+  cache.Put("c", 3)
+
+  assert await cache.Run("a", transfer) == 1
+  assert await cache.Run("b", transfer) == 9
+
+@pytest.mark.asyncio
+async def test_Start_PurgesExpiredKeys(mock_sql_client):
+  mock_sql_client.DeleteIdempotencyKeys = AsyncMock(return_value=0)
+  cache = IdempotencyKeyCache(mock_sql_client, 10, 0.01)
+  cache.Start()
+  await asyncio.sleep(0.05)
+  await cache.Close()
+
+  mock_sql_client.DeleteIdempotencyKeys.assert_awaited_with(0.01)
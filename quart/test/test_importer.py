@@ -0,0 +1,38 @@
+from ledger.importer import ReadRecords, TRANSFERS, USERS
+
+from datetime import datetime
+
+
+def test_ReadRecords_UsersCsv(tmp_path):
+  path = tmp_path / "users.csv"
+  path.write_text("userId,balance\n1,100\n2,0\n")
+  assert list(ReadRecords(USERS, str(path))) == [(1, 100), (2, 0)]
+
+def test_ReadRecords_TransfersNdjson(tmp_path):
+  path = tmp_path / "transfers.ndjson"
+  path.write_text(
+      '{"userIdFrom": 1, "userIdTo": 2, "amount": 10, '
+      '"timestamp": "2024-01-01T10:00:00"}\n'
+      '\n'
+      '{"userIdFrom": "2", "userIdTo": "1", "amount": "5", '
+      '"timestamp": "2024-01-02"}\n')
+  assert list(ReadRecords(TRANSFERS, str(path))) == [
+      (datetime(2024, 1, 1, 10), 1, 2, 10),
+      (datetime(2024, 1, 2), 2, 1, 5)]
+
+def test_ReadRecords_TransfersCsv(tmp_path):
+  path = tmp_path / "transfers.csv"
+  path.write_text(
+      "timestamp,userIdFrom,userIdTo,amount\n2024-01-01,1,2,10\n")
+  assert list(ReadRecords(TRANSFERS, str(path))) == [
+      (datetime(2024, 1, 1), 1, 2, 10)]
+
+def test_ReadRecords_TransferTimestampWithOffsetIsUtc(tmp_path):
+  path = tmp_path / "transfers.csv"
+  path.write_text(
+      "timestamp,userIdFrom,userIdTo,amount\n"
+      "2024-01-01T01:00:00+02:00,1,2,10\n"
+      "2024-01-01T10:00:00Z,2,1,5\n")
+  assert list(ReadRecords(TRANSFERS, str(path))) == [
+      (datetime(2023, 12, 31, 23), 1, 2, 10),
+      (datetime(2024, 1, 1, 10), 2, 1, 5)]
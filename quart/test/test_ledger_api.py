@@ -1,10 +1,16 @@
-from ledger.model import InsufficientFundsException, User
+from ledger.events import TransferEventHub
+from ledger.model import (
+    InsufficientFundsException, OverloadedException, ReplayedTransferId,
+    TransferRecord, User, UserVolume, VolumeBucket)
+from ledger.idempotency import IdempotencyKeyCache
 from ledger.ledger_api import LedgerAPI
+from ledger.metrics import INSUFFICIENT_FUNDS, TRANSFER_AMOUNT, TRANSFERS
 
+from datetime import datetime
 import json
 import pytest
 import pytest_asyncio
-from unittest.mock import AsyncMock
+from unittest.mock import AsyncMock, MagicMock
 
 @pytest_asyncio.fixture
 async def mock_sql_client():         
@@ -44,6 +50,40 @@ async def test_GetUser_SqlClientRaisesAnException(mock_sql_client):
   response = await LedgerAPI(100, mock_sql_client).GetUserDetails(1)  
   assert response.status == "500 INTERNAL SERVER ERROR"
 
+@pytest.mark.asyncio
+async def test_GetUserDetails_AsOf(mock_sql_client):
+  mock_sql_client.FetchBalanceAsOf = AsyncMock(return_value=70)
+  mock_user_cache = MagicMock()
+  response = await LedgerAPI(
+      100, mock_sql_client, user_cache=mock_user_cache).GetUserDetails(
+          1, "2024-03-01T12:00:00+01:00")
+  assert response == {
+      'balance': 70, 'userId': 1, 'asOf': '2024-03-01T11:00:00'}
+  mock_sql_client.FetchBalanceAsOf.assert_awaited_once_with(
+      1, datetime(2024, 3, 1, 11), min_lsn=None)
+  mock_user_cache.FetchUser.assert_not_called()
+
+@pytest.mark.parametrize("as_of", ["", "yesterday", "2024-13-01"])
+@pytest.mark.asyncio
+async def test_GetUserDetails_InvalidAsOf(mock_sql_client, as_of):
+  response = await LedgerAPI(100, mock_sql_client).GetUserDetails(1, as_of)
+  assert response.status == "400 BAD REQUEST"
+  mock_sql_client.FetchBalanceAsOf.assert_not_called()
+
+@pytest.mark.asyncio
+async def test_GetUserDetails_AsOfUnknownUser(mock_sql_client):
+  mock_sql_client.FetchBalanceAsOf = AsyncMock(return_value=None)
+  response = await LedgerAPI(100, mock_sql_client).GetUserDetails(
+      1, "2024-03-01")
+  assert response.status == "400 BAD REQUEST"
+
+@pytest.mark.asyncio
+async def test_GetUserDetails_AsOfSqlClientRaisesAnException(mock_sql_client):
+  mock_sql_client.FetchBalanceAsOf = AsyncMock(side_effect=Exception)
+  response = await LedgerAPI(100, mock_sql_client).GetUserDetails(
+      1, "2024-03-01")
+  assert response.status == "500 INTERNAL SERVER ERROR"
+
 @pytest.mark.asyncio
 async def test_CreateUser_Ok(mock_sql_client):  
   mock_sql_client.InsertUser = AsyncMock(return_value=1)
@@ -67,6 +107,26 @@ async def test_Transfer_Ok(mock_sql_client, mock_request):
   assert response_json == {'transferId': 1}
   assert status == 200
 
+@pytest.mark.asyncio
+async def test_Transfer_CountsTransferVolume(mock_sql_client, mock_request):
+  mock_sql_client.Transfer = AsyncMock(return_value=1)
+  mock_request.get_data = AsyncMock(return_value=json.dumps(
+      {"userIdFrom": "2", "userIdTo": "1", "amount": "25"}))
+  transfers, amount = TRANSFERS.Value(), TRANSFER_AMOUNT.Value()
+  await LedgerAPI(100, mock_sql_client).Transfer(mock_request)
+  assert TRANSFERS.Value() == transfers + 1
+  assert TRANSFER_AMOUNT.Value() == amount + 25
+
+@pytest.mark.asyncio
+async def test_Transfer_CountsInsufficientFunds(mock_sql_client, mock_request):
+  mock_sql_client.Transfer = AsyncMock(side_effect=InsufficientFundsException)
+  mock_request.get_data = AsyncMock(return_value=json.dumps(
+      {"userIdFrom": "2", "userIdTo": "1", "amount": "25"}))
+  rejections, transfers = INSUFFICIENT_FUNDS.Value(), TRANSFERS.Value()
+  await LedgerAPI(100, mock_sql_client).Transfer(mock_request)
+  assert INSUFFICIENT_FUNDS.Value() == rejections + 1
+  assert TRANSFERS.Value() == transfers
+
 @pytest.mark.asyncio
 async def test_Transfer_UserIdFromIsNotSet(mock_sql_client, mock_request): 
   mock_request.get_data = AsyncMock(return_value=json.dumps(
@@ -198,4 +258,636 @@ async def test_Transfer_SqlClientRaisesException(mock_sql_client, mock_request):
   mock_request.get_data = AsyncMock(return_value=json.dumps(
       {"userIdFrom": "2", "userIdTo": "1", "amount": "25"}))
   response = await LedgerAPI(100, mock_sql_client).Transfer(mock_request)
-  assert response.status == "500 INTERNAL SERVER ERROR"
\ No newline at end of file
+  assert response.status == "500 INTERNAL SERVER ERROR"
+@pytest.mark.asyncio
+async def test_TransferBatch_Ok(mock_sql_client, mock_request):
+  mock_sql_client.TransferBatch = AsyncMock(return_value=[1, 2])
+  mock_request.get_data = AsyncMock(return_value=json.dumps([
+      {"userIdFrom": "2", "userIdTo": "1", "amount": "25"},
+      {"userIdFrom": "1", "userIdTo": "3", "amount": "5"}]))
+  response_json, status = await LedgerAPI(
+      100, mock_sql_client).TransferBatch(mock_request)
+  mock_sql_client.TransferBatch.assert_awaited_once_with(
+      [(2, 1, 25), (1, 3, 5)])
+  assert response_json == {
+      "results": [{"transferId": 1}, {"transferId": 2}]}
+  assert status == 200
+
+@pytest.mark.asyncio
+async def test_TransferBatch_PerTransferErrors(mock_sql_client, mock_request):
+  mock_sql_client.TransferBatch = AsyncMock(
+      return_value=[InsufficientFundsException(), ValueError(), 7])
+  mock_request.get_data = AsyncMock(return_value=json.dumps([
+      {"userIdFrom": "2", "userIdTo": "1", "amount": "25"},
+      {"userIdFrom": "1", "userIdTo": "1", "amount": "25"},
+      {"userIdFrom": "1", "userIdTo": "9", "amount": "25"},
+      {"userIdFrom": "3", "userIdTo": "1", "amount": "5"}]))
+  response_json, status = await LedgerAPI(
+      100, mock_sql_client).TransferBatch(mock_request)
+  mock_sql_client.TransferBatch.assert_awaited_once_with(
+      [(2, 1, 25), (1, 9, 25), (3, 1, 5)])
+  assert response_json == {"results": [
+      {"error": "Insufficient funds."},
+      {"error": "Invalid arguments."},
+      {"error": "Invalid arguments."},
+      {"transferId": 7}]}
+  assert status == 200
+
+@pytest.mark.asyncio
+async def test_TransferBatch_TransferFailedOnItsOwn(
+    mock_sql_client, mock_request):
+  mock_sql_client.TransferBatch = AsyncMock(return_value=[TimeoutError(), 7])
+  mock_request.get_data = AsyncMock(return_value=json.dumps([
+      {"userIdFrom": "2", "userIdTo": "1", "amount": "25"},
+      {"userIdFrom": "3", "userIdTo": "1", "amount": "5"}]))
+  response_json, _ = await LedgerAPI(
+      100, mock_sql_client).TransferBatch(mock_request)
+  assert response_json == {"results": [
+      {"error": "Transfer failed."}, {"transferId": 7}]}
+
+@pytest.mark.parametrize("invalid_body", [
+  '{"userIdFrom": "2", "userIdTo": "1", "amount": "25"}',  # Not a list.
+  '[]',  # Empty.
+  '[{"userIdFrom": "2", "userIdFrom": "3", "userIdTo": "1", "amount": "25"}]',
+  'userIdFrom',  # Not json.
+])
+@pytest.mark.asyncio
+async def test_TransferBatch_InvalidBody(
+    mock_sql_client, mock_request, invalid_body):
+  mock_request.get_data = AsyncMock(return_value=invalid_body)
+  response = await LedgerAPI(100, mock_sql_client).TransferBatch(mock_request)
+  assert response.status == '400 BAD REQUEST'
+
+@pytest.mark.asyncio
+async def test_TransferBatch_SqlClientRaisesException(
+    mock_sql_client, mock_request):
+  mock_sql_client.TransferBatch = AsyncMock(side_effect=Exception)
+  mock_request.get_data = AsyncMock(return_value=json.dumps(
+      [{"userIdFrom": "2", "userIdTo": "1", "amount": "25"}]))
+  response = await LedgerAPI(100, mock_sql_client).TransferBatch(mock_request)
+  assert response.status == "500 INTERNAL SERVER ERROR"
+
+@pytest.mark.asyncio
+async def test_Transfer_GoesThroughTransferClient(
+    mock_sql_client, mock_request):
+  mock_transfer_client = AsyncMock()
+  mock_transfer_client.Transfer = AsyncMock(return_value=1)
+  mock_request.get_data = AsyncMock(return_value=json.dumps(
+      {"userIdFrom": "2", "userIdTo": "1", "amount": "25"}))
+  response_json, status = await LedgerAPI(
+      100, mock_sql_client, mock_transfer_client).Transfer(mock_request)
+  mock_transfer_client.Transfer.assert_awaited_once_with(
+      2, 1, 25, idempotency_key=None)
+  mock_sql_client.Transfer.assert_not_awaited()
+  assert response_json == {'transferId': 1}
+  assert status == 200
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("header_key, body", [
+  ("key", {"userIdFrom": "2", "userIdTo": "1", "amount": "25"}),
+  (None, {"userIdFrom": "2", "userIdTo": "1", "amount": "25",
+          "idempotencyKey": "key"}),
+  ("key", {"userIdFrom": "2", "userIdTo": "1", "amount": "25",
+           "idempotencyKey": "key"}),
+])
+async def test_Transfer_PassesIdempotencyKey(
+    mock_sql_client, mock_request, header_key, body):
+  mock_sql_client.Transfer = AsyncMock(return_value=1)
+  mock_request.get_data = AsyncMock(return_value=json.dumps(body))
+  response_json, status = await LedgerAPI(100, mock_sql_client).Transfer(
+      mock_request, header_key)
+  mock_sql_client.Transfer.assert_awaited_once_with(
+      2, 1, 25, idempotency_key="key")
+  assert response_json == {'transferId': 1}
+  assert status == 200
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("header_key, body_key", [
+  ("key", "other key"),  # Header and body disagree.
+  ("", None),  # Empty.
+  (None, 1),  # Not a string.
+  ("k" * 256, None),  # Too long.
+])
+async def test_Transfer_InvalidIdempotencyKey(
+    mock_sql_client, mock_request, header_key, body_key):
+  body = {"userIdFrom": "2", "userIdTo": "1", "amount": "25"}
+  if body_key is not None:
+    body["idempotencyKey"] = body_key
+  mock_request.get_data = AsyncMock(return_value=json.dumps(body))
+  response = await LedgerAPI(100, mock_sql_client).Transfer(
+      mock_request, header_key)
+  assert response.status == "400 BAD REQUEST"
+  mock_sql_client.Transfer.assert_not_awaited()
+
+@pytest.mark.asyncio
+async def test_Transfer_GoesThroughIdempotencyKeyCache(
+    mock_sql_client, mock_request):
+  mock_idempotency_key_cache = MagicMock()
+  mock_idempotency_key_cache.Run = AsyncMock(return_value=7)
+  mock_request.get_data = AsyncMock(return_value=json.dumps(
+      {"userIdFrom": "2", "userIdTo": "1", "amount": "25"}))
+  response_json, status = await LedgerAPI(
+      100, mock_sql_client,
+      idempotency_key_cache=mock_idempotency_key_cache).Transfer(
+          mock_request, "key")
+  assert mock_idempotency_key_cache.Run.await_args.args[0] == "key"
+  assert response_json == {'transferId': 7}
+  assert status == 200
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("max_cached_keys", [10, 0])
+async def test_Transfer_RepeatedIdempotencyKeyIsCountedOnce(
+    mock_sql_client, mock_request, max_cached_keys):
+  # Without the cache, the database replays the key.
+  mock_sql_client.Transfer = AsyncMock(
+      side_effect=[1, ReplayedTransferId(1)])
+  mock_request.get_data = AsyncMock(return_value=json.dumps(
+      {"userIdFrom": "2", "userIdTo": "1", "amount": "25"}))
+  ledger_api = LedgerAPI(
+      100, mock_sql_client,
+      idempotency_key_cache=IdempotencyKeyCache(
+          mock_sql_client, max_cached_keys, 60))
+  transfers, amount = TRANSFERS.Value(), TRANSFER_AMOUNT.Value()
+
+  for _ in range(2):
+    response_json, status = await ledger_api.Transfer(mock_request, "key")
+    assert response_json == {"transferId": 1}
+    assert status == 200
+
+  assert TRANSFERS.Value() == transfers + 1
+  assert TRANSFER_AMOUNT.Value() == amount + 25
+
+@pytest.mark.asyncio
+async def test_GetUserDetails_ReadsThroughUserCache(mock_sql_client):
+  mock_user_cache = AsyncMock()
+  mock_user_cache.FetchUser = AsyncMock(return_value=User(1, 100))
+  response = await LedgerAPI(
+      100, mock_sql_client, user_cache=mock_user_cache).GetUserDetails(1)
+  assert response == {'balance': 100, 'userId': 1}
+  mock_sql_client.FetchUser.assert_not_awaited()
+
+@pytest.mark.asyncio
+async def test_GetUserDetails_ReadsFromReplicas(mock_sql_client):
+  mock_replica_reader = AsyncMock()
+  mock_replica_reader.FetchUser = AsyncMock(return_value=User(1, 100))
+  response = await LedgerAPI(
+      100, mock_sql_client,
+      replica_reader=mock_replica_reader).GetUserDetails(1)
+  assert response == {'balance': 100, 'userId': 1}
+  mock_sql_client.FetchUser.assert_not_awaited()
+
+@pytest.mark.asyncio
+async def test_GetUserDetails_LsnBypassesUserCache(mock_sql_client):
+  mock_user_cache = AsyncMock()
+  mock_replica_reader = AsyncMock()
+  mock_replica_reader.FetchUser = AsyncMock(return_value=User(1, 100))
+  response = await LedgerAPI(
+      100, mock_sql_client, user_cache=mock_user_cache,
+      replica_reader=mock_replica_reader).GetUserDetails(1, None, "1/A0")
+  assert response == {'balance': 100, 'userId': 1}
+  mock_replica_reader.FetchUser.assert_awaited_once_with(
+      1, min_lsn=(1 << 32) + 0xA0)
+  mock_user_cache.FetchUser.assert_not_awaited()
+
+@pytest.mark.parametrize("invalid_lsn", ["", "A0", "1/G", "1/A0/2", " 1/A0"])
+@pytest.mark.asyncio
+async def test_GetUserDetails_InvalidLsn(mock_sql_client, invalid_lsn):
+  response = await LedgerAPI(100, mock_sql_client).GetUserDetails(
+      1, None, invalid_lsn)
+  assert response.status == "400 BAD REQUEST"
+
+@pytest.mark.asyncio
+async def test_GetUserTransfers_WaitsForLsn(mock_sql_client):
+  mock_sql_client.FetchTransfers = AsyncMock(return_value=[])
+  await LedgerAPI(100, mock_sql_client).GetUserTransfers(1, {}, "0/A0")
+  mock_sql_client.FetchTransfers.assert_awaited_once_with(
+      1, "all", 101, before_transfer_id=None, min_lsn=0xA0)
+
+@pytest.mark.asyncio
+async def test_GetReplicaStats_Ok(mock_sql_client):
+  mock_replica_reader = MagicMock()
+  mock_replica_reader.Stats = MagicMock(return_value={"replicaReads": 1})
+  stats, status = await LedgerAPI(
+      100, mock_sql_client,
+      replica_reader=mock_replica_reader).GetReplicaStats()
+  assert stats == {"replicaReads": 1}
+  assert status == 200
+
+@pytest.mark.asyncio
+async def test_GetReplicaStats_NoReplicas(mock_sql_client):
+  response = await LedgerAPI(100, mock_sql_client).GetReplicaStats()
+  assert response.status == "404 NOT FOUND"
+
+@pytest.mark.asyncio
+async def test_CreateUser_PutsUserIntoUserCache(mock_sql_client):
+  mock_user_cache = MagicMock()
+  mock_sql_client.InsertUser = AsyncMock(return_value=1)
+  await LedgerAPI(100, mock_sql_client, user_cache=mock_user_cache).CreateUser()
+  mock_user_cache.Put.assert_called_once_with(User(1, 100))
+
+@pytest.mark.asyncio
+async def test_Transfer_InvalidatesUserCache(mock_sql_client, mock_request):
+  mock_user_cache = MagicMock()
+  mock_sql_client.Transfer = AsyncMock(return_value=1)
+  mock_request.get_data = AsyncMock(return_value=json.dumps(
+      {"userIdFrom": "2", "userIdTo": "1", "amount": "25"}))
+  await LedgerAPI(
+      100, mock_sql_client, user_cache=mock_user_cache).Transfer(mock_request)
+  mock_user_cache.Invalidate.assert_called_once_with([2, 1])
+
+@pytest.mark.asyncio
+async def test_Transfer_FailedTransferDoesNotInvalidateUserCache(
+    mock_sql_client, mock_request):
+  mock_user_cache = MagicMock()
+  mock_sql_client.Transfer = AsyncMock(side_effect=InsufficientFundsException)
+  mock_request.get_data = AsyncMock(return_value=json.dumps(
+      {"userIdFrom": "2", "userIdTo": "1", "amount": "25"}))
+  await LedgerAPI(
+      100, mock_sql_client, user_cache=mock_user_cache).Transfer(mock_request)
+  mock_user_cache.Invalidate.assert_not_called()
+
+@pytest.mark.asyncio
+async def test_TransferBatch_InvalidatesUserCacheForAppliedTransfers(
+    mock_sql_client, mock_request):
+  mock_user_cache = MagicMock()
+  mock_sql_client.TransferBatch = AsyncMock(
+      return_value=[1, InsufficientFundsException()])
+  mock_request.get_data = AsyncMock(return_value=json.dumps([
+      {"userIdFrom": "2", "userIdTo": "1", "amount": "25"},
+      {"userIdFrom": "3", "userIdTo": "4", "amount": "25"}]))
+  await LedgerAPI(100, mock_sql_client, user_cache=mock_user_cache
+                  ).TransferBatch(mock_request)
+  assert list(mock_user_cache.Invalidate.call_args.args[0]) == [2, 1]
+
+@pytest.mark.asyncio
+async def test_GetUserCacheStats_Ok(mock_sql_client):
+  mock_user_cache = MagicMock()
+  mock_user_cache.Stats = MagicMock(return_value={"hits": 1})
+  stats, status = await LedgerAPI(
+      100, mock_sql_client, user_cache=mock_user_cache).GetUserCacheStats()
+  assert stats == {"hits": 1}
+  assert status == 200
+
+@pytest.mark.asyncio
+async def test_GetUserCacheStats_CacheDisabled(mock_sql_client):
+  response = await LedgerAPI(100, mock_sql_client).GetUserCacheStats()
+  assert response.status == "404 NOT FOUND"
+
+@pytest.mark.asyncio
+async def test_GetUsersDetails_Ok(mock_sql_client):
+  mock_sql_client.FetchUsers = AsyncMock(
+      return_value=[User(1, 100), User(3, 300)])
+  response = await LedgerAPI(100, mock_sql_client).GetUsersDetails("3,2,1,3")
+  mock_sql_client.FetchUsers.assert_awaited_once_with([3, 2, 1])
+  assert response == {"users": [
+      {"userId": 3, "balance": 300}, {"userId": 1, "balance": 100}]}
+
+@pytest.mark.parametrize("invalid_ids", [
+  "1,abc",  # Not numeric.
+  "1,1.1",  # Not an int.
+  "1,0",  # Not positive.
+  "1,,2",  # Mess.
+  "",  # Empty.
+  None  # Not set.
+])
+@pytest.mark.asyncio
+async def test_GetUsersDetails_InvalidUserIds(mock_sql_client, invalid_ids):
+  response = await LedgerAPI(100, mock_sql_client).GetUsersDetails(invalid_ids)
+  assert response.status == "400 BAD REQUEST"
+
+@pytest.mark.asyncio
+async def test_GetUsersDetails_TooManyUserIds(mock_sql_client):
+  response = await LedgerAPI(
+      100, mock_sql_client, max_users_per_request=2).GetUsersDetails("1,2,3")
+  assert response.status == "400 BAD REQUEST"
+
+@pytest.mark.asyncio
+async def test_GetUsersDetails_SqlClientRaisesException(mock_sql_client):
+  mock_sql_client.FetchUsers = AsyncMock(side_effect=Exception)
+  response = await LedgerAPI(100, mock_sql_client).GetUsersDetails("1,2")
+  assert response.status == "500 INTERNAL SERVER ERROR"
+
+@pytest.mark.asyncio
+async def test_GetUserTransfers_Ok(mock_sql_client):
+  mock_sql_client.FetchTransfers = AsyncMock(return_value=[
+      TransferRecord(5, datetime(2024, 1, 2), 1, 2, 10),
+      TransferRecord(3, datetime(2024, 1, 1), 2, 1, 20)])
+  response = await LedgerAPI(100, mock_sql_client).GetUserTransfers(1, {})
+  mock_sql_client.FetchTransfers.assert_awaited_once_with(
+      1, "all", 101, before_transfer_id=None, min_lsn=None)
+  assert response == {
+      "transfers": [
+          {"transferId": 5, "timestamp": "2024-01-02T00:00:00",
+           "userIdFrom": 1, "userIdTo": 2, "amount": 10},
+          {"transferId": 3, "timestamp": "2024-01-01T00:00:00",
+           "userIdFrom": 2, "userIdTo": 1, "amount": 20}],
+      "nextCursor": None}
+
+@pytest.mark.asyncio
+async def test_GetUserTransfers_ReturnsNextCursor(mock_sql_client):
+  mock_sql_client.FetchTransfers = AsyncMock(return_value=[
+      TransferRecord(5, datetime(2024, 1, 2), 1, 2, 10),
+      TransferRecord(3, datetime(2024, 1, 1), 2, 1, 20)])
+  response = await LedgerAPI(100, mock_sql_client).GetUserTransfers(
+      1, {"limit": "1", "cursor": "7", "direction": "sent",
+          "since": "2024-01-01T01:00:00+01:00", "until": "2024-02-01"})
+  mock_sql_client.FetchTransfers.assert_awaited_once_with(
+      1, "sent", 2, before_transfer_id=7, since=datetime(2024, 1, 1),
+      until=datetime(2024, 2, 1), min_lsn=None)
+  assert [transfer["transferId"] for transfer in response["transfers"]] == [5]
+  assert response["nextCursor"] == 5
+
+@pytest.mark.parametrize("invalid_args", [
+  {"direction": "up"},
+  {"limit": "0"},
+  {"limit": "1001"},
+  {"cursor": "abc"},
+  {"since": "yesterday"},
+  {"until": "2024-13-01"},
+])
+@pytest.mark.asyncio
+async def test_GetUserTransfers_InvalidArgs(mock_sql_client, invalid_args):
+  response = await LedgerAPI(100, mock_sql_client).GetUserTransfers(
+      1, invalid_args)
+  assert response.status == "400 BAD REQUEST"
+
+@pytest.mark.asyncio
+async def test_GetUserTransfers_InvalidUserId(mock_sql_client):
+  response = await LedgerAPI(100, mock_sql_client).GetUserTransfers("abc", {})
+  assert response.status == "400 BAD REQUEST"
+
+@pytest.mark.asyncio
+async def test_GetUserTransfers_SqlClientRaisesException(mock_sql_client):
+  mock_sql_client.FetchTransfers = AsyncMock(side_effect=Exception)
+  response = await LedgerAPI(100, mock_sql_client).GetUserTransfers(1, {})
+  assert response.status == "500 INTERNAL SERVER ERROR"
+
+@pytest.mark.asyncio
+async def test_ExportTransfers_Ok(mock_sql_client):
+  async def StreamTransfers(since, until, chunk_size, min_lsn=None):
+    yield [TransferRecord(1, datetime(2024, 1, 1), 1, 2, 10)]
+  mock_sql_client.StreamTransfers = StreamTransfers
+  response = await LedgerAPI(100, mock_sql_client).ExportTransfers(
+      {"format": "csv", "since": "2024-01-01", "until": "2024-02-01"})
+  assert response.status == "200 OK"
+  assert response.mimetype == "text/csv"
+  assert await response.get_data() == (
+      b"transferId,timestamp,userIdFrom,userIdTo,amount\r\n"
+      b"1,2024-01-01T00:00:00,1,2,10\r\n")
+
+@pytest.mark.parametrize("invalid_args", [
+  {"format": "xml", "since": "2024-01-01", "until": "2024-02-01"},
+  {"since": "2024-01-01"},
+  {"until": "2024-02-01"},
+  {"since": "yesterday", "until": "2024-02-01"},
+])
+@pytest.mark.asyncio
+async def test_ExportTransfers_InvalidArgs(mock_sql_client, invalid_args):
+  response = await LedgerAPI(100, mock_sql_client).ExportTransfers(
+      invalid_args)
+  assert response.status == "400 BAD REQUEST"
+
+@pytest.mark.asyncio
+async def test_CreateUsers_Count(mock_sql_client, mock_request):
+  mock_sql_client.InsertUsers = AsyncMock(return_value=[[1, 3]])
+  mock_request.get_data = AsyncMock(return_value=json.dumps({"count": "3"}))
+  response_json, status = await LedgerAPI(100, mock_sql_client).CreateUsers(
+      mock_request)
+  mock_sql_client.InsertUsers.assert_awaited_once_with([100, 100, 100])
+  assert response_json == {"userIdRanges": [[1, 3]]}
+  assert status == 201
+
+@pytest.mark.asyncio
+async def test_CreateUsers_Balances(mock_sql_client, mock_request):
+  mock_sql_client.InsertUsers = AsyncMock(return_value=[[1, 2], [4, 4]])
+  mock_request.get_data = AsyncMock(return_value=json.dumps(
+      {"balances": [10, "0", 30]}))
+  response_json, status = await LedgerAPI(100, mock_sql_client).CreateUsers(
+      mock_request)
+  mock_sql_client.InsertUsers.assert_awaited_once_with([10, 0, 30])
+  assert response_json == {"userIdRanges": [[1, 2], [4, 4]]}
+  assert status == 201
+
+@pytest.mark.parametrize("invalid_body", [
+  '{"count": "0"}',  # Not positive.
+  '{"count": "100001"}',  # Too many.
+  '{"count": "abc"}',  # Not numeric.
+  '{"balances": []}',  # Empty.
+  '{"balances": [10, -1]}',  # Negative.
+  '{"balances": [10, "1.1"]}',  # Not an int.
+  '{"balances": 10}',  # Not a list.
+  '{"count": 1, "balances": [10]}',  # Both.
+  '{"count": 1, "count": 2}',  # Duplicate.
+  '{}',  # Neither.
+  '[1]',  # Not an object.
+  'count',  # Not json.
+])
+@pytest.mark.asyncio
+async def test_CreateUsers_InvalidBody(
+    mock_sql_client, mock_request, invalid_body):
+  mock_request.get_data = AsyncMock(return_value=invalid_body)
+  response = await LedgerAPI(100, mock_sql_client).CreateUsers(mock_request)
+  assert response.status == "400 BAD REQUEST"
+
+@pytest.mark.asyncio
+async def test_CreateUsers_SqlClientRaisesException(
+    mock_sql_client, mock_request):
+  mock_sql_client.InsertUsers = AsyncMock(side_effect=Exception)
+  mock_request.get_data = AsyncMock(return_value=json.dumps({"count": 2}))
+  response = await LedgerAPI(100, mock_sql_client).CreateUsers(mock_request)
+  assert response.status == "500 INTERNAL SERVER ERROR"
+
+@pytest.mark.asyncio
+async def test_GetPoolStats_Ok(mock_sql_client):
+  mock_sql_client.PoolStats = MagicMock(return_value={"size": 10})
+  stats, status = await LedgerAPI(100, mock_sql_client).GetPoolStats()
+  assert stats == {"size": 10}
+  assert status == 200
+
+@pytest.mark.asyncio
+async def test_GetPoolStats_NoPool():
+  response = await LedgerAPI(100, AsyncMock(spec=["InsertUser"])).GetPoolStats()
+  assert response.status == "404 NOT FOUND"
+
+@pytest.mark.asyncio
+async def test_GetUserEvents_Ok(mock_sql_client):
+  mock_sql_client.FetchUser = AsyncMock(return_value=User(1, 100))
+  event_hub = TransferEventHub(mock_sql_client)
+  response = await LedgerAPI(
+      100, mock_sql_client, event_hub=event_hub).GetUserEvents("1")
+  assert response.status == "200 OK"
+  assert response.mimetype == "text/event-stream"
+  assert response.headers["Cache-Control"] == "no-cache"
+  assert event_hub.Stats()["subscriptions"] == 1
+  mock_sql_client.FetchUser.assert_awaited_once_with(1)
+
+@pytest.mark.asyncio
+async def test_GetUserEvents_NoEventHub(mock_sql_client):
+  response = await LedgerAPI(100, mock_sql_client).GetUserEvents("1")
+  assert response.status == "404 NOT FOUND"
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("user_id_str", ["abc", "0", "-1"])
+async def test_GetUserEvents_InvalidUserId(mock_sql_client, user_id_str):
+  event_hub = TransferEventHub(mock_sql_client)
+  response = await LedgerAPI(
+      100, mock_sql_client, event_hub=event_hub).GetUserEvents(user_id_str)
+  assert response.status == "400 BAD REQUEST"
+
+@pytest.mark.asyncio
+async def test_GetUserEvents_UserDoesNotExist(mock_sql_client):
+  mock_sql_client.FetchUser = AsyncMock(return_value=None)
+  event_hub = TransferEventHub(mock_sql_client)
+  response = await LedgerAPI(
+      100, mock_sql_client, event_hub=event_hub).GetUserEvents("1")
+  assert response.status == "400 BAD REQUEST"
+  assert event_hub.Stats()["subscriptions"] == 0
+
+@pytest.mark.asyncio
+async def test_GetUserEvents_FetchFails(mock_sql_client):
+  mock_sql_client.FetchUser = AsyncMock(side_effect=Exception)
+  event_hub = TransferEventHub(mock_sql_client)
+  response = await LedgerAPI(
+      100, mock_sql_client, event_hub=event_hub).GetUserEvents("1")
+  assert response.status == "500 INTERNAL SERVER ERROR"
+  assert event_hub.Stats()["subscriptions"] == 0
+
+@pytest.mark.asyncio
+async def test_GetEventStats_Ok(mock_sql_client):
+  stats, status = await LedgerAPI(
+      100, mock_sql_client,
+      event_hub=TransferEventHub(mock_sql_client)).GetEventStats()
+  assert stats == {"users": 0, "subscriptions": 0, "events": 0, "overflows": 0}
+  assert status == 200
+
+@pytest.mark.asyncio
+async def test_GetEventStats_NoEventHub(mock_sql_client):
+  response = await LedgerAPI(100, mock_sql_client).GetEventStats()
+  assert response.status == "404 NOT FOUND"
+
+@pytest.mark.asyncio
+async def test_GetTransferVolume_Ok(mock_sql_client):
+  mock_sql_client.FetchRollupProgress = AsyncMock(
+      return_value=datetime(2024, 1, 1, 12, 30))
+  mock_sql_client.FetchTransferVolume = AsyncMock(
+      return_value=[VolumeBucket(datetime(2024, 1, 1, 12), 2, 30)])
+  response, status = await LedgerAPI(100, mock_sql_client).GetTransferVolume(
+      {"bucket": "minute", "limit": "5"})
+  assert status == 200
+  assert response == {
+      "bucket": "minute",
+      "rolledUpUntil": "2024-01-01T12:30:00",
+      "buckets": [
+          {"bucketStart": "2024-01-01T12:00:00", "transferCount": 2,
+           "amount": 30}]}
+  mock_sql_client.FetchTransferVolume.assert_awaited_once_with("minute", 5)
+
+@pytest.mark.asyncio
+async def test_GetTransferVolume_Defaults(mock_sql_client):
+  mock_sql_client.FetchRollupProgress = AsyncMock(return_value=None)
+  mock_sql_client.FetchTransferVolume = AsyncMock(return_value=[])
+  response, _ = await LedgerAPI(100, mock_sql_client).GetTransferVolume({})
+  assert response == {"bucket": "hour", "rolledUpUntil": None, "buckets": []}
+  mock_sql_client.FetchTransferVolume.assert_awaited_once_with("hour", 24)
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("args", [
+  {"bucket": "week"},
+  {"limit": "0"},
+  {"limit": "1001"},
+  {"limit": "abc"},
+])
+async def test_GetTransferVolume_InvalidArgs(mock_sql_client, args):
+  response = await LedgerAPI(100, mock_sql_client).GetTransferVolume(args)
+  assert response.status == "400 BAD REQUEST"
+
+@pytest.mark.asyncio
+async def test_GetTransferVolume_Error(mock_sql_client):
+  mock_sql_client.FetchTransferVolume = AsyncMock(side_effect=Exception)
+  response = await LedgerAPI(100, mock_sql_client).GetTransferVolume({})
+  assert response.status == "500 INTERNAL SERVER ERROR"
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("window, granularity, bucket_count", [
+  ("15m", "minute", 15),
+  ("24h", "hour", 24),
+  ("7d", "day", 7),
+])
+async def test_GetTopUsers_Ok(mock_sql_client, window, granularity,
+                              bucket_count):
+  mock_sql_client.FetchRollupProgress = AsyncMock(
+      return_value=datetime(2024, 1, 1, 12, 30))
+  mock_sql_client.FetchTopUsers = AsyncMock(
+      return_value=[UserVolume(1, 2, 30)])
+  response, status = await LedgerAPI(100, mock_sql_client).GetTopUsers(
+      "sent", {"window": window, "limit": "3"})
+  assert status == 200
+  assert response == {
+      "window": window,
+      "rolledUpUntil": "2024-01-01T12:30:00",
+      "users": [{"userId": 1, "transferCount": 2, "amount": 30}]}
+  mock_sql_client.FetchTopUsers.assert_awaited_once_with(
+      "sent", granularity, bucket_count, 3)
+
+@pytest.mark.asyncio
+async def test_GetTopUsers_Defaults(mock_sql_client):
+  mock_sql_client.FetchRollupProgress = AsyncMock(return_value=None)
+  mock_sql_client.FetchTopUsers = AsyncMock(return_value=[])
+  response, _ = await LedgerAPI(100, mock_sql_client).GetTopUsers(
+      "received", {})
+  assert response["window"] == "24h"
+  mock_sql_client.FetchTopUsers.assert_awaited_once_with(
+      "received", "hour", 24, 10)
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("args", [
+  {"window": "24"},
+  {"window": "h"},
+  {"window": "0h"},
+  {"window": "1001m"},
+  {"window": "1w"},
+  {"limit": "0"},
+  {"limit": "1001"},
+])
+async def test_GetTopUsers_InvalidArgs(mock_sql_client, args):
+  response = await LedgerAPI(100, mock_sql_client).GetTopUsers("sent", args)
+  assert response.status == "400 BAD REQUEST"
+
+@pytest.mark.asyncio
+async def test_Rollups_NotOnBackendWithoutRollups():
+  class Backend:
+    pass
+  api = LedgerAPI(100, Backend())
+  assert (await api.GetTransferVolume({})).status == "404 NOT FOUND"
+  assert (await api.GetTopUsers("sent", {})).status == "404 NOT FOUND"
+
+@pytest.mark.asyncio
+async def test_Transfer_Overloaded(mock_sql_client, mock_request):
+  mock_sql_client.Transfer = AsyncMock(side_effect=OverloadedException(3))
+  mock_request.get_data = AsyncMock(return_value=json.dumps(
+      {"userIdFrom": 1, "userIdTo": 2, "amount": 10}))
+  response = await LedgerAPI(100, mock_sql_client).Transfer(mock_request)
+  assert response.status == "503 SERVICE UNAVAILABLE"
+  assert response.headers["Retry-After"] == "3"
+
+@pytest.mark.asyncio
+async def test_GetUserDetails_Overloaded(mock_sql_client):
+  mock_sql_client.FetchUser = AsyncMock(side_effect=OverloadedException())
+  response = await LedgerAPI(100, mock_sql_client).GetUserDetails(1)
+  assert response.status == "503 SERVICE UNAVAILABLE"
+  assert response.headers["Retry-After"] == "1"
+
+@pytest.mark.asyncio
+async def test_GetAdmissionStats_Ok(mock_sql_client):
+  mock_admission_controller = MagicMock()
+  mock_admission_controller.Stats = MagicMock(return_value={"inFlight": 1})
+  stats, status = await LedgerAPI(
+      100, mock_sql_client,
+      admission_controller=mock_admission_controller).GetAdmissionStats()
+  assert stats == {"inFlight": 1}
+  assert status == 200
+
+@pytest.mark.asyncio
+async def test_GetAdmissionStats_NoAdmissionControl(mock_sql_client):
+  response = await LedgerAPI(100, mock_sql_client).GetAdmissionStats()
+  assert response.status == "404 NOT FOUND"
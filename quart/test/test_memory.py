@@ -0,0 +1,207 @@
+from ledger.backend import LedgerBackend
+from ledger.memory import MemoryLedger
+from ledger.model import (
+    DIRECTION_ALL, DIRECTION_RECEIVED, DIRECTION_SENT,
+    InsufficientFundsException, User)
+from ledger.sql_client import PostgreSQLClient
+
+import asyncio
+from datetime import datetime, timedelta
+import os
+import pytest
+import pytest_asyncio
+
+@pytest_asyncio.fixture
+async def ledger(tmp_path):
+  ledger = MemoryLedger(str(tmp_path), snapshot_interval_seconds=0)
+  await ledger.Open()
+  yield ledger
+  await ledger.Close()
+
+async def _Reopen(ledger, tmp_path):
+  await ledger.Close()
+  ledger = MemoryLedger(str(tmp_path), snapshot_interval_seconds=0)
+  await ledger.Open()
+  return ledger
+
+def test_Backends():
+  assert isinstance(MemoryLedger("unused"), LedgerBackend)
+  assert isinstance(PostgreSQLClient("unused"), LedgerBackend)
+
+@pytest.mark.asyncio
+async def test_InsertUsers(ledger):
+  assert await ledger.InsertUser(100) == 1
+  assert await ledger.InsertUsers([10, 20]) == [[2, 3]]
+  assert await ledger.FetchUser(3) == User(3, 20)
+  assert await ledger.FetchUser(4) is None
+  assert await ledger.FetchUsers([1, 3, 4, 1]) == [User(1, 100), User(3, 20)]
+
+@pytest.mark.asyncio
+async def test_Transfer(ledger):
+  await ledger.InsertUsers([100, 0])
+  assert await ledger.Transfer(1, 2, 30) == 1
+  assert await ledger.Transfer(1, 2, 70) == 2
+  assert await ledger.FetchUsers([1, 2]) == [User(1, 0), User(2, 100)]
+
+@pytest.mark.parametrize("user_id_from,user_id_to", [(1, 3), (3, 1), (1, 1)])
+@pytest.mark.asyncio
+async def test_Transfer_InvalidArguments(ledger, user_id_from, user_id_to):
+  await ledger.InsertUsers([100, 100])
+  with pytest.raises(ValueError):
+    await ledger.Transfer(user_id_from, user_id_to, 1)
+
+@pytest.mark.asyncio
+async def test_Transfer_InsufficientFunds(ledger):
+  await ledger.InsertUsers([100, 100])
+  with pytest.raises(InsufficientFundsException):
+    await ledger.Transfer(1, 2, 101)
+  assert await ledger.FetchUsers([1, 2]) == [User(1, 100), User(2, 100)]
+
+@pytest.mark.asyncio
+async def test_Transfer_Overflow(ledger):
+  await ledger.InsertUsers([100, 2**63 - 1])
+  with pytest.raises(OverflowError):
+    await ledger.Transfer(1, 2, 1)
+  assert await ledger.FetchUsers([1, 2]) == [User(1, 100), User(2, 2**63 - 1)]
+
+@pytest.mark.asyncio
+async def test_Transfer_IdempotencyKey(ledger):
+  await ledger.InsertUsers([100, 100])
+  assert await ledger.Transfer(1, 2, 10, "key") == 1
+  assert await ledger.Transfer(1, 2, 10, "key") == 1
+  assert await ledger.FetchUser(1) == User(1, 90)
+  assert await ledger.FetchIdempotencyKeys(["key", "other"]) == {"key": 1}
+  # Unknown users are checked first.
+  with pytest.raises(ValueError):
+    await ledger.Transfer(1, 3, 10, "key")
+
+@pytest.mark.asyncio
+async def test_TransferBatch(ledger):
+  await ledger.InsertUsers([100, 0])
+  await ledger.Transfer(1, 2, 10, "known")
+  results = await ledger.TransferBatch(
+      [(1, 2, 50), (2, 1, 100), (1, 3, 1), (1, 2, 5), (1, 2, 5), (1, 2, 5)],
+      [None, None, None, "known", "new", "new"])
+  assert results[0] == 2
+  assert isinstance(results[1], InsufficientFundsException)
+  assert isinstance(results[2], ValueError)
+  assert results[3:5] == [1, 3]
+  assert isinstance(results[5], ValueError)
+  assert await ledger.FetchUsers([1, 2]) == [User(1, 35), User(2, 65)]
+
+@pytest.mark.asyncio
+async def test_FetchTransfers(ledger):
+  await ledger.InsertUsers([100, 100, 100])
+  await ledger.Transfer(1, 2, 1)
+  await ledger.Transfer(2, 1, 2)
+  await ledger.Transfer(2, 3, 3)
+  await ledger.Transfer(1, 3, 4)
+
+  transfers = await ledger.FetchTransfers(1, DIRECTION_ALL, 10)
+  assert [transfer.transfer_id for transfer in transfers] == [4, 2, 1]
+  transfers = await ledger.FetchTransfers(1, DIRECTION_SENT, 1)
+  assert [transfer.transfer_id for transfer in transfers] == [4]
+  transfers = await ledger.FetchTransfers(
+      1, DIRECTION_RECEIVED, 10, before_transfer_id=4)
+  assert [transfer.transfer_id for transfer in transfers] == [2]
+  transfers = await ledger.FetchTransfers(
+      1, DIRECTION_ALL, 10, since=transfers[0].timestamp,
+      until=transfers[0].timestamp + timedelta(microseconds=1))
+  assert [transfer.transfer_id for transfer in transfers][-1] == 2
+  assert await ledger.FetchTransfers(4, DIRECTION_ALL, 10) == []
+
+@pytest.mark.asyncio
+async def test_FetchBalanceAsOf(ledger):
+  await ledger.InsertUsers([100, 100])
+  before = datetime.utcnow() - timedelta(seconds=1)
+  await ledger.Transfer(1, 2, 10)
+  [transfer] = await ledger.FetchTransfers(1, DIRECTION_ALL, 1)
+  await asyncio.sleep(0.001)
+  await ledger.Transfer(2, 1, 3)
+
+  assert await ledger.FetchBalanceAsOf(1, before) == 100
+  assert await ledger.FetchBalanceAsOf(1, transfer.timestamp) == 90
+  assert await ledger.FetchBalanceAsOf(1, datetime.utcnow()) == 93
+  assert await ledger.FetchBalanceAsOf(3, before) is None
+
+@pytest.mark.asyncio
+async def test_StreamTransfers(ledger):
+  await ledger.InsertUsers([100, 100])
+  since = datetime.utcnow() - timedelta(seconds=1)
+  for _ in range(5):
+    await ledger.Transfer(1, 2, 1)
+  until = datetime.utcnow() + timedelta(seconds=1)
+  chunks = [
+      [transfer.transfer_id for transfer in chunk]
+      async for chunk in ledger.StreamTransfers(since, until, 2)]
+  assert chunks == [[1, 2], [3, 4], [5]]
+  assert [chunk async for chunk in ledger.StreamTransfers(
+      until, until + timedelta(seconds=1), 2)] == []
+
+@pytest.mark.asyncio
+async def test_DeleteIdempotencyKeys(ledger):
+  await ledger.InsertUsers([100, 100])
+  await ledger.Transfer(1, 2, 1, "old")
+  await asyncio.sleep(0.05)
+  await ledger.Transfer(1, 2, 1, "new")
+  assert await ledger.DeleteIdempotencyKeys(0.02) == 1
+  assert await ledger.FetchIdempotencyKeys(["old", "new"]) == {"new": 2}
+
+@pytest.mark.asyncio
+async def test_ConcurrentTransfersShareSyncs(ledger):
+  await ledger.InsertUsers([1000, 0])
+  transfer_ids = await asyncio.gather(*[
+      ledger.Transfer(1, 2, 1) for _ in range(100)])
+  assert sorted(transfer_ids) == list(range(1, 101))
+  assert await ledger.FetchUser(2) == User(2, 100)
+
+@pytest.mark.asyncio
+async def test_OpenTwice(ledger, tmp_path):
+  with pytest.raises(ValueError):
+    await MemoryLedger(str(tmp_path)).Open()
+
+@pytest.mark.asyncio
+async def test_Recover_FromLog(ledger, tmp_path):
+  await ledger.InsertUsers([100, 100])
+  await ledger.Transfer(1, 2, 10, "key")
+  await ledger.TransferBatch([(2, 1, 5), (1, 2, 1000)])
+  ledger = await _Reopen(ledger, tmp_path)
+
+  assert await ledger.FetchUsers([1, 2]) == [User(1, 95), User(2, 105)]
+  assert await ledger.FetchIdempotencyKeys(["key"]) == {"key": 1}
+  assert len(await ledger.FetchTransfers(1, DIRECTION_ALL, 10)) == 2
+  assert await ledger.Transfer(1, 2, 1) == 3
+  await ledger.Close()
+
+@pytest.mark.asyncio
+async def test_Recover_FromSnapshotAndLog(ledger, tmp_path):
+  await ledger.InsertUsers([100, 100])
+  await ledger.Transfer(1, 2, 10, "key")
+  await ledger.Snapshot()
+  await ledger.Transfer(2, 1, 5)
+  ledger = await _Reopen(ledger, tmp_path)
+
+  assert sorted(os.listdir(tmp_path)) == [
+      "LOCK", "snapshot-0000000001.bin", "wal-0000000001.log"]
+  assert await ledger.FetchUsers([1, 2]) == [User(1, 95), User(2, 105)]
+  assert await ledger.Transfer(1, 2, 10, "key") == 1
+  transfers = await ledger.FetchTransfers(2, DIRECTION_ALL, 10)
+  assert [transfer.transfer_id for transfer in transfers] == [2, 1]
+  await ledger.Close()
+
+@pytest.mark.asyncio
+async def test_Recover_DropsTornEntry(ledger, tmp_path):
+  await ledger.InsertUsers([100, 100])
+  await ledger.Transfer(1, 2, 10)
+  await ledger.Transfer(1, 2, 20)
+  await ledger.Close()
+  path = os.path.join(tmp_path, "wal-0000000000.log")
+  os.truncate(path, os.path.getsize(path) - 1)
+
+  ledger = MemoryLedger(str(tmp_path), snapshot_interval_seconds=0)
+  await ledger.Open()
+  assert await ledger.FetchUsers([1, 2]) == [User(1, 90), User(2, 110)]
+  assert await ledger.Transfer(1, 2, 5) == 2
+  ledger = await _Reopen(ledger, tmp_path)
+  assert await ledger.FetchUser(1) == User(1, 85)
+  await ledger.Close()
@@ -0,0 +1,52 @@
+from ledger.metrics import Counter, Gauge, LabeledHistogram, Registry
+
+
+def test_Counter_RendersOneSamplePerLabelSet():
+  counter = Counter("requests_total", "Requests.", ["route", "status"])
+  counter.Inc(route="Transfer", status=200)
+  counter.Inc(route="Transfer", status=200)
+  counter.Inc(2, route="Transfer", status=400)
+
+  assert counter.Render() == [
+      "# HELP requests_total Requests.",
+      "# TYPE requests_total counter",
+      'requests_total{route="Transfer",status="200"} 2',
+      'requests_total{route="Transfer",status="400"} 2',
+  ]
+
+def test_Counter_EscapesLabelValues():
+  counter = Counter("c", "C.", ["name"])
+  counter.Inc(name='a"b\\c\nd')
+  assert counter.Render()[-1] == 'c{name="a\\"b\\\\c\\nd"} 1'
+
+def test_LabeledHistogram_RendersCumulativeBuckets():
+  histogram = LabeledHistogram("latency", "Latency.", ["statement"], (1, 5))
+  for value in (0.5, 3, 7):
+    histogram.Observe(value, statement="fetch_user")
+
+  assert histogram.Render() == [
+      "# HELP latency Latency.",
+      "# TYPE latency histogram",
+      'latency_bucket{statement="fetch_user",le="1"} 1',
+      'latency_bucket{statement="fetch_user",le="5"} 2',
+      'latency_bucket{statement="fetch_user",le="+Inf"} 3',
+      'latency_sum{statement="fetch_user"} 10.5',
+      'latency_count{statement="fetch_user"} 3',
+  ]
+
+def test_LabeledHistogram_TimeObservesOnError():
+  histogram = LabeledHistogram("latency", "Latency.", ["statement"])
+  try:
+    with histogram.Time(statement="transfer"):
+      raise ValueError()
+  except ValueError:
+    pass
+  assert histogram.Render()[-1] == 'latency_count{statement="transfer"} 1'
+
+def test_Registry_RendersAllMetrics():
+  registry = Registry()
+  registry.Register(Counter("c", "C.")).Inc()
+  registry.Register(Gauge("g", "G.", lambda: 7))
+  assert registry.Render() == (
+      "# HELP c C.\n# TYPE c counter\nc 1\n"
+      "# HELP g G.\n# TYPE g gauge\ng 7\n")
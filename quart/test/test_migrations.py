@@ -0,0 +1,25 @@
+from ledger.migrations import MIGRATIONS_DIR, LoadMigrations, Migration
+
+import pytest
+
+def test_LoadMigrations(tmp_path):
+  (tmp_path / "10_add_index.sql").write_text(
+      "-- migration: no transaction\nCREATE INDEX CONCURRENTLY i ON t (c);")
+  (tmp_path / "0002_add_table.sql").write_text("CREATE TABLE t (c INT);")
+  (tmp_path / "README.md").write_text("Not a migration.")
+  assert LoadMigrations(tmp_path) == [
+      Migration(2, "add_table", "CREATE TABLE t (c INT);"),
+      Migration(
+          10, "add_index",
+          "-- migration: no transaction\nCREATE INDEX CONCURRENTLY i ON t (c);",
+          in_transaction=False)]
+
+def test_LoadMigrations_DuplicateVersions(tmp_path):
+  (tmp_path / "1_a.sql").write_text("SELECT 1;")
+  (tmp_path / "01_b.sql").write_text("SELECT 2;")
+  with pytest.raises(ValueError):
+    LoadMigrations(tmp_path)
+
+def test_LoadMigrations_Bundled():
+  migrations = LoadMigrations(MIGRATIONS_DIR)
+  assert migrations[0].version == 1
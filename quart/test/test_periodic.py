@@ -0,0 +1,33 @@
+from ledger.periodic import PeriodicTask
+
+import asyncio
+import pytest
+from unittest.mock import AsyncMock
+
+@pytest.mark.asyncio
+async def test_PeriodicTask_RunsRoundsUntilClosed():
+  round = AsyncMock(side_effect=[Exception, None, None, None, None, None])
+  task = PeriodicTask(round, 0.01)
+
+  task.Start()
+  await asyncio.sleep(0.005)
+  assert round.await_count == 0
+  await asyncio.sleep(0.03)
+  await task.Close()
+
+  # Keeps going after a failed round.
+  assert round.await_count >= 2
+  await_count = round.await_count
+  await asyncio.sleep(0.02)
+  assert round.await_count == await_count
+
+@pytest.mark.asyncio
+async def test_PeriodicTask_RunFirstRunsRightAway():
+  round = AsyncMock()
+  task = PeriodicTask(round, 60, run_first=True)
+
+  task.Start()
+  await asyncio.sleep(0.005)
+  await task.Close()
+
+  round.assert_awaited_once_with()
@@ -0,0 +1,133 @@
+from ledger.model import User
+from ledger.replicas import FormatLsn, ParseLsn, ReplicaReader
+
+import asyncpg
+import pytest
+import pytest_asyncio
+from unittest.mock import AsyncMock
+
+@pytest_asyncio.fixture
+async def mock_primary():
+  primary = AsyncMock()
+  primary.FetchWalLsn = AsyncMock(return_value="0/100")
+  primary.FetchUser = AsyncMock(return_value=User(1, 100))
+  return primary
+
+def _Replica(replay_lsn="0/100", in_recovery=True):
+  replica = AsyncMock()
+  replica.FetchReplayStatus = AsyncMock(return_value={
+      "in_recovery": in_recovery, "replay_lsn": replay_lsn})
+  replica.FetchUser = AsyncMock(return_value=User(1, 90))
+  return replica
+
+def _ReplicaReader(primary, replicas, max_lag_seconds=10, read_wait_ms=0):
+  return ReplicaReader(primary, replicas, max_lag_seconds, read_wait_ms, 1)
+
+def test_ParseLsn():
+  assert ParseLsn("16/B374D848") == 0x16B374D848
+  assert FormatLsn(ParseLsn("16/B374D848")) == "16/B374D848"
+  with pytest.raises(ValueError):
+    ParseLsn("16B374D848")
+
+@pytest.mark.asyncio
+async def test_CheckReplicas(mock_primary):
+  replicas = [
+      _Replica(), _Replica(in_recovery=False), _Replica(),
+      _Replica("0/80")]
+  replicas[2].FetchReplayStatus = AsyncMock(side_effect=ConnectionError)
+  reader = _ReplicaReader(mock_primary, replicas, max_lag_seconds=0)
+
+  assert await reader.CheckReplicas() == 1
+
+  stats = reader.Stats()["replicas"]
+  assert [replica["healthy"] for replica in stats] == [
+      True, False, False, False]
+  assert stats[0]["lagBytes"] == 0
+  assert stats[1]["error"] == "Not in recovery."
+  assert stats[2]["error"] == "ConnectionError"
+  assert stats[3]["error"] == "Lagging behind."
+  assert stats[3]["lagBytes"] == 0x80
+  assert stats[3]["replayLsn"] == "0/80"
+  replicas[0].CreateConnectionPool.assert_awaited_once()
+
+@pytest.mark.asyncio
+async def test_FetchUser_ReadsFromReplicas(mock_primary):
+  replicas = [_Replica(), _Replica()]
+  reader = _ReplicaReader(mock_primary, replicas)
+  await reader.CheckReplicas()
+
+  assert await reader.FetchUser(1) == User(1, 90)
+  await reader.FetchUser(1)
+
+  replicas[0].FetchUser.assert_awaited_once_with(1)
+  replicas[1].FetchUser.assert_awaited_once_with(1)
+  mock_primary.FetchUser.assert_not_awaited()
+
+@pytest.mark.asyncio
+async def test_FetchUser_ReplicaHasReplayedLsn(mock_primary):
+  replicas = [_Replica("0/80"), _Replica("0/100")]
+  reader = _ReplicaReader(mock_primary, replicas, read_wait_ms=0)
+  await reader.CheckReplicas()
+
+  assert await reader.FetchUser(1, min_lsn=0x100) == User(1, 90)
+  replicas[1].FetchUser.assert_awaited_once_with(1)
+
+@pytest.mark.asyncio
+async def test_FetchUser_WaitsForReplicaToReplayLsn(mock_primary):
+  replica = _Replica("0/80")
+  reader = _ReplicaReader(mock_primary, [replica], read_wait_ms=1000)
+  await reader.CheckReplicas()
+  replica.FetchReplayStatus = AsyncMock(side_effect=[
+      {"in_recovery": True, "replay_lsn": "0/90"},
+      {"in_recovery": True, "replay_lsn": "0/100"}])
+
+  assert await reader.FetchUser(1, min_lsn=0x100) == User(1, 90)
+  assert replica.FetchReplayStatus.await_count == 2
+
+@pytest.mark.asyncio
+async def test_FetchUser_FallsBackToPrimaryForLsn(mock_primary):
+  replica = _Replica("0/80")
+  reader = _ReplicaReader(mock_primary, [replica], read_wait_ms=0)
+  await reader.CheckReplicas()
+
+  assert await reader.FetchUser(1, min_lsn=0x100) == User(1, 100)
+  replica.FetchUser.assert_not_awaited()
+
+@pytest.mark.asyncio
+async def test_FetchUser_NoHealthyReplica(mock_primary):
+  replica = _Replica(in_recovery=False)
+  reader = _ReplicaReader(mock_primary, [replica])
+  await reader.CheckReplicas()
+
+  assert await reader.FetchUser(1) == User(1, 100)
+  replica.FetchUser.assert_not_awaited()
+
+@pytest.mark.asyncio
+async def test_FetchUser_ReplicaFails(mock_primary):
+  replicas = [_Replica(), _Replica()]
+  replicas[0].FetchUser = AsyncMock(
+      side_effect=asyncpg.exceptions.ConnectionDoesNotExistError("closed"))
+  replicas[1].FetchUser = AsyncMock(
+      side_effect=asyncpg.exceptions.SerializationError)
+  reader = _ReplicaReader(mock_primary, replicas)
+  await reader.CheckReplicas()
+
+  assert await reader.FetchUser(1) == User(1, 100)
+  assert await reader.FetchUser(1) == User(1, 100)
+
+  # Only the lost connection takes the replica out.
+  assert [replica["healthy"] for replica in reader.Stats()["replicas"]] == [
+      False, True]
+
+@pytest.mark.asyncio
+async def test_StreamTransfers_StaysOnOneReplica(mock_primary):
+  async def StreamTransfers(since, until, chunk_size):
+    yield [1]
+    yield [2]
+  replica = _Replica()
+  replica.StreamTransfers = StreamTransfers
+  reader = _ReplicaReader(mock_primary, [replica])
+  await reader.CheckReplicas()
+
+  assert [chunk async for chunk in reader.StreamTransfers(None, None, 10)] == [
+      [1], [2]]
@@ -0,0 +1,314 @@
+from ledger.migrations import Migration
+from ledger.model import (
+    InsufficientFundsException, TransferRecord, User, UserVolume, VolumeBucket)
+from ledger.sharding import ID_RANGE_SIZE, ShardedPostgreSQLClient
+
+from datetime import datetime
+import asyncpg
+import pytest
+import pytest_asyncio
+from unittest.mock import AsyncMock, call
+
+# A user on the first and one on the second shard.
+USER_0 = 7
+USER_1 = ID_RANGE_SIZE + 7
+
+@pytest_asyncio.fixture
+async def mock_shards():
+  return [AsyncMock(), AsyncMock()]
+
+@pytest.mark.asyncio
+async def test_ApplyMigrations_SetsIdRangeOfEachShard(mock_shards):
+  migrations = [Migration(1, "baseline", "SELECT 1")]
+  mock_shards[0].ApplyMigrations = AsyncMock(return_value=[])
+  mock_shards[1].ApplyMigrations = AsyncMock(return_value=[1])
+
+  assert await ShardedPostgreSQLClient(mock_shards).ApplyMigrations(
+      migrations) == [1]
+
+  mock_shards[0].ApplyMigrations.assert_awaited_once_with(
+      migrations,
+      {"ledger.id_range_start": 0, "ledger.id_range_size": ID_RANGE_SIZE})
+  mock_shards[1].ApplyMigrations.assert_awaited_once_with(
+      migrations,
+      {"ledger.id_range_start": ID_RANGE_SIZE,
+       "ledger.id_range_size": ID_RANGE_SIZE})
+
+@pytest.mark.asyncio
+async def test_InsertUser_AlternatesShards(mock_shards):
+  mock_shards[0].InsertUser = AsyncMock(return_value=1)
+  mock_shards[1].InsertUser = AsyncMock(return_value=ID_RANGE_SIZE)
+  client = ShardedPostgreSQLClient(mock_shards)
+  assert [await client.InsertUser(100) for _ in range(3)] == [
+      1, ID_RANGE_SIZE, 1]
+
+@pytest.mark.asyncio
+async def test_FetchUsers_GroupsByShard(mock_shards):
+  mock_shards[0].FetchUsers = AsyncMock(return_value=[User(USER_0, 1)])
+  mock_shards[1].FetchUsers = AsyncMock(return_value=[User(USER_1, 2)])
+  users = await ShardedPostgreSQLClient(mock_shards).FetchUsers(
+      [USER_1, USER_0, 2 * ID_RANGE_SIZE])
+  assert users == [User(USER_1, 2), User(USER_0, 1)]
+  mock_shards[0].FetchUsers.assert_awaited_once_with([USER_0], min_lsn=None)
+  mock_shards[1].FetchUsers.assert_awaited_once_with([USER_1], min_lsn=None)
+
+@pytest.mark.asyncio
+async def test_FetchUser_OutsideOfShards(mock_shards):
+  client = ShardedPostgreSQLClient(mock_shards)
+  assert await client.FetchUser(2 * ID_RANGE_SIZE) is None
+  with pytest.raises(ValueError):
+    await client.Transfer(USER_0, 2 * ID_RANGE_SIZE, 1)
+
+@pytest.mark.asyncio
+async def test_StreamTransfers_SkipsCopiesOfReceivers(mock_shards):
+  def Transfer(transfer_id):
+    return TransferRecord(transfer_id, datetime(2024, 1, 1), 1, 2, 3)
+  async def Stream0(*args, **kwargs):
+    yield [Transfer(1), Transfer(2)]
+  async def Stream1(*args, **kwargs):
+    yield [Transfer(1)]
+    yield [Transfer(ID_RANGE_SIZE)]
+  mock_shards[0].StreamTransfers = Stream0
+  mock_shards[1].StreamTransfers = Stream1
+
+  chunks = [
+      chunk async for chunk in ShardedPostgreSQLClient(
+          mock_shards).StreamTransfers(None, None, 10)]
+
+  assert [[transfer.transfer_id for transfer in chunk] for chunk in chunks] == [
+      [1, 2], [ID_RANGE_SIZE]]
+
+@pytest.mark.asyncio
+async def test_Transfer_WithinShard(mock_shards):
+  mock_shards[1].Transfer = AsyncMock(return_value=ID_RANGE_SIZE)
+  transfer_id = await ShardedPostgreSQLClient(mock_shards).Transfer(
+      USER_1, USER_1 + 1, 5, "key")
+  assert transfer_id == ID_RANGE_SIZE
+  mock_shards[1].Transfer.assert_awaited_once_with(
+      USER_1, USER_1 + 1, 5, idempotency_key="key")
+  mock_shards[0].PrepareTransferDebit.assert_not_called()
+
+@pytest.mark.asyncio
+async def test_Transfer_AcrossShards(mock_shards):
+  timestamp = datetime(2024, 1, 1)
+  mock_shards[0].PrepareTransferDebit = AsyncMock(return_value=(3, timestamp))
+  mock_shards[0].DecideTransaction = AsyncMock(return_value=True)
+
+  transfer_id = await ShardedPostgreSQLClient(mock_shards).Transfer(
+      USER_0, USER_1, 5, "key")
+
+  assert transfer_id == 3
+  debit_id = mock_shards[0].PrepareTransferDebit.await_args.args[0]
+  transaction_id = debit_id.rsplit("_", 1)[0]
+  assert transaction_id.startswith("ledger_0_")
+  mock_shards[0].PrepareTransferDebit.assert_awaited_once_with(
+      transaction_id + "_0", USER_0, USER_1, 5, "key")
+  mock_shards[1].PrepareTransferCredit.assert_awaited_once_with(
+      transaction_id + "_1", 3, timestamp, USER_0, USER_1, 5)
+  mock_shards[0].DecideTransaction.assert_awaited_once_with(
+      transaction_id, True)
+  mock_shards[0].FinishPreparedTransaction.assert_awaited_once_with(
+      transaction_id + "_0", True)
+  mock_shards[1].FinishPreparedTransaction.assert_awaited_once_with(
+      transaction_id + "_1", True)
+  mock_shards[0].DeleteTransactionDecision.assert_awaited_once_with(
+      transaction_id)
+  transfer = TransferRecord(3, timestamp, USER_0, USER_1, 5)
+  for shard in mock_shards:
+    shard.NotifyTransfers.assert_awaited_once_with([transfer])
+
+@pytest.mark.asyncio
+async def test_Transfer_AcrossShardsNotifyFailureIsNotRaised(mock_shards):
+  mock_shards[0].PrepareTransferDebit = AsyncMock(
+      return_value=(3, datetime(2024, 1, 1)))
+  mock_shards[0].DecideTransaction = AsyncMock(return_value=True)
+  mock_shards[1].NotifyTransfers = AsyncMock(side_effect=Exception)
+  assert await ShardedPostgreSQLClient(mock_shards).Transfer(
+      USER_0, USER_1, 5) == 3
+
+@pytest.mark.asyncio
+async def test_ListenForTransfers_ListensOnEveryShard(mock_shards):
+  callback, on_interruption = object(), object()
+  await ShardedPostgreSQLClient(mock_shards).ListenForTransfers(
+      callback, on_interruption)
+  for shard in mock_shards:
+    shard.ListenForTransfers.assert_awaited_once_with(
+        callback, on_interruption)
+
+@pytest.mark.asyncio
+async def test_Transfer_AcrossShardsReplaysIdempotencyKey(mock_shards):
+  mock_shards[0].PrepareTransferDebit = AsyncMock(return_value=(3, None))
+  assert await ShardedPostgreSQLClient(mock_shards).Transfer(
+      USER_0, USER_1, 5, "key") == 3
+  mock_shards[1].PrepareTransferCredit.assert_not_called()
+
+@pytest.mark.asyncio
+async def test_Transfer_AcrossShardsInsufficientFunds(mock_shards):
+  mock_shards[0].PrepareTransferDebit = AsyncMock(
+      side_effect=InsufficientFundsException)
+  with pytest.raises(InsufficientFundsException):
+    await ShardedPostgreSQLClient(mock_shards).Transfer(USER_0, USER_1, 5)
+  mock_shards[1].PrepareTransferCredit.assert_not_called()
+
+@pytest.mark.asyncio
+async def test_Transfer_AcrossShardsReceiverFails(mock_shards):
+  mock_shards[0].PrepareTransferDebit = AsyncMock(
+      return_value=(3, datetime(2024, 1, 1)))
+  mock_shards[1].PrepareTransferCredit = AsyncMock(side_effect=ValueError)
+
+  with pytest.raises(ValueError):
+    await ShardedPostgreSQLClient(mock_shards).Transfer(USER_0, USER_1, 5)
+
+  debit_id = mock_shards[0].PrepareTransferDebit.await_args.args[0]
+  mock_shards[0].FinishPreparedTransaction.assert_awaited_once_with(
+      debit_id, False)
+  mock_shards[0].DecideTransaction.assert_not_called()
+
+@pytest.mark.asyncio
+async def test_Transfer_AcrossShardsRolledBackByRecovery(mock_shards):
+  mock_shards[0].PrepareTransferDebit = AsyncMock(
+      return_value=(3, datetime(2024, 1, 1)))
+  mock_shards[0].DecideTransaction = AsyncMock(return_value=False)
+  # Recovery rolled back one side already.
+  mock_shards[1].FinishPreparedTransaction = AsyncMock(
+      side_effect=asyncpg.exceptions.UndefinedObjectError)
+
+  with pytest.raises(TimeoutError):
+    await ShardedPostgreSQLClient(mock_shards).Transfer(USER_0, USER_1, 5)
+
+  assert mock_shards[0].FinishPreparedTransaction.await_args.args[1] is False
+  assert mock_shards[1].FinishPreparedTransaction.await_args.args[1] is False
+
+@pytest.mark.asyncio
+async def test_Transfer_AcrossShardsCommitLeftToRecovery(mock_shards):
+  mock_shards[0].PrepareTransferDebit = AsyncMock(
+      return_value=(3, datetime(2024, 1, 1)))
+  mock_shards[0].DecideTransaction = AsyncMock(return_value=True)
+  mock_shards[1].FinishPreparedTransaction = AsyncMock(
+      side_effect=ConnectionError)
+
+  assert await ShardedPostgreSQLClient(mock_shards).Transfer(
+      USER_0, USER_1, 5) == 3
+  # Recovery needs the decision.
+  mock_shards[0].DeleteTransactionDecision.assert_not_called()
+
+@pytest.mark.asyncio
+async def test_TransferBatch_SplitsByShard(mock_shards):
+  mock_shards[0].TransferBatch = AsyncMock(
+      return_value=[1, InsufficientFundsException()])
+  mock_shards[0].PrepareTransferDebit = AsyncMock(
+      side_effect=InsufficientFundsException)
+  mock_shards[1].TransferBatch = AsyncMock(return_value=[ID_RANGE_SIZE])
+
+  results = await ShardedPostgreSQLClient(mock_shards).TransferBatch(
+      [(USER_0, USER_0 + 1, 1), (USER_1, USER_1 + 1, 2),
+       (USER_0, USER_1, 3), (USER_0 + 1, USER_0, 4),
+       (USER_0, 2 * ID_RANGE_SIZE, 5)],
+      ["a", None, None, "b", None])
+
+  assert results[:2] == [1, ID_RANGE_SIZE]
+  assert isinstance(results[2], InsufficientFundsException)
+  assert isinstance(results[3], InsufficientFundsException)
+  assert isinstance(results[4], ValueError)
+  mock_shards[0].TransferBatch.assert_awaited_once_with(
+      [(USER_0, USER_0 + 1, 1), (USER_0 + 1, USER_0, 4)], ["a", "b"])
+  mock_shards[1].TransferBatch.assert_awaited_once_with(
+      [(USER_1, USER_1 + 1, 2)], [None])
+
+@pytest.mark.asyncio
+async def test_WriteBalanceCheckpoints_SumsShards(mock_shards):
+  mock_shards[0].WriteBalanceCheckpoints = AsyncMock(return_value=2)
+  mock_shards[1].WriteBalanceCheckpoints = AsyncMock(return_value=None)
+  client = ShardedPostgreSQLClient(mock_shards)
+  assert await client.WriteBalanceCheckpoints(1, 60) == 2
+  mock_shards[0].WriteBalanceCheckpoints = AsyncMock(return_value=None)
+  assert await client.WriteBalanceCheckpoints(1, 60) is None
+
+@pytest.mark.asyncio
+async def test_RollUpTransfers_SumsShards(mock_shards):
+  mock_shards[0].RollUpTransfers = AsyncMock(return_value=2)
+  mock_shards[1].RollUpTransfers = AsyncMock(return_value=None)
+  client = ShardedPostgreSQLClient(mock_shards)
+  assert await client.RollUpTransfers(60) == 2
+  mock_shards[0].RollUpTransfers = AsyncMock(return_value=None)
+  assert await client.RollUpTransfers(60) is None
+
+@pytest.mark.asyncio
+async def test_FetchRollupProgress_ShardFurthestBehind(mock_shards):
+  mock_shards[0].FetchRollupProgress = AsyncMock(
+      return_value=datetime(2024, 1, 2))
+  mock_shards[1].FetchRollupProgress = AsyncMock(
+      return_value=datetime(2024, 1, 1))
+  client = ShardedPostgreSQLClient(mock_shards)
+  assert await client.FetchRollupProgress() == datetime(2024, 1, 1)
+  mock_shards[1].FetchRollupProgress = AsyncMock(return_value=None)
+  assert await client.FetchRollupProgress() is None
+
+@pytest.mark.asyncio
+async def test_FetchTransferVolume_AddsUpBuckets(mock_shards):
+  mock_shards[0].FetchTransferVolume = AsyncMock(return_value=[
+      VolumeBucket(datetime(2024, 1, 3), 1, 10),
+      VolumeBucket(datetime(2024, 1, 1), 2, 20)])
+  mock_shards[1].FetchTransferVolume = AsyncMock(return_value=[
+      VolumeBucket(datetime(2024, 1, 2), 4, 40),
+      VolumeBucket(datetime(2024, 1, 1), 8, 80)])
+
+  assert await ShardedPostgreSQLClient(mock_shards).FetchTransferVolume(
+      "day", 3) == [
+          VolumeBucket(datetime(2024, 1, 3), 1, 10),
+          VolumeBucket(datetime(2024, 1, 2), 4, 40),
+          VolumeBucket(datetime(2024, 1, 1), 10, 100)]
+  mock_shards[0].FetchTransferVolume.assert_awaited_once_with("day", 3)
+
+@pytest.mark.asyncio
+async def test_FetchTopUsers_MergesShards(mock_shards):
+  mock_shards[0].FetchTopUsers = AsyncMock(return_value=[
+      UserVolume(USER_0, 1, 50), UserVolume(1, 1, 10)])
+  mock_shards[1].FetchTopUsers = AsyncMock(return_value=[
+      UserVolume(USER_1, 2, 30), UserVolume(USER_1 + 1, 1, 10)])
+
+  assert await ShardedPostgreSQLClient(mock_shards).FetchTopUsers(
+      "sent", "hour", 24, 3) == [
+          UserVolume(USER_0, 1, 50), UserVolume(USER_1, 2, 30),
+          UserVolume(1, 1, 10)]
+  mock_shards[1].FetchTopUsers.assert_awaited_once_with("sent", "hour", 24, 3)
+
+@pytest.mark.asyncio
+async def test_SetSlotCount_GoesToShardOfUser(mock_shards):
+  mock_shards[1].SetSlotCount = AsyncMock(return_value=True)
+  client = ShardedPostgreSQLClient(mock_shards)
+  assert await client.SetSlotCount(USER_1, 8)
+  assert not await client.SetSlotCount(2 * ID_RANGE_SIZE, 8)
+  mock_shards[1].SetSlotCount.assert_awaited_once_with(USER_1, 8)
+  mock_shards[0].SetSlotCount.assert_not_awaited()
+
+@pytest.mark.asyncio
+async def test_ConsolidateBalanceSlots_SumsShards(mock_shards):
+  mock_shards[0].ConsolidateBalanceSlots = AsyncMock(return_value=2)
+  mock_shards[1].ConsolidateBalanceSlots = AsyncMock(return_value=1)
+  assert await ShardedPostgreSQLClient(
+      mock_shards).ConsolidateBalanceSlots() == 3
+
+@pytest.mark.asyncio
+async def test_RecoverPreparedTransactions(mock_shards):
+  prepared = [["ledger_1_b_0"], ["ledger_0_a_1", "ledger_1_b_1"]]
+  in_doubt = [[], ["ledger_0_a_1"]]
+  for shard, shard_prepared, shard_in_doubt in zip(
+      mock_shards, prepared, in_doubt):
+    shard.ListPreparedTransactions = AsyncMock(
+        side_effect=[shard_prepared, shard_in_doubt])
+  mock_shards[0].DecideTransaction = AsyncMock(return_value=True)
+
+  assert await ShardedPostgreSQLClient(
+      mock_shards).RecoverPreparedTransactions(60) == 1
+
+  mock_shards[0].ListPreparedTransactions.assert_has_awaits([
+      call("ledger_", 0), call("ledger_", 60)])
+  # The coordinator's log decides.
+  mock_shards[0].DecideTransaction.assert_awaited_once_with(
+      "ledger_0_a", False)
+  mock_shards[1].FinishPreparedTransaction.assert_awaited_once_with(
+      "ledger_0_a_1", True)
+  for shard in mock_shards:
+    shard.DeleteTransactionDecisions.assert_awaited_once_with(
+        86400, ["ledger_1_b", "ledger_0_a", "ledger_1_b"])
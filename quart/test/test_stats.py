@@ -0,0 +1,19 @@
+from ledger.stats import Histogram
+
+
+def test_Histogram_CountsObservationsPerBucket():
+  histogram = Histogram((1, 5))
+  for value in (0.5, 1, 3, 7, 9):
+    histogram.Observe(value)
+
+  assert histogram.CumulativeCounts() == [2, 3, 5]
+  assert histogram.Stats() == {
+      "buckets": {"1": 2, "5": 3, "+Inf": 5},
+      "count": 5,
+      "sum": 20.5,
+  }
+
+def test_Histogram_Empty():
+  histogram = Histogram((1,))
+  assert histogram.Stats() == {
+      "buckets": {"1": 0, "+Inf": 0}, "count": 0, "sum": 0.0}
@@ -0,0 +1,157 @@
+from ledger import tracing
+from ledger.tracing import Span, Tracer
+
+import json
+import logging
+import pytest
+
+TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+PARENT_ID = "00f067aa0ba902b7"
+
+@pytest.fixture
+def trace_file(tmp_path):
+  return tmp_path / "traces.jsonl"
+
+def NewTracer(trace_file, sample_rate=1, slow_request_ms=60000):
+  return Tracer(str(trace_file), sample_rate, slow_request_ms, 1000000, 1)
+
+def ReadTraces(trace_file):
+  return [json.loads(line) for line in trace_file.read_text().splitlines()]
+
+def test_Span_NestsUnderRequest(trace_file):
+  tracer = NewTracer(trace_file)
+  trace = tracer.Start("POST Transfer", **{"http.path": "/transactions"})
+  with Span("pool_acquire"):
+    pass
+  with Span("sql lock_users", rows=2):
+    with Span("inner"):
+      pass
+  tracer.Finish(trace, **{"http.status_code": 200})
+  tracer.Close()
+
+  [[root, acquire, inner, lock_users]] = ReadTraces(trace_file)
+  assert root["name"] == "POST Transfer"
+  assert root["kind"] == "SERVER"
+  assert "parentId" not in root
+  assert root["tags"] == {
+      "http.path": "/transactions", "http.status_code": "200"}
+  assert acquire["parentId"] == root["id"]
+  assert lock_users["parentId"] == root["id"]
+  assert lock_users["tags"] == {"rows": "2"}
+  assert inner["parentId"] == lock_users["id"]
+  for span in (root, acquire, inner, lock_users):
+    assert span["traceId"] == root["traceId"]
+    assert span["localEndpoint"] == {"serviceName": "ledger"}
+  assert len(root["traceId"]) == 32
+  assert len(root["id"]) == 16
+
+def test_Span_RecordsError(trace_file):
+  tracer = NewTracer(trace_file)
+  trace = tracer.Start("POST Transfer")
+  with pytest.raises(ValueError):
+    with Span("validate"):
+      raise ValueError()
+  tracer.Finish(trace)
+  tracer.Close()
+
+  [[_, span]] = ReadTraces(trace_file)
+  assert span["tags"] == {"error": "ValueError"}
+
+def test_Span_TagsAddedInBlock(trace_file):
+  tracer = NewTracer(trace_file)
+  trace = tracer.Start("POST Transfer")
+  with Span("group_commit_wait") as tags:
+    tags["batch_size"] = 3
+  tracer.Finish(trace)
+  tracer.Close()
+
+  [[_, span]] = ReadTraces(trace_file)
+  assert span["tags"] == {"batch_size": "3"}
+
+def test_Span_WithoutTraceDoesNothing():
+  with Span("sql fetch_user"):
+    pass
+
+def test_Start_PropagatesTraceparent(trace_file):
+  tracer = NewTracer(trace_file)
+  trace = tracer.Start("GET GetUserDetails", f"00-{TRACE_ID}-{PARENT_ID}-00")
+  tracer.Finish(trace)
+  tracer.Close()
+
+  [[root]] = ReadTraces(trace_file)
+  assert root["traceId"] == TRACE_ID
+  assert root["parentId"] == PARENT_ID
+
+@pytest.mark.parametrize("traceparent", [
+  "garbage",
+  f"01-{TRACE_ID}-{PARENT_ID}-01",  # Unknown version.
+  f"00-{'0' * 32}-{PARENT_ID}-01",  # Invalid trace id.
+  f"00-{TRACE_ID}-{'0' * 16}-01",  # Invalid parent id.
+  f"00-{TRACE_ID.upper()}-{PARENT_ID}-01",
+])
+def test_Start_InvalidTraceparentStartsNewTrace(trace_file, traceparent):
+  tracer = NewTracer(trace_file)
+  trace = tracer.Start("GET GetUserDetails", traceparent)
+  tracer.Finish(trace)
+  tracer.Close()
+
+  [[root]] = ReadTraces(trace_file)
+  assert root["traceId"] != TRACE_ID.lower()
+  assert "parentId" not in root
+
+def test_Finish_UnsampledTraceIsDropped(trace_file):
+  tracer = NewTracer(trace_file, sample_rate=0)
+  trace = tracer.Start("GET GetUserDetails")
+  with Span("sql fetch_user"):
+    pass
+  tracer.Finish(trace)
+  tracer.Close()
+
+  assert not trace_file.exists()
+
+def test_Finish_CallerSampledTraceIsWritten(trace_file):
+  tracer = NewTracer(trace_file, sample_rate=0)
+  trace = tracer.Start("GET GetUserDetails", f"00-{TRACE_ID}-{PARENT_ID}-01")
+  tracer.Finish(trace)
+  tracer.Close()
+
+  assert len(ReadTraces(trace_file)) == 1
+
+def test_Finish_SlowTraceIsWrittenAndLogged(trace_file, caplog):
+  tracer = NewTracer(trace_file, sample_rate=0, slow_request_ms=0)
+  trace = tracer.Start("POST Transfer")
+  with Span("sql transfer_function"):
+    pass
+  with caplog.at_level(logging.WARNING):
+    tracer.Finish(trace)
+  tracer.Close()
+
+  [[root, span]] = ReadTraces(trace_file)
+  assert span["name"] == "sql transfer_function"
+  assert "Slow request POST Transfer" in caplog.text
+  assert root["traceId"] in caplog.text
+  assert "sql transfer_function" in caplog.text
+
+def test_Finish_SpansAreCapped(trace_file, monkeypatch):
+  monkeypatch.setattr(tracing, "MAX_SPANS_PER_TRACE", 2)
+  tracer = NewTracer(trace_file)
+  trace = tracer.Start("POST TransferBatch")
+  for _ in range(5):
+    with Span("sql update_user"):
+      pass
+  tracer.Finish(trace)
+  tracer.Close()
+
+  [[root, *spans]] = ReadTraces(trace_file)
+  assert len(spans) == 2
+  assert root["tags"] == {"droppedSpans": "3"}
+
+def test_Finish_EndsSpansOfRequest(trace_file):
+  tracer = NewTracer(trace_file)
+  trace = tracer.Start("GET GetUserDetails")
+  tracer.Finish(trace)
+  with Span("sql fetch_user"):
+    pass
+  tracer.Close()
+
+  assert trace.spans == []
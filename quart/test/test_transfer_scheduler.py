@@ -0,0 +1,200 @@
+from ledger.model import InsufficientFundsException, OverloadedException
+from ledger.tracing import Tracer
+from ledger.transfer_scheduler import TransferScheduler
+
+import asyncio
+import asyncpg
+import pytest
+import pytest_asyncio
+from unittest.mock import AsyncMock, call
+
+@pytest_asyncio.fixture
+async def mock_sql_client():
+  return AsyncMock()
+
+@pytest.mark.asyncio
+async def test_Transfer_CoalescesConcurrentTransfersIntoOneBatch(
+    mock_sql_client):
+  mock_sql_client.TransferBatch = AsyncMock(return_value=[1, 2, 3])
+  scheduler = TransferScheduler(mock_sql_client, 10, 50)
+  scheduler.Start()
+
+  results = await asyncio.gather(
+      scheduler.Transfer(1, 2, 10),
+      scheduler.Transfer(2, 3, 20),
+      scheduler.Transfer(3, 1, 30))
+  await scheduler.Close()
+
+  assert results == [1, 2, 3]
+  mock_sql_client.TransferBatch.assert_awaited_once_with(
+      [(1, 2, 10), (2, 3, 20), (3, 1, 30)], [None, None, None])
+
+@pytest.mark.asyncio
+async def test_Transfer_CommitsFullBatchWithoutWaitingForWindow(
+    mock_sql_client):
+  mock_sql_client.TransferBatch = AsyncMock(
+      side_effect=lambda transfers, _: list(range(len(transfers))))
+  scheduler = TransferScheduler(mock_sql_client, 2, 60000)
+  scheduler.Start()
+
+  results = await asyncio.wait_for(asyncio.gather(
+      scheduler.Transfer(1, 2, 10),
+      scheduler.Transfer(2, 3, 20),
+      scheduler.Transfer(3, 1, 30),
+      scheduler.Transfer(1, 3, 40)), 1)
+  await scheduler.Close()
+
+  assert results == [0, 1, 0, 1]
+  assert mock_sql_client.TransferBatch.await_count == 2
+
+@pytest.mark.asyncio
+async def test_Transfer_FailsOnlyRejectedTransfers(mock_sql_client):
+  mock_sql_client.TransferBatch = AsyncMock(
+      return_value=[1, InsufficientFundsException(), ValueError()])
+  scheduler = TransferScheduler(mock_sql_client, 10, 1)
+  scheduler.Start()
+
+  results = await asyncio.gather(
+      scheduler.Transfer(1, 2, 10),
+      scheduler.Transfer(2, 3, 20),
+      scheduler.Transfer(3, 4, 30),
+      return_exceptions=True)
+  await scheduler.Close()
+
+  assert results[0] == 1
+  assert isinstance(results[1], InsufficientFundsException)
+  assert isinstance(results[2], ValueError)
+
+@pytest.mark.asyncio
+async def test_Transfer_FailedBatchIsRetriedTransferByTransfer(
+    mock_sql_client):
+  mock_sql_client.TransferBatch = AsyncMock(
+      side_effect=asyncpg.exceptions.LockNotAvailableError)
+  mock_sql_client.Transfer = AsyncMock(
+      side_effect=[1, asyncpg.exceptions.LockNotAvailableError(), 3])
+  scheduler = TransferScheduler(mock_sql_client, 10, 50)
+  scheduler.Start()
+
+  results = await asyncio.gather(
+      scheduler.Transfer(1, 2, 10),
+      scheduler.Transfer(2, 3, 20, "key"),
+      scheduler.Transfer(3, 1, 30),
+      return_exceptions=True)
+  await scheduler.Close()
+
+  assert results[0] == 1
+  assert isinstance(results[1], asyncpg.exceptions.LockNotAvailableError)
+  assert results[2] == 3
+  assert mock_sql_client.Transfer.await_args_list == [
+      call(1, 2, 10, idempotency_key=None),
+      call(2, 3, 20, idempotency_key="key"),
+      call(3, 1, 30, idempotency_key=None)]
+
+@pytest.mark.asyncio
+async def test_Transfer_FailedBatchIsRetriedOneAtATime(mock_sql_client):
+  in_flight = 0
+  async def Transfer(*args, idempotency_key):
+    nonlocal in_flight
+    in_flight += 1
+    try:
+      if in_flight > 1:
+        raise asyncpg.exceptions.LockNotAvailableError()
+      await asyncio.sleep(0.001)
+      return args[2]
+    finally:
+      in_flight -= 1
+  mock_sql_client.TransferBatch = AsyncMock(
+      side_effect=asyncpg.exceptions.LockNotAvailableError)
+  mock_sql_client.Transfer = Transfer
+  scheduler = TransferScheduler(mock_sql_client, 10, 50)
+  scheduler.Start()
+
+  results = await asyncio.gather(
+      *(scheduler.Transfer(1, 2, amount) for amount in (10, 20, 30)))
+  await scheduler.Close()
+
+  assert results == [10, 20, 30]
+
+@pytest.mark.asyncio
+async def test_Transfer_OverloadedBatchIsNotRetried(mock_sql_client):
+  mock_sql_client.TransferBatch = AsyncMock(side_effect=OverloadedException)
+  scheduler = TransferScheduler(mock_sql_client, 10, 50)
+  scheduler.Start()
+
+  results = await asyncio.gather(
+      scheduler.Transfer(1, 2, 10),
+      scheduler.Transfer(2, 3, 20),
+      return_exceptions=True)
+  await scheduler.Close()
+
+  assert all(isinstance(result, OverloadedException) for result in results)
+  mock_sql_client.Transfer.assert_not_awaited()
+
+@pytest.mark.asyncio
+async def test_Transfer_SqlClientRaisesException(mock_sql_client):
+  mock_sql_client.TransferBatch = AsyncMock(side_effect=Exception)
+  mock_sql_client.Transfer = AsyncMock(side_effect=Exception)
+  scheduler = TransferScheduler(mock_sql_client, 10, 1)
+  scheduler.Start()
+
+  with pytest.raises(Exception):
+    await scheduler.Transfer(1, 2, 10)
+  await scheduler.Close()
+
+@pytest.mark.asyncio
+async def test_Close_CommitsPendingTransfers(mock_sql_client):
+  mock_sql_client.TransferBatch = AsyncMock(return_value=[1])
+  scheduler = TransferScheduler(mock_sql_client, 10, 60000)
+  scheduler.Start()
+
+  transfer = asyncio.create_task(scheduler.Transfer(1, 2, 10))
+  await asyncio.sleep(0)
+  await asyncio.wait_for(scheduler.Close(), 1)
+
+  assert await transfer == 1
+
+@pytest.mark.asyncio
+async def test_Transfer_AfterCloseIsRejected(mock_sql_client):
+  scheduler = TransferScheduler(mock_sql_client, 10, 1)
+  scheduler.Start()
+  await scheduler.Close()
+
+  with pytest.raises(OverloadedException):
+    await asyncio.wait_for(scheduler.Transfer(1, 2, 10), 1)
+  mock_sql_client.TransferBatch.assert_not_awaited()
+
+@pytest.mark.asyncio
+async def test_Transfer_TracesWaitForBatch(mock_sql_client, tmp_path):
+  mock_sql_client.TransferBatch = AsyncMock(return_value=[1, 2])
+  scheduler = TransferScheduler(mock_sql_client, 10, 50)
+  scheduler.Start()
+  tracer = Tracer(str(tmp_path / "traces.jsonl"), 1, 60000, 1000000, 1)
+
+  async def TracedTransfer(user_id_from, user_id_to):
+    trace = tracer.Start("POST Transfer")
+    await scheduler.Transfer(user_id_from, user_id_to, 10)
+    tracer.Finish(trace)
+    return trace
+
+  traces = await asyncio.gather(TracedTransfer(1, 2), TracedTransfer(2, 3))
+  await scheduler.Close()
+  tracer.Close()
+
+  for trace in traces:
+    [span] = trace.spans
+    assert span["name"] == "group_commit_wait"
+    assert span["tags"] == {"batch_size": "2"}
+
+@pytest.mark.asyncio
+async def test_Transfer_PassesIdempotencyKeys(mock_sql_client):
+  mock_sql_client.TransferBatch = AsyncMock(return_value=[1, 2])
+  scheduler = TransferScheduler(mock_sql_client, 10, 50)
+  scheduler.Start()
+
+  await asyncio.gather(
+      scheduler.Transfer(1, 2, 10, "key"),
+      scheduler.Transfer(2, 3, 20))
+  await scheduler.Close()
+
+  mock_sql_client.TransferBatch.assert_awaited_once_with(
+      [(1, 2, 10), (2, 3, 20)], ["key", None])
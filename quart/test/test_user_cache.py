@@ -0,0 +1,131 @@
+from ledger.model import User
+from ledger.user_cache import INVALIDATION_CHANNEL, UserCache
+
+import asyncio
+import pytest
+import pytest_asyncio
+from unittest.mock import AsyncMock
+
+@pytest_asyncio.fixture
+async def mock_sql_client():
+  return AsyncMock()
+
+@pytest.mark.asyncio
+async def test_FetchUser_ReadsThroughOnMiss(mock_sql_client):
+  mock_sql_client.FetchUser = AsyncMock(return_value=User(1, 100))
+  cache = UserCache(mock_sql_client, 10, 60)
+
+  assert await cache.FetchUser(1) == User(1, 100)
+  assert await cache.FetchUser(1) == User(1, 100)
+
+  mock_sql_client.FetchUser.assert_awaited_once_with(1)
+  assert cache.Stats() == {"size": 1, "hits": 1, "misses": 1, "evictions": 0}
+
+@pytest.mark.asyncio
+async def test_FetchUser_DoesNotCacheMissingUser(mock_sql_client):
+  mock_sql_client.FetchUser = AsyncMock(return_value=None)
+  cache = UserCache(mock_sql_client, 10, 60)
+
+  assert await cache.FetchUser(1) is None
+  assert await cache.FetchUser(1) is None
+
+  assert mock_sql_client.FetchUser.await_count == 2
+
+@pytest.mark.asyncio
+async def test_FetchUser_ExpiredEntryIsRefetched(mock_sql_client):
+  mock_sql_client.FetchUser = AsyncMock(
+      side_effect=[User(1, 100), User(1, 50)])
+  cache = UserCache(mock_sql_client, 10, 0)
+
+  assert await cache.FetchUser(1) == User(1, 100)
+  assert await cache.FetchUser(1) == User(1, 50)
+
+@pytest.mark.asyncio
+async def test_Put_EvictsLeastRecentlyUsed(mock_sql_client):
+  cache = UserCache(mock_sql_client, 2, 60)
+  cache.Put(User(1, 100))
+  cache.Put(User(2, 100))
+  await cache.FetchUser(1)
+  cache.Put(User(3, 100))
+
+  mock_sql_client.FetchUser = AsyncMock(return_value=User(2, 100))
+  await cache.FetchUser(1)
+  await cache.FetchUser(2)
+
+  mock_sql_client.FetchUser.assert_awaited_once_with(2)
+  assert cache.Stats()["evictions"] == 2
+
+@pytest.mark.asyncio
+async def test_Invalidate_EvictsAndNotifiesOtherWorkers(mock_sql_client):
+  cache = UserCache(mock_sql_client, 10, 60)
+  cache.Put(User(1, 100))
+  cache.Put(User(2, 100))
+
+  cache.Invalidate([2, 1, 2])
+  await asyncio.sleep(0)
+
+  assert cache.Stats()["size"] == 0
+  mock_sql_client.Notify.assert_awaited_once_with(
+      INVALIDATION_CHANNEL, ["1,2"])
+
+@pytest.mark.asyncio
+async def test_Invalidate_NotifyFailureIsNotRaised(mock_sql_client):
+  mock_sql_client.Notify = AsyncMock(side_effect=Exception)
+  cache = UserCache(mock_sql_client, 10, 60)
+
+  cache.Invalidate([1])
+  await asyncio.sleep(0)
+
+@pytest.mark.asyncio
+async def test_Notification_EvictsUsers(mock_sql_client):
+  cache = UserCache(mock_sql_client, 10, 60)
+  await cache.Start()
+  callback = mock_sql_client.Listen.await_args.args[1]
+  cache.Put(User(1, 100))
+  cache.Put(User(2, 100))
+  cache.Put(User(3, 100))
+
+  callback(None, 1234, INVALIDATION_CHANNEL, "1,3")
+
+  mock_sql_client.FetchUser = AsyncMock(return_value=User(1, 75))
+  assert await cache.FetchUser(1) == User(1, 75)
+  assert cache.Stats()["hits"] == 0
+  assert await cache.FetchUser(2) == User(2, 100)
+  assert cache.Stats()["hits"] == 1
+
+@pytest.mark.asyncio
+async def test_Interruption_EvictsAllUsers(mock_sql_client):
+  cache = UserCache(mock_sql_client, 10, 60)
+  await cache.Start()
+  on_interruption = mock_sql_client.Listen.await_args.args[2]
+  cache.Put(User(1, 100))
+  cache.Put(User(2, 100))
+
+  on_interruption()
+
+  assert cache.Stats()["size"] == 0
+
+@pytest.mark.asyncio
+async def test_FetchUser_RacingInvalidationIsNotCached(mock_sql_client):
+  cache = UserCache(mock_sql_client, 10, 60)
+  async def FetchUser(user_id):
+    cache.Invalidate([user_id])
+    return User(user_id, 100)
+  mock_sql_client.FetchUser = FetchUser
+
+  await cache.FetchUser(1)
+
+  assert cache.Stats()["size"] == 0
+
+@pytest.mark.asyncio
+async def test_FetchUsers_FetchesOnlyMissingUsers(mock_sql_client):
+  mock_sql_client.FetchUsers = AsyncMock(return_value=[User(3, 300)])
+  cache = UserCache(mock_sql_client, 10, 60)
+  cache.Put(User(1, 100))
+
+  users = await cache.FetchUsers([1, 2, 3])
+
+  mock_sql_client.FetchUsers.assert_awaited_once_with([2, 3])
+  assert users == [User(1, 100), User(3, 300)]
+  assert await cache.FetchUsers([1, 3]) == [User(1, 100), User(3, 300)]
+  assert mock_sql_client.FetchUsers.await_count == 1